@@ -1,18 +1,24 @@
 import os
+import json
 import config
 import shutil
-from bottle import static_file, response
-from modules import manage_cache
-from modules.parse import (_safe_path, validate_request, canonical_product,
-                           parse_cog_time, parse_request_time, parse_fxx)
-from process_data import process_hrrr, process_ecmwf, process_gfs, ensure_cog
-
-# HRRR output format -> (AVAILABLE_FORMATS key, file open mode). Drives reading
-# the processed file without a per-format if/elif chain.
-_HRRR_FORMAT_IO = {
-    'geotiff': ('tiff', 'rb'),
-    'png': ('png', 'rb'),
-    'gribjson': ('json', 'r'),
+import itertools
+from bottle import static_file, request, response, HTTPResponse
+from modules import batch, bundle, conditional, hotcache, manage_cache, tiles
+from modules.parse import (_safe_path, validate_request, canonical_product, hrrr_format_error, parse_cog_time,
+                           parse_request_time, parse_fxx, parse_fxx_range, parse_points, WIND_FORMATS)
+from process_data import (process_hrrr, process_ecmwf, process_gfs, ensure_cog, ensure_tile,
+                          hrrr_point_series, map_forecast_hours, stream_groups, valid_times)
+
+# HRRR output format -> AVAILABLE_FORMATS key. Drives the Content-Type of the
+# streamed file without a per-format if/elif chain.
+_HRRR_FORMAT_CONTENT = {
+    'geotiff': 'tiff',
+    'png': 'png',
+    'legend': 'png',
+    'gribjson': 'json',
+    'windbin': 'windbin',
+    'windpng': 'png',
 }
 
 # Content type used for error bodies returned through the (content_type, data)
@@ -35,6 +41,117 @@ def text_error(status, message):
     return message
 
 
+def _pick_encoded(path, st, encodings):
+    """Return ``(path, stat, coding)`` of the precompressed sibling the request's
+    Accept-Encoding allows, or the plain file with coding None. A sibling older
+    than its parent is left over from a previous build and is never served."""
+    coding = conditional.negotiate_encoding(request.environ.get('HTTP_ACCEPT_ENCODING'),
+                                            [c for _suffix, c in encodings])
+    for suffix, name in encodings:
+        if name != coding:
+            continue
+        try:
+            sst = os.stat(path + suffix)
+        except OSError:
+            break  # not built (yet): fall back to the plain body
+        if sst.st_mtime_ns >= st.st_mtime_ns:
+            return path + suffix, sst, coding
+    return path, st, None
+
+
+def _json_number(value):
+    """A float for JSON, to 6 significant digits (float32 noise dropped); None
+    for NaN."""
+    value = float(value)
+    return float(f'{value:.6g}') if value == value else None
+
+
+def _batch_output(spec):
+    """The modules.batch.Output one POST /batch request asks for, checked like
+    the GET data routes (ecmwf/gfs raster formats get gribjson there too).
+    Raises ValueError with the message its 400 carries."""
+    if not isinstance(spec, dict):
+        raise ValueError('Each request must be an object')
+    model, format = spec.get('model', 'hrrr'), spec.get('format', 'gribjson')
+    product, projwin = spec.get('product', 'winds'), spec.get('projwin')
+    if isinstance(projwin, str):
+        projwin = projwin.split(',')
+    projwin, error = validate_request(model, format, projwin, product)
+    if error is None and model == 'hrrr':
+        error = hrrr_format_error(product, format)
+    if error is not None:
+        raise ValueError(error)
+    time_param = str(spec.get('time') or '')
+    try:
+        date, time = parse_request_time(time_param)
+    except ValueError:
+        raise ValueError(f'Invalid time {time_param!r}; expected ISO 8601 (e.g. 2024-03-05T19:00:00)')
+    if model == 'hrrr':
+        fxx = parse_fxx(None if spec.get('fxx') is None else str(spec['fxx']), time)
+        product = canonical_product(product)
+    else:
+        fxx, product = 0, 'winds'
+        format = format if format in WIND_FORMATS else 'gribjson'
+    return batch.make_output(model, product, date, int(time[:2]), fxx, projwin, format)
+
+
+def _batch_url(output):
+    """The GET route answering the same request as a batch item."""
+    projwin = '' if output.projwin is None else '/' + ','.join(str(v) for v in output.projwin)
+    if output.model == 'hrrr':
+        return (f'/hrrr/{output.product}/{output.format}/{output.date}T{output.hour}Z{projwin}'
+                + (f'?fxx={output.fxx}' if output.fxx else ''))
+    return f'/{output.model}/{output.format}/{output.date}T{output.hour}Z{projwin}'
+
+
+def serve_cached(path, mimetype, run=None, encodings=(), hot=False):
+    """Stream a cached artifact with HTTP validators, or answer 304.
+
+    ``path`` must already be confined under CACHE_DIR. ``run`` is the model run's
+    UTC datetime (conditional.run_time), which decides between a short max-age and
+    ``immutable``. ``encodings`` lists the (suffix, Content-Encoding) siblings that
+    may exist next to ``path`` (config.COMPRESSED_SIBLINGS); the one Accept-Encoding
+    allows is streamed instead, with its own ETag. The 304 is decided from a stat
+    alone, so the body is never opened for a client whose copy is current.
+
+    With ``hot``, the file is also marked used here (throttled) and a small body
+    is answered from the shared hot cache (modules.hotcache) without opening it;
+    Range requests and larger files are streamed as usual."""
+    cfg = config.APP_CONFIG
+    st = os.stat(path)
+    if hot and hotcache.due_for_mark(path):
+        manage_cache.mark_used(path)
+    coding = None
+    if encodings:
+        path, st, coding = _pick_encoded(path, st, encodings)
+    etag = conditional.etag_for(path, st)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': conditional.last_modified(st),
+        'Cache-Control': conditional.cache_control(run, cfg['CACHE_RECENT_RUN_HOURS'],
+                                                   cfg['CACHE_RECENT_MAX_AGE']),
+    }
+    extra = {'Cache-Control': headers['Cache-Control']}
+    if encodings:
+        # Shared caches must key on Accept-Encoding whichever body this one got.
+        extra['Vary'] = headers['Vary'] = 'Accept-Encoding'
+    if coding:
+        extra['Content-Encoding'] = coding
+    if conditional.is_not_modified(request.environ, etag, st.st_mtime):
+        return HTTPResponse(status=304, **headers)
+    if hot and 'HTTP_RANGE' not in request.environ:
+        body = hotcache.get(path, st)
+        if body is not None:
+            return HTTPResponse(body, status=200, headers=dict(
+                headers, **extra, **{'Content-Type': mimetype, 'Content-Length': str(len(body)),
+                                     'Accept-Ranges': 'bytes'}))
+    # The conditionals were already evaluated above with RFC 7232 precedence;
+    # keep static_file from re-applying If-Modified-Since on its own.
+    request.environ.pop('HTTP_IF_MODIFIED_SINCE', None)
+    return static_file(os.path.relpath(path, os.path.abspath(cfg['CACHE_DIR'])),
+                       root=cfg['CACHE_DIR'], mimetype=mimetype, etag=etag, headers=extra)
+
+
 class App():
     def __init__(self):
         # clear out any pre-existing cache on server startup
@@ -44,6 +161,9 @@ class App():
         # create cache directory
         if not os.path.exists(config.APP_CONFIG["CACHE_DIR"]):
             os.makedirs(config.APP_CONFIG["CACHE_DIR"])
+        # build (or reconcile) the cache index eviction reads sizes from
+        manage_cache.prepare_index(config.APP_CONFIG["CACHE_DIR"],
+                                   config.APP_CONFIG['CACHE_INDEX_REBUILD_HOURS'] * 3600)
 
     def get_data(self, model, format, iso_string, projwin=None, product='winds', fxx_raw=None):
         # Validate all user-supplied tokens before they reach any path/subprocess.
@@ -65,27 +185,33 @@ class App():
             except ValueError as e:
                 return json_error(400, str(e))
 
+        run = conditional.run_time(date, time)
+        # ecmwf/gfs only carry winds; raster formats there keep getting gribjson
+        wind_format = format if format in WIND_FORMATS else 'gribjson'
+
         # if fetching or processing the data fails, return a 502 instead of
         # letting the error become a 500 page
         try:
             if model == 'hrrr':
-                result = self._serve_hrrr(product, projwin, date, time, format, fxx)
+                result = self._serve_hrrr(product, projwin, date, time, format, fxx, run)
             elif model == 'ecmwf':
-                result = self._serve_json(process_ecmwf(
-                    projwin, date, config.APP_CONFIG["CACHE_DIR"]))
+                result = self._serve_winds(process_ecmwf(
+                    projwin, date, config.APP_CONFIG["CACHE_DIR"], wind_format), wind_format, run)
             else:
                 # Last case would be gfs here.
-                result = self._serve_json(process_gfs(
-                    projwin, date, time, config.APP_CONFIG["CACHE_DIR"]))
+                result = self._serve_winds(process_gfs(
+                    projwin, date, time, config.APP_CONFIG["CACHE_DIR"], wind_format), wind_format, run)
         except Exception as e:
             # flush so the reason is written to the log right away
             print(f'[get_data] upstream {model} fetch failed: {e}', flush=True)
             return json_error(502, f'Upstream data fetch failed for {model}')
 
-        # Keep the cache under its byte budget. Runs after the response is read
-        # into memory (and the served file's mtime is freshened), so the file we
-        # just returned is the most-recently-used and never the first evicted.
-        manage_cache.enforce_configured(config.APP_CONFIG)
+        # Keep the cache under its byte budget: normally left to the background
+        # evictor, inline only without one. Runs after the response file is
+        # opened for streaming (and marked used), so the file we are
+        # returning is the most-recently-used and never the first evicted -- and
+        # even if it were, the open descriptor keeps streaming it on POSIX.
+        manage_cache.note_growth(config.APP_CONFIG)
         return result
 
     def serve_cog(self, product, time_param, fxx_raw=None):
@@ -104,18 +230,198 @@ class App():
             # ensure_cog returns the existing path on a cache hit (before taking any
             # lock) and builds it on a miss, so no separate existence pre-check.
             cog_path = ensure_cog(product, date, hour, fxx, cache_dir)
-            # Freshen mtime then evict *before* streaming, so the COG we are about to
+            # Mark used then evict *before* streaming, so the COG we are about to
             # serve is the most-recently-used file and cannot be deleted mid-stream.
             manage_cache.mark_used(cog_path)
-            manage_cache.enforce_configured(config.APP_CONFIG)
-            return static_file(os.path.basename(cog_path), root=cache_dir, mimetype='image/tiff')
+            manage_cache.note_growth(config.APP_CONFIG)
+            return serve_cached(cog_path, 'image/tiff', conditional.run_time(date, hour))
         except (FileNotFoundError, ValueError):
             return text_error(404, f'No HRRR data available for {product} at the requested time')
         except Exception as e:
             print(f'[COG] error serving {product}: {e}')
             return text_error(500, 'Error serving COG')
 
-    def _serve_hrrr(self, product, projwin, date, time, format, fxx=0):
+    def serve_tile(self, product, z, x, y, ext, time_param, fxx_raw=None, size_raw=None):
+        """Serve one XYZ tile (png/tif/npy) of the EPSG:3857 COG for a
+        product/run/forecast-hour, building the COG and then the tile on a miss.
+        ``time_param``/``fxx_raw``/``size_raw`` are the ?time=, ?fxx= and ?size=
+        query values."""
+        try:
+            product = canonical_product(product)
+            date, hour = parse_cog_time(time_param or '')
+            fxx = parse_fxx(fxx_raw, hour)
+            size = tiles.parse_tile_size(size_raw)
+            tiles.validate_tile(z, x, y, ext)
+        except ValueError as e:
+            return text_error(400, str(e))
+        cache_dir = config.APP_CONFIG['CACHE_DIR']
+
+        try:
+            tile_path, cog_path = ensure_tile(product, date, hour, fxx, z, x, y, size, ext, cache_dir)
+            # Same ordering as serve_cog: freshen, evict, then stream, so neither the
+            # tile nor its parent COG can be evicted out from under this response.
+            manage_cache.mark_used(cog_path)
+            manage_cache.mark_used(tile_path)
+            manage_cache.note_growth(config.APP_CONFIG)
+            mimetype = config.APP_CONFIG['AVAILABLE_FORMATS'][tiles.TILE_FORMATS[ext]]
+            return serve_cached(tile_path, mimetype, conditional.run_time(date, hour))
+        except (FileNotFoundError, ValueError):
+            return text_error(404, f'No HRRR data available for {product} at the requested time')
+        except Exception as e:
+            print(f'[tiles] error serving {product} {z}/{x}/{y}.{ext}: {e}')
+            return text_error(500, 'Error serving tile')
+
+    def serve_point(self, product, time_param, fxx_raw, points):
+        """Time series of an HRRR product at one or more points across a run's
+        forecast hours, as ``(content_type, json)``. ``points`` is a list of
+        {'lat', 'lon'} (one from the GET query, a batch from the POST body);
+        ``time_param`` is the run and ``fxx_raw`` an 'N' or 'A-B' range (absent
+        -> the whole run). Hours not cached yet are built in parallel; hours
+        still unavailable upstream are listed in ``missing`` with null values."""
+        try:
+            product = canonical_product(product)
+            date, hour = parse_cog_time(time_param or '')
+            fxx_list = parse_fxx_range(fxx_raw, hour)
+            lats, lons = parse_points(points, config.APP_CONFIG['POINT_MAX_POINTS'])
+        except ValueError as e:
+            return json_error(400, str(e))
+
+        try:
+            bands, series, grid_lats, grid_lons, missing = hrrr_point_series(
+                product, date, hour, fxx_list, lats, lons, config.APP_CONFIG['CACHE_DIR'])
+        except Exception as e:
+            print(f'[point] error sampling {product}: {e}', flush=True)
+            return json_error(502, 'Upstream data fetch failed for hrrr')
+        manage_cache.note_growth(config.APP_CONFIG)
+        if len(missing) == len(fxx_list):
+            return json_error(404, f'No HRRR data available for {product} at the requested time')
+
+        if not missing:
+            cfg = config.APP_CONFIG
+            response.headers['Cache-Control'] = conditional.cache_control(
+                conditional.run_time(date, hour), cfg['CACHE_RECENT_RUN_HOURS'], cfg['CACHE_RECENT_MAX_AGE'])
+        body = {
+            'product': product,
+            'label': config.HRRR_PRODUCTS[product]['label'],
+            'run': f'{date}T{hour}Z',
+            'fxx': fxx_list,
+            'valid_time': valid_times(date, hour, fxx_list),
+            'missing': missing,
+            'points': [{'lat': lat, 'lon': lon,
+                        'grid_lat': _json_number(grid_lats[i]), 'grid_lon': _json_number(grid_lons[i]),
+                        'values': {band: [_json_number(v) for v in series[b, i]] for b, band in enumerate(bands)}}
+                       for i, (lat, lon) in enumerate(zip(lats, lons))],
+        }
+        return (_JSON, json.dumps(body, separators=(',', ':')))
+
+    def serve_bundle(self, product, format, time_param, fxx_raw, projwin_raw=None, container_raw=None):
+        """A run's forecast-hour stack of one HRRR product/format (optionally a
+        projwin subset) as one multi-frame response: ``(content_type, iterator)``
+        streaming a tar or multipart/mixed payload (modules.bundle). Hours are
+        built concurrently, bounded by HOUR_BUILD_WORKERS, and each frame is sent
+        as soon as it and the hours before it are ready. The first hour decides
+        the status; a later hour that fails is reported inside the payload."""
+        container = container_raw or 'tar'
+        projwin = projwin_raw.split(',') if projwin_raw else None
+        projwin, error = validate_request('hrrr', format, projwin, product)
+        if error is None:
+            error = hrrr_format_error(product, format)
+        if error is None and container not in bundle.CONTAINERS:
+            error = f'Unsupported container: {container}. Use one of: {", ".join(bundle.CONTAINERS)}'
+        try:
+            if error is not None:
+                raise ValueError(error)
+            product = canonical_product(product)
+            date, hour = parse_cog_time(time_param or '')
+            fxx_list = parse_fxx_range(fxx_raw, hour)
+        except ValueError as e:
+            return json_error(400, str(e))
+
+        cache_dir = config.APP_CONFIG['CACHE_DIR']
+        frames = map_forecast_hours(
+            lambda fxx: process_hrrr(product, projwin, date, hour, cache_dir, format, fxx), fxx_list)
+        first_fxx, first = next(frames)
+        if isinstance(first, Exception):
+            frames.close()
+            print(f'[bundle] upstream hrrr fetch failed: {first}', flush=True)
+            return json_error(502, 'Upstream data fetch failed for hrrr')
+        if not os.path.isfile(first):
+            # A request error (e.g. a projwin off the grid) is the same for every hour.
+            frames.close()
+            return json_error(400, first)
+
+        def used():
+            # Freshen each frame before it is streamed; evict once the bundle is
+            # done (or the client went away, which also cancels unstarted hours).
+            try:
+                for fxx, result in itertools.chain([(first_fxx, first)], frames):
+                    if isinstance(result, str) and os.path.isfile(result):
+                        manage_cache.mark_used(result)
+                    yield fxx, result
+            finally:
+                frames.close()
+                manage_cache.note_growth(config.APP_CONFIG)
+
+        boundary = bundle.new_boundary()
+        mimetype = config.APP_CONFIG['AVAILABLE_FORMATS'][_HRRR_FORMAT_CONTENT[format]]
+        stream = bundle.stream(container, used(), boundary, mimetype)
+        return (bundle.content_type(container, boundary), stream)
+
+    def serve_batch(self, specs, container_raw=None):
+        """Several data requests in one response, for a client opening many
+        layers at once: ``(content_type, iterator)`` streaming an ndjson or
+        multipart/mixed payload (modules.bundle) with one item per request, in
+        the order they finish. ``specs`` is the POSTed list of {model, product,
+        format, time, projwin, fxx}. Requests sharing a download or regrid are
+        built one after another on one thread (modules.batch.group), and the
+        groups concurrently (process_data.stream_groups). Each item carries its
+        own status; the cache is trimmed once, after the last item."""
+        container = container_raw or 'ndjson'
+        max_items = config.APP_CONFIG['BATCH_MAX_ITEMS']
+        if container not in bundle.BATCH_CONTAINERS:
+            return json_error(400, f'Unsupported container: {container}. '
+                                   f'Use one of: {", ".join(bundle.BATCH_CONTAINERS)}')
+        if not isinstance(specs, list) or not specs:
+            return json_error(400, 'JSON body must be an object with a non-empty "requests" list')
+        if len(specs) > max_items:
+            return json_error(400, f'Too many requests: {len(specs)} (at most {max_items})')
+
+        indices, rejected = {}, []
+        for index, spec in enumerate(specs):
+            try:
+                # The same output asked for twice is built once.
+                indices.setdefault(_batch_output(spec), []).append(index)
+            except ValueError as e:
+                rejected.append((index, str(e)))
+        cache_dir = config.APP_CONFIG['CACHE_DIR']
+        built = stream_groups(list(batch.group(indices).values()), cache_dir)
+
+        def items():
+            try:
+                for index, error in rejected:
+                    yield {'index': index, 'status': 400}, error
+                for output, result in built:
+                    meta = {'url': _batch_url(output), 'content_type': config.APP_CONFIG['AVAILABLE_FORMATS'][
+                        _HRRR_FORMAT_CONTENT[output.format]]}
+                    if isinstance(result, Exception):
+                        meta['status'], result = 502, f'Upstream data fetch failed for {output.model}'
+                    elif os.path.isfile(result):
+                        # Re-confined under CACHE_DIR like _read_output, and
+                        # freshened before it is streamed.
+                        meta['status'], result = 200, _safe_path(cache_dir, os.path.basename(result))
+                        manage_cache.mark_used(result)
+                    else:
+                        meta['status'] = 400
+                    for index in indices[output]:
+                        yield dict(meta, index=index), result
+            finally:
+                built.close()
+                manage_cache.note_growth(config.APP_CONFIG)
+
+        boundary = bundle.new_boundary()
+        return (bundle.content_type(container, boundary), bundle.batch_stream(container, items(), boundary))
+
+    def _serve_hrrr(self, product, projwin, date, time, format, fxx=0, run=None):
         output = process_hrrr(product,
                               projwin,
                               date,
@@ -127,23 +433,33 @@ class App():
         # error message (e.g. unsupported product/format) on failure.
         if not os.path.isfile(output):
             return json_error(400, output)
-        ct_key, mode = _HRRR_FORMAT_IO.get(format, ('json', 'r'))
-        return self._read_output(output, ct_key, mode)
+        return self._read_output(output, _HRRR_FORMAT_CONTENT.get(format, 'json'), run)
 
-    def _serve_json(self, output):
-        """ecmwf/gfs produce a JSON file path on success, or an error string."""
+    def _serve_winds(self, output, format, run=None):
+        """ecmwf/gfs produce a wind-field file path on success, or an error string."""
         if not os.path.isfile(output):
             return json_error(400, output)
-        return self._read_output(output, 'json', 'r')
+        return self._read_output(output, _HRRR_FORMAT_CONTENT[format], run)
 
     @staticmethod
-    def _read_output(output, ct_key, mode):
-        # Re-confine the returned path under CACHE_DIR before reading it, so the
+    def _read_output(output, ct_key, run=None):
+        """Return ``(content_type, response)`` where the response streams the
+        cached file instead of holding its body in worker memory.
+
+        static_file hands the open file to the server's ``wsgi.file_wrapper``
+        (sendfile under gunicorn), sets Content-Length from the file size and
+        answers Range requests, the same way /cog is served; serve_cached adds the
+        ETag/Last-Modified validators and 304s. Bodies small enough for the
+        shared hot cache (HOT_CACHE_MAX_ENTRY) are answered from it instead."""
+        cache_dir = config.APP_CONFIG["CACHE_DIR"]
+        # Re-confine the returned path under CACHE_DIR before serving it, so the
         # file open can't be steered outside the cache. _safe_path is the
         # project's path sanitizer (path-injection hardening, Sonar S2083).
-        output = _safe_path(config.APP_CONFIG["CACHE_DIR"], os.path.basename(output))
-        # Mark as recently used so LRU eviction keeps recently-used files (manage_cache.py keys on
-        # mtime); do this before the read so it counts even on a cache hit.
-        manage_cache.mark_used(output)
-        with open(output, mode) as f:
-            return (config.APP_CONFIG["AVAILABLE_FORMATS"][ct_key], f.read())
+        output = _safe_path(cache_dir, os.path.basename(output))
+        content_type = config.APP_CONFIG["AVAILABLE_FORMATS"][ct_key]
+        # gribjson gets .br/.gz siblings at build time (convert.to_gribjson).
+        encodings = config.COMPRESSED_SIBLINGS if ct_key == 'json' else ()
+        # hot: serve_cached marks the file used before answering (so it counts
+        # even on a cache hit or a 304, and LRU eviction keeps it) and serves
+        # small bodies from the shared hot cache.
+        return (content_type, serve_cached(output, content_type, run, encodings, hot=True))
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Benchmark the /cog cache-miss build: in-process COG vs the gdal CLI pipeline.
+
+Writes a synthetic GRIB2 on HRRR's full native grid (1799 x 1059 Lambert
+conformal, 3 km) and times convert.to_cog on it with each COG_BUILDER. For every
+build it reports:
+
+  time        wall-clock seconds (median of --repeat runs)
+  written     bytes this process and its reaped children wrote (/proc/self/io
+              wchar, so gdalwarp & co. are included)
+  peak disk   the largest the build directory got while building, i.e. the
+              intermediate rasters plus the COG
+
+Each builder gets one untimed warm-up build first: for 'native' that builds the
+EPSG:3857 lookup table (modules/regrid.py) a server builds once per source grid,
+so the timed runs are the steady state. The warm-up time is printed too.
+
+The 'gdal' builder runs only where gdalwarp, gdaladdo and gdal_translate are on
+PATH (the container); elsewhere its row says so.
+
+Usage:  python3 benchmarks/cog_build.py [--product winds] [--repeat 3]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np  # noqa: E402
+import rasterio  # noqa: E402
+import rasterio.shutil  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+
+import config  # noqa: E402
+from modules import convert  # noqa: E402
+
+# HRRR's native CONUS grid.
+HRRR_NX, HRRR_NY = 1799, 1059
+HRRR_ORIGIN = (-2699020.143, 1588193.847)
+HRRR_DX = 3000.0
+HRRR_LCC = ('+proj=lcc +lat_0=38.5 +lon_0=-97.5 +lat_1=38.5 +lat_2=38.5 '
+            '+x_0=0 +y_0=0 +R=6371229 +units=m +no_defs')
+_IDS = ('CENTER=7 SUBCENTER=0 MASTER_TABLE=2 SIGNF_REF_TIME=1 '
+        'REF_TIME=2024-03-05T19:00:00Z PROD_STATUS=0 TYPE=1')
+_GDAL_TOOLS = ('gdalwarp', 'gdaladdo', 'gdal_translate')
+
+
+def make_hrrr_grib(path, bands):
+    """A GRIB2 on HRRR's native grid with ``bands`` smooth random fields."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:HRRR_NY, 0:HRRR_NX] / 50.0
+    tif = path + '.src.tif'
+    profile = dict(driver='GTiff', width=HRRR_NX, height=HRRR_NY, count=bands, dtype='float32',
+                   crs=rasterio.crs.CRS.from_proj4(HRRR_LCC),
+                   transform=from_origin(*HRRR_ORIGIN, HRRR_DX, HRRR_DX))
+    opts = {'DISCIPLINE': '0', 'IDS': _IDS}
+    with rasterio.open(tif, 'w', **profile) as dst:
+        for i in range(1, bands + 1):
+            field = 10 * np.sin(x + rng.uniform(0, 6)) * np.cos(y) + rng.normal(0, 0.5, x.shape)
+            dst.write(field.astype(np.float32), i)
+            opts[f'BAND_{i}_PDS_PDTN'] = '0'
+            opts[f'BAND_{i}_PDS_TEMPLATE_ASSEMBLED_VALUES'] = f'2 {i + 1} 2 0 96 0 0 1 0 103 0 10 255 0 0'
+    rasterio.shutil.copy(tif, path, driver='GRIB', **opts)
+    os.remove(tif)
+    return path
+
+
+def _wchar():
+    """Bytes written by this process and its reaped children so far."""
+    try:
+        with open('/proc/self/io') as f:
+            return int(next(line for line in f if line.startswith('wchar:')).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+
+def _dir_bytes(path):
+    total = 0
+    for entry in os.scandir(path):
+        try:
+            total += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+class _PeakDisk:
+    """Sample a directory's size every few milliseconds; keep the largest growth
+    over its size on entry."""
+
+    def __init__(self, path, interval=0.005):
+        self.path, self.interval, self.peak = path, interval, 0
+        self._base = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        self.peak = max(self.peak, _dir_bytes(self.path) - self._base)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._base = _dir_bytes(self.path)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def build_once(builder, grib, product, out_dir):
+    """One to_cog build into out_dir (lookup tables from earlier builds kept);
+    returns (seconds, written, peak)."""
+    config.APP_CONFIG['COG_BUILDER'] = builder
+    cog = os.path.join(out_dir, 'bench-cog.tif')
+    before = _wchar()
+    with _PeakDisk(out_dir) as disk:
+        start = time.perf_counter()
+        convert.to_cog(grib, cog, product)
+        seconds = time.perf_counter() - start
+    after = _wchar()
+    os.remove(cog)
+    return seconds, (after - before) if before is not None else None, disk.peak
+
+
+def _mb(n):
+    return 'n/a' if n is None else f'{n / 1e6:8.1f} MB'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--product', default='winds', choices=sorted(config.HRRR_PRODUCTS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='velo-bench-cog-')
+    try:
+        grib = make_hrrr_grib(os.path.join(workdir, 'hrrr.grib2'), 2 if args.product == 'winds' else 1)
+        print(f'HRRR-sized GRIB ({HRRR_NX}x{HRRR_NY}, {args.product}): {os.path.getsize(grib) / 1e6:.1f} MB')
+        print(f'{"builder":<8} {"time":>9} {"written":>12} {"peak disk":>12}')
+        for builder in ('gdal', 'native'):
+            if builder == 'gdal' and not all(shutil.which(t) for t in _GDAL_TOOLS):
+                print(f'{builder:<8} skipped: {", ".join(_GDAL_TOOLS)} not on PATH')
+                continue
+            out_dir = tempfile.mkdtemp(dir=workdir)
+            warmup = build_once(builder, grib, args.product, out_dir)[0]
+            runs = [build_once(builder, grib, args.product, out_dir) for _ in range(args.repeat)]
+            seconds = statistics.median(r[0] for r in runs)
+            written = runs[-1][1]
+            peak = max(r[2] for r in runs)
+            print(f'{builder:<8} {seconds:8.2f}s {_mb(written):>12} {_mb(peak):>12}   (first build {warmup:.2f}s)')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
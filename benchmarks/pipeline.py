@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""Benchmark each stage of the data pipeline offline, with JSON for comparing commits.
+
+Writes synthetic GRIB2 files shaped like the feeds: HRRR on its full native
+grid (1799 x 1059 Lambert, 3 km, see cog_build.py), GFS on the global 0.25
+degree grid and ECMWF on the global 0.1 degree grid, each with 10 m U/V. The
+upstream calls are stubbed to hand back those files: Herbie.download copies
+the HRRR file into its save_dir, ECMWFDataServer.retrieve copies the ECMWF
+file to its target, and the pooled NOMADS session streams back the GFS file,
+whole or subregion query alike. Nothing touches the network.
+
+Stages, each timed in-process on a warm lookup-table cache unless named
+``first``:
+
+  regrid_latlon.*       native HRRR GRIB -> 0.1 degree .field (modules.regrid)
+  subset_field          projwin slice of a mapped .field (_subset_hrrr)
+  subset_grib           wgrib2 -small_grib (skipped without wgrib2)
+  to_gribjson.*         from the HRRR field, and from the GFS GRIB
+  to_geotiff / to_png   from the HRRR field
+  to_cog                native HRRR GRIB -> EPSG:3857 COG
+  process_*             a whole cache miss through process_data with stubbed upstreams
+  enforce_budget.N.*    cache eviction over N files: index rebuild (walk),
+                        a pass under budget, and a pass evicting 10%
+
+The table printed is the median and fastest of --repeat runs. --json writes
+every run with the commit and host, and --compare reads such a file and flags
+stages slower than --threshold times the baseline (exit status 1 if any).
+
+Usage:  python3 benchmarks/pipeline.py [--repeat 3] [--only regrid,to_png]
+            [--evict-files 10000,100000,1000000] [--json out.json]
+            [--compare baseline.json] [--threshold 1.25]
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import subprocess
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np  # noqa: E402
+import rasterio  # noqa: E402
+import rasterio.shutil  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+
+import config  # noqa: E402
+import process_data  # noqa: E402
+from modules import convert, fieldcache, manage_cache, regrid  # noqa: E402
+from cog_build import make_hrrr_grib  # noqa: E402
+
+RUN_DATE, RUN_TIME = '2024-03-05', '18:00:00'
+PROJWIN = [-105, 41, -104, 40]
+_IDS = ('CENTER=7 SUBCENTER=0 MASTER_TABLE=2 SIGNF_REF_TIME=1 '
+        'REF_TIME=2024-03-05T18:00:00Z PROD_STATUS=0 TYPE=1')
+# UGRD / VGRD at 10 m above ground (PDS template 4.0).
+_UV_PDS = ('2 2 2 0 96 0 0 1 0 103 0 10 255 0 0', '2 3 2 0 96 0 0 1 0 103 0 10 255 0 0')
+
+
+def make_latlon_grib(path, res):
+    """A global U/V GRIB2 on a ``res``-degree lat/lon grid (0..360 E), as GFS
+    and the ECMWF feed ship it."""
+    nx, ny = int(round(360 / res)), int(round(180 / res)) + 1
+    lat, lon = np.mgrid[90:-90 - res / 2:-res, 0:360:res]
+    tif = path + '.src.tif'
+    profile = dict(driver='GTiff', width=nx, height=ny, count=2, dtype='float32', crs='EPSG:4326',
+                   transform=from_origin(-res / 2, 90 + res / 2, res, res))
+    with rasterio.open(tif, 'w', **profile) as dst:
+        dst.write((15 * np.cos(np.radians(lat)) * np.sin(np.radians(3 * lon))).astype(np.float32), 1)
+        dst.write((8 * np.sin(np.radians(2 * lat)) * np.cos(np.radians(lon))).astype(np.float32), 2)
+    opts = {'DISCIPLINE': '0', 'IDS': _IDS}
+    for band, pds in enumerate(_UV_PDS, 1):
+        opts[f'BAND_{band}_PDS_PDTN'] = '0'
+        opts[f'BAND_{band}_PDS_TEMPLATE_ASSEMBLED_VALUES'] = pds
+    rasterio.shutil.copy(tif, path, driver='GRIB', **opts)
+    os.remove(tif)
+    return path
+
+
+class Fixtures:
+    def __init__(self, workdir):
+        d = os.path.join(workdir, 'fixtures')
+        os.makedirs(d)
+        self.hrrr = {'winds': make_hrrr_grib(os.path.join(d, 'hrrr-winds.grib2'), 2),
+                     'temp_2m': make_hrrr_grib(os.path.join(d, 'hrrr-temp_2m.grib2'), 1)}
+        self.gfs = make_latlon_grib(os.path.join(d, 'gfs.grib2'), 0.25)
+        self.ecmwf = make_latlon_grib(os.path.join(d, 'ecmwf.grib2'), 0.1)
+
+    def herbie(self):
+        """Stand-in for herbie.Herbie: download() copies the product's fixture
+        to where Herbie would save it."""
+        by_search = {config.HRRR_PRODUCTS[p]['search']: path for p, path in self.hrrr.items()}
+
+        class _Herbie:
+            def __init__(self, date, model, fxx, save_dir):
+                self.save_dir = os.path.join(save_dir, model, date.split()[0].replace('-', ''))
+
+            def download(self, search, verbose=False):
+                os.makedirs(self.save_dir, exist_ok=True)
+                path = os.path.join(self.save_dir, f'subset_{abs(hash(search)):x}.grib2')
+                shutil.copyfile(by_search[search], path)
+                return path
+        return _Herbie
+
+    def ecmwf_server(self):
+        fixture = self.ecmwf
+
+        class _Server:
+            def retrieve(self, request):
+                shutil.copyfile(fixture, request['target'])
+        return _Server
+
+    def nomads_session(self):
+        """Stand-in for process_data._http_session(): every get() streams the
+        GFS fixture back, as _stream_download reads it."""
+        fixture = self.gfs
+
+        class _Response:
+            status_code = 200
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def iter_content(self, chunk_size):
+                with open(fixture, 'rb') as f:
+                    yield from iter(lambda: f.read(chunk_size), b'')
+
+        class _Session:
+            def get(self, url, timeout=None, stream=False):
+                return _Response()
+        return _Session()
+
+    @contextlib.contextmanager
+    def upstreams(self):
+        session = self.nomads_session()
+        with mock.patch.object(process_data, 'Herbie', self.herbie()), \
+                mock.patch.object(process_data, 'ECMWFDataServer', self.ecmwf_server()), \
+                mock.patch.object(process_data, '_http_session', lambda: session):
+            yield
+
+
+def timed(fn, setup=None, repeat=3):
+    """Seconds of each of ``repeat`` calls of ``fn``, with ``setup`` run untimed
+    before each. The producers' "Created ..." lines are swallowed."""
+    runs = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            runs.append(time.perf_counter() - start)
+    return runs
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        for suffix, _coding in config.COMPRESSED_SIBLINGS:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+def _clear_cache(cache_dir):
+    """Empty the cache but keep the lookup tables, as a server would have them."""
+    for name in os.listdir(cache_dir):
+        if name != regrid.LUT_SUBDIR:
+            _remove(os.path.join(cache_dir, name))
+
+
+def pipeline_stages(fx, cache_dir, repeat):
+    """Yield ``(name, run)`` for every pipeline stage, where ``run()`` times it
+    and returns the runs (or a reason it was skipped). Each is consumed before
+    the next is yielded, so the closures see the loop's current values."""
+    def out(name):
+        return os.path.join(cache_dir, name)
+
+    grib = fx.hrrr['winds']
+    yield 'regrid_latlon.first', lambda: timed(
+        lambda: process_data._regrid_latlon(grib, out('first.field'), winds=True),
+        lambda: _remove(out('first.field'), out(regrid.LUT_SUBDIR)), repeat=1)
+    for product, winds in (('winds', True), ('temp_2m', False)):
+        field = out(f'{product}.field')
+        yield f'regrid_latlon.{product}', lambda: timed(
+            lambda: process_data._regrid_latlon(fx.hrrr[product], field, winds=winds),
+            lambda: _remove(field), repeat)
+        # The fields the later stages read, whether or not this one was run.
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_data._regrid_latlon(fx.hrrr[product], field, winds=winds)
+    winds_field, temp_field = out('winds.field'), out('temp_2m.field')
+
+    yield 'subset_field', lambda: timed(lambda: process_data._subset_hrrr(winds_field, PROJWIN), repeat=repeat)
+    sub = out('gfs-sub.grib2')
+    yield 'subset_grib', lambda: 'wgrib2 not on PATH' if not shutil.which('wgrib2') else timed(
+        lambda: process_data._subset_grib(fx.gfs, sub, 255, 256, 40, 41, 'gfs'), lambda: _remove(sub), repeat)
+
+    producers = (
+        ('to_gribjson.hrrr_field', lambda p: convert.to_gribjson(fieldcache.open_field(winds_field), p), '.json'),
+        ('to_gribjson.gfs_grib', lambda p: convert.to_gribjson(fx.gfs, p), '.json'),
+        ('to_geotiff', lambda p: convert.to_geotiff(fieldcache.open_field(temp_field), p), '.tif'),
+        ('to_png.temp_2m', lambda p: convert.to_png(fieldcache.open_field(temp_field), p, 'temp_2m'), '.png'),
+        ('to_png.winds', lambda p: convert.to_png(fieldcache.open_field(winds_field), p, 'winds'), '.png'),
+        ('to_cog', lambda p: convert.to_cog(grib, p, 'winds'), '-3857-cog.tif'),
+    )
+    for name, produce, ext in producers:
+        path = out('bench' + ext)
+        yield name, lambda: timed(lambda: produce(path), lambda: _remove(path), repeat)
+
+    with fx.upstreams():
+        for product, fmt in (('winds', 'gribjson'), ('temp_2m', 'png')):
+            yield f'process_hrrr.{product}.{fmt}', lambda: timed(
+                lambda: process_data.process_hrrr(product, None, RUN_DATE, RUN_TIME, cache_dir, fmt),
+                lambda: _clear_cache(cache_dir), repeat)
+        yield 'process_gfs.gribjson', lambda: timed(
+            lambda: process_data.process_gfs(None, RUN_DATE, RUN_TIME, cache_dir, 'gribjson'),
+            lambda: _clear_cache(cache_dir), repeat)
+        with mock.patch.dict(config.APP_CONFIG, GFS_GLOBAL=False):
+            yield 'process_gfs.filter.gribjson', lambda: timed(
+                lambda: process_data.process_gfs(None, RUN_DATE, RUN_TIME, cache_dir, 'gribjson'),
+                lambda: _clear_cache(cache_dir), repeat)
+        yield 'process_ecmwf.gribjson', lambda: timed(
+            lambda: process_data.process_ecmwf(None, RUN_DATE, cache_dir, 'gribjson'),
+            lambda: _clear_cache(cache_dir), repeat)
+
+
+def _fill(cache_dir, n):
+    """``n`` small files under ``cache_dir``, a thousand per directory, with
+    distinct last-use times."""
+    now = time.time()
+    for i in range(n):
+        sub = os.path.join(cache_dir, f'd{i // 1000:04d}')
+        if i % 1000 == 0:
+            os.makedirs(sub)
+        path = os.path.join(sub, f'hrrr-temp_2m-{i:07d}.png')
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+        os.write(fd, b'x' * 100)
+        os.close(fd)
+        os.utime(path, (now - n + i, now - n + i))
+
+
+def eviction_stages(workdir, counts, repeat, only):
+    """Yield ``(name, run)`` for enforce_budget over each file count, in order:
+    the index is built by the first stage and emptied by a tenth by the last."""
+    for n in counts:
+        if only and not any(f'enforce_budget.{n}.'.startswith(p) or p.startswith(f'enforce_budget.{n}.')
+                            for p in only):
+            continue  # don't create the files for nothing
+        cache_dir = tempfile.mkdtemp(dir=workdir)
+        try:
+            _fill(cache_dir, n)
+            total = 100 * n
+            yield f'enforce_budget.{n}.rebuild', lambda: timed(
+                lambda: manage_cache.prepare_index(cache_dir, rebuild_seconds=0), repeat=1)
+            yield f'enforce_budget.{n}.under_budget', lambda: timed(
+                lambda: manage_cache.enforce_budget(cache_dir, total * 2),
+                lambda: manage_cache.prepare_index(cache_dir), repeat)  # built unless just rebuilt
+            # Over budget by one byte, low-water mark 90%: a tenth of the files go.
+            yield f'enforce_budget.{n}.evict_10pct', lambda: timed(
+                lambda: manage_cache.enforce_budget(cache_dir, total - 1, target_ratio=0.9), repeat=1)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def _summary(runs):
+    return {'median': statistics.median(runs), 'min': min(runs), 'runs': runs}
+
+
+def _meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(), 'host': platform.node(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, threshold):
+    """Print each stage's median against the baseline's; return the names of
+    those slower than ``threshold`` times it."""
+    slower = []
+    print(f'\n{"stage":<36} {"baseline":>10} {"now":>10} {"ratio":>7}')
+    for name, now in results.items():
+        before = baseline.get(name)
+        if not isinstance(now, dict) or not isinstance(before, dict):
+            continue
+        ratio = now['median'] / before['median'] if before['median'] else float('inf')
+        flag = '  SLOWER' if ratio > threshold else ''
+        if flag:
+            slower.append(name)
+        print(f'{name:<36} {before["median"]:9.3f}s {now["median"]:9.3f}s {ratio:6.2f}x{flag}')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default='', help='comma-separated stage name prefixes')
+    parser.add_argument('--evict-files', default='10000,100000,1000000',
+                        help='comma-separated file counts for enforce_budget ("" to skip)')
+    parser.add_argument('--json', help='write the results here')
+    parser.add_argument('--compare', help='a --json file to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+    only = tuple(p for p in args.only.split(',') if p)
+    counts = [int(n) for n in args.evict_files.split(',') if n]
+
+    workdir = tempfile.mkdtemp(prefix='velo-bench-pipeline-')
+    cache_dir = os.path.join(workdir, 'cache')
+    os.makedirs(cache_dir)
+    saved = config.APP_CONFIG['CACHE_DIR']
+    config.APP_CONFIG['CACHE_DIR'] = cache_dir
+    results = {}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fx = Fixtures(workdir)
+        print(f'{"stage":<36} {"median":>10} {"fastest":>10}')
+        stages = _chain(pipeline_stages(fx, cache_dir, args.repeat),
+                        eviction_stages(workdir, counts, args.repeat, only))
+        for name, runs in _selected(stages, only):
+            if isinstance(runs, str):
+                results[name] = {'skipped': runs}
+                print(f'{name:<36} skipped: {runs}')
+                continue
+            results[name] = _summary(runs)
+            print(f'{name:<36} {results[name]["median"]:9.3f}s {results[name]["min"]:9.3f}s')
+    finally:
+        config.APP_CONFIG['CACHE_DIR'] = saved
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': _meta(), 'repeat': args.repeat, 'results': results}, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+def _chain(*generators):
+    for gen in generators:
+        yield from gen
+
+
+def _selected(stages, only):
+    """Run the stages whose name starts with one of ``only`` (all if empty) and
+    yield ``(name, runs)`` for each."""
+    for name, run in stages:
+        if not only or name.startswith(only):
+            yield name, run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Replay a captured access log against a running server, at its original rate or scaled.
+
+Reads the JSON lines a server writes with ACCESS_LOG set (modules/access_log.py)
+and re-issues each GET at the same offset from the first request, divided by
+--speed: 1 reproduces the captured traffic shape, 4 sends it four times as fast,
+and 0 sends everything as fast as --concurrency allows. POST lines (point
+batches) are counted and skipped, since the log does not keep their bodies.
+
+It reports, overall and per route:
+
+  throughput   completed requests per second of wall time
+  p50/p95/p99  latency from sending the request to reading the whole body
+  errors       requests that failed to connect or answered 5xx; 4xx are
+               counted apart, as the captured traffic may have had them too
+  lag          how late requests went out against the schedule, p95; a lag
+               that grows means the client (--concurrency) or server is saturated
+
+Usage:  python3 benchmarks/replay.py access.jsonl [--base http://localhost:8104]
+            [--speed 1] [--concurrency 16] [--limit N] [--timeout 300] [--json out.json]
+"""
+import sys
+import json
+import time
+import math
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load(path, limit=None):
+    """The logged requests, oldest first, and the number of POSTs skipped."""
+    entries, skipped = [], 0
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if entry.get('method', 'GET') != 'GET':
+                skipped += 1
+                continue
+            entries.append(entry)
+    entries.sort(key=lambda e: e['ts'])
+    return entries[:limit] if limit else entries, skipped
+
+
+def percentile(values, q):
+    """Nearest-rank ``q``-th percentile of ``values``."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+
+def fetch(base, entry, timeout):
+    """GET one logged request; returns (status or None, bytes read, seconds)."""
+    url = base + entry['path'] + ('?' + entry['query'] if entry.get('query') else '')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as r:
+            status, size = r.status, len(r.read())
+    except urllib.error.HTTPError as e:
+        status, size = e.code, len(e.read())
+    except Exception:
+        status, size = None, 0
+    return status, size, time.perf_counter() - start
+
+
+def replay(entries, base, speed, concurrency, timeout):
+    """Send ``entries`` on their schedule; returns one result dict per request
+    and the wall time."""
+    results = []
+    lock = threading.Lock()
+    first = entries[0]['ts'] if entries else 0.0
+    t0 = time.perf_counter()
+
+    def one(entry, due):
+        lag = time.perf_counter() - due
+        status, size, seconds = fetch(base, entry, timeout)
+        with lock:
+            results.append({'route': entry.get('route') or entry['path'], 'status': status,
+                            'logged_status': entry.get('status'), 'bytes': size,
+                            'seconds': seconds, 'lag': max(0.0, lag)})
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for entry in entries:
+            due = t0 + ((entry['ts'] - first) / speed if speed else 0.0)
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            pool.submit(one, entry, due)
+    return results, time.perf_counter() - t0
+
+
+def summarize(results, wall):
+    seconds = [r['seconds'] for r in results]
+    errors = sum(1 for r in results if r['status'] is None or r['status'] >= 500)
+    client = sum(1 for r in results if r['status'] is not None and 400 <= r['status'] < 500)
+    return {'requests': len(results), 'throughput': len(results) / wall if wall else 0.0,
+            'p50': percentile(seconds, 50), 'p95': percentile(seconds, 95),
+            'p99': percentile(seconds, 99), 'max': max(seconds, default=0.0),
+            'errors': errors, 'error_rate': errors / len(results) if results else 0.0,
+            'client_errors': client,
+            'status_changed': sum(1 for r in results if r['logged_status'] not in (None, r['status'])),
+            'lag_p95': percentile([r['lag'] for r in results], 95),
+            'bytes': sum(r['bytes'] for r in results)}
+
+
+def _row(name, s):
+    return (f'{name[:44]:<44} {s["requests"]:>6} {s["throughput"]:>8.1f} {s["p50"]:>8.3f} '
+            f'{s["p95"]:>8.3f} {s["p99"]:>8.3f} {s["error_rate"] * 100:>6.1f}% {s["lag_p95"]:>8.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log', help='an ACCESS_LOG file')
+    parser.add_argument('--base', default='http://localhost:8104')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='rate multiplier over the captured rate (0: as fast as possible)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--limit', type=int, help='replay only the first N requests')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--json', help='write the summary here')
+    args = parser.parse_args()
+
+    entries, skipped = load(args.log, args.limit)
+    if not entries:
+        sys.exit(f'{args.log}: no GET requests to replay')
+    span = entries[-1]['ts'] - entries[0]['ts']
+    print(f'replaying {len(entries)} requests captured over {span:.1f}s '
+          f'at speed {args.speed or "max"} with concurrency {args.concurrency}'
+          + (f' ({skipped} POSTs skipped)' if skipped else ''))
+    results, wall = replay(entries, args.base.rstrip('/'), args.speed, args.concurrency, args.timeout)
+
+    by_route = {}
+    for r in results:
+        by_route.setdefault(r['route'], []).append(r)
+    # A route's throughput is over the whole replay, so the rows add up.
+    routes = {route: summarize(rs, wall) for route, rs in sorted(by_route.items())}
+    total = summarize(results, wall)
+    print(f'{"route":<44} {"reqs":>6} {"req/s":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"errors":>7} {"lag p95":>8}')
+    for route, s in routes.items():
+        print(_row(route, s))
+    print(_row('all', total))
+    print(f'wall {wall:.1f}s, {total["bytes"] / 1e6:.1f} MB, {total["client_errors"]} 4xx, '
+          f'{total["status_changed"]} answered with a different status than logged')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'log': args.log, 'base': args.base, 'speed': args.speed,
+                       'concurrency': args.concurrency, 'skipped_posts': skipped, 'wall': wall,
+                       'total': total, 'routes': routes}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,10 +8,69 @@ APP_CONFIG = {
     'CACHE_MAX_BYTES': int(os.environ.get('CACHE_MAX_BYTES', 300 * 1024 ** 3)),  # 300 GB
     'CACHE_TTL_HOURS': int(os.environ.get('CACHE_TTL_HOURS', 0)),
     'CACHE_TARGET_RATIO': float(os.environ.get('CACHE_TARGET_RATIO', 0.50)),
+    # The cache index (modules/cache_index.py) is reconciled with the disk when
+    # its last rebuild is older than this.
+    'CACHE_INDEX_REBUILD_HOURS': int(os.environ.get('CACHE_INDEX_REBUILD_HOURS', 24)),
+    # Eviction runs in a background thread of the server process (server.main),
+    # checking the budget every CACHE_EVICT_POLL_SECONDS and deleting at most
+    # CACHE_EVICT_DELETES_PER_SEC files a second (0 = unpaced) so a big purge
+    # doesn't starve concurrent streaming. Set CACHE_EVICT_IN_BACKGROUND=0 to
+    # evict inline on the request path instead.
+    'CACHE_EVICT_IN_BACKGROUND': os.environ.get('CACHE_EVICT_IN_BACKGROUND', '1') != '0',
+    'CACHE_EVICT_POLL_SECONDS': int(os.environ.get('CACHE_EVICT_POLL_SECONDS', 5)),
+    'CACHE_EVICT_DELETES_PER_SEC': int(os.environ.get('CACHE_EVICT_DELETES_PER_SEC', 50)),
+    # Artifacts of runs younger than this may still change upstream, so they get a
+    # short max-age (seconds) instead of Cache-Control: immutable.
+    'CACHE_RECENT_RUN_HOURS': int(os.environ.get('CACHE_RECENT_RUN_HOURS', 6)),
+    'CACHE_RECENT_MAX_AGE': int(os.environ.get('CACHE_RECENT_MAX_AGE', 60)),
+    # 'native' encodes gribjson in-process (modules/gribjson.py), falling back to
+    # the grib2json Java tool for files it doesn't handle; 'grib2json' always
+    # runs the Java tool.
+    'GRIBJSON_ENCODER': os.environ.get('GRIBJSON_ENCODER', 'native'),
+    # 'native' builds COGs in-process (one warp in memory, written by GDAL's COG
+    # driver); 'gdal' runs the gdalwarp / gdaladdo / gdal_translate pipeline.
+    'COG_BUILDER': os.environ.get('COG_BUILDER', 'native'),
+    # 'fast' draws HRRR PNGs straight from the field through a cached colormap
+    # lookup table (the legend is the separate 'legend' format); 'matplotlib'
+    # draws the titled figure with a colorbar.
+    'PNG_RENDERER': os.environ.get('PNG_RENDERER', 'fast'),
+    # Forecast hours built at once for a point series or bundle that isn't
+    # cached yet, and the most points one /hrrr/<product>/point request may ask for.
+    'HOUR_BUILD_WORKERS': int(os.environ.get('HOUR_BUILD_WORKERS', 4)),
+    'POINT_MAX_POINTS': int(os.environ.get('POINT_MAX_POINTS', 1000)),
+    # The most data requests one POST /batch may carry.
+    'BATCH_MAX_ITEMS': int(os.environ.get('BATCH_MAX_ITEMS', 64)),
+    # Response bodies up to HOT_CACHE_MAX_ENTRY bytes are served from an arena of
+    # HOT_CACHE_BYTES mapped by every worker (modules/hotcache.py) instead of
+    # being re-read from disk on each hit. HOT_CACHE_BYTES=0 turns it off.
+    'HOT_CACHE_BYTES': int(os.environ.get('HOT_CACHE_BYTES', 64 * 1024 ** 2)),
+    'HOT_CACHE_MAX_ENTRY': int(os.environ.get('HOT_CACHE_MAX_ENTRY', 256 * 1024)),
+    # Per-request stage timings (modules/tracing.py) sent as a Server-Timing
+    # header, and with TRACE_LOG also printed as one JSON line per request.
+    'SERVER_TIMING': os.environ.get('SERVER_TIMING', '1') != '0',
+    'TRACE_LOG': os.environ.get('TRACE_LOG', '0') != '0',
+    # File that gets one JSON line per request (modules.access_log), for
+    # replaying real traffic with benchmarks/replay.py. Empty: no access log.
+    'ACCESS_LOG': os.environ.get('ACCESS_LOG', ''),
+    # Upstream locations. HRRR_SOURCE_URL replaces Herbie's public mirrors with
+    # one bucket of the same layout (hrrr.YYYYMMDD/conus/...), e.g. the tests'
+    # fake upstream; empty means the mirrors. GFS_FILTER_URL is the NOMADS
+    # filter_gfs_0p25.pl script process_gfs queries.
+    'HRRR_SOURCE_URL': os.environ.get('HRRR_SOURCE_URL', ''),
+    'GFS_FILTER_URL': os.environ.get('GFS_FILTER_URL', 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl'),
+    # GFS_GLOBAL fetches a cycle's global 10 m winds once and cuts every projwin
+    # from its memory-mapped .field; 0 sends each projwin to the filter as its
+    # own subregion request. With GFS_COLD_FILTER=1, a projwin of a cycle whose
+    # global field isn't cached yet is answered by a subregion request while
+    # the global field downloads in the background.
+    'GFS_GLOBAL': os.environ.get('GFS_GLOBAL', '1') != '0',
+    'GFS_COLD_FILTER': os.environ.get('GFS_COLD_FILTER', '0') == '1',
     'AVAILABLE_FORMATS': {
         "json": "application/json",
         "png": "image/png",
-        "tiff": "image/tiff"
+        "tiff": "image/tiff",
+        "npy": "application/octet-stream",
+        "windbin": "application/octet-stream"
     },
     'DEFAULT_FORMAT': "application/json"
 }
@@ -43,4 +102,9 @@ WINDS_BAND_COLORMAPS = {
     'speed': {'cmap': 'viridis', 'label': 'Wind Speed (m/s)'},
 }
 
-NODATA = -9999
\ No newline at end of file
+NODATA = -9999
+
+# Precompressed siblings written next to each gribjson file, as
+# (file suffix, Content-Encoding), in server preference order. app.py serves them
+# when Accept-Encoding allows; manage_cache evicts them together with the parent.
+COMPRESSED_SIBLINGS = (('.br', 'br'), ('.gz', 'gzip'))
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""Structured access log: one JSON line per request, for capacity testing.
+
+With ``ACCESS_LOG`` set to a file path, server.py wraps the bottle app in
+:func:`middleware`, which appends a line per request once its response is
+done::
+
+    {"ts": 1722492000.123, "method": "GET", "path": "/hrrr/winds/png/2024-08-01T06:00:00",
+     "query": "", "route": "/<model>/<seg2>/<seg3>/<seg4>", "model": "hrrr", "product": "winds",
+     "format": "png", "time": "2024-08-01T06:00:00", "projwin": null, "fxx": null,
+     "status": 200, "bytes": 48213, "cache": "miss", "duration_ms": 2140.7}
+
+``cache`` is ``hit`` or ``miss`` when every built output the request looked up
+was (or was not) in the cache, ``mixed`` for a bundle, point series or batch
+that found some, and null when the request looked none up (static files, errors
+before the pipeline). A cached file handed to the server's ``wsgi.file_wrapper``
+(or a buffered body) is logged when the handler returns: ``bytes`` is its
+Content-Length and ``duration_ms`` leaves out the time on the wire. A streamed
+body -- a bundle or a batch, whose outputs are looked up and built while it is
+sent -- is logged when the server closes it, counting the lookups and bytes of
+the whole stream and the time to its end. ``benchmarks/replay.py`` re-issues a
+log against a server.
+
+Every worker appends to the same file: each line is a single ``write`` on an
+``O_APPEND`` descriptor, so lines from different processes never interleave.
+"""
+import os
+import json
+import time
+import threading
+import contextvars
+from urllib.parse import parse_qs
+
+import config
+
+_current = contextvars.ContextVar('veloserver_access', default=None)
+_lock = threading.Lock()
+_fd = None
+_fd_path = None
+
+
+def _reset():
+    # A forked worker opens its own descriptor (and lock) on first use.
+    global _lock, _fd, _fd_path
+    _lock = threading.Lock()
+    _fd, _fd_path = None, None
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def note_cache(hit):
+    """Count one cache lookup of a built output for the current request; a
+    no-op outside a logged request."""
+    counts = _current.get()
+    if counts is not None:
+        counts['hit' if hit else 'miss'] += 1
+
+
+def _cache_result(counts):
+    if counts['hit'] and counts['miss']:
+        return 'mixed'
+    if counts['hit']:
+        return 'hit'
+    return 'miss' if counts['miss'] else None
+
+
+def request_fields(path, url_args, query):
+    """The model, product, format, run time, projwin and fxx a request asked
+    for, from the matched route's arguments (None where a route has no such
+    part)."""
+    args = dict(url_args or {})
+    root = path.split('/')[1] if path.count('/') else ''
+    fields = {'model': args.get('model'), 'product': args.get('product'), 'format': args.get('format'),
+              'time': args.get('datetime') or args.get('time_param') or query.get('time'),
+              'projwin': args.get('projwin') or query.get('projwin'), 'fxx': query.get('fxx')}
+    if 'seg4' in args:  # the two four-segment shapes, told apart as in server.py
+        if ',' in args['seg4']:
+            fields.update(format=args['seg2'], time=args['seg3'], projwin=args['seg4'])
+        else:
+            fields.update(product=args['seg2'], format=args['seg3'], time=args['seg4'])
+    elif root == 'cog':
+        fields.update(model='hrrr', format='cog')
+    elif root == 'tiles':
+        fields.update(model='hrrr', format=args.get('ext'))
+    elif root == 'hrrr' and path.endswith('/point'):
+        fields.update(model='hrrr', format='point')
+    elif root == 'hrrr' and 'product' in args and fields['model'] is None:
+        fields['model'] = 'hrrr'  # /hrrr/<product>/bundle/<format>
+    return fields
+
+
+def write(entry, path=None):
+    """Append ``entry`` as one JSON line to the access log."""
+    global _fd, _fd_path
+    path = path or config.APP_CONFIG['ACCESS_LOG']
+    line = (json.dumps(entry, separators=(',', ':')) + '\n').encode()
+    with _lock:
+        if _fd is None or _fd_path != path:
+            if _fd is not None:
+                os.close(_fd)
+            _fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            _fd_path = path
+        os.write(_fd, line)
+
+
+class _Streamed:
+    """A streamed response body, passed through chunk by chunk with each
+    ``next()`` run in the request's context (so lookups made while streaming
+    are counted), that calls ``finish(bytes_sent)`` once when closed."""
+
+    def __init__(self, body, ctx, finish):
+        self._body, self._ctx, self._finish = body, ctx, finish
+        self._sent = 0
+        self._closed = False
+
+    def __iter__(self):
+        chunks = self._ctx.run(iter, self._body)
+        while True:
+            try:
+                chunk = self._ctx.run(next, chunks)
+            except StopIteration:
+                return
+            self._sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._body, 'close'):
+                self._ctx.run(self._body.close)
+        finally:
+            self._finish(self._sent)
+
+
+def middleware(app):
+    """Wrap the WSGI ``app`` so every request is written to the access log.
+    A cached file (or a buffered body) is returned untouched, so it still goes
+    out through the server's sendfile wrapper; a streamed body is wrapped so
+    its line is written when the server closes it."""
+    def logged(environ, start_response):
+        began, start = time.time(), time.perf_counter()
+        sent = {}
+
+        def start_logged(status, headers, exc_info=None):
+            sent['status'] = int(status.split()[0])
+            sent['bytes'] = next((int(v) for k, v in headers if k.lower() == 'content-length'), None)
+            return start_response(status, headers, exc_info)
+
+        def finish(streamed=None):
+            try:
+                path = environ.get('PATH_INFO', '')
+                query = environ.get('QUERY_STRING', '')
+                route = environ.get('bottle.route')
+                entry = {'ts': round(began, 3), 'method': environ.get('REQUEST_METHOD'), 'path': path,
+                         'query': query, 'route': getattr(route, 'rule', None)}
+                entry.update(request_fields(path, environ.get('route.url_args'),
+                                            {k: v[0] for k, v in parse_qs(query).items()}))
+                entry.update(status=sent.get('status'), bytes=sent.get('bytes') if streamed is None else streamed,
+                             cache=_cache_result(counts),
+                             duration_ms=round((time.perf_counter() - start) * 1000, 1))
+                write(entry)
+            except Exception as exc:  # the log must never fail a request
+                print(f'[access_log] write failed: {exc}')
+
+        counts = {'hit': 0, 'miss': 0}
+        # The request runs in a context of its own, kept for streaming its body.
+        ctx = contextvars.copy_context()
+        ctx.run(_current.set, counts)
+        body = ctx.run(app, environ, start_logged)
+        # file_wrapper objects (gunicorn's, wsgiref's) keep the file as .filelike.
+        if isinstance(body, (list, tuple)) or hasattr(body, 'filelike'):
+            finish()
+            return body
+        return _Streamed(body, ctx, finish)
+
+    return logged
@@ -0,0 +1,182 @@
+"""Batch runs of the process_data CLI: every output a backfill names, grouped
+by the intermediate they share, with a state file to resume from.
+
+A batch is one or more specs (from the command line, or a JSON manifest
+holding a list of them)::
+
+    {"model": "hrrr", "products": "winds,temp_2m", "date": "2024-08-01",
+     "end_date": "2024-08-03", "hours": "0-23", "fxx": "0-6",
+     "projwins": ["-105,41,-104,40", null], "formats": "png,geotiff"}
+
+Each expands to the product of its lists (a null projwin is the whole grid),
+normalized the way process_data rounds each model's run: HRRR to the hour,
+GFS down to its 6-hourly cycle (f000 only), ECMWF to the 00z run. Product and
+format pairs process_hrrr refuses (gribjson of a scalar) are dropped.
+
+Outputs that share an intermediate form one group, run in one process: an
+HRRR product/run/fxx (one download and regrid feeding every projwin and
+format), a GFS cycle (one global NOMADS fetch; per projwin with GFS_GLOBAL
+off), an ECMWF day (one download). The state file records every output as
+it finishes, so a rerun skips those that succeeded and retries the rest.
+"""
+import os
+import json
+from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
+
+import config
+from modules.parse import canonical_product, hrrr_format_error, normalize_date, parse_fxx
+
+Output = namedtuple('Output', 'model product date hour fxx projwin format')
+
+MODELS = ('hrrr', 'gfs', 'ecmwf')
+
+
+def parse_int_list(raw):
+    """'0-6,12' -> [0, 1, 2, 3, 4, 5, 6, 12]. Ints and lists pass through."""
+    if isinstance(raw, int):
+        return [raw]
+    if isinstance(raw, list):
+        return [int(v) for v in raw]
+    values = []
+    for part in str(raw).split(','):
+        first, sep, last = part.strip().partition('-')
+        start, end = int(first), int(last) if sep else int(first)
+        if end < start:
+            raise ValueError(f'range {part!r} ends before it starts')
+        values.extend(range(start, end + 1))
+    return values
+
+
+def _names(raw):
+    if raw is None:
+        return []
+    return [v.strip() for v in (raw if isinstance(raw, list) else str(raw).split(',')) if v.strip()]
+
+
+def _projwin(raw):
+    """A projwin as 4 floats, or None for the whole grid."""
+    if raw is None or raw == '' or raw == 'global':
+        return None
+    values = [float(v) for v in (raw if isinstance(raw, (list, tuple)) else str(raw).split(','))]
+    if len(values) != 4:
+        raise ValueError(f'projwin {raw!r}: expected ulx,uly,lrx,lry')
+    return tuple(values)
+
+
+def _dates(start, end):
+    day = datetime.strptime(normalize_date(start), '%Y-%m-%d')
+    last = datetime.strptime(normalize_date(end or start), '%Y-%m-%d')
+    if last < day:
+        raise ValueError(f'end_date {end} is before date {start}')
+    while day <= last:
+        yield day.strftime('%Y-%m-%d')
+        day += timedelta(days=1)
+
+
+def _run_hour(model, hour):
+    if model == 'gfs':
+        return f'{hour // 6 * 6:02d}:00:00'
+    if model == 'ecmwf':
+        return '00:00:00'
+    return f'{hour:02d}:00:00'
+
+
+def make_output(model, product, date, hour, fxx, projwin, format):
+    """One Output, ``hour`` (an int) rounded to the model's run and ``projwin``
+    (4 numbers, a comma-separated string, or None) made a tuple of floats."""
+    return Output(model, product, date, _run_hour(model, hour), fxx, _projwin(projwin), format)
+
+
+def expand(spec):
+    """The outputs one spec names, in order, without duplicates. Returns
+    ``(outputs, dropped)``, dropped being the product/format pairs left out.
+    Raises ValueError on a malformed spec."""
+    model = spec.get('model', 'hrrr')
+    if not spec.get('date'):
+        raise ValueError(f'spec has no date: {spec}')
+    if model not in MODELS:
+        raise ValueError(f'Unsupported model: {model}')
+    products = [canonical_product(p) for p in _names(spec.get('products', 'winds'))] if model == 'hrrr' \
+        else ['winds']
+    formats = _names(spec.get('formats', 'gribjson'))
+    projwins = [_projwin(p) for p in (spec.get('projwins') or [None])]
+    hours = parse_int_list(spec.get('hours', 0))
+    if any(not 0 <= h <= 23 for h in hours):
+        raise ValueError(f'hours must be within 0-23, got {spec.get("hours")!r}')
+    outputs, dropped = OrderedDict(), set()
+    for date in _dates(spec['date'], spec.get('end_date')):
+        for hour in hours:
+            fxx_list = [parse_fxx(str(f), _run_hour(model, hour)) for f in parse_int_list(spec.get('fxx', 0))] \
+                if model == 'hrrr' else [0]
+            for product in products:
+                for fxx in fxx_list:
+                    for projwin in projwins:
+                        for format in formats:
+                            if model == 'hrrr' and hrrr_format_error(product, format):
+                                dropped.add((product, format))
+                                continue
+                            outputs[make_output(model, product, date, hour, fxx, projwin, format)] = None
+    return list(outputs), sorted(dropped)
+
+
+def load_manifest(path):
+    """The specs of a JSON manifest: a list of specs, or an object with a
+    "jobs" list."""
+    with open(path) as f:
+        data = json.load(f)
+    specs = data.get('jobs') if isinstance(data, dict) else data
+    if not isinstance(specs, list) or not all(isinstance(s, dict) for s in specs):
+        raise ValueError(f'{path}: expected a list of job objects (or {{"jobs": [...]}})')
+    return specs
+
+
+def group_key(output):
+    """The intermediate ``output`` is built from."""
+    if output.model == 'hrrr':
+        return ('hrrr', output.product, output.date, output.hour, output.fxx)
+    if output.model == 'gfs':
+        # A cycle's global download feeds every projwin unless GFS_GLOBAL is off.
+        if config.APP_CONFIG['GFS_GLOBAL']:
+            return ('gfs', output.date, output.hour)
+        return ('gfs', output.date, output.hour, output.projwin)
+    return ('ecmwf', output.date)
+
+
+def group(outputs):
+    """``{group_key: [outputs]}``, groups and outputs in first-seen order."""
+    groups = OrderedDict()
+    for output in outputs:
+        groups.setdefault(group_key(output), []).append(output)
+    return groups
+
+
+def key(output):
+    """The state file's name for an output."""
+    projwin = 'global' if output.projwin is None else ','.join(str(float(v)) for v in output.projwin)
+    return (f'{output.model}/{output.product}/{output.date}T{output.hour}/f{output.fxx:02d}/'
+            f'{projwin}/{output.format}')
+
+
+def load_state(path):
+    """Keys of the outputs a previous run of the batch finished."""
+    done = set()
+    if not path or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by a crash
+            if entry.get('ok'):
+                done.add(entry['key'])
+    return done
+
+
+def record_state(path, output, ok, detail):
+    """Append one finished output to the state file."""
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps({'key': key(output), 'ok': ok, 'detail': detail}) + '\n')
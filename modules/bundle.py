@@ -0,0 +1,160 @@
+"""Multi-frame payloads for the HRRR bundle route: one response carrying a
+forecast-hour stack, written frame by frame as each hour is ready.
+
+Frames are ``(fxx, path_or_error)`` in forecast-hour order, where ``path`` is a
+cached output file and an error is whatever that hour failed with. Each
+container streams a file in 64 KB chunks straight from the cache, so a bundle
+never holds more than one chunk in memory:
+
+* ``tar``: a POSIX tar of the frame files under their cache names, then a
+  ``manifest.json`` listing every hour and why any is missing.
+* ``multipart``: ``multipart/mixed``, one part per hour with ``X-Forecast-Hour``;
+  a missing hour is an ``application/json`` part holding its error.
+
+POST /batch answers several data requests the same way, one item per request
+in the order they finish. Items are ``(meta, path_or_error)``, ``meta`` holding
+the request's ``index``, its ``status``, ``content_type`` and ``url``:
+
+* ``ndjson``: one JSON line per item, ``meta`` plus the file as ``body``
+  (embedded as is when it is JSON, base64 otherwise) or the ``error``.
+* ``multipart``: one part per item with ``X-Batch-Index`` and ``X-Status``.
+"""
+import io
+import os
+import json
+import uuid
+import base64
+import tarfile
+
+CONTAINERS = ('tar', 'multipart')
+BATCH_CONTAINERS = ('ndjson', 'multipart')
+
+_CHUNK = 64 * 1024
+# A multiple of 3, so each chunk base64-encodes without padding.
+_B64_CHUNK = 48 * 1024
+_BLOCK = tarfile.BLOCKSIZE
+MANIFEST_NAME = 'manifest.json'
+
+
+def content_type(container, boundary):
+    """Response Content-Type of a container."""
+    if container == 'multipart':
+        return f'multipart/mixed; boundary={boundary}'
+    if container == 'ndjson':
+        return 'application/x-ndjson'
+    return 'application/x-tar'
+
+
+def new_boundary():
+    return f'velo-{uuid.uuid4().hex}'
+
+
+def _file_chunks(path, size=_CHUNK):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(size), b''):
+            yield chunk
+
+
+def _tar_member(name, size, mtime, chunks):
+    info = tarfile.TarInfo(name)
+    info.size, info.mtime, info.mode = size, int(mtime), 0o644
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    yield from chunks
+    if size % _BLOCK:
+        yield b'\0' * (_BLOCK - size % _BLOCK)
+
+
+def _error_text(error):
+    return str(error) or type(error).__name__
+
+
+def tar_stream(frames):
+    """The tar container: each frame file, then the manifest."""
+    manifest = {'frames': [], 'missing': []}
+    for fxx, result in frames:
+        if isinstance(result, str) and os.path.isfile(result):
+            st = os.stat(result)
+            name = os.path.basename(result)
+            manifest['frames'].append({'fxx': fxx, 'name': name, 'size': st.st_size})
+            yield from _tar_member(name, st.st_size, st.st_mtime, _file_chunks(result))
+        else:
+            manifest['missing'].append({'fxx': fxx, 'error': _error_text(result)})
+    body = json.dumps(manifest, separators=(',', ':')).encode()
+    yield from _tar_member(MANIFEST_NAME, len(body), 0, [body])
+    yield b'\0' * (2 * _BLOCK)  # end-of-archive marker
+
+
+def multipart_stream(frames, boundary, mimetype):
+    """The multipart/mixed container: a ``mimetype`` part per frame file, a JSON
+    error part per missing hour."""
+    for fxx, result in frames:
+        if isinstance(result, str) and os.path.isfile(result):
+            name, size = os.path.basename(result), os.path.getsize(result)
+            chunks, part_type = _file_chunks(result), mimetype
+        else:
+            body = json.dumps({'fxx': fxx, 'error': _error_text(result)}).encode()
+            name, size, chunks, part_type = f'f{fxx:02d}-error.json', len(body), [body], 'application/json'
+        yield from _part(boundary, part_type, name, size, {'X-Forecast-Hour': fxx}, chunks)
+    yield f'--{boundary}--\r\n'.encode()
+
+
+def _part(boundary, part_type, name, size, headers, chunks):
+    head = io.StringIO()
+    head.write(f'--{boundary}\r\n')
+    head.write(f'Content-Type: {part_type}\r\n')
+    head.write(f'Content-Disposition: attachment; filename="{name}"\r\n')
+    head.write(f'Content-Length: {size}\r\n')
+    for key, value in headers.items():
+        head.write(f'{key}: {value}\r\n')
+    head.write('\r\n')
+    yield head.getvalue().encode()
+    yield from chunks
+    yield b'\r\n'
+
+
+def stream(container, frames, boundary, mimetype):
+    """Bytes of ``frames`` in ``container`` ('tar' or 'multipart'), lazily."""
+    if container == 'multipart':
+        return multipart_stream(frames, boundary, mimetype)
+    return tar_stream(frames)
+
+
+def ndjson_stream(items):
+    """The ndjson batch container: a line per item."""
+    for meta, result in items:
+        if meta['status'] != 200:
+            yield (json.dumps(dict(meta, error=_error_text(result)), separators=(',', ':')) + '\n').encode()
+            continue
+        head = json.dumps(meta, separators=(',', ':'))[:-1]
+        if meta['content_type'].startswith('application/json'):
+            yield (head + ',"body":').encode()
+            # A raw newline can only be whitespace in JSON, and would end the line.
+            for chunk in _file_chunks(result):
+                yield chunk.replace(b'\n', b'').replace(b'\r', b'')
+        else:
+            yield (head + ',"body_encoding":"base64","body":"').encode()
+            for chunk in _file_chunks(result, _B64_CHUNK):
+                yield base64.b64encode(chunk)
+            yield b'"'
+        yield b'}\n'
+
+
+def batch_multipart_stream(items, boundary):
+    """The multipart batch container: a part per item, the file or a JSON error."""
+    for meta, result in items:
+        headers = {'X-Batch-Index': meta['index'], 'X-Status': meta['status']}
+        if meta['status'] == 200:
+            name, size = os.path.basename(result), os.path.getsize(result)
+            chunks, part_type = _file_chunks(result), meta['content_type']
+        else:
+            body = json.dumps(dict(meta, error=_error_text(result))).encode()
+            name, size, chunks, part_type = f'{meta["index"]}-error.json', len(body), [body], 'application/json'
+        yield from _part(boundary, part_type, name, size, headers, chunks)
+    yield f'--{boundary}--\r\n'.encode()
+
+
+def batch_stream(container, items, boundary):
+    """Bytes of the batch ``items`` in ``container`` ('ndjson' or 'multipart'), lazily."""
+    if container == 'multipart':
+        return batch_multipart_stream(items, boundary)
+    return ndjson_stream(items)
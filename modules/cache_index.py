@@ -0,0 +1,284 @@
+"""Persistent size / last-use index of the cache, so eviction doesn't walk it.
+
+One SQLite database under CACHE_DIR holds a row per cached unit (a file, or a
+gribjson file together with its precompressed siblings): relative path, size in
+bytes and last-use time. Triggers keep the byte total in a meta row, so the
+budget check is a single-row read, and an index on last_use lets eviction pop
+least-recently-used entries in order.
+
+Rows are written by _atomic_output when it publishes a file, by mark_used on
+access (throttled per process), and explicitly for Herbie downloads, which
+don't go through _atomic_output. WAL mode lets every gunicorn worker read while
+one writes, and makes the file crash-safe. Anything the index misses (a crash
+between publish and record, files removed by hand) is reconciled by a rebuild
+from disk, which manage_cache runs under its eviction lock at startup and then
+whenever the last rebuild is older than CACHE_INDEX_REBUILD_HOURS.
+
+Recording is best-effort: an index error is logged and never fails a request.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+import config
+from config import COMPRESSED_SIBLINGS
+
+INDEX_NAME = '.cache-index.sqlite'
+
+# Bump when the schema changes; an index with another version is rebuilt.
+SCHEMA_VERSION = 1
+
+# Seconds a writer waits for another process's write lock before giving up.
+_BUSY_TIMEOUT = 5
+
+# mark_used fires on every hit; only re-record the same file this often (seconds)
+# per process. LRU ordering at one-minute resolution is plenty for eviction.
+_TOUCH_INTERVAL = 60
+_TOUCH_MEMO_MAX = 100_000
+
+# Rows read per query while walking entries oldest-first.
+_BATCH = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used, path);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+    UPDATE meta SET value = value + NEW.size WHERE key = 'total_bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+    UPDATE meta SET value = value - OLD.size WHERE key = 'total_bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS entries_resize AFTER UPDATE OF size ON entries BEGIN
+    UPDATE meta SET value = value + NEW.size - OLD.size WHERE key = 'total_bytes';
+END;
+INSERT OR IGNORE INTO meta VALUES ('total_bytes', 0);
+INSERT OR IGNORE INTO meta VALUES ('rebuilt_at', 0);
+"""
+
+_UPSERT = ('INSERT INTO entries (path, size, last_used) VALUES (?, ?, ?) '
+           'ON CONFLICT (path) DO UPDATE SET size = excluded.size, '
+           'last_used = max(last_used, excluded.last_used)')
+
+_local = threading.local()
+_last_touch = {}
+
+
+def index_path(cache_dir):
+    return os.path.join(os.path.abspath(cache_dir), INDEX_NAME)
+
+
+def is_index_file(name):
+    """True for the index and its -wal / -shm / -journal companions, which
+    eviction must never touch."""
+    return name.startswith(INDEX_NAME)
+
+
+def _connection(db_path):
+    """Per-thread, per-process connection (sqlite3 connections must not cross
+    threads, and must not survive gunicorn's fork)."""
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid, _local.conns = os.getpid(), {}
+    conn = _local.conns.get(db_path)
+    if conn is None:
+        # Autocommit; multi-statement writes open their own transaction.
+        conn = sqlite3.connect(db_path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _local.conns[db_path] = conn
+    return conn
+
+
+def _discard(db_path):
+    """Close this thread's connection and delete a corrupt or outdated index."""
+    conn = getattr(_local, 'conns', {}).pop(db_path, None)
+    if conn is not None:
+        conn.close()
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        try:
+            os.remove(db_path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def _meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _open_existing(cache_dir):
+    """Connection to the index of ``cache_dir``, or None if it has none yet."""
+    db_path = index_path(cache_dir)
+    if not os.path.exists(db_path):
+        return None
+    return _connection(db_path)
+
+
+def ensure(cache_dir, scan, max_age):
+    """Create the index if missing and rebuild it from ``scan()`` when it is
+    new, unreadable, from another schema version, or last rebuilt more than
+    ``max_age`` seconds ago. ``scan`` yields ``(path, size, last_used)`` units
+    (manage_cache._evictable_entries). The caller holds the eviction lock, so
+    only one process rebuilds at a time. Returns True if it rebuilt."""
+    db_path = index_path(cache_dir)
+    try:
+        conn = _connection(db_path)
+        conn.executescript(_SCHEMA)
+        outdated = _meta(conn, 'schema') not in (None, SCHEMA_VERSION)
+    except sqlite3.DatabaseError as exc:
+        print(f'[cache] index unreadable, rebuilding: {exc}')
+        outdated = True
+    if outdated:
+        _discard(db_path)
+        conn = _connection(db_path)
+        conn.executescript(_SCHEMA)
+    elif time.time() - (_meta(conn, 'rebuilt_at') or 0) < max_age:
+        return False
+    rebuild(cache_dir, scan)
+    return True
+
+
+def rebuild(cache_dir, scan):
+    """Reconcile the index with what is on disk.
+
+    The walk runs outside any transaction so workers can keep recording while
+    it takes its time; rows recorded after it started are kept even though the
+    walk didn't see them."""
+    base = os.path.abspath(cache_dir)
+    conn = _connection(index_path(base))
+    started = time.time()
+    rows = [(os.path.relpath(path, base), size, used) for path, size, used in scan()]
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (path TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM seen')
+        conn.executemany(_UPSERT, rows)
+        conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', ((r[0],) for r in rows))
+        conn.execute('DELETE FROM entries WHERE last_used < ? AND path NOT IN (SELECT path FROM seen)',
+                     (started,))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema', ?)", (SCHEMA_VERSION,))
+        conn.execute("UPDATE meta SET value = ? WHERE key = 'rebuilt_at'", (started,))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    print(f'[cache] index rebuilt: {len(rows)} entries')
+
+
+def _unit(path):
+    """The entry a file is accounted under: a precompressed sibling belongs to
+    its parent (see manage_cache), anything else to itself."""
+    for suffix, _coding in COMPRESSED_SIBLINGS:
+        if path.endswith(suffix) and os.path.exists(path[:-len(suffix)]):
+            return path[:-len(suffix)]
+    return path
+
+
+def _unit_size(path):
+    """Bytes of ``path`` plus its siblings, or None if ``path`` is gone."""
+    try:
+        total = os.lstat(path).st_size
+    except OSError:
+        return None
+    for suffix, _coding in COMPRESSED_SIBLINGS:
+        try:
+            total += os.lstat(path + suffix).st_size
+        except OSError:
+            pass
+    return total
+
+
+def _resolve(path, cache_dir):
+    """(connection, unit path relative to the cache) for a file under an indexed
+    cache, else (None, None)."""
+    base = os.path.abspath(cache_dir or config.APP_CONFIG['CACHE_DIR'])
+    path = os.path.abspath(path)
+    if not path.startswith(base + os.sep):
+        return None, None
+    conn = _open_existing(base)
+    if conn is None:
+        return None, None
+    return conn, _unit(path)
+
+
+def record(path, cache_dir=None):
+    """Add or refresh the entry for a just-published (or just-used) file under
+    ``cache_dir`` (default CACHE_DIR). A no-op when the cache has no index yet
+    or the file is outside it; errors are logged, never raised."""
+    try:
+        conn, unit = _resolve(path, cache_dir)
+        if conn is None:
+            return
+        size = _unit_size(unit)
+        if size is None:
+            return  # evicted or replaced in the meantime
+        base = os.path.abspath(cache_dir or config.APP_CONFIG['CACHE_DIR'])
+        conn.execute(_UPSERT, (os.path.relpath(unit, base), size, time.time()))
+    except (OSError, sqlite3.Error) as exc:
+        print(f'[cache] index update skipped for {os.path.basename(path)}: {exc}')
+
+
+def touch(path, cache_dir=None):
+    """:func:`record` for an access, at most once per ``_TOUCH_INTERVAL`` per
+    file and process, so a hot file doesn't write the index on every hit."""
+    now = time.monotonic()
+    if now - _last_touch.get(path, -_TOUCH_INTERVAL) < _TOUCH_INTERVAL:
+        return
+    if len(_last_touch) >= _TOUCH_MEMO_MAX:
+        _last_touch.clear()
+    _last_touch[path] = now
+    record(path, cache_dir)
+
+
+def forget(cache_dir, path):
+    """Drop the entry for ``path`` (absolute) after it was evicted."""
+    conn = _open_existing(cache_dir)
+    if conn is not None:
+        conn.execute('DELETE FROM entries WHERE path = ?',
+                     (os.path.relpath(path, os.path.abspath(cache_dir)),))
+
+
+def total_bytes(cache_dir):
+    """Indexed bytes under ``cache_dir`` (0 without an index)."""
+    conn = _open_existing(cache_dir)
+    return (_meta(conn, 'total_bytes') or 0) if conn is not None else 0
+
+
+def beat(cache_dir, key):
+    """Store the current time under ``key`` in the meta table (a liveness
+    heartbeat another process can read with :func:`last_beat`)."""
+    conn = _open_existing(cache_dir)
+    if conn is not None:
+        conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, time.time()))
+
+
+def last_beat(cache_dir, key):
+    """Time of the last :func:`beat` for ``key``, or 0 if there was none."""
+    conn = _open_existing(cache_dir)
+    return (_meta(conn, key) or 0) if conn is not None else 0
+
+
+def least_recently_used(cache_dir):
+    """Yield ``(path, size, last_used)`` oldest first, with absolute paths.
+
+    Reads in small keyset-paginated batches instead of holding a cursor open, so
+    the caller can delete (and :func:`forget`) entries as it goes."""
+    conn = _open_existing(cache_dir)
+    if conn is None:
+        return
+    base = os.path.abspath(cache_dir)
+    after = (float('-inf'), '')
+    while True:
+        rows = conn.execute('SELECT path, size, last_used FROM entries '
+                            'WHERE (last_used, path) > (?, ?) ORDER BY last_used, path LIMIT ?',
+                            (after[0], after[1], _BATCH)).fetchall()
+        if not rows:
+            return
+        for rel, size, used in rows:
+            yield os.path.join(base, rel), size, used
+        after = (rows[-1][2], rows[-1][0])
@@ -1,10 +1,20 @@
 import os
+import time
 import fcntl
 import threading
 import contextlib
+from concurrent.futures import Future
 
+from modules import cache_index, metrics, tracing
 from modules.parse import _safe_path
 
+# In-flight builds of this process, keyed like the cache entry they produce, and
+# how callers were served: as the leader that ran the build or as a waiter that
+# shared a leader's result ('waiting' is how many are blocked right now).
+_flights = {}
+_flights_lock = threading.Lock()
+_flight_counts = {'leaders': 0, 'coalesced': 0, 'waiting': 0}
+
 
 @contextlib.contextmanager
 def _atomic_output(final_path):
@@ -14,7 +24,8 @@ def _atomic_output(final_path):
     concurrent identical requests -- or a reader hitting the os.path.exists cache
     check mid-write -- could otherwise see a half-written file. Renaming a
     per-process temp into the final path makes the cached file appear only once
-    complete (os.replace is atomic on POSIX). Temp confined under the same dir
+    complete (os.replace is atomic on POSIX), and it is entered in the cache
+    index as it is published. Temp confined under the same dir
     (path-injection hardening, Sonar S8707)."""
     uid = f'{os.getpid()}-{threading.get_ident()}'
     tmp = _safe_path(os.path.dirname(final_path),
@@ -23,6 +34,7 @@ def _atomic_output(final_path):
         yield tmp
         if os.path.exists(tmp):
             os.replace(tmp, final_path)
+            cache_index.record(final_path)
     finally:
         if os.path.exists(tmp):
             os.remove(tmp)
@@ -33,11 +45,75 @@ def _download_lock(cache_dir, key):
     """Cross-process lock so concurrent identical requests don't fetch the same
     source file at once (duplicate downloads / partial-file reads). An in-memory
     threading.Lock would not span gunicorn worker processes, hence fcntl. The key
-    is built only from allowlisted/numeric/date tokens (S2083)."""
+    is built only from allowlisted/numeric/date tokens (S2083). The wait for
+    the lock is observed in /metrics and traced as ``lock_wait``."""
     lock_file = open(_safe_path(cache_dir, f'{key}.lock'), 'w')
     try:
+        start = time.perf_counter()
         fcntl.flock(lock_file, fcntl.LOCK_EX)
+        waited = time.perf_counter() - start
+        metrics.observe('veloserver_lock_wait_seconds', waited)
+        tracing.add('lock_wait', waited)
         yield
     finally:
         fcntl.flock(lock_file, fcntl.LOCK_UN)
         lock_file.close()
+
+
+def _single_flight(key, build):
+    """Run ``build()`` once per ``key`` among the threads of this process.
+
+    The first caller runs it; threads asking for the same key meanwhile wait on
+    its future and get the same result (or exception) instead of each opening
+    the lock file, queueing in flock and re-checking the cache after it. The
+    fcntl _download_lock inside ``build`` is then only contended between worker
+    processes. ``key`` is a hashable naming the cache entry being built (its
+    path, or a tuple); nested flights must use distinct keys."""
+    with _flights_lock:
+        future = _flights.get(key)
+        leader = future is None
+        if leader:
+            future = _flights[key] = Future()
+            _flight_counts['leaders'] += 1
+        else:
+            _flight_counts['coalesced'] += 1
+            _flight_counts['waiting'] += 1
+    if not leader:
+        try:
+            with tracing.span('flight_wait'):
+                return future.result()
+        finally:
+            with _flights_lock:
+                _flight_counts['waiting'] -= 1
+    try:
+        result = build()
+    except BaseException as e:
+        _land(key)
+        future.set_exception(e)
+        raise
+    _land(key)
+    future.set_result(result)
+    return result
+
+
+def _land(key):
+    # Drop the flight before resolving it, so a caller arriving afterwards
+    # starts afresh (re-checking the cache) rather than sharing a stale result.
+    with _flights_lock:
+        _flights.pop(key, None)
+
+
+def flight_counts():
+    """Snapshot of the single-flight counters: builds led, callers coalesced
+    onto another thread's build, callers waiting now and builds in flight."""
+    with _flights_lock:
+        return dict(_flight_counts, in_flight=len(_flights))
+
+
+def _collect():
+    counts = flight_counts()
+    return [('veloserver_single_flight_total', {'role': 'leader'}, counts['leaders']),
+            ('veloserver_single_flight_total', {'role': 'coalesced'}, counts['coalesced'])]
+
+
+metrics.register_collector(_collect)
@@ -0,0 +1,122 @@
+"""HTTP validators for cached artifacts (ETag / Last-Modified / Cache-Control).
+
+A cached output never changes once _atomic_output has renamed it into place, and
+manage_cache.mark_used only moves its atime, so the file's mtime is its build
+time. That makes (cache key, size, build time) a stable identity for one build:
+rebuilt after an eviction it gets a new mtime and so a new ETag. Stdlib only --
+the request layer (app.py) turns the answers into bottle responses.
+"""
+import os
+import hashlib
+import email.utils
+from datetime import datetime, timezone
+
+# One year: the conventional "never revalidate" max-age for immutable responses.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def etag_for(path, st, variant=''):
+    """Strong, quoted ETag for one build of a cached file. ``variant`` tells
+    representations of the same file apart (e.g. a content encoding)."""
+    key = f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}:{variant}'
+    return '"' + hashlib.sha1(key.encode()).hexdigest() + '"'
+
+
+def last_modified(st):
+    """HTTP-date of the file's build time."""
+    return email.utils.formatdate(st.st_mtime, usegmt=True)
+
+
+def run_time(date, hour):
+    """UTC datetime of a model run from the request's 'YYYY-MM-DD' date and
+    'HH:MM:SS' time (naive request times are UTC throughout)."""
+    return datetime.strptime(f'{date}T{hour}', '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+
+
+def cache_control(run, recent_hours, recent_max_age, now=None):
+    """Cache-Control for an artifact of the run starting at ``run``.
+
+    Runs older than ``recent_hours`` are complete upstream, so their artifacts are
+    immutable. A recent run may still be publishing (or be rebuilt after an
+    eviction with fresher upstream data), so it only gets a short max-age and is
+    revalidated cheaply with the ETag afterwards."""
+    now = now or datetime.now(timezone.utc)
+    if run is None or (now - run).total_seconds() < recent_hours * 3600:
+        return f'public, max-age={recent_max_age}'
+    return f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+
+
+def _etag_matches(header, etag):
+    """If-None-Match uses the weak comparison (RFC 7232 3.2): a W/ prefix on
+    either side is ignored, and '*' matches any current representation."""
+    if header.strip() == '*':
+        return True
+    bare = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == bare:
+            return True
+    return False
+
+
+def is_not_modified(environ, etag, mtime):
+    """True if the request's conditional headers say the client's copy is
+    current, i.e. the answer is 304. If-None-Match takes precedence: when it is
+    present If-Modified-Since is ignored (RFC 7232 3.3)."""
+    inm = environ.get('HTTP_IF_NONE_MATCH')
+    if inm:
+        return _etag_matches(inm, etag)
+    ims = environ.get('HTTP_IF_MODIFIED_SINCE')
+    if ims:
+        try:
+            since = email.utils.parsedate_to_datetime(ims.split(';')[0].strip())
+        except (TypeError, ValueError):
+            return False
+        if since is None:
+            return False
+        return int(mtime) <= since.timestamp()
+    return False
+
+
+def _accepted_codings(header):
+    """Parse Accept-Encoding into {coding: q}. Codings with a malformed q are
+    dropped rather than failing the request."""
+    accepted = {}
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = -1.0
+        if q >= 0:
+            accepted[coding] = q
+    return accepted
+
+
+def negotiate_encoding(header, available):
+    """Pick the content coding to send from an Accept-Encoding header.
+
+    ``available`` lists the codings we have precompressed, in server preference
+    order; ties in q go to the earlier one. Returns None for the identity (plain)
+    body: no header, nothing acceptable, or only ``q=0`` entries (RFC 9110 12.5.3).
+    A ``*`` entry covers codings not named explicitly."""
+    if not header:
+        return None
+    accepted = _accepted_codings(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    if accepted.get('identity', 0.0) > best_q:
+        return None  # the client explicitly prefers the plain body
+    return best
@@ -1,9 +1,12 @@
-"""Format producers: turn a (possibly subsetted) GRIB into the requested output
-format. Each to_* function is idempotent -- it returns the existing file on a
-cache hit, otherwise writes it atomically and returns the path. gdal/grib2json
-commands are kept inline here (rather than behind a gdal wrapper) so the exact
-flags stay visible at the point of use."""
+"""Format producers: turn a GRIB, or a modules.fieldcache Field (a projwin slice
+of a mapped field), into the requested output format. Each to_* function is
+idempotent -- it returns the existing file on a cache hit, otherwise writes it
+atomically and returns the path. gdal/grib2json commands are kept inline here
+(rather than behind a gdal wrapper) so the exact flags stay visible at the
+point of use."""
 import os
+import gzip
+import shutil
 import subprocess
 import threading
 import numpy as np
@@ -15,45 +18,168 @@ import matplotlib.ticker
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_agg import FigureCanvasAgg
 import rasterio
+import rasterio.warp
 
+from modules import fieldcache, gribjson, regrid, render
 from modules.parse import _safe_path
 from modules.concurrency import _atomic_output
-from config import HRRR_PRODUCTS, WINDS_BAND_COLORMAPS, NODATA
+from config import APP_CONFIG, HRRR_PRODUCTS, WINDS_BAND_COLORMAPS, NODATA
+
+# Brotli is optional: without it only the .gz sibling is built, and clients that
+# only accept br get the plain file.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# gribjson's float text compresses 8-15x, and compressing once at cache-write time
+# is far cheaper than per response. Brotli quality 5 is already well ahead of gzip
+# on this data; the top qualities cost seconds per global file.
+_GZIP_LEVEL = 6
+_BROTLI_QUALITY = 5
+_COPY_CHUNK = 1024 * 1024
+
+# COG layout shared by both builders: 512px LZW tiles and five nearest-neighbour
+# overview levels (the 2..32 gdaladdo levels), so tiles.py sees the same file.
+_COG_OPTIONS = {'BLOCKSIZE': 512, 'COMPRESS': 'LZW', 'OVERVIEWS': 'IGNORE_EXISTING',
+                'OVERVIEW_RESAMPLING': 'NEAREST', 'OVERVIEW_COUNT': 5, 'NUM_THREADS': 'ALL_CPUS'}
+
+# gribjson holds only the 10 m above-ground messages (grib2json's --fv filter).
+_GRIBJSON_SURFACE_VALUE = 10.0
 
 # These producers receive paths the caller already built from validated tokens and
 # confined with _safe_path, so they trust their inputs (clean-at-the-boundary):
 # the request layer cleans once, the workers don't re-clean.
 
 
-def to_gribjson(grib_path, out_path, timeout=None):
-    """Convert a GRIB to grib2json. Returns out_path (existing or freshly built).
-    timeout bounds the grib2json subprocess when set (used for the ECMWF feed)."""
+def _native_gribjson(source, tmp, fallback=True):
+    """Encode with modules/gribjson.py when it is the configured encoder.
+    Returns False (leaving the caller to run grib2json) if it is not, or if the
+    source is one the native encoder doesn't handle. With ``fallback`` False
+    (a Field with no GRIB behind it for grib2json) it is always encoded here
+    and a failure raises."""
+    if fallback and APP_CONFIG['GRIBJSON_ENCODER'] != 'native':
+        return False
+    field = isinstance(source, fieldcache.Field)
+    try:
+        with open(tmp, 'w') as f:
+            if field:
+                gribjson.encode_field(source, f, surface_value=_GRIBJSON_SURFACE_VALUE)
+            else:
+                gribjson.encode(source, f, surface_value=_GRIBJSON_SURFACE_VALUE)
+        return True
+    except Exception as e:
+        if not fallback:
+            raise
+        name = 'field' if field else os.path.basename(source)
+        print(f'[gribjson] native encoder failed for {name}, falling back to grib2json: {e}')
+        return False
+
+
+def to_gribjson(source, out_path, timeout=None, grib=None):
+    """Convert a GRIB (or Field) to grib2json. Returns out_path (existing or
+    freshly built). Encoded in-process (modules/gribjson.py) unless
+    GRIBJSON_ENCODER is 'grib2json' or the source needs the Java tool; timeout
+    bounds the grib2json subprocess when set (used for the ECMWF feed). A Field
+    has no file for grib2json to read, so ``grib`` is a callable returning the
+    GRIB it was cut from, only called when grib2json runs; without one a Field
+    is always encoded natively."""
     if os.path.exists(out_path):
         return out_path
+    field = isinstance(source, fieldcache.Field)
     with _atomic_output(out_path) as tmp:
-        with open(tmp, 'w') as f:
-            subprocess.run(['grib2json', '--names', '--data', '--fv', '10.0', grib_path],
-                           stdout=f, text=True, timeout=timeout)
+        if not _native_gribjson(source, tmp, fallback=not field or grib is not None):
+            if field:
+                source = grib()
+            with open(tmp, 'w') as f:
+                subprocess.run(['grib2json', '--names', '--data', '--fv', str(_GRIBJSON_SURFACE_VALUE),
+                                source], stdout=f, text=True, timeout=timeout)
     print('Created', out_path)
+    if os.path.exists(out_path):
+        _write_compressed_siblings(out_path)
     return out_path
 
 
-def to_geotiff(grib_path, out_path):
-    """Reproject a GRIB to an EPSG:3857 GeoTIFF. Returns out_path."""
+def _write_compressed_siblings(path):
+    """Write ``path + '.gz'`` (and ``.br`` when brotli is installed) next to a
+    freshly published file, each streamed through its own atomic temp so a reader
+    never sees a partial sibling. manage_cache evicts siblings with their parent."""
+    with _atomic_output(path + '.gz') as tmp:
+        # mtime=0 keeps the gzip header (and so the bytes) reproducible.
+        with open(path, 'rb') as src, gzip.GzipFile(tmp, 'wb', _GZIP_LEVEL, mtime=0) as dst:
+            shutil.copyfileobj(src, dst, _COPY_CHUNK)
+    if brotli is None:
+        return
+    with _atomic_output(path + '.br') as tmp:
+        compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=_BROTLI_QUALITY)
+        with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            for chunk in iter(lambda: src.read(_COPY_CHUNK), b''):
+                dst.write(compressor.process(chunk))
+            dst.write(compressor.finish())
+
+
+def to_geotiff(source, out_path):
+    """Reproject a GRIB (or Field) to an EPSG:3857 GeoTIFF. Returns out_path."""
     if os.path.exists(out_path):
         return out_path
     with _atomic_output(out_path) as tmp:
-        subprocess.run(['gdalwarp', '-of', 'GTiff', '-t_srs', 'EPSG:3857', grib_path, tmp])
+        if isinstance(source, fieldcache.Field):
+            _warp_field(source, tmp)
+        else:
+            subprocess.run(['gdalwarp', '-of', 'GTiff', '-t_srs', 'EPSG:3857', source, tmp])
     print('Created', out_path)
     return out_path
 
 
-def to_png(grib_path, out_path, product):
-    """Render a GRIB to a colorized PNG visualization. Returns out_path."""
+def _warp_field(field, output_file):
+    """gdalwarp -t_srs EPSG:3857 for a Field, in-process: same default output
+    grid (GDALSuggestedWarpOutput) and nearest resampling, NaN as nodata."""
+    count, height, width = field.data.shape
+    src_crs = field.grid['crs'] or 'EPSG:4326'
+    src_transform = fieldcache.transform(field)
+    dst_transform, dst_width, dst_height = rasterio.warp.calculate_default_transform(
+        src_crs, 'EPSG:3857', width, height,
+        *rasterio.transform.array_bounds(height, width, src_transform))
+    profile = dict(driver='GTiff', width=dst_width, height=dst_height, count=count,
+                   dtype='float32', crs='EPSG:3857', transform=dst_transform, nodata=np.nan)
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for i in range(count):
+            band = np.full((dst_height, dst_width), np.nan, dtype=np.float32)
+            rasterio.warp.reproject(np.asarray(field.data[i]), band,
+                                    src_transform=src_transform, src_crs=src_crs, src_nodata=np.nan,
+                                    dst_transform=dst_transform, dst_crs='EPSG:3857', dst_nodata=np.nan,
+                                    resampling=rasterio.warp.Resampling.nearest)
+            dst.write(band, i + 1)
+
+
+def to_png(source, out_path, product):
+    """Render a GRIB (or Field) to a colorized PNG visualization. Returns out_path."""
     if os.path.exists(out_path):
         return out_path
     with _atomic_output(out_path) as tmp:
-        _create_png(grib_path, tmp, product)
+        _create_png(source, tmp, product)
+    print('Created', out_path)
+    return out_path
+
+
+def to_legend(source, out_path, product):
+    """Render the color legend of the product's fast PNG (same limits) as a
+    small PNG of its own. Returns out_path."""
+    if os.path.exists(out_path):
+        return out_path
+    values, cmap_info = _png_values(source, product)
+    vmin, vmax = render.color_limits(values, cmap_info)
+    if cmap_info.get('log', False):
+        norm = matplotlib.colors.LogNorm(vmin=vmin, vmax=vmax)
+    else:
+        norm = matplotlib.colors.Normalize(vmin=vmin, vmax=vmax)
+    with _atomic_output(out_path) as tmp:
+        fig = Figure(figsize=(6, 1.1), dpi=100)
+        FigureCanvasAgg(fig)
+        cax = fig.add_axes([0.05, 0.55, 0.9, 0.3])
+        _add_colorbar(fig, norm, matplotlib.colormaps[cmap_info['cmap']], cmap_info,
+                      cax=cax, orientation='horizontal')
+        fig.savefig(tmp, format='png', transparent=True)
     print('Created', out_path)
     return out_path
 
@@ -61,19 +187,69 @@ def to_png(grib_path, out_path, product):
 def to_cog(grib_path, out_path, product):
     """Produce the EPSG:3857 Cloud-Optimized GeoTIFF. Returns out_path (existing or
     freshly built); published atomically. The expensive download+build is serialized
-    by the caller's lock (process_data.ensure_cog); this stays a pure producer."""
+    by the caller's lock (process_data.ensure_cog); this stays a pure producer.
+    Built in-process unless COG_BUILDER is 'gdal' (the gdalwarp/gdaladdo/
+    gdal_translate pipeline)."""
     if os.path.exists(out_path):
         return out_path
     with _atomic_output(out_path) as tmp:
-        _create_cog(grib_path, tmp, product)
+        if APP_CONFIG['COG_BUILDER'] == 'gdal':
+            _create_cog(grib_path, tmp, product)
+        else:
+            _create_cog_native(grib_path, tmp, product)
     print(f'Created COG {out_path}')
     return out_path
 
 
+def _derive_cog_bands(bands, product):
+    """The COG's bands from the warped source bands (NODATA where empty): u, v and
+    speed for winds, kg/m^3 -> µg/m^3 for smoke, the band as-is otherwise."""
+    if product == 'winds':
+        u = bands[0]
+        v = bands[1] if len(bands) >= 2 else np.zeros_like(u)
+        mask = (u == NODATA) | (v == NODATA)
+        speed = np.sqrt(u**2 + v**2)
+        for band in (u, v, speed):
+            band[mask] = NODATA
+        return [u, v, speed]
+    band = bands[0]
+    if product == 'smoke_massden':
+        # HRRR near-surface smoke (MASSDEN) is native kg/m^3; convert to the
+        # conventional µg/m^3 to make it interpretable with other pm 2.5 products.
+        mask = band == NODATA
+        band = band * 1e9
+        band[mask] = NODATA
+    return [band]
+
+
+def _create_cog_native(grib_path, output_file, product):
+    """The COG in one pass: gather each band onto gdalwarp's default EPSG:3857
+    grid through the nearest-neighbour lookup table of modules.regrid (built
+    once per source grid, kept under ``luts/`` next to the COG), derive the
+    product bands, and write through GDAL's COG driver, which builds the
+    nearest-neighbour overviews and compresses on all cores. Nothing but the
+    COG touches the disk."""
+    lut_dir = os.path.join(os.path.dirname(os.path.abspath(output_file)), regrid.LUT_SUBDIR)
+    with rasterio.open(grib_path) as src:
+        dst_crs = 'EPSG:3857'
+        index, transform, width, height = regrid.mercator_table(src.crs, src.transform, src.shape, lut_dir)
+        warped = [regrid.nearest(src.read(i, masked=True).astype(np.float32).filled(np.nan), index, NODATA)
+                  for i in range(1, src.count + 1)]
+    bands = _derive_cog_bands(warped, product)
+    names = list(WINDS_BAND_COLORMAPS) if product == 'winds' else [product]
+    profile = dict(driver='COG', width=width, height=height, count=len(bands), dtype='float32',
+                   crs=dst_crs, transform=transform, nodata=NODATA, **_COG_OPTIONS)
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for i, (band, name) in enumerate(zip(bands, names), start=1):
+            dst.write(band, i)
+            dst.set_band_description(i, name)
+
+
 def _create_cog(grib_path, output_file, product):
-    """Reproject a GRIB to EPSG:3857, derive bands (u/v/speed for winds, kg/m^3 ->
-    µg/m^3 for smoke), build overviews, and write the COG to output_file. Manages
-    its own intermediate raster (confined to output_file's dir, S8707)."""
+    """The gdal command-line COG build (COG_BUILDER=gdal): reproject a GRIB to
+    EPSG:3857, derive bands (u/v/speed for winds, kg/m^3 -> µg/m^3 for smoke),
+    build overviews, and write the COG to output_file. Manages its own
+    intermediate raster (confined to output_file's dir, S8707)."""
     base = os.path.dirname(output_file)
     stem = os.path.basename(output_file)
     uid = f'{os.getpid()}-{threading.get_ident()}'
@@ -88,42 +264,18 @@ def _create_cog(grib_path, output_file, product):
             grib_path, tmp_tif
         ], check=True)
 
-        if product == 'winds':
-            tmp_uvs = _safe_path(base, f'{stem}-uvs-{uid}.tif')
+        if product in ('winds', 'smoke_massden'):
+            tmp_derived = _safe_path(base, f'{stem}-derived-{uid}.tif')
             with rasterio.open(tmp_tif) as src:
-                u = src.read(1).astype(np.float32)
-                v = src.read(2).astype(np.float32) if src.count >= 2 else np.zeros_like(u)
-                nodata = src.nodata
-                mask = (u == nodata) | (v == nodata) if nodata is not None else np.zeros_like(u, dtype=bool)
-                speed = np.sqrt(u**2 + v**2)
-                u[mask] = NODATA
-                v[mask] = NODATA
-                speed[mask] = NODATA
+                bands = list(src.read().astype(np.float32))  # nodata is -dstnodata (NODATA)
                 profile = src.profile.copy()
-            profile.update(count=3, nodata=NODATA)
-            with rasterio.open(tmp_uvs, 'w', **profile) as dst:
-                dst.write(u, 1)
-                dst.write(v, 2)
-                dst.write(speed, 3)
+            bands = _derive_cog_bands(bands, product)
+            profile.update(count=len(bands), nodata=NODATA)
+            with rasterio.open(tmp_derived, 'w', **profile) as dst:
+                for i, band in enumerate(bands, start=1):
+                    dst.write(band, i)
             os.remove(tmp_tif)
-            os.rename(tmp_uvs, tmp_tif)
-
-        elif product == 'smoke_massden':
-            # HRRR near-surface smoke (MASSDEN) is native kg/m^3; convert to the
-            # conventional µg/m^3 to make it interpretable with other pm 2.5 products.
-            tmp_scaled = _safe_path(base, f'{stem}-scaled-{uid}.tif')
-            with rasterio.open(tmp_tif) as src:
-                band = src.read(1).astype(np.float32)
-                nodata = src.nodata
-                mask = (band == nodata) if nodata is not None else np.zeros_like(band, dtype=bool)
-                band = band * 1e9
-                band[mask] = NODATA
-                profile = src.profile.copy()
-            profile.update(count=1, nodata=NODATA)
-            with rasterio.open(tmp_scaled, 'w', **profile) as dst:
-                dst.write(band, 1)
-            os.remove(tmp_tif)
-            os.rename(tmp_scaled, tmp_tif)
+            os.rename(tmp_derived, tmp_tif)
 
         # Label bands so the COG is self-describing for downstream consumers
         # (gdal_translate carries these descriptions through into the final COG).
@@ -148,37 +300,43 @@ def _create_cog(grib_path, output_file, product):
             os.remove(tmp_tif)
 
 
-def _create_png(grib_file, output_file, product):
+def _png_values(source, product):
+    """(values, cmap_info): the field a product's PNG is colored by, scaled to
+    display units -- speed for winds, else the first band -- with NaN where the
+    GRIB has no value."""
     cmap_info = HRRR_PRODUCTS.get(product, {'cmap': 'viridis', 'label': product})
+    # Bands straight from the decoded field; a GRIB path is decoded in-process.
+    field = fieldcache.as_field(source)
+    if product == 'winds' and len(field.bands) >= 2:
+        values = np.hypot(field.data[0], field.data[1])
+    else:
+        values = np.asarray(field.data[0], dtype=np.float32)
+    scale = cmap_info.get('scale', 1)
+    if scale != 1:
+        values = values * np.float32(scale)
+    return values, cmap_info
 
-    # Convert GRIB2 to GeoTIFF first (temp file confined to the output dir, S8707).
-    # The uid keeps concurrent renders of the same product from sharing one temp.
-    uid = f'{os.getpid()}-{threading.get_ident()}'
-    tmp_tif = _safe_path(os.path.dirname(output_file),
-                         f'{os.path.basename(output_file)}-{uid}_tmp.tif')
-    subprocess.run(['gdal_translate', '-of', 'GTiff', grib_file, tmp_tif], check=True)
-
-    with rasterio.open(tmp_tif) as src:
-        nodata = src.nodata
-        if product == 'winds' and src.count >= 2:
-            u = src.read(1).astype(float)
-            v = src.read(2).astype(float)
-            if nodata is not None:
-                u = np.where(u == nodata, np.nan, u)
-                v = np.where(v == nodata, np.nan, v)
-            data = np.sqrt(u**2 + v**2)
-        else:
-            data = src.read(1).astype(float)
-            if nodata is not None:
-                data = np.where(data == nodata, np.nan, data)
 
-    os.remove(tmp_tif)
+def _create_png(source, output_file, product):
+    """The PNG the configured PNG_RENDERER draws: the field itself through the
+    colormap's lookup table (fast), or a matplotlib figure with title and
+    colorbar (matplotlib)."""
+    if APP_CONFIG['PNG_RENDERER'] == 'matplotlib':
+        return _create_png_figure(source, output_file, product)
+    values, cmap_info = _png_values(source, product)
+    vmin, vmax = render.color_limits(values, cmap_info)
+    rgba = render.colorize(values, cmap_info['cmap'], vmin, vmax, log=cmap_info.get('log', False))
+    with open(output_file, 'wb') as f:
+        f.write(render.encode_png(rgba, {render.LEGEND_TEXT_KEY: render.legend_text(cmap_info, vmin, vmax)}))
 
-    scale = cmap_info.get('scale', 1)
-    data = data * scale
 
-    vmin = cmap_info['vmin'] if 'vmin' in cmap_info else np.nanpercentile(data, 2)
-    vmax = cmap_info['vmax'] if 'vmax' in cmap_info else np.nanpercentile(data, 98)
+def _create_png_figure(source, output_file, product):
+    """PNG_RENDERER=matplotlib: the field drawn in a 12x6in figure with its
+    title and a colorbar."""
+    values, cmap_info = _png_values(source, product)
+    data = values.astype(float)
+
+    vmin, vmax = render.color_limits(data, cmap_info)
     if cmap_info.get('log', False):
         data = np.where(data <= 0, np.nan, data)
         norm = matplotlib.colors.LogNorm(vmin=vmin, vmax=vmax)
@@ -196,15 +354,23 @@ def _create_png(grib_file, output_file, product):
     FigureCanvasAgg(fig)
     ax = fig.subplots()
     ax.imshow(rgba, aspect='auto')
-    sm = matplotlib.cm.ScalarMappable(cmap=cmap, norm=norm)
-    sm.set_array([])
-    cb = fig.colorbar(sm, ax=ax, label=cmap_info['label'], shrink=0.8)
-    if cmap_info.get('log', False):
-        cb.ax.yaxis.set_major_formatter(matplotlib.ticker.ScalarFormatter())
-        cb.ax.yaxis.set_minor_formatter(matplotlib.ticker.NullFormatter())
+    _add_colorbar(fig, norm, cmap, cmap_info, ax=ax, shrink=0.8)
     ax.set_title(cmap_info['label'])
     ax.axis('off')
     fig.tight_layout()
     # output_file is the atomic-write temp path ending in .tmp, so matplotlib can't
     # infer the image type from the extension; state it explicitly.
     fig.savefig(output_file, format='png', dpi=150, bbox_inches='tight', transparent=False)
+
+
+def _add_colorbar(fig, norm, cmap, cmap_info, **kwargs):
+    """A labelled colorbar for ``norm``/``cmap``; kwargs go to fig.colorbar.
+    Log scales get plain-number ticks."""
+    sm = matplotlib.cm.ScalarMappable(cmap=cmap, norm=norm)
+    sm.set_array([])
+    cb = fig.colorbar(sm, label=cmap_info['label'], **kwargs)
+    if cmap_info.get('log', False):
+        axis = cb.ax.xaxis if kwargs.get('orientation') == 'horizontal' else cb.ax.yaxis
+        axis.set_major_formatter(matplotlib.ticker.ScalarFormatter())
+        axis.set_minor_formatter(matplotlib.ticker.NullFormatter())
+    return cb
@@ -0,0 +1,246 @@
+"""Decoded GRIB fields kept on disk as memory-mapped float32 arrays.
+
+The regridded HRRR field is written as a ``.field`` file (modules.regrid), and
+every projwin after that is a slice of the mapped array handed straight to the
+format producers -- no wgrib2 ``-small_grib`` run and no subset GRIB per box.
+:func:`load` decodes any other GRIB the same way.
+All gunicorn workers map the same file, so they share one copy in the page
+cache.
+
+A ``.field`` file is ``b'VFLD'``, the header length as a little-endian uint32,
+a UTF-8 JSON header (space-padded so the array starts 64-byte aligned), then a
+little-endian float32 ``(bands, ny, nx)`` array, NaN where the GRIB has no
+value. Rows run north to south and columns west to east, whatever the GRIB's
+scan order. The header holds the grid (pixel centers, in the GRIB's own
+longitudes: 0-360 grids are not rotated), the CRS, and per band the GDAL GRIB
+tags plus the gribjson header of its message, so every producer can work from
+the array alone.
+"""
+import os
+import json
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import rasterio
+
+from modules import gribjson
+from modules.concurrency import _atomic_output
+
+MAGIC = b'VFLD'
+EXT_FIELD = '.field'
+
+# Bump when the layout or header changes; files with another version are rebuilt.
+FORMAT_VERSION = 1
+
+_ALIGN = 64
+
+# GDAL band tags the producers read (windfield picks bands and times by them).
+_TAGS = ('GRIB_ELEMENT', 'GRIB_SHORT_NAME', 'GRIB_REF_TIME', 'GRIB_VALID_TIME',
+         'GRIB_FORECAST_SECONDS', 'GRIB_UNIT', 'GRIB_COMMENT')
+
+# Grid points this close (degrees) to a projwin edge count as inside it.
+_EDGE_EPS = 1e-6
+
+# Mapped fields kept open per process. A mapping costs address space, not
+# memory, so this only bounds open descriptors.
+_OPEN_MAX = 32
+
+# ``data``: (bands, ny, nx) float32, north-up. ``grid``: nx, ny, lo1/la1 (the
+# north-west pixel center), dx, dy and crs. ``bands``: one dict per band with
+# ``tags`` and ``header`` (None where gribjson can't read the message).
+Field = namedtuple('Field', 'data grid bands')
+
+_open = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def field_path(grib_path):
+    """The ``.field`` file kept next to a GRIB."""
+    return os.path.splitext(grib_path)[0] + EXT_FIELD
+
+
+def read_grib(grib_path):
+    """Decode a GRIB into an in-memory :class:`Field`."""
+    try:
+        headers = gribjson._headers(grib_path)
+    except (gribjson.UnsupportedGrib, OSError, IndexError, ValueError):
+        headers = None
+    # Keep 0-360 grids as published; GDAL would otherwise rotate them.
+    with rasterio.Env(GRIB_ADJUST_LONGITUDE_RANGE='NO'):
+        with rasterio.open(grib_path) as src:
+            data = src.read(masked=True).astype(np.float32).filled(np.nan)
+            tags = [src.tags(i) for i in range(1, src.count + 1)]
+            t, crs = src.transform, src.crs
+    grid = {
+        'nx': data.shape[2], 'ny': data.shape[1],
+        'lo1': t.c + t.a / 2, 'la1': t.f + t.e / 2,
+        'dx': abs(t.a), 'dy': abs(t.e),
+        'crs': crs.to_wkt() if crs else None,
+    }
+    return Field(data, grid, band_info(tags, headers))
+
+
+def band_info(tags, headers):
+    """The ``bands`` of a :class:`Field`: per band the GDAL tags the producers
+    read and its gribjson header. ``tags`` is the list of each band's GDAL
+    tags; ``headers`` the gribjson headers, or None (all headers are then None,
+    as they are when there isn't one per band)."""
+    if headers is not None and len(headers) != len(tags):
+        headers = None
+    return [{'tags': {k: tag[k] for k in _TAGS if k in tag},
+             'header': _plain(headers[i]) if headers else None}
+            for i, tag in enumerate(tags)]
+
+
+def as_field(source):
+    """``source`` itself if it is a :class:`Field`, else the GRIB at that path
+    decoded with :func:`read_grib`."""
+    return source if isinstance(source, Field) else read_grib(source)
+
+
+def _plain(header):
+    """A gribjson header with numpy scalars turned into JSON-serializable ones."""
+    return {k: v.item() if isinstance(v, np.generic) else v for k, v in header.items()}
+
+
+def write(field, out_path):
+    """Publish ``field`` as a ``.field`` file (atomically). Returns out_path."""
+    header = {'version': FORMAT_VERSION, 'shape': list(field.data.shape),
+              'grid': field.grid, 'bands': field.bands}
+    text = json.dumps(header, separators=(',', ':')).encode()
+    text += b' ' * (-(len(MAGIC) + 4 + len(text)) % _ALIGN)
+    with _atomic_output(out_path) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + len(text).to_bytes(4, 'little') + text)
+            f.write(np.ascontiguousarray(field.data, dtype='<f4').tobytes())
+    return out_path
+
+
+def _map(path):
+    """Map a ``.field`` file read-only. Raises ValueError if it isn't one."""
+    with open(path, 'rb') as f:
+        prefix = f.read(8)
+        if prefix[:4] != MAGIC:
+            raise ValueError(f'{os.path.basename(path)} is not a field file')
+        size = int.from_bytes(prefix[4:8], 'little')
+        header = json.loads(f.read(size))
+    if header.get('version') != FORMAT_VERSION:
+        raise ValueError(f'{os.path.basename(path)} has field format {header.get("version")}')
+    data = np.memmap(path, dtype='<f4', mode='r', offset=8 + size, shape=tuple(header['shape']))
+    return Field(data, header['grid'], header['bands'])
+
+
+def open_field(path):
+    """Map an existing ``.field`` file as a :class:`Field`. Mappings are reused
+    within the process until the file is replaced (or evicted and rebuilt).
+    Raises FileNotFoundError if it is missing and ValueError if it isn't a
+    field file of this version."""
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns)
+    with _open_lock:
+        cached = _open.get(path)
+        if cached is not None and cached[0] == key:
+            _open.move_to_end(path)
+            return cached[1]
+    field = _map(path)
+    with _open_lock:
+        _open[path] = (key, field)
+        while len(_open) > _OPEN_MAX:
+            _open.popitem(last=False)
+    return field
+
+
+def load(grib_path):
+    """The memory-mapped :class:`Field` for a GRIB, decoding it into its
+    ``.field`` file first on a miss."""
+    path = field_path(grib_path)
+    if not os.path.exists(path):
+        write(read_grib(grib_path), path)
+        print('Created', path)
+    try:
+        return open_field(path)
+    except ValueError as e:
+        # An older layout (or a foreign file): rebuild it in place.
+        print(f'[field] rebuilding {os.path.basename(path)}: {e}')
+        os.remove(path)
+        return load(grib_path)
+
+
+def _index_range(first, step, count, lo, hi):
+    """[start, stop) of the grid indices whose coordinate ``first + i*step``
+    lies in [lo, hi]."""
+    start = int(np.ceil((lo - first) / step - _EDGE_EPS))
+    stop = int(np.floor((hi - first) / step + _EDGE_EPS)) + 1
+    return max(start, 0), min(stop, count)
+
+
+def _periodic(grid):
+    """True if the grid's columns go all the way round the globe."""
+    return abs(grid['nx'] * grid['dx'] - 360) < grid['dx'] / 2
+
+
+def subset(field, projwin):
+    """The part of ``field`` inside ``projwin`` ([ulx, uly, lrx, lry], lon/lat)
+    as a view of the same array: every grid point in the box, edges included,
+    the way ``wgrib2 -small_grib`` picks them. Longitudes are matched in the
+    grid's own convention. On a global grid a box running past its east edge
+    continues from the west edge, as the NOMADS filter cuts it (longitudes
+    past lo1 + 360 in the header), and so does one whose east edge is west
+    of its west edge (170..-170); that slice is a copy. On a regional grid
+    the box is clipped to the grid. Raises ValueError when no grid point is
+    inside."""
+    grid = field.grid
+    west, north, east, south = (float(v) for v in projwin)
+    periodic = _periodic(grid)
+    if periodic:
+        # Shift the box into [lo1, lo1 + 360) so -180..180 requests meet 0-360 grids.
+        shift = grid['lo1'] + (west - grid['lo1']) % 360 - west
+    else:
+        # Whole turns only, centering the box on the grid; _index_range clips it.
+        middle = grid['lo1'] + (grid['nx'] - 1) * grid['dx'] / 2
+        shift = 360 * round((middle - (west + east) / 2) / 360)
+    west, east = west + shift, east + shift
+    if periodic and east < west:
+        # A box across the antimeridian, e.g. 170..-170: its east edge is a turn on.
+        east += 360
+    c0, c1 = _index_range(grid['lo1'], grid['dx'], grid['nx'], west, east)
+    r0, r1 = _index_range(-grid['la1'], grid['dy'], grid['ny'], -north, -south)
+    wrap = 0
+    if periodic:
+        # Columns of the next turn round, never repeating one already taken.
+        wrap = min(max(_index_range(grid['lo1'] + 360, grid['dx'], grid['nx'], west, east)[1], 0), c0)
+    if c0 >= c1 or r0 >= r1:
+        raise ValueError(f'projwin {",".join(str(v) for v in projwin)} does not overlap the grid')
+    sub = dict(grid, nx=c1 - c0 + wrap, ny=r1 - r0,
+               lo1=grid['lo1'] + c0 * grid['dx'], la1=grid['la1'] - r0 * grid['dy'])
+    data = field.data[:, r0:r1, c0:c1]
+    if wrap:
+        data = np.concatenate([data, field.data[:, r0:r1, :wrap]], axis=2)
+    return Field(data, sub, field.bands)
+
+
+def sample(field, lats, lons):
+    """The values of ``field`` at the grid point nearest each (lat, lon), for any
+    number of points at once: ``(values, grid_lats, grid_lons)``, values being
+    (bands, points) float32. Points off the grid are NaN throughout. On a mapped
+    field only the pages holding those grid points are read."""
+    grid = field.grid
+    lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+    # Offset from lo1 in [-dx/2, 360 - dx/2), so either longitude convention works.
+    east = (lons - grid['lo1'] + grid['dx'] / 2) % 360 - grid['dx'] / 2
+    cols = np.rint(east / grid['dx']).astype(np.int64)
+    rows = np.rint((grid['la1'] - lats) / grid['dy']).astype(np.int64)
+    inside = (rows >= 0) & (rows < grid['ny']) & (cols >= 0) & (cols < grid['nx'])
+    values = np.array(field.data[:, np.where(inside, rows, 0), np.where(inside, cols, 0)], dtype=np.float32)
+    values[:, ~inside] = np.nan
+    grid_lats = np.where(inside, grid['la1'] - rows * grid['dy'], np.nan)
+    grid_lons = np.where(inside, (grid['lo1'] + cols * grid['dx'] + 180) % 360 - 180, np.nan)
+    return values, grid_lats, grid_lons
+
+
+def transform(field):
+    """The rasterio affine transform (pixel corners) of a :class:`Field`."""
+    grid = field.grid
+    return rasterio.transform.from_origin(grid['lo1'] - grid['dx'] / 2, grid['la1'] + grid['dy'] / 2,
+                                          grid['dx'], grid['dy'])
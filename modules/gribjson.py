@@ -0,0 +1,394 @@
+"""In-process gribjson encoder: the JSON the grib2json tool writes, without the JVM.
+
+grib2json prints, for every GRIB2 message that passes its filters, a record
+``{"header": {...}, "data": [...]}`` where the header is the message's
+identification / product / grid sections (with --names, each code also spelled
+out) and ``data`` is every grid value in the message's own scan order. The
+velocity clients read the header keys (parameterCategory/Number, nx/ny,
+lo1/la1, dx/dy, refTime, ...) and index ``data`` with them.
+
+The header fields come from parsing sections 0, 1, 3 and 4 of each message
+directly, so they are the message's own values rather than GDAL's
+interpretation. The values are decoded by GDAL's GRIB driver (rasterio), which
+handles every packing the feeds use, then put back into the message's scan
+order. Floats are written the way Java prints a float (shortest round-trip
+digits, "10.0", "1.0E-4"), formatted once per distinct value: GRIB packing
+quantizes a field to a few thousand distinct values, so the bulk of the text is
+a table lookup rather than millions of float->str calls.
+
+:func:`encode_field` writes the same records from a modules.fieldcache Field,
+so a projwin slice of a mapped field is encoded without cutting a GRIB for it.
+
+Only what our feeds produce is supported: GRIB2, a regular lat/lon grid
+(template 3.0) and product templates that start like 4.0 (0, 1, 8, 11). Anything
+else raises :class:`UnsupportedGrib`, and convert.to_gribjson falls back to the
+grib2json tool.
+"""
+import json
+import struct
+import datetime
+
+import numpy as np
+import rasterio
+
+# grib2json's record layout, in its key order.
+HEADER_KEYS = (
+    'discipline', 'disciplineName', 'gribEdition', 'gribLength', 'center', 'centerName',
+    'subcenter', 'refTime', 'significanceOfRT', 'significanceOfRTName', 'productStatus',
+    'productStatusName', 'productType', 'productTypeName', 'productDefinitionTemplate',
+    'productDefinitionTemplateName', 'parameterCategory', 'parameterCategoryName',
+    'parameterNumber', 'parameterNumberName', 'parameterUnit', 'genProcessType',
+    'genProcessTypeName', 'forecastTime', 'surface1Type', 'surface1TypeName', 'surface1Value',
+    'surface2Type', 'surface2TypeName', 'surface2Value', 'gridDefinitionTemplate',
+    'gridDefinitionTemplateName', 'numberPoints', 'shape', 'shapeName', 'gridUnits',
+    'resolution', 'winds', 'scanMode', 'nx', 'ny', 'basicAngle', 'subDivisions',
+    'lo1', 'la1', 'lo2', 'la2', 'dx', 'dy',
+)
+
+# Code-table names (--names) for the codes our feeds use. Unlisted codes are
+# written as 'Unknown' rather than failing the conversion.
+_DISCIPLINES = {0: 'Meteorological products', 10: 'Oceanographic products'}
+_CENTERS = {7: 'US National Weather Service - NCEP(WMC)',
+            98: 'European Centre for Medium-Range Weather Forecasts (RSMC)'}
+_REF_TIME_SIGNIFICANCE = {0: 'Analysis', 1: 'Start of forecast',
+                          2: 'Verifying time of forecast', 3: 'Observation time'}
+_PRODUCT_STATUS = {0: 'Operational products', 1: 'Operational test products',
+                   2: 'Research products', 3: 'Re-analysis products'}
+_PRODUCT_TYPES = {0: 'Analysis products', 1: 'Forecast products',
+                  2: 'Analysis and forecast products', 3: 'Control forecast products',
+                  4: 'Perturbed forecast products', 5: 'Control and perturbed forecast products'}
+_PRODUCT_TEMPLATES = {
+    0: 'Analysis/forecast at horizontal level/layer at a point in time',
+    1: 'Individual ensemble forecast, control and perturbed, at a horizontal level or in a '
+       'horizontal layer at a point in time',
+    8: 'Average, accumulation, extreme values or other statistically processed values at a '
+       'horizontal level or in a horizontal layer in a continuous or non-continuous time interval',
+    11: 'Individual ensemble forecast, control and perturbed, at a horizontal level or in a '
+        'horizontal layer, in a continuous or non-continuous time interval',
+}
+# (discipline, category) -> name; (discipline, category, number) -> (name, unit)
+_CATEGORIES = {(0, 0): 'Temperature', (0, 1): 'Moisture', (0, 2): 'Momentum',
+               (0, 3): 'Mass', (0, 6): 'Cloud', (0, 7): 'Thermodynamic stability indices'}
+_PARAMETERS = {
+    (0, 0, 0): ('Temperature', 'K'),
+    (0, 1, 1): ('Relative_humidity', '%'),
+    (0, 2, 1): ('Wind_speed', 'm.s-1'),
+    (0, 2, 2): ('U-component_of_wind', 'm.s-1'),
+    (0, 2, 3): ('V-component_of_wind', 'm.s-1'),
+    (0, 2, 22): ('Wind_speed_gust', 'm.s-1'),
+    (0, 3, 0): ('Pressure', 'Pa'),
+    (0, 3, 1): ('Pressure_reduced_to_MSL', 'Pa'),
+}
+_GEN_PROCESS = {0: 'Analysis', 1: 'Initialization', 2: 'Forecast', 3: 'Bias corrected forecast',
+                4: 'Ensemble forecast'}
+_SURFACES = {1: 'Ground or water surface', 100: 'Isobaric surface', 101: 'Mean sea level',
+             103: 'Specified height level above ground', 255: 'Missing'}
+_SHAPES = {
+    0: 'Earth spherical with radius = 6,367,470.0 m',
+    1: 'Earth spherical with radius specified by producer',
+    2: 'Earth oblate spheroid with size as determined by IAU in 1965',
+    4: 'Earth oblate spheroid as defined in IAG-GRS80 model',
+    5: 'Earth assumed represented by WGS84 (as used by ICAO since 1998)',
+    6: 'Earth spherical with radius of 6,371,229.0 m',
+}
+_UNKNOWN = 'Unknown'
+
+# Product templates whose octets 10-34 follow template 4.0.
+_PRODUCT_TEMPLATES_LIKE_4_0 = (0, 1, 8, 11)
+
+# Scanning-mode flags (code table 3.4).
+_SCAN_I_NEGATIVE = 0x80
+_SCAN_J_POSITIVE = 0x40
+_SCAN_J_CONSECUTIVE = 0x20
+
+_MISSING_U32 = 0xFFFFFFFF
+
+
+class UnsupportedGrib(ValueError):
+    """The file uses something this encoder doesn't implement; use grib2json."""
+
+
+def _signed(raw, bits):
+    """GRIB2 signed integers are sign-and-magnitude, not two's complement."""
+    sign = 1 << (bits - 1)
+    return -(raw & (sign - 1)) if raw & sign else raw
+
+
+def _scaled(scale, value):
+    """A GRIB2 (scale factor, scaled value) pair as a float."""
+    if value == _MISSING_U32 or scale == 0xFF:
+        return 0.0
+    return _signed(value, 32) / 10.0 ** _signed(scale, 8)
+
+
+def java_float(value):
+    """How Java's Float.toString prints ``value`` (a float32): the shortest
+    digits that round-trip, at least one fractional digit, and E notation
+    outside [1e-3, 1e7)."""
+    value = np.float32(value)
+    if value == 0:
+        return '-0.0' if np.signbit(value) else '0.0'
+    if 1e-3 <= abs(value) < 1e7:
+        return np.format_float_positional(value, unique=True, trim='0')
+    mantissa, exponent = np.format_float_scientific(value, unique=True, trim='0').split('e')
+    return f'{mantissa}E{int(exponent)}'
+
+
+def _messages(blob):
+    """Yield each GRIB2 message of a file as ``(offset, {section number: bytes})``."""
+    pos = 0
+    while True:
+        pos = blob.find(b'GRIB', pos)
+        if pos < 0:
+            return
+        edition = blob[pos + 7]
+        if edition != 2:
+            raise UnsupportedGrib(f'GRIB edition {edition} (only GRIB2 is supported)')
+        length = struct.unpack_from('>Q', blob, pos + 8)[0]
+        sections, at, end = {0: blob[pos:pos + 16]}, pos + 16, pos + length
+        while at < end - 4:
+            size, number = struct.unpack_from('>IB', blob, at)
+            sections[number] = blob[at:at + size]
+            at += size
+        yield pos, sections
+        pos = end
+
+
+def _identification(sec0, sec1):
+    discipline = sec0[6]
+    center, subcenter = struct.unpack_from('>HH', sec1, 5)
+    significance = sec1[11]
+    year, month, day, hour, minute, second = struct.unpack_from('>HBBBBB', sec1, 12)
+    status, kind = sec1[19], sec1[20]
+    ref = datetime.datetime(year, month, day, hour, minute, second)
+    return {
+        'discipline': discipline,
+        'disciplineName': _DISCIPLINES.get(discipline, _UNKNOWN),
+        'gribEdition': sec0[7],
+        'gribLength': struct.unpack_from('>Q', sec0, 8)[0],
+        'center': center,
+        'centerName': _CENTERS.get(center, _UNKNOWN),
+        'subcenter': subcenter,
+        'refTime': ref.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'significanceOfRT': significance,
+        'significanceOfRTName': _REF_TIME_SIGNIFICANCE.get(significance, _UNKNOWN),
+        'productStatus': status,
+        'productStatusName': _PRODUCT_STATUS.get(status, _UNKNOWN),
+        'productType': kind,
+        'productTypeName': _PRODUCT_TYPES.get(kind, _UNKNOWN),
+    }
+
+
+def _product(discipline, sec4):
+    template = struct.unpack_from('>H', sec4, 7)[0]
+    if template not in _PRODUCT_TEMPLATES_LIKE_4_0:
+        raise UnsupportedGrib(f'product definition template 4.{template}')
+    category, number, process = sec4[9], sec4[10], sec4[11]
+    forecast_time = struct.unpack_from('>I', sec4, 18)[0]
+    s1_type, s1_scale, s1_value = struct.unpack_from('>BBI', sec4, 22)
+    s2_type, s2_scale, s2_value = struct.unpack_from('>BBI', sec4, 28)
+    name, unit = _PARAMETERS.get((discipline, category, number), (_UNKNOWN, _UNKNOWN))
+    return {
+        'productDefinitionTemplate': template,
+        'productDefinitionTemplateName': _PRODUCT_TEMPLATES[template],
+        'parameterCategory': category,
+        'parameterCategoryName': _CATEGORIES.get((discipline, category), _UNKNOWN),
+        'parameterNumber': number,
+        'parameterNumberName': name,
+        'parameterUnit': unit,
+        'genProcessType': process,
+        'genProcessTypeName': _GEN_PROCESS.get(process, _UNKNOWN),
+        'forecastTime': forecast_time,
+        'surface1Type': s1_type,
+        'surface1TypeName': _SURFACES.get(s1_type, _UNKNOWN),
+        'surface1Value': _scaled(s1_scale, s1_value),
+        'surface2Type': s2_type,
+        'surface2TypeName': _SURFACES.get(s2_type, _UNKNOWN),
+        'surface2Value': _scaled(s2_scale, s2_value),
+    }
+
+
+def _grid(sec3):
+    template = struct.unpack_from('>H', sec3, 12)[0]
+    if template != 0:
+        raise UnsupportedGrib(f'grid definition template 3.{template}')
+    points = struct.unpack_from('>I', sec3, 6)[0]
+    shape = sec3[14]
+    nx, ny, basic_angle, subdivisions, la1, lo1 = struct.unpack_from('>IIIIII', sec3, 30)
+    resolution = sec3[54]
+    la2, lo2, dx, dy = struct.unpack_from('>IIII', sec3, 55)
+    scan_mode = sec3[71]
+    if scan_mode & _SCAN_J_CONSECUTIVE:
+        raise UnsupportedGrib('column-major scanning mode')
+    if basic_angle in (0, _MISSING_U32):
+        unit = 1e-6
+    else:
+        unit = basic_angle / (subdivisions or 1)
+    return {
+        'gridDefinitionTemplate': template,
+        'gridDefinitionTemplateName': 'Latitude_Longitude',
+        'numberPoints': points,
+        'shape': shape,
+        'shapeName': _SHAPES.get(shape, _UNKNOWN),
+        'gridUnits': 'degrees',
+        'resolution': resolution,
+        # bit 5 of the flags: u/v relative to the grid rather than east/north
+        'winds': 'false' if resolution & 0x08 else 'true',
+        'scanMode': scan_mode,
+        'nx': nx,
+        'ny': ny,
+        'basicAngle': 0 if basic_angle == _MISSING_U32 else basic_angle,
+        'subDivisions': 0 if subdivisions == _MISSING_U32 else subdivisions,
+        'lo1': np.float32(lo1 * unit),
+        'la1': np.float32(_signed(la1, 32) * unit),
+        'lo2': np.float32(lo2 * unit),
+        'la2': np.float32(_signed(la2, 32) * unit),
+        'dx': np.float32(dx * unit),
+        'dy': np.float32(dy * unit),
+    }
+
+
+def _headers(grib_path):
+    """One grib2json header dict per message, in file order."""
+    with open(grib_path, 'rb') as f:
+        blob = f.read()
+    headers = []
+    for _offset, sections in _messages(blob):
+        if not all(n in sections for n in (1, 3, 4)):
+            raise UnsupportedGrib('message without identification/grid/product section')
+        header = _identification(sections[0], sections[1])
+        header.update(_product(header['discipline'], sections[4]))
+        header.update(_grid(sections[3]))
+        headers.append(header)
+    return headers
+
+
+def latlon_headers(grib_path, nx, ny, lo1, la1, dx, dy):
+    """Headers for the messages of ``grib_path`` regridded onto a regular lat/lon
+    grid (modules.regrid): identification and product from each message, and
+    the grid section wgrib2 -new_grid latlon writes -- template 3.0, scanned
+    south to north from (lo1, la1) with earth-relative winds, on the source's
+    earth shape. gribLength stays the source message's; no GRIB is encoded."""
+    with open(grib_path, 'rb') as f:
+        blob = f.read()
+    headers = []
+    for _offset, sections in _messages(blob):
+        if not all(n in sections for n in (1, 3, 4)):
+            raise UnsupportedGrib('message without identification/grid/product section')
+        header = _identification(sections[0], sections[1])
+        header.update(_product(header['discipline'], sections[4]))
+        shape = sections[3][14]
+        header.update({
+            'gridDefinitionTemplate': 0,
+            'gridDefinitionTemplateName': 'Latitude_Longitude',
+            'numberPoints': nx * ny,
+            'shape': shape,
+            'shapeName': _SHAPES.get(shape, _UNKNOWN),
+            'gridUnits': 'degrees',
+            'resolution': 48,  # i and j increments given, u/v relative to east/north
+            'winds': 'true',
+            'scanMode': _SCAN_J_POSITIVE,
+            'nx': nx, 'ny': ny, 'basicAngle': 0, 'subDivisions': 0,
+            'lo1': lo1 % 360, 'la1': la1,
+            'lo2': (lo1 + (nx - 1) * dx) % 360, 'la2': la1 + (ny - 1) * dy,
+            'dx': dx, 'dy': dy,
+        })
+        headers.append(header)
+    return headers
+
+
+def _header_json(header):
+    """Serialize a header in grib2json's key order; floats as Java prints them."""
+    parts = []
+    for key in HEADER_KEYS:
+        value = header[key]
+        if isinstance(value, (float, np.floating)):
+            text = java_float(value)
+        else:
+            text = json.dumps(value)
+        parts.append(f'"{key}":{text}')
+    return '{' + ','.join(parts) + '}'
+
+
+def _data_json(values):
+    """Comma-separated values: each distinct value is formatted once and the
+    text gathered by index; missing (NaN) points are written as null."""
+    flat = values.astype(np.float32, copy=False).ravel()
+    missing = np.isnan(flat)
+    uniq, inverse = np.unique(np.where(missing, 0, flat), return_inverse=True)
+    table = np.array([java_float(v) for v in uniq], dtype=object)
+    text = table[inverse]
+    text[missing] = 'null'
+    return ','.join(text)
+
+
+def _storage_order(band, scan_mode):
+    """GDAL hands back rows north-up, west to east; reorder to the message's
+    own scan order, which is what grib2json writes."""
+    if scan_mode & _SCAN_J_POSITIVE:
+        band = band[::-1]
+    if scan_mode & _SCAN_I_NEGATIVE:
+        band = band[:, ::-1]
+    return band
+
+
+def _write_records(out, records, surface_value):
+    """Write ``(header, north-up band)`` pairs as the gribjson array, keeping
+    only messages whose first fixed surface is ``surface_value`` (when set)."""
+    written = 0
+    out.write('[')
+    for header, read in records:
+        if surface_value is not None and header['surface1Value'] != surface_value:
+            continue
+        data = read()
+        if data.shape != (header['ny'], header['nx']):
+            raise UnsupportedGrib(f'shape {data.shape} does not match its grid')
+        if written:
+            out.write(',')
+        out.write('{"header":' + _header_json(header) + ',"data":[')
+        out.write(_data_json(_storage_order(data, header['scanMode'])))
+        out.write(']}')
+        written += 1
+    out.write(']')
+    return written
+
+
+def encode(grib_path, out, surface_value=None):
+    """Write the gribjson records of ``grib_path`` to the text stream ``out``.
+
+    ``surface_value`` mirrors grib2json's ``--fv``: only messages whose first
+    fixed surface has that value are written. Returns the number of records.
+    Raises :class:`UnsupportedGrib` for files outside what this encoder handles.
+    """
+    headers = _headers(grib_path)
+    # Keep GDAL from rotating 0-360 grids to -180..180: we need storage order.
+    with rasterio.Env(GRIB_ADJUST_LONGITUDE_RANGE='NO'):
+        with rasterio.open(grib_path) as src:
+            if src.count != len(headers):
+                raise UnsupportedGrib(f'{src.count} bands for {len(headers)} messages')
+            records = ((header, lambda band=band: src.read(band, masked=True).astype(np.float32).filled(np.nan))
+                       for band, header in enumerate(headers, start=1))
+            return _write_records(out, records, surface_value)
+
+
+def _subset_header(header, grid):
+    """A message header re-described for a (possibly subset) fieldcache grid:
+    size and corner points in the message's own scan order. gribLength stays the
+    source message's; no GRIB is encoded for the subset."""
+    south = grid['la1'] - (grid['ny'] - 1) * grid['dy']
+    east = grid['lo1'] + (grid['nx'] - 1) * grid['dx']
+    la1, la2 = (south, grid['la1']) if header['scanMode'] & _SCAN_J_POSITIVE else (grid['la1'], south)
+    lo1, lo2 = (east, grid['lo1']) if header['scanMode'] & _SCAN_I_NEGATIVE else (grid['lo1'], east)
+    return dict(header, nx=grid['nx'], ny=grid['ny'], numberPoints=grid['nx'] * grid['ny'],
+                lo1=lo1, la1=la1, lo2=lo2, la2=la2)
+
+
+def encode_field(field, out, surface_value=None):
+    """:func:`encode` for a modules.fieldcache Field (typically a projwin slice
+    of a mapped field): the records a GRIB of just that grid would give.
+    Raises :class:`UnsupportedGrib` if the field's messages had no header."""
+    if any(band['header'] is None for band in field.bands):
+        raise UnsupportedGrib('field was decoded from a GRIB this encoder does not read')
+    records = ((_subset_header(band['header'], field.grid), lambda i=i: field.data[i])
+               for i, band in enumerate(field.bands))
+    return _write_records(out, records, surface_value)
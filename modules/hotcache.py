@@ -0,0 +1,245 @@
+"""Small, hot response bodies held in memory shared by every gunicorn worker.
+
+The data routes serve a hit by streaming the cached file (App._read_output), so
+each worker re-opens and re-reads the same latest-run PNG or small-bbox gribjson
+on every request. Bodies up to HOT_CACHE_MAX_ENTRY bytes are instead copied
+once into an arena file (``.hotcache.arena`` in CACHE_DIR, HOT_CACHE_BYTES
+long) that every worker memory-maps; a hit is then the stat the validators need
+plus a memory copy.
+
+The arena is split into size classes (4 KB slots, 16 KB, 64 KB, ... up to
+HOT_CACHE_MAX_ENTRY), each an equal share of the bytes, and a body goes in the
+smallest class it fits. Each class is set-associative: a path can only live in
+the ``_WAYS`` slots of the set its hash picks, and a store replaces the least
+recently used of them. Entries are keyed by path and mtime, so a rebuilt file
+never matches the copy of its old build.
+
+Stores (misses only) hold the arena's flock, which orders workers, and a thread
+lock. Reads take no lock: a slot's sequence number is odd while it is being
+written, and a read that sees it change counts as a miss.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+
+import config
+from modules import metrics
+
+ARENA_NAME = '.hotcache.arena'
+
+# Slots per set. Lookups read this many slot headers.
+_WAYS = 8
+_SMALLEST_SLOT = 4096
+
+# Arena header: magic, layout version, arena bytes, largest entry.
+_HEADER = struct.Struct('<4sIQQ')
+_HEADER_BYTES = 64
+_MAGIC = b'VHOT'
+_VERSION = 1
+
+# Slot header: sequence, body size, file mtime_ns, path hash, last use (monotonic ns).
+_SLOT = struct.Struct('<IIq16sQ')
+_SLOT_HEADER = 64
+_SEQ = struct.Struct('<I')
+_LAST_USED = struct.Struct('<Q')
+_LAST_USED_AT = 32
+
+# Data routes call mark_used (a utime plus an index touch) at most this often per
+# path and process; eviction's last-use granularity is far coarser.
+_MARK_INTERVAL = 30.0
+_MARK_MEMO_MAX = 4096
+
+_lock = threading.Lock()
+_arena = None
+_last_mark = {}
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'too_large': 0}
+
+
+def is_arena_file(name):
+    """True for the arena, which cache eviction must never delete."""
+    return name == ARENA_NAME
+
+
+def _classes(total, max_entry):
+    """``[(slot_size, offset, sets)]`` of each size class of an arena."""
+    sizes, size = [], _SMALLEST_SLOT
+    while size < max_entry:
+        sizes.append(size)
+        size *= 4
+    sizes.append(max_entry)
+    share = (total - _HEADER_BYTES) // len(sizes)
+    classes, offset = [], _HEADER_BYTES
+    for size in sizes:
+        sets = share // ((_SLOT_HEADER + size) * _WAYS)
+        if sets:
+            classes.append((size, offset, sets))
+        offset += share
+    return classes
+
+
+class _Arena:
+    def __init__(self, path, total, max_entry):
+        self.path, self.total, self.max_entry = path, total, max_entry
+        self.classes = _classes(total, max_entry)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            head = os.pread(self.fd, _HEADER.size, 0)
+            if len(head) < _HEADER.size or _HEADER.unpack(head) != (_MAGIC, _VERSION, total, max_entry):
+                # New, or laid out for other settings: start empty.
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, total)
+                os.pwrite(self.fd, _HEADER.pack(_MAGIC, _VERSION, total, max_entry), 0)
+            self.map = mmap.mmap(self.fd, total)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def __del__(self):
+        os.close(self.fd)
+
+    def key(self):
+        return (self.path, self.total, self.max_entry)
+
+    def _set(self, digest, size):
+        """Offset and stride of the set ``digest`` maps to in the class ``size``
+        fits, or None if no class holds it."""
+        for slot_size, offset, sets in self.classes:
+            if size <= slot_size:
+                stride = _SLOT_HEADER + slot_size
+                return offset + (int.from_bytes(digest[:8], 'little') % sets) * _WAYS * stride, stride
+        return None
+
+    def get(self, digest, mtime_ns, size):
+        where = self._set(digest, size)
+        if where is None:
+            return None
+        base, stride = where
+        for way in range(_WAYS):
+            off = base + way * stride
+            seq, got_size, got_mtime, got_digest, _used = _SLOT.unpack_from(self.map, off)
+            if got_digest != digest or got_mtime != mtime_ns or got_size != size or seq % 2:
+                continue
+            body = self.map[off + _SLOT_HEADER:off + _SLOT_HEADER + size]
+            if _SLOT.unpack_from(self.map, off)[0] != seq:
+                return None  # rewritten under us
+            _LAST_USED.pack_into(self.map, off + _LAST_USED_AT, time.monotonic_ns())
+            return body
+        return None
+
+    def put(self, digest, mtime_ns, body):
+        """Store ``body``; True if it replaced a live entry."""
+        where = self._set(digest, len(body))
+        if where is None:
+            return False
+        base, stride = where
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            victim, oldest = None, None
+            for way in range(_WAYS):
+                off = base + way * stride
+                _seq, size, mtime, got_digest, used = _SLOT.unpack_from(self.map, off)
+                if got_digest == digest and mtime == mtime_ns and size == len(body):
+                    return False  # another worker stored it first
+                if oldest is None or used < oldest:
+                    victim, oldest = off, used
+            # Writers are serialized, so seq is even here: odd while the body is
+            # copied in, then the next even value with the new header.
+            seq, size = _SLOT.unpack_from(self.map, victim)[:2]
+            _SEQ.pack_into(self.map, victim, (seq + 1) & 0xFFFFFFFF)
+            self.map[victim + _SLOT_HEADER:victim + _SLOT_HEADER + len(body)] = body
+            _SLOT.pack_into(self.map, victim, (seq + 2) & 0xFFFFFFFF, len(body), mtime_ns, digest,
+                            time.monotonic_ns())
+            return size > 0
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+def _current():
+    """This process's mapping of the arena for the current settings, or None
+    when the cache is disabled (HOT_CACHE_BYTES <= 0)."""
+    global _arena
+    cfg = config.APP_CONFIG
+    total, max_entry = cfg.get('HOT_CACHE_BYTES', 0), cfg.get('HOT_CACHE_MAX_ENTRY', 0)
+    if total <= 0 or max_entry <= 0:
+        return None
+    key = (os.path.join(os.path.abspath(cfg['CACHE_DIR']), ARENA_NAME), total, max_entry)
+    arena = _arena
+    if arena is not None and arena.key() == key:
+        return arena
+    with _lock:
+        # A replaced mapping is left to the garbage collector: another thread
+        # may still be reading it.
+        if _arena is None or _arena.key() != key:
+            _arena = _Arena(*key)
+        return _arena
+
+
+def _digest(path):
+    return hashlib.blake2b(path.encode(), digest_size=16).digest()
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def get(path, st):
+    """The body of the cached file ``path`` (whose stat is ``st``) from the
+    shared arena, reading and storing it on a miss. None when the file is larger
+    than HOT_CACHE_MAX_ENTRY or the cache is disabled; the caller then streams
+    the file as before."""
+    arena = _current()
+    if arena is None:
+        return None
+    if st.st_size > arena.max_entry:
+        _count('too_large')
+        return None
+    digest = _digest(path)
+    body = arena.get(digest, st.st_mtime_ns, st.st_size)
+    if body is not None:
+        _count('hits')
+        return body
+    _count('misses')
+    with open(path, 'rb') as f:
+        body = f.read()
+        replaced = os.fstat(f.fileno()).st_mtime_ns != st.st_mtime_ns
+    if replaced or len(body) != st.st_size:
+        return body  # rebuilt since the stat: serve it, don't store it
+    with _lock:
+        evicted = arena.put(digest, st.st_mtime_ns, body)
+        _stats['stores'] += 1
+        _stats['evictions'] += evicted
+    return body
+
+
+def due_for_mark(path):
+    """True if the data routes should mark_used ``path`` now: at most once per
+    ``_MARK_INTERVAL`` per path and process, so a hot hit skips the utime."""
+    now = time.monotonic()
+    with _lock:
+        if now - _last_mark.get(path, -_MARK_INTERVAL) < _MARK_INTERVAL:
+            return False
+        if len(_last_mark) >= _MARK_MEMO_MAX:
+            _last_mark.clear()
+        _last_mark[path] = now
+    return True
+
+
+def stats():
+    """This process's hot-cache counters (hits, misses, stores, evictions of a
+    live entry, bodies too large to hold) and the arena's settings."""
+    cfg = config.APP_CONFIG
+    with _lock:
+        return dict(_stats, bytes=cfg.get('HOT_CACHE_BYTES', 0), max_entry=cfg.get('HOT_CACHE_MAX_ENTRY', 0))
+
+
+def _collect():
+    with _lock:
+        return [('veloserver_hot_cache_total', {'event': name}, count) for name, count in _stats.items()]
+
+
+metrics.register_collector(_collect)
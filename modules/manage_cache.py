@@ -2,6 +2,11 @@ import os
 import stat
 import time
 import fcntl
+import threading
+import contextlib
+
+from config import COMPRESSED_SIBLINGS
+from modules import cache_index, hotcache, metrics
 
 # Lock file eviction holds while it runs
 _EVICT_LOCK_NAME = '.evict.lock'
@@ -9,22 +14,52 @@ _EVICT_LOCK_NAME = '.evict.lock'
 # These guard in-flight downloads and must never be deleted by eviction.
 _LOCK_SUFFIX = '.lock'
 
+# Default age after which the cache index is reconciled with the disk again.
+_INDEX_REBUILD_SECONDS = 24 * 3600
+
+# Index meta key the background evictor refreshes on every pass. While it is
+# recent, request handlers leave eviction to the evictor.
+_EVICTOR_BEAT = 'evictor_beat'
+
+# Missed passes after which the evictor counts as gone and requests evict inline.
+_EVICTOR_GRACE_PASSES = 3
+
 
 def mark_used(path):
-    """Bump a cached file's mtime so LRU eviction treats it as recently used.
+    """Bump a cached file's atime so LRU eviction treats it as recently used.
+
+    Only the atime moves: the mtime stays the time the file was built, which is
+    what the HTTP validators (ETag / Last-Modified) are derived from, so a hit
+    never changes them. Eviction keys on the later of the two (:func:`_last_used`).
+
+    The cache index is updated too (throttled, see cache_index.touch).
 
     Best-effort: a file that vanished in a concurrent eviction is ignored rather
     than raised, since marking usage must never fail a request.
     """
     try:
-        os.utime(path, None)
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
     except OSError:
-        pass
+        return
+    cache_index.touch(path)
+
+
+def _last_used(st):
+    """Last-use time of a cached file from its stat: the atime bumped by
+    :func:`mark_used`, or the mtime (build time) if it was never read since."""
+    return max(st.st_atime, st.st_mtime)
 
 
 def _safe_remove(path):
-    """Delete ``path``, tolerating a concurrent removal. Returns True if this
-    call removed it, False if it was already gone."""
+    """Delete ``path`` and any precompressed siblings of it (``.br``/``.gz``),
+    tolerating a concurrent removal. Siblings go first, so a request never finds
+    an encoded body whose parent is already gone. Returns True if this call
+    removed ``path``, False if it was already gone."""
+    for suffix, _coding in COMPRESSED_SIBLINGS:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
     try:
         os.remove(path)
         return True
@@ -32,8 +67,29 @@ def _safe_remove(path):
         return False
 
 
+def _is_sibling(name, names):
+    """True if ``name`` is a precompressed sibling whose parent is in ``names``;
+    it is then accounted for (and evicted) as part of the parent's entry."""
+    for suffix, _coding in COMPRESSED_SIBLINGS:
+        if name.endswith(suffix) and name[:-len(suffix)] in names:
+            return True
+    return False
+
+
+def _with_siblings(entry, base):
+    """Fold the size and last use of ``entry``'s precompressed siblings into it,
+    so a gribjson file and its .br/.gz copies are evicted as one unit."""
+    path, size, used = entry
+    for suffix, _coding in COMPRESSED_SIBLINGS:
+        sibling = _entry_if_evictable(path + suffix, base)
+        if sibling is not None:
+            size += sibling[1]
+            used = max(used, sibling[2])
+    return path, size, used
+
+
 def _entry_if_evictable(path, base):
-    """Return ``(path, size, mtime)`` if ``path`` is a deletable regular file
+    """Return ``(path, size, last_used)`` if ``path`` is a deletable regular file
     confined under ``base``, else ``None``. Uses ``lstat`` so a symlink is never
     followed out of the cache, and confines the path first (S2083 / S8707)."""
     if path != base and not os.path.abspath(path).startswith(base + os.sep):
@@ -44,98 +100,156 @@ def _entry_if_evictable(path, base):
         return None
     if not stat.S_ISREG(st.st_mode):
         return None
-    return path, st.st_size, st.st_mtime
+    return path, st.st_size, _last_used(st)
 
 
 def _evictable_entries(cache_dir):
-    """Yield ``(path, size, mtime)`` for every regular file under ``cache_dir``
-    that eviction is allowed to delete. Lock files (in-flight downloads) are
-    skipped; per-file vetting is in :func:`_entry_if_evictable`."""
+    """Yield ``(path, size, last_used)`` for every regular file under ``cache_dir``
+    that eviction is allowed to delete; this full walk is what the cache index is
+    rebuilt from. Lock files (in-flight downloads), the index, the hot-cache
+    arena and the metrics snapshots are skipped, and precompressed siblings ride
+    along with their parent's entry (an orphaned sibling is an entry of its
+    own); per-file vetting is in :func:`_entry_if_evictable`."""
     base = os.path.abspath(cache_dir)
-    for root, _dirs, files in os.walk(base):
+    for root, dirs, files in os.walk(base):
+        dirs[:] = [d for d in dirs if not (root == base and metrics.is_metrics_dir(d))]
+        names = set(files)
         for name in files:
-            if name == _EVICT_LOCK_NAME or name.endswith(_LOCK_SUFFIX):
+            if name == _EVICT_LOCK_NAME or name.endswith(_LOCK_SUFFIX) or cache_index.is_index_file(name) \
+                    or hotcache.is_arena_file(name):
+                continue
+            if _is_sibling(name, names):
                 continue
             entry = _entry_if_evictable(os.path.join(root, name), base)
             if entry is not None:
-                yield entry
+                yield _with_siblings(entry, base)
 
 
-def _prune_empty_dirs(cache_dir):
-    """Remove now-empty subdirectories left behind by eviction (e.g. Herbie's
-    per-date folders). The cache directory itself is never removed. Best-effort."""
-    base = os.path.abspath(cache_dir)
-    for root, _dirs, _files in os.walk(base, topdown=False):
-        if root == base:
-            continue
+def _prune_parents(path, base):
+    """Remove the directories above an evicted file that it left empty (e.g.
+    Herbie's per-date folders), stopping at the first non-empty one. The cache
+    directory itself is never removed. Best-effort."""
+    parent = os.path.dirname(path)
+    while parent != base and parent.startswith(base + os.sep):
         try:
-            os.rmdir(root)
+            os.rmdir(parent)
         except OSError:
-            pass
+            return
+        parent = os.path.dirname(parent)
+
+
+def _evict(cache_dir, path):
+    """Delete one indexed entry (with its siblings) and drop it from the index.
+    The row goes even if the file was already gone or isn't evictable, so a
+    stale row can't be retried forever. Returns True if this call deleted it."""
+    base = os.path.abspath(cache_dir)
+    entry = _entry_if_evictable(path, base)
+    if entry is not None:
+        entry = _with_siblings(entry, base)  # their bytes are freed too
+    removed = entry is not None and _safe_remove(path)
+    cache_index.forget(cache_dir, path)
+    if removed:
+        _prune_parents(path, base)
+        metrics.inc('veloserver_evicted_files_total')
+        metrics.inc('veloserver_evicted_bytes_total', entry[1])
+    return removed
 
 
-def _ttl_pass(entries, ttl_seconds):
-    """Delete entries whose mtime is older than ``ttl_seconds`` ago (when > 0).
-    Returns ``(kept_entries, num_deleted)``."""
+def _ttl_pass(cache_dir, ttl_seconds, pace=0):
+    """Delete entries last used more than ``ttl_seconds`` ago (when > 0), oldest
+    first, stopping at the first fresher one. Returns the number deleted."""
     if ttl_seconds <= 0:
-        return entries, 0
+        return 0
     cutoff = time.time() - ttl_seconds
-    kept, deleted = [], 0
-    for path, size, mtime in entries:
-        if mtime < cutoff and _safe_remove(path):
+    deleted = 0
+    for path, _size, used in cache_index.least_recently_used(cache_dir):
+        if used >= cutoff:
+            break
+        if _evict(cache_dir, path):
             deleted += 1
-        else:
-            kept.append((path, size, mtime))
-    return kept, deleted
+            time.sleep(pace)
+    return deleted
 
 
-def _size_pass(entries, max_bytes, target_ratio):
-    """Delete oldest files by last modified time (mtime) first until the total is at or below
-    ``max_bytes * target_ratio`` (a low-water mark). Returns the number deleted."""
-    total = sum(size for _, size, _ in entries)
+def _size_pass(cache_dir, max_bytes, target_ratio, pace=0):
+    """Delete least-recently-used entries first until the indexed total is at or
+    below ``max_bytes * target_ratio`` (a low-water mark). Returns the number
+    deleted."""
+    total = cache_index.total_bytes(cache_dir)
     if total <= max_bytes:
         return 0
     target = int(max_bytes * target_ratio)
     deleted = 0
-    for path, size, _mtime in sorted(entries, key=lambda e: e[2]):  # oldest first
+    for path, size, _used in cache_index.least_recently_used(cache_dir):  # oldest first
         if total <= target:
             break
-        if _safe_remove(path):
+        if _evict(cache_dir, path):
             deleted += 1
-            total -= size
+            time.sleep(pace)
+        total -= size
     return deleted
 
 
-def enforce_budget(cache_dir, max_bytes, ttl_seconds=0, target_ratio=0.85):
+@contextlib.contextmanager
+def _evict_lock(cache_dir, blocking=False):
+    """Hold the cross-process eviction lock; yields False if ``blocking`` is off
+    and another process already has it."""
+    lock_file = open(os.path.join(cache_dir, _EVICT_LOCK_NAME), 'w')
+    try:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+        lock_file.close()
+
+
+def _ensure_index(cache_dir, rebuild_seconds):
+    return cache_index.ensure(cache_dir, lambda: _evictable_entries(cache_dir), rebuild_seconds)
+
+
+def prepare_index(cache_dir, rebuild_seconds=_INDEX_REBUILD_SECONDS):
+    """Create or rebuild the cache index at startup (see cache_index.ensure).
+    Waits for the eviction lock, so concurrent workers rebuild only once."""
+    if not os.path.isdir(cache_dir):
+        return False
+    with _evict_lock(cache_dir, blocking=True):
+        return _ensure_index(cache_dir, rebuild_seconds)
+
+
+def enforce_budget(cache_dir, max_bytes, ttl_seconds=0, target_ratio=0.85,
+                   rebuild_seconds=_INDEX_REBUILD_SECONDS, pace=0):
     """Evict files until the cache fits its budget; return the number deleted.
 
-    Files older than ``ttl_seconds`` (when > 0) go first regardless of size, then
-    oldest-mtime files are deleted down to ``max_bytes * target_ratio`` if the
+    Files unused for ``ttl_seconds`` (when > 0) go first regardless of size, then
+    least-recently-used files are deleted down to ``max_bytes * target_ratio`` if the
     total still exceeds ``max_bytes``. A budget of ``<= 0`` disables eviction.
+
+    Sizes and last-use times come from the persistent cache index, so when the
+    cache is under budget this is a couple of single-row reads rather than a walk
+    of the whole tree. The index is (re)built from disk first if it is missing or
+    was last rebuilt more than ``rebuild_seconds`` ago. ``pace`` is a pause in
+    seconds after each deletion, so a large purge doesn't saturate the disk.
     """
     if max_bytes <= 0 or not os.path.isdir(cache_dir):
         return 0
 
-    lock_file = open(os.path.join(cache_dir, _EVICT_LOCK_NAME), 'w')
-    try:
-        try:
-            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except OSError:
+    with _evict_lock(cache_dir) as acquired:
+        if not acquired:
             return 0  # another worker is already evicting; skip this pass
-
-        entries, deleted = _ttl_pass(list(_evictable_entries(cache_dir)), ttl_seconds)
-        deleted += _size_pass(entries, max_bytes, target_ratio)
-        if deleted:
-            _prune_empty_dirs(cache_dir)
+        _ensure_index(cache_dir, rebuild_seconds)
+        metrics.inc('veloserver_eviction_passes_total')
+        deleted = _ttl_pass(cache_dir, ttl_seconds, pace)
+        deleted += _size_pass(cache_dir, max_bytes, target_ratio, pace)
         return deleted
-    finally:
-        try:
-            fcntl.flock(lock_file, fcntl.LOCK_UN)
-        finally:
-            lock_file.close()
 
 
-def enforce_configured(app_config):
+def enforce_configured(app_config, pace=0):
     """Run :func:`enforce_budget` from ``APP_CONFIG`` values, containing any
     error so cache maintenance can never fail a data response.
 
@@ -147,7 +261,73 @@ def enforce_configured(app_config):
             app_config['CACHE_MAX_BYTES'],
             app_config.get('CACHE_TTL_HOURS', 0) * 3600,
             app_config.get('CACHE_TARGET_RATIO', 0.85),
+            app_config.get('CACHE_INDEX_REBUILD_HOURS', 24) * 3600,
+            pace,
         )
     except Exception as exc:
         print(f'[cache] eviction skipped: {exc}')
         return 0
+
+
+def _evictor_alive(app_config):
+    """True while the background evictor has run a pass recently."""
+    poll = app_config.get('CACHE_EVICT_POLL_SECONDS', 5)
+    last = cache_index.last_beat(app_config['CACHE_DIR'], _EVICTOR_BEAT)
+    return time.time() - last < poll * _EVICTOR_GRACE_PASSES
+
+
+def note_growth(app_config):
+    """Request-path hook after a response may have added to the cache.
+
+    The bytes themselves are already counted: _atomic_output records every
+    published file in the cache index, which the background evictor polls. So
+    while the evictor is alive this is a single meta-row read and never deletes
+    anything on the request path. Without one (not started from server.main,
+    disabled, or dead) it falls back to evicting inline.
+
+    Like :func:`enforce_configured`, never raises. Returns the number of files
+    deleted inline."""
+    try:
+        if _evictor_alive(app_config):
+            return 0
+    except Exception as exc:
+        print(f'[cache] evictor check failed: {exc}')
+    return enforce_configured(app_config)
+
+
+def _evictor_loop(app_config, stop):
+    """Body of the evictor thread: one budget pass every poll interval, paced,
+    then a heartbeat. Each pass is a meta-row read while the cache is under
+    budget. Errors are logged and the loop carries on, so the thread outlives
+    any single bad pass; if it ever does stop, the stale heartbeat hands
+    eviction back to the request path."""
+    poll = app_config.get('CACHE_EVICT_POLL_SECONDS', 5)
+    rate = app_config.get('CACHE_EVICT_DELETES_PER_SEC', 0)
+    pace = 1.0 / rate if rate > 0 else 0
+    while True:
+        try:
+            deleted = enforce_configured(app_config, pace)
+            if deleted:
+                print(f'[cache] evictor removed {deleted} entries')
+            cache_index.beat(app_config['CACHE_DIR'], _EVICTOR_BEAT)
+            metrics.flush(app_config['CACHE_DIR'])  # the master serves no requests to flush after
+        except Exception as exc:
+            print(f'[cache] evictor pass failed: {exc}')
+        if stop.wait(poll):
+            return
+
+
+def start_evictor(app_config):
+    """Start the background eviction thread and return its stop Event, or None
+    when ``CACHE_EVICT_IN_BACKGROUND`` is off.
+
+    Call it once, from the process that forks the workers (server.main, i.e. the
+    gunicorn master): threads don't survive fork, so the workers never carry a
+    copy. Should a second one run anyway (e.g. bottle's reloader parent and
+    child), the eviction lock keeps their passes from overlapping."""
+    if not app_config.get('CACHE_EVICT_IN_BACKGROUND', True):
+        return None
+    stop = threading.Event()
+    threading.Thread(target=_evictor_loop, args=(app_config, stop),
+                     name='cache-evictor', daemon=True).start()
+    return stop
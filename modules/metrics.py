@@ -0,0 +1,248 @@
+"""Prometheus metrics of the pipeline, summed over every gunicorn worker.
+
+Each process counts in memory and snapshots its samples to
+``.metrics/<pid>.json`` under CACHE_DIR: at most once a second after a request
+(:func:`maybe_flush`), after each pass of the master's evictor, and whenever it
+answers /metrics (:func:`render`). Rendering sums the snapshots of every
+process, so whichever worker answers, the numbers cover all of them. Counters
+and histograms of a worker that has exited keep counting, since they are
+cumulative; gauges are summed over live processes only.
+
+prometheus_client is not a dependency: its multiprocess mode does the same
+with mmap files per process, and the text format is short enough to write here.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+import config
+from modules import tracing
+
+METRICS_DIR_NAME = '.metrics'
+
+# Histogram bucket upper bounds in seconds, from a hot hit to a cold download.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_FLUSH_INTERVAL = 1.0
+
+# Every family /metrics exposes: name -> (type, help), in exposition order.
+FAMILIES = {
+    'veloserver_cache_requests_total': (
+        'counter', 'Cache lookups of a built output by model, product, format and result (hit/miss).'),
+    'veloserver_download_seconds': ('histogram', 'Time to fetch a source GRIB, by source.'),
+    'veloserver_download_bytes_total': ('counter', 'Bytes of source GRIB fetched, by source.'),
+    'veloserver_stage_seconds': (
+        'histogram', 'Time spent in a pipeline stage (regrid, subset) by model.'),
+    'veloserver_produce_seconds': (
+        'histogram', 'Time spent in the producer of an output format (convert.to_* and friends).'),
+    'veloserver_lock_wait_seconds': ('histogram', 'Time spent waiting to acquire a _download_lock.'),
+    'veloserver_eviction_passes_total': ('counter', 'Cache eviction passes that ran (held the eviction lock).'),
+    'veloserver_evicted_files_total': ('counter', 'Cache entries deleted by eviction.'),
+    'veloserver_evicted_bytes_total': ('counter', 'Bytes freed by eviction.'),
+    'veloserver_requests_in_flight': ('gauge', 'Requests being handled now, by worker pid.'),
+    'veloserver_single_flight_total': (
+        'counter', 'In-process builds by role: led, or coalesced onto another thread\'s build.'),
+    'veloserver_hot_cache_total': ('counter', 'Hot-cache (shared arena) lookups and stores, by event.'),
+}
+
+_lock = threading.Lock()
+# (name, ((label, value), ...)) -> a number, or for a histogram the per-bucket
+# counts (non-cumulative, +Inf last) followed by the sum and the count.
+_samples = {}
+_collectors = []
+_last_flush = 0.0
+
+
+def _reset():
+    # A forked worker starts from zero; the parent's counts are in its own file.
+    global _lock, _last_flush
+    _lock = threading.Lock()
+    _samples.clear()
+    _last_flush = 0.0
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add ``value`` to a counter."""
+    key = _key(name, labels)
+    with _lock:
+        _samples[key] = _samples.get(key, 0) + value
+
+
+def gauge_add(name, delta, **labels):
+    """Move a gauge by ``delta``."""
+    inc(name, delta, **labels)
+
+
+def observe(name, seconds, **labels):
+    """Record one observation of a histogram."""
+    key = _key(name, labels)
+    with _lock:
+        counts = _samples.get(key)
+        if counts is None:
+            counts = _samples[key] = [0] * (len(BUCKETS) + 3)
+        counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        counts[-2] += seconds
+        counts[-1] += 1
+
+
+@contextlib.contextmanager
+def timer(name, span=None, **labels):
+    """Observe the time the block takes, whether it returns or raises. With
+    ``span``, the time is also added to that stage of the request's trace
+    (modules.tracing)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe(name, seconds, **labels)
+        if span is not None:
+            tracing.add(span, seconds)
+
+
+def register_collector(collect):
+    """Add a callable returning ``[(name, labels, value)]`` of counts a module
+    keeps itself (e.g. concurrency.flight_counts); called at every flush."""
+    _collectors.append(collect)
+
+
+def metrics_dir(cache_dir=None):
+    return os.path.join(cache_dir or config.APP_CONFIG['CACHE_DIR'], METRICS_DIR_NAME)
+
+
+def is_metrics_dir(name):
+    """True for the snapshot directory, which cache eviction must skip."""
+    return name == METRICS_DIR_NAME
+
+
+def clear(cache_dir=None):
+    """Drop the snapshots of earlier runs; called once when the server starts."""
+    directory = metrics_dir(cache_dir)
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        with contextlib.suppress(OSError):
+            os.remove(os.path.join(directory, name))
+
+
+def flush(cache_dir=None):
+    """Write this process's samples to its snapshot file (atomically)."""
+    global _last_flush
+    with _lock:
+        rows = [[name, list(labels), list(value) if isinstance(value, list) else value]
+                for (name, labels), value in _samples.items()]
+        _last_flush = time.monotonic()
+    for collect in _collectors:
+        try:
+            rows.extend([name, sorted((k, str(v)) for k, v in labels.items()), value]
+                        for name, labels, value in collect())
+        except Exception as exc:
+            print(f'[metrics] collector failed: {exc}')
+    directory = metrics_dir(cache_dir)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(rows, f)
+    os.replace(tmp, path)
+
+
+def maybe_flush():
+    """:func:`flush` if the last one is over a second old. Never raises, since
+    it runs after every request."""
+    if time.monotonic() - _last_flush < _FLUSH_INTERVAL:
+        return
+    try:
+        flush()
+    except Exception as exc:
+        print(f'[metrics] flush failed: {exc}')
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(directory):
+    """Sum the samples of every snapshot under ``directory``."""
+    totals = {}
+    for name in os.listdir(directory):
+        pid = name[:-len('.json')]
+        if not name.endswith('.json') or not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            continue  # removed or replaced under us
+        alive = None
+        for family, labels, value in rows:
+            kind = FAMILIES.get(family, (None,))[0]
+            if kind is None:
+                continue
+            if kind == 'gauge':
+                if alive is None:
+                    alive = _alive(int(pid))
+                if not alive:
+                    continue
+            key = (family, tuple(map(tuple, labels)))
+            if kind == 'histogram':
+                got = totals.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    got[i] += v
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(cache_dir=None):
+    """The text exposition (format 0.0.4) of every process's metrics."""
+    flush(cache_dir)
+    totals = _merge(metrics_dir(cache_dir))
+    lines = []
+    for family, (kind, help_text) in FAMILIES.items():
+        lines.append(f'# HELP {family} {help_text}')
+        lines.append(f'# TYPE {family} {kind}')
+        for (name, labels), value in sorted(totals.items()):
+            if name != family:
+                continue
+            if kind != 'histogram':
+                lines.append(f'{family}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), value):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(float(bound))
+                lines.append(f'{family}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{family}_sum{_labels(labels)} {_number(float(value[-2]))}')
+            lines.append(f'{family}_count{_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
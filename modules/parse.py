@@ -10,7 +10,10 @@ from config import HRRR_PRODUCTS
 # sets (or be a parsed number/date), so untrusted input can't steer file I/O
 # (path-injection hardening, Sonar S2083).
 ALLOWED_MODELS = {'hrrr', 'ecmwf', 'gfs'}
-ALLOWED_FORMATS = {'gribjson', 'geotiff', 'png'}
+ALLOWED_FORMATS = {'gribjson', 'geotiff', 'png', 'legend', 'windbin', 'windpng'}
+
+# Formats that carry the U/V wind field, so only the 'winds' product has them.
+WIND_FORMATS = {'gribjson', 'windbin', 'windpng'}
 
 # HRRR forecast-hour limits: F18 every run, F48 only for the 00/06/12/18z runs.
 HRRR_FXX_MAX_STANDARD = 18
@@ -122,6 +125,11 @@ def parse_cog_time(time_param):
     return datetime_object.strftime('%Y-%m-%d'), datetime_object.strftime('%H:00:00')
 
 
+def _max_fxx(hour):
+    """Last forecast hour of the HRRR run starting at ``hour`` ('HH:00:00')."""
+    return HRRR_FXX_MAX_EXTENDED if int(hour[:2]) in HRRR_EXTENDED_INIT_HOURS else HRRR_FXX_MAX_STANDARD
+
+
 def parse_fxx(raw, hour):
     """Coerce the ?fxx= query value to a validated forecast-hour int. Absent
     (None/'') -> 0 (the F00 analysis). ``hour`` is parse_cog_time's 'HH:00:00';
@@ -133,9 +141,7 @@ def parse_fxx(raw, hour):
     except (TypeError, ValueError):
         raise ValueError(f'fxx must be an integer, got {raw!r}')
     init_hour = int(hour[:2])
-    max_fxx = (HRRR_FXX_MAX_EXTENDED
-               if init_hour in HRRR_EXTENDED_INIT_HOURS
-               else HRRR_FXX_MAX_STANDARD)
+    max_fxx = _max_fxx(hour)
     if not 0 <= fxx <= max_fxx:
         raise ValueError(
             f'fxx {fxx} out of range for the {init_hour:02d}z HRRR run '
@@ -143,11 +149,48 @@ def parse_fxx(raw, hour):
     return fxx
 
 
+def parse_fxx_range(raw, hour):
+    """Coerce a point or bundle query's ?fxx= value to the list of forecast hours
+    it names: 'N' or 'A-B' (inclusive). Absent -> every hour of the run (0-18,
+    or 0-48 for 00/06/12/18z). Each end is checked like :func:`parse_fxx`;
+    raises ValueError (-> 400)."""
+    raw = '' if raw is None else str(raw).strip()
+    if not raw:
+        return list(range(_max_fxx(hour) + 1))
+    first, sep, last = raw.partition('-')
+    start = parse_fxx(first, hour)
+    end = parse_fxx(last, hour) if sep else start
+    if end < start:
+        raise ValueError(f'fxx range {raw!r} ends before it starts')
+    return list(range(start, end + 1))
+
+
+def parse_points(points, max_points):
+    """Validate a point query's locations -- a list of {'lat': .., 'lon': ..} --
+    into (lats, lons) float lists. lon may be -180..180 or 0..360. Raises
+    ValueError (-> 400) on anything else or more than ``max_points``."""
+    if not isinstance(points, list) or not points:
+        raise ValueError('points must be a non-empty list of {"lat": .., "lon": ..}')
+    if len(points) > max_points:
+        raise ValueError(f'at most {max_points} points per request, got {len(points)}')
+    lats, lons = [], []
+    for point in points:
+        try:
+            lat, lon = float(point['lat']), float(point['lon'])
+        except (TypeError, KeyError, ValueError):
+            raise ValueError(f'invalid point {point!r}: expected {{"lat": .., "lon": ..}}')
+        if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 360):
+            raise ValueError(f'point out of range: lat {lat}, lon {lon}')
+        lats.append(lat)
+        lons.append(lon)
+    return lats, lons
+
+
 def hrrr_format_error(product, format):
     """Return an error message if this product/format combination is unsupported,
-    else None. gribjson is only produced for winds; other products must use a
-    raster format or the COG route."""
-    if format == 'gribjson' and product != 'winds':
-        return (f"gribjson is only available for the 'winds' product; "
+    else None. The wind formats (gribjson, windbin, windpng) are only produced
+    for winds; other products must use a raster format or the COG route."""
+    if format in WIND_FORMATS and product != 'winds':
+        return (f"{format} is only available for the 'winds' product; "
                 f"use geotiff, png, or the /cog route for '{product}'.")
     return None
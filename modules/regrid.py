@@ -0,0 +1,213 @@
+"""Reprojection of HRRR's native grid through precomputed lookup tables.
+
+HRRR's Lambert-conformal grid never changes, so where each output pixel takes
+its values from is computed once per source grid and stored as ``.npy`` tables
+under ``luts/`` in the cache. Every worker memory-maps them, and reprojecting a
+product, run or forecast hour is then a NumPy gather:
+
+* ``latlon``: the 0.1-degree lat/lon grid the data routes serve (what
+  ``wgrib2 -new_grid latlon -134:730:0.1 21:310:0.1`` produced), as the four
+  bilinear neighbours and weights of every output point.
+* ``rotation``: cos/sin of the meridian convergence at every source point
+  (pyproj), turning grid-relative u/v into earth-relative u/v before they are
+  interpolated -- ``-new_grid_winds earth``.
+* ``mercator``: the nearest source pixel of every EPSG:3857 COG pixel on
+  gdalwarp's default output grid (``gdalwarp -t_srs EPSG:3857 -r near``).
+
+Tables are keyed by a hash of the source CRS, transform and shape (and the
+target), so a different source grid simply gets tables of its own. A missing
+(e.g. evicted) table is rebuilt on the next use.
+"""
+import os
+import hashlib
+import threading
+
+import numpy as np
+import pyproj
+import rasterio
+import rasterio.warp
+from rasterio.transform import array_bounds
+
+from modules import cache_index, fieldcache, gribjson
+from modules.concurrency import _atomic_output
+
+LUT_SUBDIR = 'luts'
+
+# The data routes' lat/lon grid: (first lon, nx, dlon, first lat, ny, dlat),
+# wgrib2's -new_grid latlon -134:730:0.1 21:310:0.1.
+HRRR_LATLON = (-134.0, 730, 0.1, 21.0, 310, 0.1)
+
+# Bump when a table's layout or contents change; old tables are then ignored.
+_LUT_VERSION = 1
+
+# A bilinear point is defined when at least this much of its weight falls on
+# defined source points (the iplib / wgrib2 rule); the weights are renormalized.
+_MIN_WEIGHT = 0.5
+
+# Output rows transformed per pyproj call while building the mercator table.
+_ROWS_PER_CHUNK = 256
+
+_mapped = {}
+_mapped_lock = threading.Lock()
+
+
+def _key(kind, crs, transform, shape, target=''):
+    text = f'{_LUT_VERSION}|{kind}|{crs.to_wkt()}|{tuple(transform)[:6]}|{tuple(shape)}|{target}'
+    return f'{kind}-{hashlib.sha1(text.encode()).hexdigest()[:16]}'
+
+
+def _tables(lut_dir, key, names, build):
+    """Map the ``<key>-<name>.npy`` tables read-only, building them with
+    ``build()`` (a dict of arrays) when any is missing."""
+    paths = [os.path.join(lut_dir, f'{key}-{name}.npy') for name in names]
+    with _mapped_lock:
+        cached = _mapped.get(key)
+    if cached is not None and all(os.path.exists(p) for p in paths):
+        for path in paths:
+            cache_index.touch(path)
+        return cached
+    if not all(os.path.exists(p) for p in paths):
+        os.makedirs(lut_dir, exist_ok=True)
+        arrays = build()
+        for name, path in zip(names, paths):
+            with _atomic_output(path) as tmp:
+                with open(tmp, 'wb') as f:
+                    np.save(f, arrays[name])
+        print(f'[regrid] built lookup table {key}')
+    tables = tuple(np.load(path, mmap_mode='r') for path in paths)
+    with _mapped_lock:
+        _mapped[key] = tables
+    return tables
+
+
+def _to_source(crs, xs, ys, from_crs):
+    """Transform points from ``from_crs`` into the source ``crs``."""
+    transformer = pyproj.Transformer.from_crs(from_crs, pyproj.CRS.from_wkt(crs.to_wkt()), always_xy=True)
+    return transformer.transform(xs, ys)
+
+
+def latlon_table(crs, transform, shape, lut_dir, spec=HRRR_LATLON):
+    """``(index, weight)``, each (4, ny * nx): the flat source index (-1 outside
+    the grid) and bilinear weight of the four neighbours of every lat/lon point,
+    rows north to south."""
+    lon0, nx, dlon, lat0, ny, dlat = spec
+
+    def build():
+        lons = lon0 + np.arange(nx) * dlon
+        lats = (lat0 + np.arange(ny) * dlat)[::-1]
+        lon, lat = np.meshgrid(lons, lats)
+        geodetic = pyproj.CRS.from_wkt(crs.to_wkt()).geodetic_crs
+        x, y = _to_source(crs, lon.ravel(), lat.ravel(), geodetic)
+        col = (np.asarray(x) - transform.c) / transform.a - 0.5
+        row = (np.asarray(y) - transform.f) / transform.e - 0.5
+        i0, j0 = np.floor(col).astype(np.int64), np.floor(row).astype(np.int64)
+        fx, fy = col - i0, row - j0
+        index = np.empty((4, lon.size), dtype=np.int32)
+        weight = np.empty((4, lon.size), dtype=np.float32)
+        for k, (dj, di, w) in enumerate(((0, 0, (1 - fx) * (1 - fy)), (0, 1, fx * (1 - fy)),
+                                         (1, 0, (1 - fx) * fy), (1, 1, fx * fy))):
+            j, i = j0 + dj, i0 + di
+            inside = (j >= 0) & (j < shape[0]) & (i >= 0) & (i < shape[1]) & np.isfinite(col)
+            index[k] = np.where(inside, j * shape[1] + i, -1)
+            weight[k] = np.where(inside, w, 0)
+        return {'index': index, 'weight': weight}
+
+    return _tables(lut_dir, _key('latlon', crs, transform, shape, spec), ('index', 'weight'), build)
+
+
+def rotation_table(crs, transform, shape, lut_dir):
+    """(2, ny, nx) cos and sin of the meridian convergence at every source
+    pixel center: the angle grid north is turned clockwise from true north."""
+    def build():
+        cols = transform.c + (np.arange(shape[1]) + 0.5) * transform.a
+        rows = transform.f + (np.arange(shape[0]) + 0.5) * transform.e
+        x, y = np.meshgrid(cols, rows)
+        proj = pyproj.Proj(pyproj.CRS.from_wkt(crs.to_wkt()))
+        lon, lat = proj(x, y, inverse=True)
+        angle = np.radians(proj.get_factors(lon, lat).meridian_convergence)
+        return {'rotation': np.stack([np.cos(angle), np.sin(angle)]).astype(np.float32)}
+
+    return _tables(lut_dir, _key('rotation', crs, transform, shape), ('rotation',), build)[0]
+
+
+def mercator_table(crs, transform, shape, lut_dir):
+    """``(index, dst_transform, width, height)``: the flat source index (-1
+    outside) of the nearest source pixel for every pixel of gdalwarp's default
+    EPSG:3857 output grid, rows north to south."""
+    dst_transform, width, height = rasterio.warp.calculate_default_transform(
+        crs, 'EPSG:3857', shape[1], shape[0], *array_bounds(shape[0], shape[1], transform))
+
+    def build():
+        index = np.empty((height, width), dtype=np.int32)
+        xs = dst_transform.c + (np.arange(width) + 0.5) * dst_transform.a
+        for r0 in range(0, height, _ROWS_PER_CHUNK):
+            ys = dst_transform.f + (np.arange(r0, min(r0 + _ROWS_PER_CHUNK, height)) + 0.5) * dst_transform.e
+            x, y = np.meshgrid(xs, ys)
+            sx, sy = _to_source(crs, x.ravel(), y.ravel(), 'EPSG:3857')
+            col = np.floor((np.asarray(sx) - transform.c) / transform.a)
+            row = np.floor((np.asarray(sy) - transform.f) / transform.e)
+            inside = (row >= 0) & (row < shape[0]) & (col >= 0) & (col < shape[1])
+            flat = np.where(inside, row * shape[1] + col, -1).astype(np.int32)
+            index[r0:r0 + len(ys)] = flat.reshape(len(ys), width)
+        return {'index': index}
+
+    key = _key('mercator', crs, transform, shape, tuple(dst_transform)[:6] + (width, height))
+    return _tables(lut_dir, key, ('index',), build)[0], dst_transform, width, height
+
+
+def rotate_to_earth(u, v, rotation):
+    """Grid-relative (u, v) on the source grid -> earth-relative (east, north)."""
+    cos, sin = rotation
+    return u * cos + v * sin, v * cos - u * sin
+
+
+def bilinear(band, table):
+    """Gather a (ny, nx) source band through a :func:`latlon_table`. NaN where
+    less than half the weight lands on defined source points."""
+    index, weight = table
+    values = band.ravel()[np.maximum(index, 0)]
+    valid = (index >= 0) & np.isfinite(values)
+    w = np.where(valid, weight, 0)
+    total = w.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = (w * np.where(valid, values, 0)).sum(axis=0) / total
+    out[total < _MIN_WEIGHT] = np.nan
+    return out.astype(np.float32)
+
+
+def nearest(band, index, fill):
+    """Gather a source band through a :func:`mercator_table` index; ``fill``
+    outside the source grid and where the source is NaN."""
+    out = band.ravel()[np.maximum(index, 0)].astype(np.float32)
+    out[(index < 0) | np.isnan(out)] = fill
+    return out
+
+
+def to_latlon_field(grib_path, out_path, winds=False, spec=HRRR_LATLON):
+    """Regrid a native HRRR GRIB onto the lat/lon grid and publish it as a
+    modules.fieldcache ``.field`` file (the source every HRRR data-route format
+    is produced from). For winds, u/v are first rotated to earth-relative.
+    Returns out_path."""
+    if os.path.exists(out_path):
+        return out_path
+    lut_dir = os.path.join(os.path.dirname(os.path.abspath(out_path)), LUT_SUBDIR)
+    with rasterio.open(grib_path) as src:
+        bands = src.read(masked=True).astype(np.float32).filled(np.nan)
+        tags = [src.tags(i) for i in range(1, src.count + 1)]
+        crs, transform, shape = src.crs, src.transform, src.shape
+    if winds and len(bands) >= 2:
+        bands[0], bands[1] = rotate_to_earth(bands[0], bands[1], rotation_table(crs, transform, shape, lut_dir))
+    table = latlon_table(crs, transform, shape, lut_dir, spec)
+    lon0, nx, dlon, lat0, ny, dlat = spec
+    data = np.stack([bilinear(band, table).reshape(ny, nx) for band in bands])
+    try:
+        headers = gribjson.latlon_headers(grib_path, nx, ny, lon0, lat0, dlon, dlat)
+    except (gribjson.UnsupportedGrib, OSError, IndexError, ValueError):
+        headers = None
+    # Longitudes as a GRIB stores them (0-360), like every other field.
+    grid = {'nx': nx, 'ny': ny, 'lo1': lon0 % 360, 'la1': lat0 + (ny - 1) * dlat,
+            'dx': dlon, 'dy': dlat, 'crs': pyproj.CRS.from_wkt(crs.to_wkt()).geodetic_crs.to_wkt()}
+    field = fieldcache.Field(data, grid, fieldcache.band_info(tags, headers))
+    fieldcache.write(field, out_path)
+    print('Created', out_path)
+    return out_path
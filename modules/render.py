@@ -0,0 +1,100 @@
+"""Colorized PNGs drawn straight from arrays: a 256-entry RGBA lookup table
+per colormap and a zlib PNG encoder, no matplotlib figure.
+
+The colormaps are matplotlib's (so ``HRRR_PRODUCTS['cmap']`` names keep
+working and colors match the figure renderer), but each is sampled once per
+process into a (256, 4) uint8 table. Rendering a field is then a float32
+normalize, one uint8 index per pixel and a table gather; encoding is a row
+filter and one ``zlib.compress``. Used by convert.to_png (PNG_RENDERER=fast)
+and the XYZ tiles.
+"""
+import json
+import zlib
+import struct
+import functools
+
+import numpy as np
+import matplotlib
+
+LUT_SIZE = 256
+
+# zlib level for IDAT. 6 is zlib's (and Pillow's) default; past it the
+# filtered rows of a smooth field barely shrink.
+_ZLIB_LEVEL = 6
+
+# PNG tEXt keyword carrying the color scale of a rendered field.
+LEGEND_TEXT_KEY = 'legend'
+
+_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_FILTER_UP = 2
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(name):
+    """The (256, 4) uint8 RGBA table of a matplotlib colormap (read-only)."""
+    lut = matplotlib.colormaps[name].resampled(LUT_SIZE)(np.arange(LUT_SIZE), bytes=True)
+    lut.setflags(write=False)
+    return lut
+
+
+def color_limits(values, cmap_info):
+    """(vmin, vmax) for a product: the catalog's fixed limits, else the 2nd and
+    98th percentiles of the field's defined values ((0, 1) if it has none)."""
+    if 'vmin' in cmap_info and 'vmax' in cmap_info:
+        return cmap_info['vmin'], cmap_info['vmax']
+    finite = values[np.isfinite(values)]
+    if finite.size == 0:
+        lo, hi = 0.0, 1.0
+    else:
+        lo, hi = (float(p) for p in np.percentile(finite, (2, 98)))
+    return cmap_info.get('vmin', lo), cmap_info.get('vmax', hi)
+
+
+def colorize(values, cmap, vmin, vmax, log=False):
+    """(ny, nx, 4) uint8 RGBA of ``values`` through colormap ``cmap``: the
+    colors matplotlib's Normalize (LogNorm when ``log``) would give, values
+    outside [vmin, vmax] clamped to the end colors, NaN (and, for log, values
+    <= 0) transparent."""
+    values = np.asarray(values, dtype=np.float32)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if log:
+            values = np.where(values > 0, np.log10(values), np.float32(np.nan))
+            vmin, vmax = np.log10(vmin), np.log10(vmax)
+        valid = np.isfinite(values)
+        span = np.float32(vmax - vmin)
+        scale = np.float32(LUT_SIZE / span) if span > 0 else np.float32(0)
+        index = np.clip((values - np.float32(vmin)) * scale, 0, LUT_SIZE - 1)
+    index = np.where(valid, index, 0).astype(np.uint8)
+    rgba = colormap_lut(cmap)[index]
+    rgba[~valid] = 0
+    return rgba
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png(rgba, text=None):
+    """PNG bytes of an (ny, nx, 4) uint8 RGBA array, with optional ``text``
+    ({keyword: str}) as tEXt chunks. Rows use the Up filter, which turns the
+    smooth fields we draw into long zero runs for zlib."""
+    height, width = rgba.shape[:2]
+    rows = np.ascontiguousarray(rgba, dtype=np.uint8).reshape(height, width * 4)
+    raw = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 0] = _FILTER_UP
+    raw[0, 1:] = rows[0]
+    np.subtract(rows[1:], rows[:-1], out=raw[1:, 1:])  # uint8 arithmetic wraps, as PNG's does
+    parts = [_SIGNATURE, _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))]
+    for key, value in (text or {}).items():
+        parts.append(_chunk(b'tEXt', key.encode('latin-1') + b'\0' + value.encode('latin-1')))
+    parts.append(_chunk(b'IDAT', zlib.compress(raw.tobytes(), _ZLIB_LEVEL)))
+    parts.append(_chunk(b'IEND', b''))
+    return b''.join(parts)
+
+
+def legend_text(cmap_info, vmin, vmax):
+    """The ``legend`` tEXt value: the color scale a client needs to draw its own
+    legend (the server's is the ``legend`` format)."""
+    return json.dumps({'label': cmap_info['label'], 'cmap': cmap_info['cmap'],
+                       'vmin': float(vmin), 'vmax': float(vmax),
+                       'log': bool(cmap_info.get('log', False))}, separators=(',', ':'))
@@ -0,0 +1,183 @@
+"""XYZ map tiles cut from the cached EPSG:3857 HRRR COGs.
+
+A tile is a windowed read of the COG: only the 512px internal blocks (or, when
+zoomed out, the gdaladdo overview level) that intersect the tile are decoded, so
+a viewer pulls a few KB per tile instead of the whole CONUS raster. Tiles are
+written atomically under CACHE_DIR like every other cached output, so they take
+part in LRU eviction without any special casing.
+"""
+import os
+import functools
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.windows import from_bounds as window_from_bounds
+
+from modules import render
+from modules.concurrency import _atomic_output
+from config import HRRR_PRODUCTS, WINDS_BAND_COLORMAPS, NODATA
+
+# Half the width of the EPSG:3857 world square, in metres.
+WEB_MERCATOR_HALF = 20037508.342789244
+
+# Deepest zoom we render. HRRR is a 3 km grid, so anything past ~z12 is just
+# nearest-neighbor upsampling; the cap keeps x/y (and the cache fan-out) bounded.
+MAX_ZOOM = 16
+
+TILE_SIZES = (256, 512)
+
+# Tile extension -> AVAILABLE_FORMATS key for the response Content-Type.
+TILE_FORMATS = {
+    'png': 'png',
+    'tif': 'tiff',
+    'npy': 'npy',
+}
+
+
+def parse_tile_size(raw):
+    """Coerce the ?size= query value to a supported tile size. Absent -> 256.
+    Raises ValueError (-> 400) on anything else."""
+    raw = (raw or '256').strip()
+    try:
+        size = int(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f'size must be an integer, got {raw!r}')
+    if size not in TILE_SIZES:
+        raise ValueError(f'size must be one of {", ".join(map(str, TILE_SIZES))}')
+    return size
+
+
+def validate_tile(z, x, y, ext):
+    """Raise ValueError unless z/x/y address a real tile and ext is supported."""
+    if ext not in TILE_FORMATS:
+        raise ValueError(f'Unsupported tile format: {ext}. '
+                         f'Valid formats: {", ".join(TILE_FORMATS)}')
+    if not 0 <= z <= MAX_ZOOM:
+        raise ValueError(f'zoom {z} out of range (valid 0-{MAX_ZOOM})')
+    n = 1 << z
+    if not (0 <= x < n and 0 <= y < n):
+        raise ValueError(f'tile {x}/{y} out of range for zoom {z} (valid 0-{n - 1})')
+
+
+def tile_bounds(z, x, y):
+    """EPSG:3857 (left, bottom, right, top) of an XYZ tile (origin top-left)."""
+    span = 2 * WEB_MERCATOR_HALF / (1 << z)
+    left = -WEB_MERCATOR_HALF + x * span
+    top = WEB_MERCATOR_HALF - y * span
+    return left, top - span, left + span, top
+
+
+def tile_relpath(cog_prefix, z, x, y, size, ext):
+    """Cache path of a tile relative to CACHE_DIR. Nested per COG and zoom/x so a
+    busy run doesn't put hundreds of thousands of tiles in one directory; every
+    component is a validated int or the COG prefix (S2083)."""
+    return os.path.join('tiles', cog_prefix, str(z), str(x), f'{y}-{size}.{ext}')
+
+
+def _bands_for(product):
+    """(band indexes to read, colormap row) for a product's COG."""
+    if product == 'winds':
+        # u, v, speed; the PNG is colored by speed (band 3).
+        return [1, 2, 3], WINDS_BAND_COLORMAPS['speed']
+    return [1], HRRR_PRODUCTS.get(product, {'cmap': 'viridis', 'label': product})
+
+
+def _read_tile(src, indexes, bounds, size):
+    """Read the tile's window from an EPSG:3857 dataset into a
+    (bands, size, size) float32 array, NODATA outside the dataset.
+
+    Only the part of the tile that overlaps the raster is read, with out_shape
+    scaled to the tile's pixel size, so GDAL decodes just the intersecting blocks
+    and picks an overview level on its own when zoomed out."""
+    out = np.full((len(indexes), size, size), NODATA, dtype=np.float32)
+    left, bottom, right, top = bounds
+    res = (right - left) / size
+    ileft, ibottom = max(left, src.bounds.left), max(bottom, src.bounds.bottom)
+    iright, itop = min(right, src.bounds.right), min(top, src.bounds.top)
+    if iright <= ileft or itop <= ibottom:
+        return out  # tile lies outside the raster entirely
+    col0 = int(round((ileft - left) / res))
+    row0 = int(round((top - itop) / res))
+    width = max(1, int(round((iright - ileft) / res)))
+    height = max(1, int(round((itop - ibottom) / res)))
+    width, height = min(width, size - col0), min(height, size - row0)
+    if width <= 0 or height <= 0:
+        return out
+    window = window_from_bounds(ileft, ibottom, iright, itop, src.transform)
+    data = src.read(indexes, window=window, out_shape=(len(indexes), height, width),
+                    resampling=Resampling.nearest).astype(np.float32)
+    if src.nodata is not None and src.nodata != NODATA:
+        data[data == src.nodata] = NODATA
+    out[:, row0:row0 + height, col0:col0 + width] = data
+    return out
+
+
+@functools.lru_cache(maxsize=64)
+def _color_range(cog_path, _identity, band, product):
+    """(vmin, vmax) for coloring a product's tiles. Fixed limits from the catalog
+    win; otherwise the 2/98th percentiles of the COG's coarsest overview, so every
+    tile of one COG shares a single color scale without reading the full raster.
+    ``_identity`` (inode, size) keys the cache to one build of the file."""
+    info = HRRR_PRODUCTS.get(product, {})
+    if 'vmin' in info and 'vmax' in info:
+        return info['vmin'], info['vmax']
+    with rasterio.open(cog_path) as src:
+        factor = max(src.overviews(band) or [1])
+        shape = (max(1, src.height // factor), max(1, src.width // factor))
+        data = src.read(band, out_shape=shape, resampling=Resampling.nearest).astype(np.float32)
+    data = data[data != NODATA]
+    if data.size == 0:
+        return 0.0, 1.0
+    return float(np.nanpercentile(data, 2)), float(np.nanpercentile(data, 98))
+
+
+def _write_png(data, out_path, cog_path, product):
+    """Colorize one tile with the product's colormap; nodata is transparent."""
+    indexes, cmap_info = _bands_for(product)
+    band = indexes[-1]
+    st = os.stat(cog_path)
+    vmin, vmax = _color_range(cog_path, (st.st_ino, st.st_size), band, product)
+    values = np.where(data[-1] == NODATA, np.float32(np.nan), data[-1])
+    rgba = render.colorize(values, cmap_info['cmap'], vmin, vmax)
+    with open(out_path, 'wb') as f:
+        f.write(render.encode_png(rgba))
+
+
+def _write_tif(data, out_path, bounds, product):
+    """Write the raw float32 tile as a small georeferenced GeoTIFF."""
+    size = data.shape[-1]
+    names = list(WINDS_BAND_COLORMAPS) if product == 'winds' else [product]
+    profile = dict(driver='GTiff', width=size, height=size, count=data.shape[0],
+                   dtype='float32', crs='EPSG:3857', nodata=NODATA,
+                   transform=from_bounds(*bounds, size, size), compress='lzw')
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.write(data)
+        for i, name in enumerate(names, start=1):
+            dst.set_band_description(i, name)
+
+
+def _write_npy(data, out_path):
+    """Write the raw float32 (bands, size, size) tile as a .npy array."""
+    with open(out_path, 'wb') as f:
+        np.save(f, data)
+
+
+def to_tile(cog_path, out_path, product, z, x, y, size, ext):
+    """Render one XYZ tile of a COG. Returns out_path (existing or freshly built);
+    published atomically like the other producers."""
+    if os.path.exists(out_path):
+        return out_path
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    bounds = tile_bounds(z, x, y)
+    indexes, _cmap = _bands_for(product)
+    with rasterio.open(cog_path) as src:
+        data = _read_tile(src, indexes[:src.count], bounds, size)
+    with _atomic_output(out_path) as tmp:
+        if ext == 'png':
+            _write_png(data, tmp, cog_path, product)
+        elif ext == 'tif':
+            _write_tif(data, tmp, bounds, product)
+        else:
+            _write_npy(data, tmp)
+    return out_path
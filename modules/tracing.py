@@ -0,0 +1,100 @@
+"""Per-request stage timings, sent back as a ``Server-Timing`` header.
+
+server.py starts a trace for each request when ``SERVER_TIMING`` is on; the
+pipeline stages (download, regrid, subset, produce, ...) add their durations
+to it through :func:`span` or ``metrics.timer(..., span=...)``, and the
+header lists them in the order they first ran, summed per stage::
+
+    Server-Timing: lock_wait;dur=812.4, regrid;dur=96.1, produce;dur=40.3, total;dur=951.0
+
+``lock_wait`` is time blocked on another worker's build (the _download_lock
+flock) and ``flight_wait`` time blocked on another thread's build of the same
+output (_single_flight), so a slow response built by someone else is told
+apart from one that built. Hours built in parallel (bundles, point series)
+run in a copy of the request's context, so their stages add up in the same
+trace and can sum to more than ``total``.
+
+The trace lives in a ContextVar, so with no trace started :func:`span` is one
+lookup returning a shared no-op context manager.
+"""
+import time
+import threading
+import contextlib
+import contextvars
+
+_current = contextvars.ContextVar('veloserver_trace', default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class Trace:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def header(self):
+        """The Server-Timing header value, durations in milliseconds."""
+        with self._lock:
+            spans = list(self.spans.items())
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in spans]
+        parts.append(f'total;dur={self.total() * 1000:.1f}')
+        return ', '.join(parts)
+
+    def record(self):
+        """The stages as a dict for a structured log line, in milliseconds."""
+        with self._lock:
+            spans = {name: round(seconds * 1000, 1) for name, seconds in self.spans.items()}
+        return {'total_ms': round(self.total() * 1000, 1), 'spans_ms': spans}
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'began')
+
+    def __init__(self, trace, name):
+        self.trace, self.name = trace, name
+
+    def __enter__(self):
+        self.began = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.trace.add(self.name, time.perf_counter() - self.began)
+        return False
+
+
+def start():
+    """Begin a trace for the request handled by this thread; returns it."""
+    trace = Trace()
+    _current.set(trace)
+    return trace
+
+
+def finish():
+    """End this thread's trace and return it (None if none was started)."""
+    trace = _current.get()
+    _current.set(None)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def span(name):
+    """Context manager adding the block's duration to stage ``name`` of the
+    current trace; a no-op when there is none."""
+    trace = _current.get()
+    return _NOOP if trace is None else _Span(trace, name)
+
+
+def add(name, seconds):
+    """Add a duration measured elsewhere to stage ``name``."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, seconds)
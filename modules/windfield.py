@@ -0,0 +1,159 @@
+"""Compact binary wind fields for WebGL clients: ``windbin`` and ``windpng``.
+
+Both are cut from the same cached GRIBs the gribjson output is, but carry the
+10 m U/V grid as quantized integers instead of decimal text, so a particle
+renderer can upload them as textures without parsing JSON.
+
+Both share one JSON header describing the grid and the quantization::
+
+    {"nx": 1440, "ny": 721, "lo1": 0.0, "la1": 90.0, "lo2": 359.75, "la2": -90.0,
+     "dx": 0.25, "dy": 0.25, "refTime": "2024-03-05T18:00:00Z", "forecastTime": 0,
+     "u": {"scale": 0.01, "offset": 0.0}, "v": {"scale": 0.01, "offset": 0.0},
+     "nodata": -32768, "encoding": "int16le"}
+
+Rows run north to south from ``la1`` and columns west to east from ``lo1``
+(pixel centers), whatever the GRIB's own scan order. A value decodes as
+``raw * scale + offset``.
+
+``windbin``: ``b'VWND'``, the header length as a little-endian uint32, the
+UTF-8 header (space-padded so the arrays start 4-byte aligned), then ``u`` and
+``v`` as little-endian int16 ``ny * nx`` arrays. ``nodata`` marks missing points.
+
+``windpng``: an RGBA PNG with ``u`` in red and ``v`` in green as 0-255 (so
+``encoding`` is ``"uint8"``), blue unused and alpha 0 on missing points. The
+header is stored in a ``tEXt`` chunk with the keyword ``wind``.
+"""
+import os
+import json
+import datetime
+
+import numpy as np
+
+from modules import fieldcache, render
+from modules.concurrency import _atomic_output
+
+MAGIC = b'VWND'
+INT16_NODATA = -32768
+PNG_TEXT_KEY = 'wind'
+
+# Smallest int16 step, in m/s. 0.01 m/s is far below what a particle renderer
+# can show, and keeps every realistic wind (|w| < 327 m/s) on the fixed scale.
+_MIN_SCALE = 0.01
+
+# GDAL GRIB element names for the U and V wind components: WMO GRIB2 names,
+# then the ECMWF GRIB1 parameter-table names.
+_U_ELEMENTS = ('UGRD', '10U')
+_V_ELEMENTS = ('VGRD', '10V')
+# Preferred level for each: 10 m above ground (GRIB2), or ECMWF's surface-coded 10u/10v.
+_PREFERRED_LEVELS = ('10-HTGL', '0-SFC')
+
+
+def _find_band(bands, elements):
+    """Index of the band holding one wind component (10 m level preferred)."""
+    candidates = [i for i, band in enumerate(bands) if band['tags'].get('GRIB_ELEMENT') in elements]
+    if not candidates:
+        raise ValueError(f'no {"/".join(elements)} band in the field')
+    for level in _PREFERRED_LEVELS:
+        for i in candidates:
+            if bands[i]['tags'].get('GRIB_SHORT_NAME') == level:
+                return i
+    return candidates[0]
+
+
+def read_uv(source):
+    """Return ``(u, v, header)``: north-up float32 U/V arrays (NaN where
+    missing) and the grid part of the shared header. ``source`` is a GRIB path
+    or a modules.fieldcache Field (e.g. a projwin slice of a mapped field)."""
+    field = fieldcache.as_field(source)
+    ui, vi = _find_band(field.bands, _U_ELEMENTS), _find_band(field.bands, _V_ELEMENTS)
+    tags, grid = field.bands[ui]['tags'], field.grid
+    nx, ny, dx, dy = grid['nx'], grid['ny'], grid['dx'], grid['dy']
+    lo1, la1 = grid['lo1'], grid['la1']
+    ref = datetime.datetime.fromtimestamp(int(tags.get('GRIB_REF_TIME', '0').split()[0]),
+                                          tz=datetime.timezone.utc)
+    header = {
+        'nx': nx, 'ny': ny,
+        'lo1': round(lo1, 6), 'la1': round(la1, 6),
+        'lo2': round(lo1 + (nx - 1) * dx, 6), 'la2': round(la1 - (ny - 1) * dy, 6),
+        'dx': round(dx, 6), 'dy': round(dy, 6),
+        'refTime': ref.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'forecastTime': int(tags.get('GRIB_FORECAST_SECONDS', '0').split()[0]) // 3600,
+    }
+    return np.asarray(field.data[ui]), np.asarray(field.data[vi]), header
+
+
+def _int16(values):
+    """Quantize to int16: returns ``(raw, {'scale', 'offset'})``."""
+    finite = values[np.isfinite(values)]
+    peak = float(np.abs(finite).max()) if finite.size else 0.0
+    scale = max(_MIN_SCALE, peak / 32767)
+    raw = np.full(values.shape, INT16_NODATA, dtype='<i2')
+    ok = np.isfinite(values)
+    raw[ok] = np.clip(np.round(values[ok] / scale), -32767, 32767)
+    return raw, {'scale': scale, 'offset': 0.0}
+
+
+def _uint8(values):
+    """Quantize to 0-255 over the field's range: ``(raw, {'scale', 'offset'})``."""
+    finite = values[np.isfinite(values)]
+    lo, hi = (float(finite.min()), float(finite.max())) if finite.size else (0.0, 0.0)
+    scale = (hi - lo) / 255 or 1.0
+    raw = np.zeros(values.shape, dtype=np.uint8)
+    ok = np.isfinite(values)
+    raw[ok] = np.clip(np.round((values[ok] - lo) / scale), 0, 255)
+    return raw, {'scale': scale, 'offset': lo}
+
+
+def encode_windbin(u, v, header):
+    """The windbin bytes for north-up U/V arrays and their grid header."""
+    uq, header['u'] = _int16(u)
+    vq, header['v'] = _int16(v)
+    header.update(nodata=INT16_NODATA, encoding='int16le')
+    text = json.dumps(header, separators=(',', ':')).encode()
+    text += b' ' * (-(len(MAGIC) + 4 + len(text)) % 4)
+    return b''.join((MAGIC, len(text).to_bytes(4, 'little'), text, uq.tobytes(), vq.tobytes()))
+
+
+def decode_windbin(blob):
+    """Inverse of :func:`encode_windbin`: ``(header, u, v)`` with u/v as raw int16."""
+    if blob[:4] != MAGIC:
+        raise ValueError('not a windbin file')
+    size = int.from_bytes(blob[4:8], 'little')
+    header = json.loads(blob[8:8 + size])
+    count = header['nx'] * header['ny']
+    arrays = np.frombuffer(blob, dtype='<i2', count=2 * count, offset=8 + size)
+    shape = (header['ny'], header['nx'])
+    return header, arrays[:count].reshape(shape), arrays[count:].reshape(shape)
+
+
+def to_windbin(source, out_path):
+    """Write the windbin for a GRIB path or Field (see :func:`read_uv`). Returns
+    out_path (existing or freshly built); published atomically like the other
+    producers."""
+    if os.path.exists(out_path):
+        return out_path
+    u, v, header = read_uv(source)
+    with _atomic_output(out_path) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(encode_windbin(u, v, header))
+    print('Created', out_path)
+    return out_path
+
+
+def to_windpng(source, out_path):
+    """Write the windpng for a GRIB path or Field. Returns out_path (existing or
+    freshly built)."""
+    if os.path.exists(out_path):
+        return out_path
+    u, v, header = read_uv(source)
+    rgba = np.zeros(u.shape + (4,), dtype=np.uint8)
+    rgba[..., 0], header['u'] = _uint8(u)
+    rgba[..., 1], header['v'] = _uint8(v)
+    rgba[..., 3] = np.where(np.isfinite(u) & np.isfinite(v), 255, 0)
+    header['encoding'] = 'uint8'
+    png = render.encode_png(rgba, {PNG_TEXT_KEY: json.dumps(header, separators=(',', ':'))})
+    with _atomic_output(out_path) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(png)
+    print('Created', out_path)
+    return out_path
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import time
+import queue
 import argparse
+import threading
+import contextvars
 import subprocess
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+import herbie.models
 from herbie import Herbie
 from ecmwfapi import ECMWFDataServer
 
 from modules.parse import _safe_path, canonical_product, hrrr_format_error, normalize_date, projwin_to_string
-from modules.concurrency import _atomic_output, _download_lock
-from modules import convert
-from config import HRRR_PRODUCTS
+from modules.concurrency import _atomic_output, _download_lock, _single_flight
+from modules import access_log, batch, cache_index, convert, fieldcache, metrics, regrid, tiles, windfield
+from config import APP_CONFIG, HRRR_PRODUCTS, WINDS_BAND_COLORMAPS
 
 # File extensions reused when deriving cache/output filenames. Centralized so the
 # literals aren't duplicated across the processing functions (Sonar S1192).
@@ -19,6 +27,16 @@ EXT_GRIB = '.grib'
 EXT_GRIB2 = '.grib2'
 EXT_JSON = '.json'
 
+# Output suffix of each wind-field format, replacing the source GRIB's extension.
+WIND_FORMAT_EXT = {
+    'gribjson': EXT_JSON,
+    'windbin': '.windbin',
+    'windpng': '.wind.png',
+}
+
+# Output suffix of every HRRR data-route format (wind formats plus rasters).
+HRRR_FORMAT_EXT = dict(WIND_FORMAT_EXT, geotiff='.tif', png='.png', legend='.legend.png')
+
 # Whole-globe bounds; a projwin equal to this means "no spatial subset".
 GLOBAL_PROJWIN = [-180, 90, 180, -90]
 
@@ -28,6 +46,55 @@ GLOBAL_PROJWIN = [-180, 90, 180, -90]
 # workers, where gunicorn's worker timeout no longer reaps a single hung request.
 _HTTP_TIMEOUT = (10, 60)
 
+# NOMADS connections each process keeps open (a worker's threads and a batch's
+# groups fetch at once), and the size of the chunks a download is written in.
+_HTTP_POOL_SIZE = 16
+_DOWNLOAD_CHUNK = 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+# GFS cycles whose global field this process is fetching in the background.
+_prefetching = set()
+_prefetch_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # A forked worker opens its own connections instead of sharing the parent's
+    # sockets, and runs none of the parent's background fetches.
+    global _session, _session_lock, _prefetch_lock
+    _session = None
+    _session_lock = threading.Lock()
+    _prefetching.clear()
+    _prefetch_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class _hrrr_mirror:
+    """Herbie model template: HRRR as the ``hrrr`` template describes it, but
+    fetched only from the bucket at HRRR_SOURCE_URL (the ``mirror`` argument)."""
+
+    def template(self):
+        herbie.models.hrrr.template(self)
+        self.SOURCES = {'mirror': f'{self.mirror}/hrrr.{self.date:%Y%m%d}/conus/'
+                                  f'hrrr.t{self.date:%H}z.wrf{self.product}f{self.fxx:02d}.grib2'}
+
+
+# Herbie looks templates up by model name on herbie.models.
+herbie.models.hrrr_mirror = _hrrr_mirror
+
+
+def _herbie(date, hour, fxx, save_dir):
+    """Herbie for one HRRR run and forecast hour: from HRRR_SOURCE_URL when it
+    is set, else from Herbie's public mirrors."""
+    mirror = APP_CONFIG['HRRR_SOURCE_URL'].rstrip('/')
+    if mirror:
+        return Herbie(date + ' ' + hour, model='hrrr_mirror', fxx=fxx, save_dir=save_dir,
+                      mirror=mirror, priority=['mirror'])
+    return Herbie(date + ' ' + hour, model='hrrr', fxx=fxx, save_dir=save_dir)
+
 
 def parse_arguments():
     """
@@ -39,8 +106,8 @@ def parse_arguments():
     parser = argparse.ArgumentParser(description="Subset wind data from selected models and generate visualization ready outputs.")
     parser.add_argument('-p', '--projwin', type=float, required=False,
                         default=None, nargs=4, help='<ulx> <uly> <lrx> <lry>')
-    parser.add_argument('-d', '--date', type=str, required=True,
-                        help='str year-month-day e.g., "2024-03-05"')
+    parser.add_argument('-d', '--date', type=str, required=False,
+                        help='str year-month-day e.g., "2024-03-05" (required unless --manifest)')
     parser.add_argument('-t', '--time', type=str, required=False,
                         default='00:00:00', help='hour_rounded: e.g., 19:00:00')
     parser.add_argument('-o', '--output_dir', type=str,
@@ -48,13 +115,31 @@ def parse_arguments():
     parser.add_argument('-m', '--model', type=str, required=False,
                         default='hrrr', help='Model name (ecmwf, gfs, hrrr)')
     parser.add_argument('-f', '--format', type=str, required=False,
-                        default='gribjson', help='Output file format (gribjson, geojson, geotiff, png)')
+                        default='gribjson', help='Output file format (gribjson, windbin, windpng, geotiff, png)')
     parser.add_argument('-r', '--product', type=str, required=False,
                         default='winds', help=f'Product name. Available: {list(HRRR_PRODUCTS.keys())}')
     parser.add_argument('-u', '--user_defined', type=str, required=False,
                         help='Path to user defined model configuration')
-
-    return parser.parse_args()
+    batch = parser.add_argument_group(
+        'batch mode', 'Build many outputs in one run: -d/-m and the lists below (or --manifest) '
+                      'name every combination; outputs sharing a download run in one worker process.')
+    batch.add_argument('-b', '--batch', action='store_true', help='Run in batch mode')
+    batch.add_argument('--end_date', type=str, help='Last date of the range starting at -d (inclusive)')
+    batch.add_argument('--hours', type=str, help='Run hours, e.g. "0-23" or "0,6,12,18" (default: the hour of -t)')
+    batch.add_argument('--products', type=str, help='Comma-separated products (default: -r)')
+    batch.add_argument('--fxx', type=str, default='0', help='HRRR forecast hours, e.g. "0-6" (default: 0)')
+    batch.add_argument('--bbox', type=str, action='append',
+                       help='ulx,uly,lrx,lry, repeatable; "global" for the whole grid (default: -p)')
+    batch.add_argument('--formats', type=str, help='Comma-separated formats (default: -f)')
+    batch.add_argument('--manifest', type=str, help='JSON list of batch specs (implies --batch)')
+    batch.add_argument('--workers', type=int, default=os.cpu_count(), help='Worker processes')
+    batch.add_argument('--state', type=str,
+                       help='State file to resume from (default: batch-state.jsonl in the output directory)')
+
+    args = parser.parse_args()
+    if not args.date and not args.manifest:
+        parser.error('the following arguments are required: -d/--date')
+    return args
 
 
 def lon360(lon):
@@ -66,25 +151,39 @@ def lon360(lon):
     return (lon + 360) % 360 if lon < 0 else lon
 
 def _regrid_latlon(grib_path, out_path, winds=False):
-    """Regrid a native HRRR GRIB onto the latlon grid. For winds, -new_grid_winds
-    earth rotates the vectors to earth-relative first. Returns out_path."""
+    """Regrid a native HRRR GRIB onto the latlon grid (0.1 degree,
+    -134..-61 by 21..52) through the precomputed lookup tables of
+    modules.regrid, writing the memory-mapped .field every HRRR format is
+    produced from. Winds are rotated to earth-relative first. Returns out_path."""
+    with metrics.timer('veloserver_stage_seconds', span='regrid', stage='regrid', model='hrrr'):
+        return regrid.to_latlon_field(grib_path, out_path, winds=winds)
+
+
+def _wgrib2_latlon(grib_path, out_path, winds=False):
+    """Regrid a native HRRR GRIB onto the same latlon grid with wgrib2 (winds
+    rotated by -new_grid_winds earth), as a GRIB grib2json can read: the
+    fallback input when an HRRR gribjson isn't encoded from the .field.
+    Returns out_path."""
     if os.path.exists(out_path):
         return out_path
-    with _atomic_output(out_path) as tmp:
+    lon, nx, dlon, lat, ny, dlat = regrid.HRRR_LATLON
+    with metrics.timer('veloserver_stage_seconds', span='regrid', stage='regrid_wgrib2', model='hrrr'), \
+            _atomic_output(out_path) as tmp:
         cmd = ['wgrib2', grib_path]
         if winds:
             cmd += ['-new_grid_winds', 'earth']
-        cmd += ['-new_grid', 'latlon', '-134:730:0.1', '21:310:0.1', tmp]
+        cmd += ['-new_grid', 'latlon', f'{lon:g}:{nx}:{dlon:g}', f'{lat:g}:{ny}:{dlat:g}', tmp]
         subprocess.run(cmd)
     return out_path
 
 
-def _subset_grib(grib_path, out_path, lon_min, lon_max, lat_min, lat_max):
+def _subset_grib(grib_path, out_path, lon_min, lon_max, lat_min, lat_max, model):
     """Subset a GRIB to a lon/lat box with wgrib2 -small_grib. The caller supplies
     the bounds in the grid's own convention (e.g. 0-360 lon). Returns out_path."""
     if os.path.exists(out_path):
         return out_path
-    with _atomic_output(out_path) as tmp:
+    with metrics.timer('veloserver_stage_seconds', span='subset', stage='subset', model=model), \
+            _atomic_output(out_path) as tmp:
         subprocess.run(['wgrib2', grib_path, '-small_grib',
                         f'{lon_min}:{lon_max}', f'{lat_min}:{lat_max}', tmp])
     return out_path
@@ -97,44 +196,162 @@ def _regrid_name_prefix(product, date, hour, fxx):
 
 
 def _regrid_hrrr(product, date, hour, output_dir, fxx):
-    """Download native HRRR and regrid it to a latlon GRIB2; return its path."""
+    """Download native HRRR and regrid it to a latlon .field; return its path."""
     prefix = _regrid_name_prefix(product, date, hour, fxx)
-    regrid_file = _safe_path(output_dir, prefix + EXT_GRIB2)
+    regrid_file = _safe_path(output_dir, prefix + fieldcache.EXT_FIELD)
     if os.path.exists(regrid_file):
         return regrid_file
 
-    with _download_lock(output_dir, prefix):
-        if os.path.exists(regrid_file):  # built by another worker while we waited
-            return regrid_file
-        H = Herbie(date + ' ' + hour, model="hrrr", fxx=fxx, save_dir=output_dir)
-        download_file = str(H.download(HRRR_PRODUCTS[product]['search'], verbose=True))
-        print('Downloaded', download_file)
-        _regrid_latlon(download_file, regrid_file, winds=(product == 'winds'))
-    return regrid_file
-
-
-def _subset_hrrr(product, projwin, date, hour, output_dir, regrid_file, fxx):
-    """Subset the regridded GRIB2 to projwin; return the GRIB to convert (the
-    subset, or the full regrid when no projwin was given)."""
-    if projwin == GLOBAL_PROJWIN:
+    def build():
+        with _download_lock(output_dir, prefix):
+            if os.path.exists(regrid_file):  # built by another worker while we waited
+                return regrid_file
+            H = _herbie(date, hour, fxx, output_dir)
+            with metrics.timer('veloserver_download_seconds', span='download', source='herbie'):
+                download_file = str(H.download(HRRR_PRODUCTS[product]['search'], verbose=True))
+            _count_download('herbie', download_file)
+            print('Downloaded', download_file)
+            cache_index.record(download_file)  # Herbie writes it itself, not via _atomic_output
+            _regrid_latlon(download_file, regrid_file, winds=(product == 'winds'))
         return regrid_file
+
+    # Threads of this worker share one download; the flock orders workers.
+    return _single_flight(regrid_file, build)
+
+
+def _hrrr_grib(product, date, hour, fxx, output_dir, projwin):
+    """The GRIB grib2json reads for an HRRR gribjson when the configured
+    encoder is grib2json or the native one fails: the native download
+    regridded by wgrib2 (_wgrib2_latlon), cut to projwin with -small_grib."""
+    prefix = _regrid_name_prefix(product, date, hour, fxx)
+    latlon_file = _safe_path(output_dir, prefix + EXT_GRIB2)
+    with _download_lock(output_dir, prefix + '-wgrib2'):
+        if not os.path.exists(latlon_file):
+            H = _herbie(date, hour, fxx, output_dir)
+            download_file = str(H.download(HRRR_PRODUCTS[product]['search'], verbose=False))
+            cache_index.record(download_file)
+            _wgrib2_latlon(download_file, latlon_file, winds=(product == 'winds'))
+    if projwin == GLOBAL_PROJWIN:
+        return latlon_file
     subset_file = _safe_path(output_dir,
                              f'hrrr-{product}-{projwin_to_string(projwin)}-{date}T{hour}-f{fxx:02d}{EXT_GRIB2}')
-    return _subset_grib(regrid_file, subset_file,
-                        projwin[0], projwin[2], projwin[3], projwin[1])
+    return _subset_grib(latlon_file, subset_file, projwin[0], projwin[2], projwin[3], projwin[1], 'hrrr')
 
 
-def _convert_hrrr(output_grib, format, product):
-    """Dispatch the GRIB to the requested format producer; return the output file
-    path, or an error string for an unsupported format. The per-format work lives
-    in modules.convert; here we just map format -> output filename."""
-    if format == 'gribjson':
-        return convert.to_gribjson(output_grib, output_grib.replace(EXT_GRIB2, EXT_JSON))
-    elif format == 'geotiff':
-        return convert.to_geotiff(output_grib, output_grib.replace(EXT_GRIB2, '.tif'))
-    elif format == 'png':
-        return convert.to_png(output_grib, output_grib.replace(EXT_GRIB2, '.png'), product)
-    return f'Unsupported format: {format}'
+def _subset_hrrr(regrid_file, projwin):
+    """The projwin part of the regridded field: a slice of its memory-mapped
+    .field, so a new box costs no subprocess and no new GRIB. Raises ValueError
+    if projwin misses the grid."""
+    with metrics.timer('veloserver_stage_seconds', span='subset', stage='subset', model='hrrr'):
+        return fieldcache.subset(fieldcache.open_field(regrid_file), projwin)
+
+
+def _count_download(source, path):
+    """Count the bytes of a fetched source file in /metrics."""
+    try:
+        metrics.inc('veloserver_download_bytes_total', os.path.getsize(path), source=source)
+    except OSError:
+        pass
+
+
+def _http_session():
+    """This process's requests.Session, whose pooled connections are kept alive
+    between downloads, so a miss reuses an open TCP/TLS connection instead of
+    making a new one."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=_HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def _check_grib_stream(chunks):
+    """Pass ``chunks`` of a GRIB2 download through, raising IOError as soon as
+    they stop being whole GRIB2 messages. Each message starts with 'GRIB' and
+    its 16-byte section 0 holds its length, so an error page or a body cut short
+    is caught without trusting Content-Length (the NOMADS filter sends none)."""
+    head, remaining = b'', 0
+    for chunk in chunks:
+        pos = 0
+        while pos < len(chunk):
+            if remaining:
+                step = min(remaining, len(chunk) - pos)
+                remaining, pos = remaining - step, pos + step
+                continue
+            take = 16 - len(head)
+            head, pos = head + chunk[pos:pos + take], pos + take
+            if len(head) < 16:
+                break
+            if head[:4] != b'GRIB' or head[7] != 2:
+                raise IOError(f'Not a GRIB2 message: {head[:16]!r}')
+            remaining, head = int.from_bytes(head[8:16], 'big') - 16, b''
+            if remaining < 0:
+                raise IOError('GRIB2 message shorter than its header')
+        yield chunk
+    if head or remaining:
+        raise IOError('Download cut short inside a GRIB2 message')
+
+
+def _stream_download(url, path, source):
+    """Fetch ``url`` into ``path`` through the pooled session, streamed to disk
+    in chunks and checked as GRIB2 as it arrives (_check_grib_stream), then
+    published atomically. Returns None, or the error message for a non-200
+    answer; a broken body raises and leaves nothing behind."""
+    start = time.monotonic()
+    size = 0
+    with metrics.timer('veloserver_download_seconds', span='download', source=source):
+        with _http_session().get(url, timeout=_HTTP_TIMEOUT, stream=True) as response:
+            if response.status_code != 200:
+                return f'Error retrieving data: {url} - {response.status_code}'
+            with _atomic_output(path) as tmp:
+                with open(tmp, 'wb') as f:
+                    for chunk in _check_grib_stream(response.iter_content(_DOWNLOAD_CHUNK)):
+                        f.write(chunk)
+                        size += len(chunk)
+    seconds = time.monotonic() - start
+    metrics.inc('veloserver_download_bytes_total', size, source=source)
+    print(f'Downloaded {path} ({size / 1e6:.1f} MB in {seconds:.1f}s, {size / 1e6 / max(seconds, 1e-6):.1f} MB/s)')
+    return None
+
+
+def _cache_lookup(path, model, product, format):
+    """True if the output ``path`` is already built; counted as a cache hit or
+    miss in /metrics and the request's access log line."""
+    hit = os.path.exists(path)
+    metrics.inc('veloserver_cache_requests_total', model=model, product=product, format=format,
+                result='hit' if hit else 'miss')
+    access_log.note_cache(hit)
+    return hit
+
+
+def _convert_winds(source, out_path, format, timeout=None, grib=None):
+    """Produce one of the wind-field formats (gribjson, windbin, windpng) from a
+    U/V GRIB or Field; shared by every model. ``timeout`` and ``grib`` (for a
+    Field, a callable returning its GRIB) only matter if grib2json runs."""
+    with metrics.timer('veloserver_produce_seconds', span='produce', format=format):
+        if format == 'windbin':
+            return windfield.to_windbin(source, out_path)
+        if format == 'windpng':
+            return windfield.to_windpng(source, out_path)
+        return convert.to_gribjson(source, out_path, timeout=timeout, grib=grib)
+
+
+def _convert_hrrr(source, out_path, format, product, grib=None):
+    """Dispatch the regridded field (or a slice of it) to the requested
+    format producer; return the output file path. The per-format work lives in
+    modules.convert / modules.windfield; here we just pick the producer."""
+    if format in WIND_FORMAT_EXT:
+        return _convert_winds(source, out_path, format, grib=grib)
+    with metrics.timer('veloserver_produce_seconds', span='produce', format=format):
+        if format == 'geotiff':
+            return convert.to_geotiff(source, out_path)
+        elif format == 'legend':
+            return convert.to_legend(source, out_path, product)
+        return convert.to_png(source, out_path, product)
 
 
 def process_hrrr(product, projwin, date, time, output_dir, format, fxx=0):
@@ -146,6 +363,8 @@ def process_hrrr(product, projwin, date, time, output_dir, format, fxx=0):
     format_error = hrrr_format_error(product, format)
     if format_error:
         return format_error
+    if format not in HRRR_FORMAT_EXT:
+        return f'Unsupported format: {format}'
 
     print(f'Processing HRRR {product}')
     if projwin is None:
@@ -155,8 +374,27 @@ def process_hrrr(product, projwin, date, time, output_dir, format, fxx=0):
     date = normalize_date(date)
 
     regrid_file = _regrid_hrrr(product, date, hour, output_dir, fxx)
-    output_grib = _subset_hrrr(product, projwin, date, hour, output_dir, regrid_file, fxx)
-    return _convert_hrrr(output_grib, format, product)
+    if projwin == GLOBAL_PROJWIN:
+        out_path = regrid_file.replace(fieldcache.EXT_FIELD, HRRR_FORMAT_EXT[format])
+    else:
+        out_path = _safe_path(output_dir, f'hrrr-{product}-{projwin_to_string(projwin)}-{date}T{hour}'
+                                          f'-f{fxx:02d}{HRRR_FORMAT_EXT[format]}')
+    if _cache_lookup(out_path, 'hrrr', product, format):
+        return out_path
+
+    def build():
+        if projwin == GLOBAL_PROJWIN:
+            source = fieldcache.open_field(regrid_file)
+        else:
+            try:
+                source = _subset_hrrr(regrid_file, projwin)
+            except ValueError as e:
+                return str(e)
+        return _convert_hrrr(source, out_path, format, product,
+                             grib=lambda: _hrrr_grib(product, date, hour, fxx, output_dir, projwin))
+
+    # The output path names product/run/fxx/projwin/format, so it is the key.
+    return _single_flight(out_path, build)
 
 
 def _cog_name_prefix(product, date, hour, fxx):
@@ -177,14 +415,18 @@ def _download_hrrr_native(product, date, hour, fxx, cache_dir):
     the file is missing or unreadable by gdal (partial/corrupt fetch). Returns the
     GRIB path. product/date/hour/fxx are already validated at the request boundary."""
     search = HRRR_PRODUCTS[product]['search']
-    H = Herbie(date + ' ' + hour, model='hrrr', fxx=fxx, save_dir=cache_dir)
-    grib_file = str(H.download(search, verbose=False))
+    H = _herbie(date, hour, fxx, cache_dir)
+    with metrics.timer('veloserver_download_seconds', span='download', source='herbie'):
+        grib_file = str(H.download(search, verbose=False))
     gdalinfo_result = subprocess.run(['gdalinfo', grib_file], capture_output=True)
     if not os.path.exists(grib_file) or gdalinfo_result.returncode != 0:
         print(f'[COG] GRIB file missing or corrupt, re-downloading: {grib_file}')
         if os.path.exists(grib_file):
             os.remove(grib_file)
-        grib_file = str(H.download(search, verbose=False))
+        with metrics.timer('veloserver_download_seconds', span='download', source='herbie'):
+            grib_file = str(H.download(search, verbose=False))
+    _count_download('herbie', grib_file)
+    cache_index.record(grib_file)  # Herbie writes it itself, not via _atomic_output
     return grib_file
 
 
@@ -192,17 +434,102 @@ def ensure_cog(product, date, hour, fxx, cache_dir):
     """Return the EPSG:3857 COG path for an HRRR product/run/forecast-hour,
     building it on a cache miss."""
     cog_file = _safe_path(cache_dir, _cog_filename(product, date, hour, fxx))
-    if os.path.exists(cog_file):
+    if _cache_lookup(cog_file, 'hrrr', product, 'cog'):
         return cog_file
     # One cross-process builder per COG: the lock spans download AND generate so
-    # two gunicorn workers can't both fetch and build the same COG
-    with _download_lock(cache_dir, _cog_name_prefix(product, date, hour, fxx)):
-        if os.path.exists(cog_file):
-            return cog_file
-        grib_file = _download_hrrr_native(product, date, hour, fxx, cache_dir)
-        return convert.to_cog(grib_file, cog_file, product)
-
-def process_ecmwf(projwin, date, output_dir):
+    # two gunicorn workers can't both fetch and build the same COG; threads of
+    # one worker share a single attempt.
+    def build():
+        with _download_lock(cache_dir, _cog_name_prefix(product, date, hour, fxx)):
+            if os.path.exists(cog_file):
+                return cog_file
+            grib_file = _download_hrrr_native(product, date, hour, fxx, cache_dir)
+            with metrics.timer('veloserver_produce_seconds', span='cog', format='cog'):
+                return convert.to_cog(grib_file, cog_file, product)
+
+    return _single_flight(cog_file, build)
+
+
+def ensure_tile(product, date, hour, fxx, z, x, y, size, ext, cache_dir):
+    """Return the cached XYZ tile path for an HRRR product/run/forecast-hour,
+    building the parent COG (ensure_cog) and then the tile on a miss. Returns
+    ``(tile_path, cog_path)`` so the caller can mark both as used."""
+    cog_file = ensure_cog(product, date, hour, fxx, cache_dir)
+    tile_file = _safe_path(cache_dir, tiles.tile_relpath(
+        _cog_name_prefix(product, date, hour, fxx), z, x, y, size, ext))
+    if _cache_lookup(tile_file, 'hrrr', product, f'tile-{ext}'):
+        return tile_file, cog_file
+
+    def build():
+        with metrics.timer('veloserver_produce_seconds', span='tile', format=f'tile-{ext}'):
+            return tiles.to_tile(cog_file, tile_file, product, z, x, y, size, ext)
+
+    tile = _single_flight(tile_file, build)
+    return tile, cog_file
+
+def map_forecast_hours(build, fxx_list):
+    """Yield ``(fxx, build(fxx))`` for each forecast hour, in fxx order, with up
+    to HOUR_BUILD_WORKERS hours building at once (a cache hit costs a stat). An
+    hour is yielded as soon as it and every hour before it are done; one that
+    raises yields its exception instead. Closing the generator early cancels
+    the hours not started yet."""
+    def attempt(fxx):
+        try:
+            return build(fxx)
+        except Exception as e:
+            print(f'[hours] forecast hour f{fxx:02d} unavailable: {e}')
+            return e
+
+    pool = ThreadPoolExecutor(max_workers=max(1, APP_CONFIG['HOUR_BUILD_WORKERS']))
+    try:
+        # Each hour runs in a copy of the request's context, so its stages
+        # land in the request's trace (modules.tracing).
+        futures = [pool.submit(contextvars.copy_context().run, attempt, fxx) for fxx in fxx_list]
+        for fxx, future in zip(fxx_list, futures):
+            yield fxx, future.result()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _build_hrrr_hours(product, date, hour, fxx_list, output_dir):
+    """Regrid each forecast hour of a run concurrently (map_forecast_hours).
+    Returns {fxx: .field path, or the exception that hour failed with}."""
+    return dict(map_forecast_hours(lambda fxx: _regrid_hrrr(product, date, hour, output_dir, fxx), fxx_list))
+
+
+def hrrr_point_series(product, date, hour, fxx_list, lats, lons, output_dir):
+    """Values of an HRRR product at a batch of points for each forecast hour in
+    fxx_list, read from the memory-mapped regridded fields (only the pages under
+    the points). Values are at the nearest 0.1-degree grid point, in the units
+    the PNG and COG use (the catalog scale applied); winds give u, v and speed.
+    Returns ``(bands, series, grid_lats, grid_lons, missing)``: series is
+    (bands, points, hours) float32, NaN off the grid and for the hours in
+    ``missing`` (not published upstream yet, or failed)."""
+    winds = product == 'winds'
+    bands = list(WINDS_BAND_COLORMAPS) if winds else [product]
+    scale = np.float32(HRRR_PRODUCTS[product].get('scale', 1))
+    series = np.full((len(bands), len(lats), len(fxx_list)), np.nan, dtype=np.float32)
+    grid_lats = grid_lons = np.full(len(lats), np.nan)
+    missing = []
+    for k, (fxx, path) in enumerate(_build_hrrr_hours(product, date, hour, fxx_list, output_dir).items()):
+        if isinstance(path, Exception):
+            missing.append(fxx)
+            continue
+        values, grid_lats, grid_lons = fieldcache.sample(fieldcache.open_field(path), lats, lons)
+        cache_index.touch(path)
+        if winds:
+            values = np.stack([values[0], values[1], np.hypot(values[0], values[1])])
+        series[:, :, k] = values[:len(bands)] * scale
+    return bands, series, grid_lats, grid_lons, missing
+
+
+def valid_times(date, hour, fxx_list):
+    """ISO valid time ('...Z') of each forecast hour of the run at date/hour."""
+    run = datetime.strptime(f'{date}T{hour}', '%Y-%m-%dT%H:%M:%S')
+    return [(run + timedelta(hours=fxx)).strftime('%Y-%m-%dT%H:%M:%SZ') for fxx in fxx_list]
+
+
+def process_ecmwf(projwin, date, output_dir, format='gribjson'):
     print('Processing ECMWF data')
 
     # Round down to the nearest 6th hour
@@ -214,7 +541,8 @@ def process_ecmwf(projwin, date, output_dir):
     with _download_lock(output_dir, 'ecmwf-uv-' + date + 'T' + hour):
         if not os.path.isfile(download_file):  # re-check inside the lock
             server = ECMWFDataServer()
-            with _atomic_output(download_file) as tmp:
+            with metrics.timer('veloserver_download_seconds', span='download', source='ecmwf'), \
+                    _atomic_output(download_file) as tmp:
                 server.retrieve({
                     "class": "s2",
                     "dataset": "s2s",
@@ -231,6 +559,7 @@ def process_ecmwf(projwin, date, output_dir):
                     "grid": "0.1/0.1",
                     "target": tmp
                 })
+            _count_download('ecmwf', download_file)
             print('Downloaded', download_file)
 
     # Subset GRIB file
@@ -239,15 +568,115 @@ def process_ecmwf(projwin, date, output_dir):
                                  'ecmwf-uv-' + projwin_to_string(projwin) + '-' + date + 'T' + hour + EXT_GRIB)
         download_file = _subset_grib(download_file, subset_file,
                                      lon360(projwin[0]), lon360(projwin[2]),
-                                     projwin[3], projwin[1])
+                                     projwin[3], projwin[1], 'ecmwf')
         print('Subset file', subset_file)
 
-    # Convert GRIB to JSON
-    output_file = download_file.replace(EXT_GRIB, EXT_JSON)
-    return convert.to_gribjson(download_file, output_file, timeout=60)
+    # Convert GRIB to the requested wind format
+    output_file = download_file.replace(EXT_GRIB, WIND_FORMAT_EXT[format])
+    if _cache_lookup(output_file, 'ecmwf', 'winds', format):
+        return output_file
+    return _convert_winds(download_file, output_file, format, timeout=60)
+
+
+def _gfs_url(date, rounded_hour, projwin):
+    """The NOMADS filter query for a cycle's 10 m winds, cut to ``projwin``
+    (None: the whole globe)."""
+    url_base = APP_CONFIG['GFS_FILTER_URL'] + '?'
+    url_middle = 'dir=%2Fgfs.' + date.replace('-', '') + '%2F' + \
+                 f'{rounded_hour:02d}' + '%2Fatmos&file=gfs.t' + \
+                 f'{rounded_hour:02d}' + 'z.pgrb2.0p25.f000'
+    url_end = '&var_TMP=on&var_UGRD=on&var_VGRD=on&lev_10_m_above_ground=on'
+    if projwin is not None:
+        subregion = '&subregion=&toplat=' + str(projwin[1]) + \
+                    '&leftlon=' + str(lon360(projwin[0])) + \
+                    '&rightlon=' + str(lon360(projwin[2])) + \
+                    '&bottomlat=' + str(projwin[3])
+        url_end = url_end + subregion
+    return url_base + url_middle + url_end
+
+
+def _gfs_global(date, hour, rounded_hour, output_dir):
+    """Download a GFS cycle's global GRIB and decode it into a .field; return
+    its path, or the error message of a failed download."""
+    prefix = 'gfs-global-' + date + 'T' + hour
+    grib_file = _safe_path(output_dir, prefix + EXT_GRIB)
+    field_file = fieldcache.field_path(grib_file)
+    if os.path.exists(field_file):
+        return field_file
+
+    def build():
+        with _download_lock(output_dir, prefix):
+            if os.path.exists(field_file):  # built by another worker while we waited
+                return field_file
+            if not os.path.isfile(grib_file):
+                url = _gfs_url(date, rounded_hour, None)
+                print('Downloading', url)
+                error = _stream_download(url, grib_file, 'nomads')
+                if error is not None:
+                    return error
+            if os.path.getsize(grib_file) == 0:
+                os.remove(grib_file)
+                return f'Error retrieving data: empty GFS download for {date}T{hour}'
+            fieldcache.write(fieldcache.read_grib(grib_file), field_file)
+            print('Created', field_file)
+        return field_file
+
+    # Threads of this worker share one download; the flock orders workers.
+    return _single_flight(field_file, build)
+
+
+def _prefetch_gfs_global(date, hour, rounded_hour, output_dir):
+    """Start fetching a cycle's global field in a background thread, unless this
+    process is already fetching it."""
+    key = (date, hour)
+    with _prefetch_lock:
+        if key in _prefetching:
+            return
+        _prefetching.add(key)
+
+    def fetch():
+        try:
+            _gfs_global(date, hour, rounded_hour, output_dir)
+        except Exception as e:
+            print(f'[gfs] background fetch of the {date}T{hour} global field failed: {e}')
+        finally:
+            with _prefetch_lock:
+                _prefetching.discard(key)
+
+    threading.Thread(target=fetch, daemon=True).start()
+
+
+def _gfs_grib(date, hour, rounded_hour, output_dir, projwin):
+    """The GRIB grib2json reads for a GFS gribjson cut from the global field
+    when the configured encoder is grib2json or the native one fails: the
+    cycle's global GRIB (fetched again if evicted), cut to projwin with
+    -small_grib in its 0-360 longitudes."""
+    prefix = 'gfs-global-' + date + 'T' + hour
+    grib_file = _safe_path(output_dir, prefix + EXT_GRIB)
+    with _download_lock(output_dir, prefix):
+        if not os.path.isfile(grib_file):
+            error = _stream_download(_gfs_url(date, rounded_hour, None), grib_file, 'nomads')
+            if error is not None:
+                raise IOError(error)
+    if projwin is None:
+        return grib_file
+    subset_file = _safe_path(output_dir, prefix + '-' + projwin_to_string(projwin) + EXT_GRIB)
+    return _subset_grib(grib_file, subset_file, lon360(projwin[0]), lon360(projwin[2]),
+                        projwin[3], projwin[1], 'gfs')
+
 
+def _subset_gfs(field_file, projwin):
+    """The projwin part of a cycle's global field (a slice of the mapped
+    .field; fieldcache.subset wraps boxes across 0 E), or all of it for None.
+    Raises ValueError if projwin misses the grid."""
+    field = fieldcache.open_field(field_file)
+    if projwin is None:
+        return field
+    with metrics.timer('veloserver_stage_seconds', span='subset', stage='subset', model='gfs'):
+        return fieldcache.subset(field, projwin)
 
-def process_gfs(projwin, date, time, output_dir):
+
+def process_gfs(projwin, date, time, output_dir, format='gribjson'):
     print('Processing GFS data')
     if projwin is not None:
         projwin_string = projwin_to_string(projwin)
@@ -259,42 +688,187 @@ def process_gfs(projwin, date, time, output_dir):
     rounded_hour = (time_obj.hour // 6) * 6
     hour = time_obj.replace(hour=rounded_hour).strftime('%H:00:00')
 
-    # Download subsetted GFS GRIB file (date already validated by strptime above)
+    # (date already validated by strptime above)
     download_file = _safe_path(output_dir, 'gfs-' + projwin_string + '-' + date + 'T' + hour + EXT_GRIB)
-    output_file = _safe_path(output_dir, 'gfs-' + projwin_string + '-' + date + 'T' + hour + EXT_JSON)
+    output_file = _safe_path(output_dir, 'gfs-' + projwin_string + '-' + date + 'T' + hour + WIND_FORMAT_EXT[format])
+    if _cache_lookup(output_file, 'gfs', 'winds', format):
+        return output_file
+
+    cold = not os.path.exists(_safe_path(output_dir, 'gfs-global-' + date + 'T' + hour + fieldcache.EXT_FIELD))
+    if APP_CONFIG['GFS_GLOBAL'] and not (cold and projwin is not None and APP_CONFIG['GFS_COLD_FILTER']):
+        # One global download per cycle; each projwin is a slice of its field.
+        field_file = _gfs_global(date, hour, rounded_hour, output_dir)
+        if not os.path.isfile(field_file):
+            return field_file
+
+        def build():
+            try:
+                source = _subset_gfs(field_file, projwin)
+            except ValueError as e:
+                return str(e)
+            return _convert_winds(source, output_file, format,
+                                  grib=lambda: _gfs_grib(date, hour, rounded_hour, output_dir, projwin))
+
+        # The output path names the cycle, projwin and format, so it is the key.
+        return _single_flight(output_file, build)
+    if APP_CONFIG['GFS_GLOBAL']:
+        # A cold cycle: this projwin gets a small subregion request now, and
+        # the global field is on its way for the next one.
+        _prefetch_gfs_global(date, hour, rounded_hour, output_dir)
+
+    # Download subsetted GFS GRIB file
     print('Checking for existing', download_file)
     with _download_lock(output_dir, 'gfs-' + projwin_string + '-' + date + 'T' + hour):
         if not os.path.isfile(download_file):  # re-check inside the lock
-            url_base = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gfs_0p25.pl?'
-            url_middle = 'dir=%2Fgfs.' + time_obj.strftime('%Y%m%d') + '%2F' + \
-                         f'{rounded_hour:02d}' + '%2Fatmos&file=gfs.t' + \
-                         f'{rounded_hour:02d}' + 'z.pgrb2.0p25.f000'
-            url_end = '&var_TMP=on&var_UGRD=on&var_VGRD=on&lev_10_m_above_ground=on'
-            if projwin is not None:
-                subregion = '&subregion=&toplat=' + str(projwin[1]) + \
-                            '&leftlon=' + str(lon360(projwin[0])) + \
-                            '&rightlon=' + str(lon360(projwin[2])) + \
-                            '&bottomlat=' + str(projwin[3])
-                url_end = url_end + subregion
-            url = url_base + url_middle + url_end
+            url = _gfs_url(date, rounded_hour, projwin)
             print('Downloading', url)
-            response = requests.get(url, timeout=_HTTP_TIMEOUT)
-            if response.status_code == 200:
-                with _atomic_output(download_file) as tmp:
-                    with open(tmp, 'wb') as f:
-                        f.write(response.content)
-                print('Downloaded', download_file)
-            else:
-                return f'Error retrieving data: {url} - {response.status_code}'
+            error = _stream_download(url, download_file, 'nomads')
+            if error is not None:
+                return error
 
-    # Convert GRIB to JSON. Guard against an empty download so we don't emit empty
-    # JSON; the cache-hit short-circuit lives in convert.to_gribjson.
-    print('Checking for existing', output_file)
+    # Convert GRIB to the requested wind format. Guard against an empty download so
+    # we don't emit an empty output.
     if os.path.getsize(download_file) > 0:
-        convert.to_gribjson(download_file, output_file)
+        _convert_winds(download_file, output_file, format)
     return output_file
 
 
+def _process_output(output, output_dir):
+    """Build one batch output (modules.batch.Output); returns the path, or the
+    error message process_* returned."""
+    if output.model == 'hrrr':
+        return process_hrrr(output.product, output.projwin and list(output.projwin), output.date,
+                            output.hour, output_dir, output.format, output.fxx)
+    if output.model == 'gfs':
+        return process_gfs(output.projwin and list(output.projwin), output.date, output.hour,
+                           output_dir, output.format)
+    return process_ecmwf(output.projwin and list(output.projwin), output.date, output_dir, output.format)
+
+
+def _run_group(outputs, output_dir):
+    """Build the outputs of one batch group in order, the first one building
+    the intermediate the rest reuse. Returns ``[(output, ok, detail)]``."""
+    done = []
+    for output in outputs:
+        try:
+            result = _process_output(output, output_dir)
+            ok = isinstance(result, str) and os.path.isfile(result)
+            detail = result
+        except Exception as e:
+            ok, detail = False, f'{type(e).__name__}: {e}'
+        done.append((output, ok, detail))
+    return done
+
+
+def run_batch(outputs, output_dir, workers=1, state_path=None):
+    """Build ``outputs`` (modules.batch.Output) across ``workers`` processes, one
+    group of outputs sharing an intermediate per task, skipping those the state
+    file records as built. Returns the number of outputs that failed."""
+    done = batch.load_state(state_path)
+    todo = [o for o in outputs if batch.key(o) not in done]
+    groups = list(batch.group(todo).values())
+    print(f'[batch] {len(outputs)} outputs, {len(outputs) - len(todo)} already built; '
+          f'{len(todo)} to build in {len(groups)} groups on {workers} workers')
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.monotonic()
+    built = failed = 0
+
+    def finished(n_group, results):
+        nonlocal built, failed
+        for output, ok, detail in results:
+            batch.record_state(state_path, output, ok, detail)
+            built += ok
+            failed += not ok
+            if not ok:
+                print(f'[batch] failed {batch.key(output)}: {detail}')
+        elapsed = time.monotonic() - start
+        eta = elapsed / n_group * (len(groups) - n_group)
+        print(f'[batch] {n_group}/{len(groups)} groups, {built} built, {failed} failed, '
+              f'{elapsed:.0f}s elapsed, ~{eta:.0f}s left', flush=True)
+
+    if workers <= 1:
+        for n, outputs_of_group in enumerate(groups, 1):
+            finished(n, _run_group(outputs_of_group, output_dir))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run_group, g, output_dir) for g in groups]
+            for n, future in enumerate(as_completed(futures), 1):
+                finished(n, future.result())
+    return failed
+
+
+class _GroupResults:
+    """The iterator stream_groups returns: ``(output, result)`` as outputs
+    finish. Closing it -- even before the first item -- stops each group after
+    its current output and cancels the groups not started; running out of
+    items closes it too."""
+
+    def __init__(self, results, count, stop, pool):
+        self._results, self._left, self._stop, self._pool = results, count, stop, pool
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._left <= 0 or self._stop.is_set():
+            self.close()
+            raise StopIteration
+        self._left -= 1
+        return self._results.get()
+
+    def close(self):
+        self._stop.set()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def stream_groups(groups, output_dir):
+    """Build each group of outputs (modules.batch.group) in the server, up to
+    HOUR_BUILD_WORKERS groups at once, each group's outputs in order on one
+    thread. Returns an iterator of ``(output, result)`` in the order outputs
+    finish, result being the path, the error message process_* returned, or
+    the exception it raised. The groups start at the call; closing the
+    iterator (_GroupResults) stops each group after its current output and
+    cancels the rest."""
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def build(outputs):
+        for output in outputs:
+            if stop.is_set():
+                return
+            try:
+                result = _process_output(output, output_dir)
+            except Exception as e:
+                print(f'[batch] {batch.key(output)} unavailable: {e}')
+                result = e
+            results.put((output, result))
+
+    pool = ThreadPoolExecutor(max_workers=max(1, APP_CONFIG['HOUR_BUILD_WORKERS']))
+    # Each group runs in a copy of the request's context, like the hours of a
+    # bundle (map_forecast_hours), so its stages land in the request's trace.
+    for outputs in groups:
+        pool.submit(contextvars.copy_context().run, build, outputs)
+    return _GroupResults(results, sum(len(outputs) for outputs in groups), stop, pool)
+
+
+def _batch_outputs(args):
+    """The outputs the batch arguments (or their manifest) name."""
+    if args.manifest:
+        specs = batch.load_manifest(args.manifest)
+    else:
+        bboxes = args.bbox or [','.join(map(str, args.projwin)) if args.projwin else None]
+        specs = [{'model': args.model, 'products': args.products or args.product, 'date': args.date,
+                  'end_date': args.end_date, 'hours': args.hours or int(args.time[:2]), 'fxx': args.fxx,
+                  'projwins': bboxes, 'formats': args.formats or args.format}]
+    outputs = {}
+    for spec in specs:
+        expanded, dropped = batch.expand(spec)
+        for product, format in dropped:
+            print(f'[batch] skipping {product} as {format}: {hrrr_format_error(product, format)}')
+        outputs.update(dict.fromkeys(expanded))
+    return list(outputs)
+
+
 def process_user_defined(definition):
     print(f'Processing user defined model: {definition}')
 
@@ -304,6 +878,13 @@ def main():
     Main function.
     """
     args = parse_arguments()
+    if args.batch or args.manifest:
+        try:
+            outputs = _batch_outputs(args)
+        except (OSError, ValueError) as e:
+            sys.exit(f'Invalid batch: {e}')
+        state = args.state or os.path.join(args.output_dir, 'batch-state.jsonl')
+        sys.exit(1 if run_batch(outputs, args.output_dir, args.workers, state) else 0)
     print('Getting info for:', args.projwin, args.date,
           args.time, args.output_dir)
 
@@ -315,9 +896,9 @@ def main():
         process_hrrr(args.product, args.projwin, args.date, args.time,
                      args.output_dir, args.format)
     elif args.model == 'ecmwf':
-        process_ecmwf(args.projwin, args.date, args.output_dir)
+        process_ecmwf(args.projwin, args.date, args.output_dir, args.format)
     elif args.model == 'gfs':
-        process_gfs(args.projwin, args.date, args.time, args.output_dir)
+        process_gfs(args.projwin, args.date, args.time, args.output_dir, args.format)
     else:
         print('Model is not supported.')
 
@@ -1,6 +1,9 @@
 import os
+import json
 from bottle import Bottle, run, request, response, static_file, abort
+import config
 from app import App, text_error
+from modules import access_log, manage_cache, metrics, tracing
 from modules.parse import is_allowed_path_info
 
 bottle_app = Bottle()
@@ -14,6 +17,72 @@ def cog_path(product, time_param):
     return dataApp.serve_cog(product, time_param, request.query.get('fxx'))
 
 
+@bottle_app.route('/tiles/<product>/<z:int>/<x:int>/<y:int>.<ext>')
+def tile_path(product, z, x, y, ext):
+    # The run is a query param (like fxx on /cog) so the path stays the plain
+    # z/x/y.ext template web map clients and CDNs expect.
+    return dataApp.serve_tile(product, z, x, y, ext,
+                              request.query.get('time'),
+                              request.query.get('fxx'),
+                              request.query.get('size'))
+
+
+@bottle_app.route('/hrrr/<product>/point', method=['GET', 'POST', 'OPTIONS'])
+def hrrr_point(product):
+    # Declared before the generic /<model>/<format>/<datetime> route, which
+    # would otherwise take this path. GET is one point (?lat=&lon=); POST a JSON
+    # body {"points": [{"lat": .., "lon": ..}, ...], "time": .., "fxx": ..} whose
+    # time/fxx may also come from the query string.
+    if request.method == 'OPTIONS':
+        return ''
+    query = request.query
+    if request.method == 'POST':
+        try:
+            body = json.loads(request.body.read() or b'{}')
+        except ValueError:
+            return text_error(400, 'Invalid JSON body')
+        if not isinstance(body, dict):
+            return text_error(400, 'JSON body must be an object with a "points" list')
+        points = body.get('points')
+        time_param, fxx = body.get('time', query.get('time')), body.get('fxx', query.get('fxx'))
+    else:
+        points = [{'lat': query.get('lat'), 'lon': query.get('lon')}]
+        time_param, fxx = query.get('time'), query.get('fxx')
+    (output_format, data) = dataApp.serve_point(product, time_param, fxx, points)
+    response.content_type = output_format
+    return data
+
+
+@bottle_app.route('/hrrr/<product>/bundle/<format>')
+def hrrr_bundle(product, format):
+    # Also ahead of the generic routes (the four-segment one would take it).
+    # The run, hour range, bbox and container are query params, like /point.
+    query = request.query
+    (output_format, data) = dataApp.serve_bundle(product, format, query.get('time'), query.get('fxx'),
+                                                 query.get('projwin'), query.get('container'))
+    response.content_type = output_format
+    return data
+
+
+@bottle_app.route('/batch', method=['POST', 'OPTIONS'])
+def data_batch():
+    # A JSON body {"requests": [{"model": .., "product": .., "format": ..,
+    # "time": .., "projwin": .., "fxx": ..}, ...], "container": "ndjson"}; the
+    # container may also come from the query string.
+    if request.method == 'OPTIONS':
+        return ''
+    try:
+        body = json.loads(request.body.read() or b'{}')
+    except ValueError:
+        return text_error(400, 'Invalid JSON body')
+    if not isinstance(body, dict):
+        return text_error(400, 'JSON body must be an object with a "requests" list')
+    (output_format, data) = dataApp.serve_batch(body.get('requests'),
+                                                body.get('container', request.query.get('container')))
+    response.content_type = output_format
+    return data
+
+
 def enable_cors(fn):
     def _enable_cors(*args, **kwargs):
         # set CORS headers
@@ -37,21 +106,52 @@ def strip_path():
     if not is_allowed_path_info(path):
         abort(400, 'Invalid request path')
     request.environ['PATH_INFO'] = path.rstrip('/')
+    # Counted only once the path is accepted; after_request undoes it.
+    metrics.gauge_add('veloserver_requests_in_flight', 1, pid=os.getpid())
+    request.environ['veloserver.in_flight'] = True
+    if config.APP_CONFIG['SERVER_TIMING'] or config.APP_CONFIG['TRACE_LOG']:
+        tracing.start()
 
 
 @bottle_app.hook('after_request')
 def enable_cors_after_request_hook():
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Methods'] = 'GET'
+    # The point and batch routes also take POSTs (and their preflight).
+    response.headers['Access-Control-Allow-Methods'] = \
+        'GET, POST' if request.path.endswith(('/point', '/batch')) else 'GET'
     response.headers['Access-Control-Allow-Headers'] = 'Origin, Accept, Content-Type, X-Requested-With, X-CSRF-Token'
 
 
+@bottle_app.hook('after_request')
+def count_request_done():
+    # A streamed body (bundles, cached files) may still be sending; this counts
+    # the handler, which is where a request waits on the pipeline.
+    if request.environ.pop('veloserver.in_flight', False):
+        metrics.gauge_add('veloserver_requests_in_flight', -1, pid=os.getpid())
+    metrics.maybe_flush()
+    trace = tracing.finish()
+    if trace is not None:
+        if config.APP_CONFIG['SERVER_TIMING']:
+            response.headers['Server-Timing'] = trace.header()
+            response.headers['Timing-Allow-Origin'] = '*'
+        if config.APP_CONFIG['TRACE_LOG']:
+            print('[trace] ' + json.dumps(dict(trace.record(), method=request.method, path=request.path,
+                                               query=request.query_string, status=response.status_code)))
+
+
 @bottle_app.route('/')
 def server_static(filename='index.html'):
     # root = os.path.dirname(__file__)
     return static_file(filename, root='.')
 
 
+@bottle_app.route('/metrics')
+def server_metrics():
+    # Prometheus scrape target; sums the snapshots of every worker (modules.metrics).
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.render()
+
+
 @bottle_app.route('/swagger.yaml')
 def server_swagger_yaml(filename='swagger.yaml'):
     return static_file(filename, root='.')
@@ -119,9 +219,16 @@ _TIMEOUT = int(os.environ.get('VELOSERVER_TIMEOUT', 60))
 
 
 def main():
+    # Snapshots of a previous run's workers would be summed into this one's.
+    metrics.clear()
+    # One eviction thread for the whole server, in the process that forks the
+    # gunicorn workers; they only note growth (manage_cache.note_growth).
+    manage_cache.start_evictor(config.APP_CONFIG)
+    # One JSON line per request when ACCESS_LOG names a file (benchmarks/replay.py).
+    app = access_log.middleware(bottle_app) if config.APP_CONFIG['ACCESS_LOG'] else bottle_app
     # production
     if (os.path.exists('/certs/key.pem') and os.path.exists('/certs/cert.pem')):
-        run(bottle_app,
+        run(app,
             host='0.0.0.0',
             port=8104,
             server='gunicorn',
@@ -132,7 +239,7 @@ def main():
             certfile='/certs/cert.pem')
     else:
         # dev mode
-        run(bottle_app,
+        run(app,
             host='0.0.0.0',
             port=8104,
             server='gunicorn',
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""A local stand-in for Veloserver's upstreams, for offline end-to-end and load
+tests that must not hammer NOAA.
+
+Serves, on one port:
+
+  /hrrr/hrrr.YYYYMMDD/conus/hrrr.tHHz.wrfsfcfFF.grib2[.idx]
+      the HRRR bucket layout Herbie reads (point the server at it with
+      HRRR_SOURCE_URL=http://host:port/hrrr). Every run and forecast hour is
+      "published": one synthetic GRIB2 on HRRR's native grid holding every
+      product's field, with the run and forecast hour stamped into each message
+      per request. HEAD, full GET and Range GETs (Herbie's curl subsets) work.
+  /cgi-bin/filter_gfs_0p25.pl?dir=...&file=...&subregion=&toplat=...
+      the NOMADS GFS filter process_gfs queries (GFS_FILTER_URL=
+      http://host:port/cgi-bin/filter_gfs_0p25.pl): 10 m U/V on the 0.25 degree
+      grid, cut to the subregion.
+  /_stats
+      JSON request/byte counts by kind (head, idx, grib, gfs) so a test can
+      tell whether the server went upstream, and the connections accepted (one
+      per /_stats call too) so it can tell whether they were kept alive.
+
+Latency, bandwidth and failures are injected per request (see --help). The
+fixtures are written with rasterio's GRIB driver, as the unit tests' are; no
+network access is needed.
+
+Run:  python3 tests/fake_upstream.py --port 8106 [--latency 0.2] [--bandwidth 20e6] [--fail-rate 0.05]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import tempfile
+import threading
+import urllib.parse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.transform import from_origin
+
+# HRRR's native CONUS grid (as benchmarks/cog_build.py writes it).
+HRRR_NX, HRRR_NY = 1799, 1059
+HRRR_ORIGIN = (-2699020.143, 1588193.847)
+HRRR_DX = 3000.0
+HRRR_LCC = ('+proj=lcc +lat_0=38.5 +lon_0=-97.5 +lat_1=38.5 +lat_2=38.5 '
+            '+x_0=0 +y_0=0 +R=6371229 +units=m +no_defs')
+_IDS = ('CENTER=7 SUBCENTER=0 MASTER_TABLE=2 SIGNF_REF_TIME=1 '
+        'REF_TIME=2024-03-05T19:00:00Z PROD_STATUS=0 TYPE=1')
+
+# The sfc messages config.HRRR_PRODUCTS searches for:
+# (variable, level, parameter category, parameter number, surface type, surface value)
+HRRR_FIELDS = (
+    ('UGRD', '10 m above ground', 2, 2, 103, 10),
+    ('VGRD', '10 m above ground', 2, 3, 103, 10),
+    ('TMP', '2 m above ground', 0, 0, 103, 2),
+    ('HPBL', 'surface', 3, 18, 1, 0),
+    ('MASSDEN', '8 m above ground', 20, 0, 103, 8),
+    ('PRATE', 'surface', 1, 7, 1, 0),
+    ('RH', '2 m above ground', 1, 1, 103, 2),
+    ('GUST', 'surface', 2, 22, 1, 0),
+    ('DPT', '2 m above ground', 0, 6, 103, 2),
+)
+# A plausible magnitude for each field, so renders and color limits look sane.
+_SCALE = {'UGRD': 10, 'VGRD': 10, 'TMP': 290, 'HPBL': 1000, 'MASSDEN': 2e-8,
+          'PRATE': 1e-4, 'RH': 60, 'GUST': 12, 'DPT': 280}
+
+GFS_RES = 0.25
+_GFS_UV_PDS = ('2 2 2 0 96 0 0 1 0 103 0 10 255 0 0', '2 3 2 0 96 0 0 1 0 103 0 10 255 0 0')
+
+_HRRR_PATH = re.compile(r'^/hrrr/hrrr\.(\d{8})/conus/hrrr\.t(\d{2})z\.wrfsfcf(\d{2})\.grib2(\.idx)?$')
+_GFS_DIR = re.compile(r'^/gfs\.(\d{8})/(\d{2})/atmos$')
+_CHUNK = 64 * 1024
+
+
+def _pds(category, number, surface, value):
+    return f'{category} {number} 2 0 96 0 0 1 0 {surface} 0 {value} 255 0 0'
+
+
+def _write_grib(path, fields, pds, crs, transform):
+    """A GRIB2 of float32 ``fields`` (one message each) with the given
+    product definition template 4.0 values."""
+    tif = path + '.src.tif'
+    ny, nx = fields[0].shape
+    profile = dict(driver='GTiff', width=nx, height=ny, count=len(fields), dtype='float32',
+                   crs=crs, transform=transform)
+    opts = {'DISCIPLINE': '0', 'IDS': _IDS}
+    with rasterio.open(tif, 'w', **profile) as dst:
+        for band, (field, values) in enumerate(zip(fields, pds), 1):
+            dst.write(field.astype(np.float32), band)
+            opts[f'BAND_{band}_PDS_PDTN'] = '0'
+            opts[f'BAND_{band}_PDS_TEMPLATE_ASSEMBLED_VALUES'] = values
+    rasterio.shutil.copy(tif, path, driver='GRIB', **opts)
+    os.remove(tif)
+    return path
+
+
+def make_hrrr_template(path):
+    """One HRRR sfc GRIB2 on the native grid holding every HRRR_FIELDS message."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:HRRR_NY, 0:HRRR_NX] / 50.0
+    fields, pds = [], []
+    for var, _level, category, number, surface, value in HRRR_FIELDS:
+        wave = np.sin(x + rng.uniform(0, 6)) * np.cos(y)
+        base = 0.0 if var in ('UGRD', 'VGRD') else 1.0
+        fields.append(_SCALE[var] * (base + 0.5 * wave))
+        pds.append(_pds(category, number, surface, value))
+    return _write_grib(path, fields, pds, rasterio.crs.CRS.from_proj4(HRRR_LCC),
+                       from_origin(*HRRR_ORIGIN, HRRR_DX, HRRR_DX))
+
+
+def make_gfs_grib(path, toplat=90.0, leftlon=0.0, rightlon=359.75, bottomlat=-90.0):
+    """10 m U/V on the 0.25 degree GFS grid points inside the box (longitudes
+    0..360 E, wrapping when leftlon > rightlon), as filter_gfs_0p25.pl cuts it."""
+    i0, i1 = int(np.ceil(leftlon / GFS_RES)), int(np.floor(rightlon / GFS_RES))
+    if i1 < i0:
+        i1 += int(360 / GFS_RES)
+    j0, j1 = int(np.ceil(bottomlat / GFS_RES)), int(np.floor(toplat / GFS_RES))
+    lon = np.arange(i0, i1 + 1) * GFS_RES
+    lat = np.arange(j1, j0 - 1, -1) * GFS_RES
+    lat, lon = np.meshgrid(lat, lon, indexing='ij')
+    u = 15 * np.cos(np.radians(lat)) * np.sin(np.radians(3 * lon))
+    v = 8 * np.sin(np.radians(2 * lat)) * np.cos(np.radians(lon))
+    transform = from_origin(lon[0, 0] - GFS_RES / 2, lat[0, 0] + GFS_RES / 2, GFS_RES, GFS_RES)
+    return _write_grib(path, [u, v], _GFS_UV_PDS, 'EPSG:4326', transform)
+
+
+def _messages(data):
+    """``[(offset, length)]`` of the GRIB2 messages in ``data``."""
+    out, pos = [], 0
+    while True:
+        pos = data.find(b'GRIB', pos)
+        if pos < 0:
+            return out
+        length = struct.unpack('>Q', data[pos + 8:pos + 16])[0]
+        out.append((pos, length))
+        pos += length
+
+
+def _stamp_offsets(data, offset):
+    """Offsets of the reference time (section 1) and forecast time (section 4,
+    template 4.0) of the message at ``offset``."""
+    ref, fcst = None, None
+    pos = offset + 16
+    while data[pos:pos + 4] != b'7777':
+        length, number = struct.unpack('>IB', data[pos:pos + 5])
+        if number == 1:
+            ref = pos + 12
+        elif number == 4:
+            fcst = pos + 17
+        pos += length
+    return ref, fcst
+
+
+class Bucket:
+    """The HRRR template GRIB, stamped per run and forecast hour on the way out."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        self.messages = _messages(self.data)
+        if len(self.messages) != len(HRRR_FIELDS):
+            raise RuntimeError(f'{path}: {len(self.messages)} GRIB messages, expected {len(HRRR_FIELDS)}')
+        self.stamps = [_stamp_offsets(self.data, offset) for offset, _length in self.messages]
+
+    def idx(self, run, fxx):
+        when = 'anl' if fxx == 0 else f'{fxx} hour fcst'
+        return ''.join(f'{n}:{offset}:d={run:%Y%m%d%H}:{var}:{level}:{when}:\n'
+                       for n, ((offset, _length), (var, level, *_pds)) in
+                       enumerate(zip(self.messages, HRRR_FIELDS), 1)).encode()
+
+    def read(self, run, fxx, start, end):
+        """Bytes ``start`` .. ``end`` (exclusive) of the GRIB of run ``run``,
+        forecast hour ``fxx``."""
+        out = bytearray(self.data[start:end])
+        ref = struct.pack('>HBBBBB', run.year, run.month, run.day, run.hour, 0, 0)
+        fcst = struct.pack('>BI', 1, fxx)  # time range unit (hours), forecast time
+        for ref_at, fcst_at in self.stamps:
+            for at, value in ((ref_at, ref), (fcst_at, fcst)):
+                lo, hi = max(at, start), min(at + len(value), end)
+                if lo < hi:
+                    out[lo - start:hi - start] = value[lo - at:hi - at]
+        return bytes(out)
+
+
+class Upstream:
+    """Fixtures, injected faults and request counts shared by the handlers."""
+
+    def __init__(self, workdir, latency=0.0, bandwidth=0.0, fail_rate=0.0, fail_status=503, seed=0):
+        self.workdir = workdir
+        self.latency, self.bandwidth = latency, bandwidth
+        self.fail_rate, self.fail_status = fail_rate, fail_status
+        self.bucket = Bucket(make_hrrr_template(os.path.join(workdir, 'hrrr-sfc.grib2')))
+        self.gfs = {}
+        self.stats = {'requests': 0, 'failed': 0, 'bytes': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def count(self, kind, nbytes=0, failed=False):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+            self.stats['bytes'] += nbytes
+            self.stats['failed'] += failed
+
+    def connected(self):
+        with self._lock:
+            self.stats['connections'] = self.stats.get('connections', 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.fail_rate
+
+    def gfs_grib(self, box):
+        """The GFS GRIB for a subregion ``box`` (None: global), built once."""
+        with self._lock:
+            path = self.gfs.get(box)
+            if path is None:
+                name = 'gfs-' + ('global' if box is None else '_'.join(map(str, box))) + '.grib2'
+                path = make_gfs_grib(os.path.join(self.workdir, name), *(box or ()))
+                self.gfs[box] = path
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream = None  # set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.upstream.connected()
+
+    def do_HEAD(self):
+        self._dispatch(head=True)
+
+    def do_GET(self):
+        self._dispatch(head=False)
+
+    def _dispatch(self, head):
+        up = self.upstream
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/_stats':
+            with up._lock:
+                return self._send(200, json.dumps(up.stats).encode(), 'application/json', head)
+        if up.latency:
+            time.sleep(up.latency)
+        hrrr = _HRRR_PATH.match(url.path)
+        kind = ('head' if head else 'idx' if hrrr.group(4) else 'grib') if hrrr else 'gfs'
+        if up.should_fail():
+            up.count(kind, failed=True)
+            return self._send(up.fail_status, b'injected failure\n', 'text/plain', head)
+        if hrrr:
+            return self._hrrr(hrrr, kind, head)
+        if url.path == '/cgi-bin/filter_gfs_0p25.pl':
+            return self._gfs(urllib.parse.parse_qs(url.query, keep_blank_values=True), head)
+        self._send(404, b'not found\n', 'text/plain', head)
+
+    def _hrrr(self, match, kind, head):
+        up = self.upstream
+        date, hour, fxx, idx = match.groups()
+        run = datetime.strptime(date + hour, '%Y%m%d%H')
+        if idx:
+            body = up.bucket.idx(run, int(fxx))
+            up.count(kind, 0 if head else len(body))
+            return self._send(200, body, 'text/plain', head)
+        size = len(up.bucket.data)
+        start, end = 0, size
+        ranged = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if ranged:
+            start = int(ranged.group(1))
+            end = min(int(ranged.group(2)) + 1, size) if ranged.group(2) else size
+            if start >= end:
+                up.count(kind)
+                return self._send(416, b'', 'text/plain', head, {'Content-Range': f'bytes */{size}'})
+        body = b'' if head else up.bucket.read(run, int(fxx), start, end)
+        up.count(kind, len(body))
+        headers = {'Accept-Ranges': 'bytes'}
+        if ranged:
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        self._send(206 if ranged else 200, body, 'application/octet-stream', head, headers, end - start)
+
+    def _gfs(self, query, head):
+        up = self.upstream
+        match = _GFS_DIR.match(query.get('dir', [''])[0])
+        if not match or not query.get('file', [''])[0].startswith(f'gfs.t{match.group(2)}z.pgrb2.0p25.f'):
+            up.count('gfs')
+            return self._send(400, b'bad dir/file\n', 'text/plain', head)
+        box = None
+        if 'subregion' in query:
+            try:
+                box = tuple(float(query[k][0]) for k in ('toplat', 'leftlon', 'rightlon', 'bottomlat'))
+            except (KeyError, ValueError):
+                up.count('gfs')
+                return self._send(400, b'bad subregion\n', 'text/plain', head)
+        body = up.gfs_grib(box)
+        up.count('gfs', 0 if head else len(body))
+        self._send(200, body, 'application/octet-stream', head)
+
+    def _send(self, status, body, content_type, head, headers=None, length=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body) if length is None else length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if head:
+            return
+        bandwidth = self.upstream.bandwidth
+        for pos in range(0, len(body), _CHUNK):
+            chunk = body[pos:pos + _CHUNK]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+
+
+def serve(port=0, host='127.0.0.1', workdir=None, **faults):
+    """Start the fake upstream in a daemon thread; returns the server (its
+    base URL is ``f'http://{host}:{server.server_port}'``). ``faults`` are
+    Upstream's latency/bandwidth/fail_rate/fail_status/seed."""
+    handler = type('BoundHandler', (Handler,), {
+        'upstream': Upstream(workdir or tempfile.mkdtemp(prefix='velo-upstream-'), **faults)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8106)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help='bytes/s per connection (0: unthrottled)')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--fail-status', type=int, default=503, help='status of an injected failure')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the failure draw')
+    parser.add_argument('--workdir', help='where the fixtures are written (default: a temp dir)')
+    args = parser.parse_args()
+    server = serve(args.port, args.host, args.workdir, latency=args.latency, bandwidth=args.bandwidth,
+                   fail_rate=args.fail_rate, fail_status=args.fail_status, seed=args.seed)
+    print(f'fake upstream on http://{args.host}:{server.server_port} '
+          f'(hrrr: /hrrr, gfs: /cgi-bin/filter_gfs_0p25.pl, stats: /_stats)', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,13 +2,15 @@
 
 Stdlib only. These tests hit a *running* server (default http://localhost:8104)
 and validate real responses, so the server must be up with network access to
-NOAA HRRR / NOMADS GFS. Bring it up with `docker compose up -d` first.
+NOAA HRRR / NOMADS GFS -- or pointed at tests/fake_upstream.py (OFFLINE=1
+tests/run_tests.sh). Bring it up with `docker compose up -d` first.
 """
 
 import os
 import re
 import math
 import json
+import time
 import shutil
 import tempfile
 import subprocess
@@ -21,6 +23,9 @@ from config import NODATA  # noqa: E402
 from datetime import datetime, timedelta, timezone
 
 BASE = os.environ.get("VELOSERVER_URL", "http://localhost:8104")
+# The fake upstream the server is pointed at (tests/fake_upstream.py), when the
+# suite runs offline; its /_stats tell whether a request went upstream.
+UPSTREAM = os.environ.get("VELOSERVER_UPSTREAM")
 # Default to a private, 0700 temp dir with an unpredictable name rather than a
 # hardcoded publicly-writable path like /tmp/velotest (Sonar S5443). Operators
 # can still pin a specific directory via VELOSERVER_TEST_OUT.
@@ -94,6 +99,47 @@ def fetch(path, timeout=240):
         return None, b"", str(e)
 
 
+def timed_fetch(path, timeout=240):
+    """fetch() plus the seconds it took: (status, body, err, seconds)."""
+    t = time.time()
+    status, body, err = fetch(path, timeout=timeout)
+    return status, body, err, time.time() - t
+
+
+def percentile(values, q):
+    """Nearest-rank ``q``-th percentile of ``values`` (0 < q <= 100)."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def latency_summary(latencies, wall):
+    """One-line throughput and p50/p95/p99 of request ``latencies`` (seconds)
+    that took ``wall`` seconds in all."""
+    if not latencies:
+        return "no requests"
+    return (f"n={len(latencies)} throughput={len(latencies) / wall:.1f} req/s "
+            f"p50={percentile(latencies, 50):.3f}s p95={percentile(latencies, 95):.3f}s "
+            f"p99={percentile(latencies, 99):.3f}s")
+
+
+def upstream_stats():
+    """The fake upstream's request counts ({kind: n, 'bytes': n, ...}), or None
+    when the suite isn't running against one."""
+    if not UPSTREAM:
+        return None
+    try:
+        with urllib.request.urlopen(UPSTREAM + "/_stats", timeout=5) as r:
+            return json.loads(r.read())
+    except Exception:
+        return None
+
+
+def upstream_fetches(before, after):
+    """GRIB downloads (HRRR ranges and GFS filter calls) between two
+    upstream_stats() snapshots."""
+    return sum(after.get(k, 0) - before.get(k, 0) for k in ("grib", "gfs"))
+
+
 # ---- content validators: return (ok, detail) ----
 
 def validate_gribjson(body, product=None):
@@ -27,8 +27,23 @@ from helpers import Results, server_up, BASE, clear_cache  # noqa: E402
 import test_parse  # noqa: E402
 import test_concurrency  # noqa: E402
 import test_config  # noqa: E402
+import test_conditional  # noqa: E402
 import test_manage_cache  # noqa: E402
+import test_cache_index  # noqa: E402
+import test_hotcache  # noqa: E402
+import test_metrics  # noqa: E402
+import test_tracing  # noqa: E402
+import test_access_log  # noqa: E402
 import test_process_data  # noqa: E402
+import test_batch  # noqa: E402
+import test_tiles  # noqa: E402
+import test_gribjson  # noqa: E402
+import test_windfield  # noqa: E402
+import test_fieldcache  # noqa: E402
+import test_cog  # noqa: E402
+import test_regrid  # noqa: E402
+import test_render  # noqa: E402
+import test_app  # noqa: E402
 import test_endpoints  # noqa: E402
 import test_status_codes  # noqa: E402
 import test_stress  # noqa: E402
@@ -51,18 +66,48 @@ def main():
     print("=" * 64)
     clear_cache()
     # Unit tests need no server/network and always run, one module at a time.
-    # test_process_data self-skips when the GIS stack isn't importable (i.e.
-    # outside the container).
+    # test_process_data and test_batch self-skip when the GIS stack isn't
+    # importable (i.e. outside the container).
     _module("test_parse")
     test_parse.run(r)
     _module("test_concurrency")
     test_concurrency.run(r)
     _module("test_config")
     test_config.run(r)
+    _module("test_conditional")
+    test_conditional.run(r)
     _module("test_manage_cache")
     test_manage_cache.run(r)
+    _module("test_cache_index")
+    test_cache_index.run(r)
+    _module("test_hotcache")
+    test_hotcache.run(r)
+    _module("test_metrics")
+    test_metrics.run(r)
+    _module("test_tracing")
+    test_tracing.run(r)
+    _module("test_access_log")
+    test_access_log.run(r)
     _module("test_process_data")
     test_process_data.run(r)
+    _module("test_batch")
+    test_batch.run(r)
+    _module("test_tiles")
+    test_tiles.run(r)
+    _module("test_gribjson")
+    test_gribjson.run(r)
+    _module("test_windfield")
+    test_windfield.run(r)
+    _module("test_fieldcache")
+    test_fieldcache.run(r)
+    _module("test_cog")
+    test_cog.run(r)
+    _module("test_regrid")
+    test_regrid.run(r)
+    _module("test_render")
+    test_render.run(r)
+    _module("test_app")
+    test_app.run(r)
 
     if not server_up():
         print(f"\nServer not reachable at {BASE}; ran unit tests only.")
@@ -90,9 +135,12 @@ def main():
         test_stress.test_slam(r)
         r.section("LRU eviction under pressure (cache full)")
         test_stress.test_lru_eviction(r)
+        r.section("cold vs warm cache latency")
+        test_stress.test_cold_warm_latency(r)
     else:
         r.skipped("slam stability (mixed load)", "set VELOSERVER_STRESS=1 to run (slow)")
         r.skipped("LRU eviction under pressure (cache full)", "set VELOSERVER_STRESS=1 to run (slow)")
+        r.skipped("cold vs warm cache latency", "set VELOSERVER_STRESS=1 to run (slow)")
     return 0 if r.summary() else 1
 
 
@@ -9,6 +9,8 @@
 #   KEEP=1 tests/run_tests.sh               # leave the container running afterwards
 #   IMAGE=NASA-AMMOS/veloserver:latest tests/run_tests.sh   # use a different image
 #   CACHE_MAX_BYTES=536870912 tests/run_tests.sh            # bigger budget (512MB)
+#   OFFLINE=1 tests/run_tests.sh            # against tests/fake_upstream.py, no NOAA traffic
+#   OFFLINE=1 UPSTREAM_ARGS="--latency 0.2 --bandwidth 20e6 --fail-rate 0.02" tests/run_tests.sh
 #
 # Budget sizing: 512MB is meant to stay larger than the concurrent working set, so
 # the LRU front holds the in-flight files (eviction only reclaims genuinely-old
@@ -43,12 +45,26 @@ cleanup() {
 }
 trap cleanup EXIT
 
+# OFFLINE=1: the server fetches HRRR and GFS from the fake upstream started in the
+# same container (tests/fake_upstream.py) instead of NOAA. UPSTREAM_ARGS are passed
+# to it (latency, bandwidth, failure injection; see its --help).
+UPSTREAM_PORT=8106
+UPSTREAM="http://localhost:$UPSTREAM_PORT"
+UPSTREAM_ENV=()
+SUITE_UPSTREAM=""
+if [[ "${OFFLINE:-0}" == "1" ]]; then
+  SUITE_UPSTREAM="$UPSTREAM"
+  UPSTREAM_ENV=(-e HRRR_SOURCE_URL="$UPSTREAM/hrrr"
+                -e GFS_FILTER_URL="$UPSTREAM/cgi-bin/filter_gfs_0p25.pl")
+fi
+
 echo "==> starting disposable test server"
 echo "    image=$IMAGE  budget=$((BUDGET/1024/1024))MB  empty cache"
 docker rm -f "$NAME" >/dev/null 2>&1 || true
 docker volume rm "$VOL" >/dev/null 2>&1 || true
 docker run -d --name "$NAME" \
   -e CACHE_MAX_BYTES="$BUDGET" \
+  "${UPSTREAM_ENV[@]}" \
   -v "$PWD":/home/veloserver \
   -v "$VOL":/home/veloserver/cache \
   "${ECMWF_MOUNT[@]}" \
@@ -65,17 +81,33 @@ for _ in $(seq 1 30); do
   sleep 1
 done
 
+if [[ "${OFFLINE:-0}" == "1" ]]; then
+  echo "==> starting fake upstream on :$UPSTREAM_PORT ${UPSTREAM_ARGS:-}"
+  # shellcheck disable=SC2086  # UPSTREAM_ARGS is a list of flags
+  docker exec -d "$NAME" python3 tests/fake_upstream.py --port "$UPSTREAM_PORT" ${UPSTREAM_ARGS:-}
+  for _ in $(seq 1 60); do
+    if docker exec "$NAME" python3 -c \
+        "import urllib.request; urllib.request.urlopen('$UPSTREAM/_stats', timeout=2)" \
+        >/dev/null 2>&1; then
+      break
+    fi
+    sleep 1
+  done
+fi
+
 echo "==> running $SUITE (live)"
 echo
 # Unbuffered (-u) so each PASS/FAIL line streams as it happens. VELOSERVER_CACHE_DIR
 # lets the suite empty the cache before the run; STRESS_BUDGET_BYTES matches the
-# server budget so the LRU eviction assertions line up.
+# server budget so the LRU eviction assertions line up; VELOSERVER_UPSTREAM (offline
+# only) lets the latency tests check the warm passes never went upstream.
 set +e
 docker exec \
   -e VELOSERVER_CACHE_DIR=/home/veloserver/cache \
   -e STRESS_BUDGET_BYTES="$BUDGET" \
   -e VELOSERVER_ECMWF="${VELOSERVER_ECMWF:-}" \
   -e VELOSERVER_STRESS="${VELOSERVER_STRESS:-}" \
+  -e VELOSERVER_UPSTREAM="$SUITE_UPSTREAM" \
   "$NAME" python3 -u "$SUITE"
 rc=$?
 set -e
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/access_log.py -- one JSON line per request -- and the
+benchmarks/replay.py harness that re-issues such a log. Stdlib only (a tiny
+WSGI app, os.fork, and http.server as the replay target).
+
+Run standalone:  python3 tests/test_access_log.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+from modules import access_log  # noqa: E402
+from benchmarks import replay  # noqa: E402
+
+
+def _lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_fields(r):
+    r.section("access log: model/product/format/time/projwin/fxx per route")
+    T = "2024-08-01T06:00:00"
+    cases = [
+        ("/hrrr/winds/png/" + T, {"model": "hrrr", "seg2": "winds", "seg3": "png", "seg4": T}, {},
+         {"model": "hrrr", "product": "winds", "format": "png", "time": T, "projwin": None}),
+        ("/gfs/gribjson/" + T + "/-105,41,-104,40",
+         {"model": "gfs", "seg2": "gribjson", "seg3": T, "seg4": "-105,41,-104,40"}, {},
+         {"model": "gfs", "product": None, "format": "gribjson", "projwin": "-105,41,-104,40"}),
+        ("/cog/temp_2m/" + T + "Z", {"product": "temp_2m", "time_param": T + "Z"}, {"fxx": "3"},
+         {"model": "hrrr", "product": "temp_2m", "format": "cog", "time": T + "Z", "fxx": "3"}),
+        ("/tiles/winds/5/6/12.png", {"product": "winds", "z": 5, "x": 6, "y": 12, "ext": "png"}, {"time": T},
+         {"model": "hrrr", "format": "png", "time": T}),
+        ("/hrrr/winds/point", {"product": "winds"}, {"time": T},
+         {"model": "hrrr", "format": "point", "time": T}),
+        ("/hrrr/winds/bundle/windbin", {"product": "winds", "format": "windbin"}, {"projwin": "-105,41,-104,40"},
+         {"model": "hrrr", "format": "windbin", "projwin": "-105,41,-104,40"}),
+        ("/", {}, {}, {"model": None, "format": None}),
+    ]
+    for path, args, query, want in cases:
+        got = access_log.request_fields(path, args, query)
+        r.check(f"fields of {path}", all(got[k] == v for k, v in want.items()), str(got))
+
+
+def _app(hits):
+    """A WSGI app answering 200 after ``hits`` cache lookups (True = hit)."""
+    def app(environ, start_response):
+        for hit in hits:
+            access_log.note_cache(hit)
+        body = b"x" * 123
+        start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+        return [body]
+    return app
+
+
+def _streaming_app(hits):
+    """A WSGI app streaming one chunk per cache lookup, each made while the body
+    is sent -- the first in a thread started then, as a bundle's hours are."""
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+
+        def body():
+            for i, hit in enumerate(hits):
+                if i == 0:
+                    worker = threading.Thread(target=contextvars.copy_context().run,
+                                              args=(access_log.note_cache, hit))
+                    worker.start()
+                    worker.join()
+                else:
+                    access_log.note_cache(hit)
+                yield b"y" * 10
+        return body()
+    return app
+
+
+class _FileWrapper:
+    def __init__(self, filelike):
+        self.filelike = filelike
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(8192), b"")
+
+
+def _call(app, path, query="", close=True):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": query,
+               "wsgi.input": io.BytesIO(), "route.url_args": {"model": "hrrr", "seg2": "winds",
+                                                                "seg3": "png", "seg4": "2024-08-01T06:00:00"}}
+    iterable = app(environ, lambda status, headers, exc_info=None: None)
+    body = b"".join(iterable)
+    if close and hasattr(iterable, "close"):
+        iterable.close()
+    return body
+
+
+def test_middleware(r, d):
+    r.section("access log: one line per request with status, bytes, cache result")
+    path = config.APP_CONFIG["ACCESS_LOG"] = os.path.join(d, "access.jsonl")
+    for hits in ([True], [False], [True, False], []):
+        _call(access_log.middleware(_app(hits)), "/hrrr/winds/png/2024-08-01T06:00:00", "fxx=2")
+    lines = _lines(path)
+    r.check("four lines, cache hit / miss / mixed / none",
+            [e["cache"] for e in lines] == ["hit", "miss", "mixed", None], str([e.get("cache") for e in lines]))
+    first = lines[0]
+    r.check("status, bytes, duration and request fields recorded",
+            first["status"] == 200 and first["bytes"] == 123 and first["duration_ms"] >= 0
+            and first["product"] == "winds" and first["format"] == "png" and first["fxx"] == "2"
+            and first["method"] == "GET" and abs(first["ts"] - time.time()) < 60, str(first))
+    access_log.note_cache(True)  # outside a request: ignored, no error
+    r.passed("note_cache outside a logged request is a no-op")
+
+
+def test_streamed(r, d):
+    r.section("access log: a streamed body is logged when closed, counting the whole stream")
+    path = config.APP_CONFIG["ACCESS_LOG"] = os.path.join(d, "streamed.jsonl")
+    app = access_log.middleware(_streaming_app([False, False, True]))
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/hrrr/winds/bundle/png", "QUERY_STRING": "",
+               "wsgi.input": io.BytesIO()}
+    iterable = app(environ, lambda status, headers, exc_info=None: None)
+    body = b"".join(iterable)
+    r.check("nothing logged before the server closes the body", not os.path.exists(path), "")
+    iterable.close()
+    iterable.close()
+    lines = _lines(path)
+    r.check("one line, with every lookup made while streaming and the bytes sent",
+            len(lines) == 1 and lines[0]["cache"] == "mixed" and lines[0]["bytes"] == len(body) == 30,
+            str(lines))
+
+    def file_app(environ, start_response):
+        access_log.note_cache(True)
+        start_response("200 OK", [("Content-Length", "5")])
+        return _FileWrapper(io.BytesIO(b"hello"))
+    environ = dict(environ, PATH_INFO="/hrrr/winds/png/2024-08-01T06:00:00")
+    iterable = access_log.middleware(file_app)(environ, lambda status, headers, exc_info=None: None)
+    r.check("a file_wrapper body is passed through untouched and logged at once",
+            isinstance(iterable, _FileWrapper) and len(_lines(path)) == 2 and _lines(path)[1]["cache"] == "hit",
+            type(iterable).__name__)
+
+
+def test_processes(r, d):
+    r.section("access log: lines from several worker processes never interleave")
+    path = config.APP_CONFIG["ACCESS_LOG"] = os.path.join(d, "workers.jsonl")
+    pids = []
+    for worker in range(4):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                for i in range(200):
+                    access_log.write({"worker": worker, "i": i, "pad": "y" * 3000})
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    try:
+        lines = _lines(path)
+        ok = len(lines) == 800 and all(len(e["pad"]) == 3000 for e in lines)
+        detail = f"lines={len(lines)}"
+    except ValueError as e:
+        ok, detail = False, f"a line did not parse: {e}"
+    r.check("800 whole JSON lines from 4 processes", ok, detail)
+
+
+class _Target(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        status = 503 if self.path.startswith("/fail") else 200
+        body = b"ok"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_replay(r, d):
+    r.section("replay: captured log re-issued on schedule, scaled by --speed")
+    log = os.path.join(d, "captured.jsonl")
+    with open(log, "w") as f:
+        for ts, method, path in ((100.0, "GET", "/a"), (101.0, "GET", "/b"), (100.5, "POST", "/hrrr/winds/point"),
+                                 (102.0, "GET", "/fail")):
+            f.write(json.dumps({"ts": ts, "method": method, "path": path, "query": "", "route": path,
+                                "status": 200}) + "\n")
+    entries, skipped = replay.load(log)
+    r.check("GETs loaded oldest first, POSTs skipped",
+            [e["path"] for e in entries] == ["/a", "/b", "/fail"] and skipped == 1, str(entries))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Target)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    try:
+        results, wall = replay.replay(entries, base, speed=4, concurrency=2, timeout=10)
+        fast, fast_wall = replay.replay(entries, base, speed=0, concurrency=2, timeout=10)
+    finally:
+        server.shutdown()
+    r.check("2s of traffic at speed 4 takes about 0.5s", 0.45 <= wall < 1.5, f"wall={wall:.2f}s")
+    r.check("speed 0 sends at once", fast_wall < 0.45, f"wall={fast_wall:.2f}s")
+    s = replay.summarize(results, wall)
+    r.check("errors (5xx) and status changes counted",
+            s["requests"] == 3 and s["errors"] == 1 and abs(s["error_rate"] - 1 / 3) < 1e-9
+            and s["status_changed"] == 1 and s["p50"] <= s["p95"] <= s["p99"] <= s["max"], str(s))
+
+
+def run(r):
+    saved = config.APP_CONFIG["ACCESS_LOG"]
+    d = tempfile.mkdtemp(prefix="velo-access-")
+    try:
+        test_fields(r)
+        test_middleware(r, d)
+        test_streamed(r, d)
+        test_processes(r, d)
+        test_replay(r, d)
+    finally:
+        config.APP_CONFIG["ACCESS_LOG"] = saved
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+"""Offline route tests for app.py / server.py: drive the bottle app through WSGI
+against a temp CACHE_DIR pre-seeded with the files process_hrrr would have built,
+so every request is a cache hit and no upstream, wgrib2 or gdal is touched.
+
+server/app import process_data (herbie, rasterio, ...), so like
+test_process_data the import is wrapped: without that stack these tests SKIP;
+in the container they run.
+
+Run standalone:  python3 tests/test_app.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import gzip
+import json
+import base64
+import shutil
+import tarfile
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+
+try:
+    import numpy as np
+    import server
+    from modules import access_log, bundle, convert, fieldcache, hotcache
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS/web deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+RUN = "2024-03-05T19:00:00"
+PREFIX = "hrrr-winds-2024-03-05T19:00:00-f00"
+BODY = json.dumps([{"header": {"parameterNumberName": "U-component_of_wind"}, "data": [1.5] * 500},
+                   {"header": {"parameterNumberName": "V-component_of_wind"}, "data": [-2.5] * 500}]).encode()
+
+
+class _Wsgi:
+    """Result of one WSGI call: status code, headers (lower-cased names), the raw
+    app iterable and the joined body."""
+
+    def __init__(self, path, query="", headers=None, method="GET", body=b"", app=None):
+        environ = {
+            "REQUEST_METHOD": method, "PATH_INFO": path, "QUERY_STRING": query,
+            "SERVER_NAME": "test", "SERVER_PORT": "80", "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body), "CONTENT_LENGTH": str(len(body)),
+            "CONTENT_TYPE": "application/json", "wsgi.errors": sys.stderr,
+            # Stand-in for gunicorn's sendfile wrapper, so we can see the file
+            # object handed to the server instead of an in-memory body.
+            "wsgi.file_wrapper": lambda f, *a: _FileWrapper(f),
+        }
+        for k, v in (headers or {}).items():
+            environ["HTTP_" + k.upper().replace("-", "_")] = v
+        captured = {}
+
+        def start_response(status, hdrs, exc_info=None):
+            # header names are case-insensitive; bottle emits e.g. "Etag"
+            captured["status"], captured["headers"] = status, {k.lower(): v for k, v in hdrs}
+
+        self.iterable = (app or server.bottle_app)(environ, start_response)
+        self.body = b"".join(self.iterable)
+        if hasattr(self.iterable, "close"):
+            self.iterable.close()
+        self.status = int(captured["status"].split()[0])
+        self.headers = captured["headers"]
+
+
+class _FileWrapper:
+    def __init__(self, f):
+        self.filelike = f
+
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(8192), b"")
+
+    def close(self):
+        self.filelike.close()
+
+
+def _seed(cache_dir):
+    """Place the regrid field + gribjson for RUN so /hrrr/winds/gribjson is a hit."""
+    with open(os.path.join(cache_dir, PREFIX + ".field"), "wb") as f:
+        f.write(b"VFLD")
+    with open(os.path.join(cache_dir, PREFIX + ".json"), "wb") as f:
+        f.write(BODY)
+
+
+def _seed_fields(cache_dir):
+    """Regridded temp_2m fields for F00-F02 of RUN: a 5x4 0.1-degree grid
+    (-105..-104.6 E, 40..39.7 N) whose value is 100*fxx + row*10 + col."""
+    rows, cols = np.mgrid[0:4, 0:5]
+    grid = {'nx': 5, 'ny': 4, 'lo1': 255.0, 'la1': 40.0, 'dx': 0.1, 'dy': 0.1, 'crs': None}
+    for fxx in range(3):
+        data = (100 * fxx + rows * 10 + cols).astype(np.float32)[None]
+        fieldcache.write(fieldcache.Field(data, grid, [{'tags': {}, 'header': None}]),
+                         os.path.join(cache_dir, f"hrrr-temp_2m-2024-03-05T19:00:00-f{fxx:02d}.field"))
+
+
+def test_point(r):
+    r.section("/hrrr/<product>/point: time series from the mapped fields")
+    res = _Wsgi("/hrrr/temp_2m/point", "lat=39.8&lon=-104.8&time=2024-03-05T19:00:00Z&fxx=0-2")
+    body = json.loads(res.body) if res.status == 200 else {}
+    point = (body.get("points") or [{}])[0]
+    r.check("GET -> 200 JSON, one value per forecast hour at the nearest grid point",
+            res.status == 200 and res.headers.get("content-type") == "application/json"
+            and body.get("fxx") == [0, 1, 2] and point.get("values") == {"temp_2m": [22.0, 122.0, 222.0]}
+            and (point.get("grid_lat"), point.get("grid_lon")) == (39.8, -104.8),
+            f"status={res.status} body={res.body[:200]!r}")
+    r.check("run, valid times and no missing hours",
+            body.get("run") == "2024-03-05T19:00:00Z" and body.get("missing") == []
+            and body.get("valid_time") == ["2024-03-05T19:00:00Z", "2024-03-05T20:00:00Z", "2024-03-05T21:00:00Z"],
+            str({k: body.get(k) for k in ("run", "valid_time", "missing")}))
+    r.check("complete past run -> Cache-Control immutable", "immutable" in res.headers.get("cache-control", ""),
+            f"got {res.headers.get('cache-control')!r}")
+
+    batch = json.dumps({"time": "2024-03-05T19:00:00Z", "fxx": "1-2", "points": [
+        {"lat": 40.0, "lon": -105.0}, {"lat": 39.71, "lon": 255.38}, {"lat": 30, "lon": -90}]}).encode()
+    res = _Wsgi("/hrrr/temp_2m/point", method="POST", body=batch)
+    points = json.loads(res.body).get("points", []) if res.status == 200 else []
+    r.check("POST batch: one series per point, either longitude convention",
+            [p["values"]["temp_2m"] for p in points[:2]] == [[100.0, 200.0], [134.0, 234.0]],
+            f"status={res.status} body={res.body[:300]!r}")
+    r.check("a point off the grid is null, not an error",
+            len(points) == 3 and points[2]["values"]["temp_2m"] == [None, None] and points[2]["grid_lat"] is None,
+            str(points[2:]))
+    r.check("POST advertised for CORS", "POST" in res.headers.get("access-control-allow-methods", ""),
+            f"got {res.headers.get('access-control-allow-methods')!r}")
+
+    for name, path, query, method, payload in (
+            ("missing lat", "/hrrr/temp_2m/point", "lon=-104.8&time=2024-03-05T19:00:00Z&fxx=0", "GET", b""),
+            ("fxx range backwards", "/hrrr/temp_2m/point", "lat=39.8&lon=-104.8&time=2024-03-05T19:00:00Z&fxx=2-1",
+             "GET", b""),
+            ("unknown product", "/hrrr/bogus/point", "lat=39.8&lon=-104.8&time=2024-03-05T19:00:00Z&fxx=0", "GET", b""),
+            ("no time", "/hrrr/temp_2m/point", "lat=39.8&lon=-104.8&fxx=0", "GET", b""),
+            ("body not JSON", "/hrrr/temp_2m/point", "", "POST", b"lat=1"),
+            ("points not a list", "/hrrr/temp_2m/point", "", "POST",
+             b'{"time": "2024-03-05T19:00:00Z", "fxx": 0, "points": {"lat": 1}}')):
+        res = _Wsgi(path, query, method=method, body=payload)
+        r.check(f"{name} -> 400", res.status == 400, f"status={res.status} body={res.body[:120]!r}")
+
+    saved = config.APP_CONFIG["POINT_MAX_POINTS"]
+    config.APP_CONFIG["POINT_MAX_POINTS"] = 2
+    try:
+        res = _Wsgi("/hrrr/temp_2m/point", method="POST", body=batch)
+        r.check("more points than POINT_MAX_POINTS -> 400", res.status == 400, f"status={res.status}")
+    finally:
+        config.APP_CONFIG["POINT_MAX_POINTS"] = saved
+
+
+def _multipart(body, boundary):
+    """[(headers, payload)] of a multipart/mixed body."""
+    parts = []
+    for chunk in body.split(b"--" + boundary.encode())[1:]:
+        if chunk.startswith(b"--"):
+            break
+        head, _, payload = chunk[2:].partition(b"\r\n\r\n")
+        headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+        parts.append(({k.lower(): v for k, v in headers.items()}, payload[:-2]))
+    return parts
+
+
+def test_bundle(r):
+    r.section("/hrrr/<product>/bundle/<format>: a forecast-hour stack in one response")
+    query = "time=2024-03-05T19:00:00Z&fxx=0-2"
+    res = _Wsgi("/hrrr/temp_2m/bundle/png", query)
+    try:
+        with tarfile.open(fileobj=io.BytesIO(res.body)) as tar:
+            members = {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+    except tarfile.TarError:
+        members = {}
+    manifest = json.loads(members.pop("manifest.json", b"{}"))
+    names = [f"hrrr-temp_2m-2024-03-05T19:00:00-f{fxx:02d}.png" for fxx in range(3)]
+    r.check("tar (default) of one PNG per hour, named as the cache names them",
+            res.status == 200 and res.headers.get("content-type") == "application/x-tar"
+            and sorted(members) == names and all(v.startswith(b"\x89PNG") for v in members.values()),
+            f"status={res.status} members={sorted(members)} body={res.body[:120]!r}")
+    r.check("streamed as an iterator, not one buffered body",
+            not isinstance(res.iterable, (bytes, list)) and "content-length" not in res.headers,
+            f"type={type(res.iterable).__name__}")
+    r.check("manifest lists the frames in fxx order and no missing hours",
+            [f["fxx"] for f in manifest.get("frames", [])] == [0, 1, 2] and manifest.get("missing") == [],
+            str(manifest))
+    r.check("frames were built into the cache like single-hour requests",
+            all(os.path.exists(os.path.join(config.APP_CONFIG["CACHE_DIR"], n)) for n in names), "")
+
+    res = _Wsgi("/hrrr/temp_2m/bundle/geotiff", query + "&projwin=-105,40,-104.8,39.8&container=multipart")
+    boundary = res.headers.get("content-type", "").partition("boundary=")[2]
+    parts = _multipart(res.body, boundary) if boundary else []
+    r.check("multipart/mixed: one image/tiff part per hour with X-Forecast-Hour",
+            res.status == 200 and [p[0].get("x-forecast-hour") for p in parts] == ["0", "1", "2"]
+            and all(p[0].get("content-type") == "image/tiff" and p[1][:2] in (b"II", b"MM") for p in parts),
+            f"status={res.status} parts={[p[0] for p in parts]}")
+    r.check("projwin subsets each frame; Content-Length per part",
+            all("-105.0_40.0_-104.8_39.8-" in p[0].get("content-disposition", "")
+                and int(p[0]["content-length"]) == len(p[1]) for p in parts),
+            str([p[0].get("content-disposition") for p in parts]))
+
+    frames = [(0, os.path.join(config.APP_CONFIG["CACHE_DIR"], names[0])), (1, RuntimeError("not published"))]
+    with tarfile.open(fileobj=io.BytesIO(b"".join(bundle.tar_stream(frames)))) as tar:
+        late = json.loads(tar.extractfile("manifest.json").read())
+    r.check("an hour that fails mid-stream is listed as missing, not fatal",
+            [f["fxx"] for f in late["frames"]] == [0] and late["missing"] == [{"fxx": 1, "error": "not published"}],
+            str(late))
+
+    for name, path, q in (
+            ("unknown container", "/hrrr/temp_2m/bundle/png", query + "&container=zip"),
+            ("wind format for a scalar product", "/hrrr/temp_2m/bundle/windbin", query),
+            ("unknown format", "/hrrr/temp_2m/bundle/jpeg", query),
+            ("bad projwin", "/hrrr/temp_2m/bundle/png", query + "&projwin=1,2,3"),
+            ("projwin off the grid", "/hrrr/temp_2m/bundle/png", query + "&projwin=10,10,11,9"),
+            ("fxx range backwards", "/hrrr/temp_2m/bundle/png", "time=2024-03-05T19:00:00Z&fxx=2-1"),
+            ("no time", "/hrrr/temp_2m/bundle/png", "fxx=0-2")):
+        res = _Wsgi(path, q)
+        r.check(f"{name} -> 400", res.status == 400, f"status={res.status} body={res.body[:120]!r}")
+
+
+def test_batch(r):
+    r.section("POST /batch: several data requests in one streamed response")
+    T = "2024-03-05T19:00:00Z"
+    requests = [{"product": "temp_2m", "format": "png", "time": T, "fxx": 1},
+                {"model": "hrrr", "product": "winds", "format": "gribjson", "time": T},
+                {"product": "temp_2m", "format": "geotiff", "time": T, "projwin": "-105,40,-104.8,39.8"},
+                {"product": "temp_2m", "format": "png", "time": T, "fxx": "1"},
+                {"product": "bogus", "format": "png", "time": T},
+                {"product": "temp_2m", "format": "windbin", "time": T},
+                {"product": "temp_2m", "format": "png", "time": "yesterday"}]
+    res = _Wsgi("/batch", method="POST", body=json.dumps({"requests": requests}).encode())
+    try:
+        lines = {e["index"]: e for e in map(json.loads, res.body.decode().splitlines())}
+    except ValueError:
+        lines = {}
+    r.check("ndjson (default): one line per request, streamed",
+            res.status == 200 and res.headers.get("content-type") == "application/x-ndjson"
+            and sorted(lines) == list(range(len(requests))) and not isinstance(res.iterable, (bytes, list)),
+            f"status={res.status} body={res.body[:200]!r}")
+    png = lines.get(0, {})
+    r.check("binary body base64, with its content type and GET url",
+            png.get("status") == 200 and png.get("content_type") == "image/png"
+            and png.get("url") == "/hrrr/temp_2m/png/2024-03-05T19:00:00Z?fxx=1"
+            and base64.b64decode(png.get("body", "")).startswith(b"\x89PNG"), str(png)[:200])
+    r.check("JSON body embedded as is", lines.get(1, {}).get("body") == json.loads(BODY), str(lines.get(1))[:200])
+    r.check("projwin subset built into the cache",
+            lines.get(2, {}).get("status") == 200 and os.path.exists(os.path.join(
+                config.APP_CONFIG["CACHE_DIR"], "hrrr-temp_2m--105.0_40.0_-104.8_39.8-2024-03-05T19:00:00-f00.tif")),
+            str(lines.get(2))[:200])
+    r.check("the same output asked twice is answered twice", lines.get(3, {}).get("body") == png.get("body"), "")
+    r.check("a bad request is a 400 item, not a failed batch",
+            [lines.get(i, {}).get("status") for i in (4, 5, 6)] == [400] * 3
+            and "Unknown product" in lines.get(4, {}).get("error", ""), str([lines.get(i) for i in (4, 5, 6)]))
+    r.check("POST advertised for CORS", "POST" in res.headers.get("access-control-allow-methods", ""),
+            f"got {res.headers.get('access-control-allow-methods')!r}")
+
+    res = _Wsgi("/batch", "container=multipart", method="POST", body=json.dumps({"requests": requests[:2]}).encode())
+    boundary = res.headers.get("content-type", "").partition("boundary=")[2]
+    parts = {p[0].get("x-batch-index"): p for p in (_multipart(res.body, boundary) if boundary else [])}
+    r.check("multipart/mixed: a part per request with X-Batch-Index and X-Status",
+            res.status == 200 and sorted(parts) == ["0", "1"] and all(p[0]["x-status"] == "200" for p in parts.values())
+            and parts["0"][1].startswith(b"\x89PNG") and parts["1"][1] == BODY,
+            f"status={res.status} parts={[p[0] for p in parts.values()]}")
+
+    saved = config.APP_CONFIG["BATCH_MAX_ITEMS"]
+    config.APP_CONFIG["BATCH_MAX_ITEMS"] = 3
+    try:
+        for name, query, payload in (
+                ("body not JSON", "", b"requests"),
+                ("requests not a list", "", b'{"requests": {"product": "winds"}}'),
+                ("no requests", "", b'{"requests": []}'),
+                ("unknown container", "container=tar", json.dumps({"requests": requests[:1]}).encode()),
+                ("more requests than BATCH_MAX_ITEMS", "", json.dumps({"requests": requests}).encode())):
+            res = _Wsgi("/batch", query, method="POST", body=payload)
+            r.check(f"{name} -> 400", res.status == 400, f"status={res.status} body={res.body[:120]!r}")
+    finally:
+        config.APP_CONFIG["BATCH_MAX_ITEMS"] = saved
+
+
+def test_hot_cache(r):
+    r.section("data routes answer small bodies from the shared hot cache")
+    config.APP_CONFIG["HOT_CACHE_BYTES"] = 4 * 1024 ** 2
+    try:
+        first = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+        before = hotcache.stats()
+        res = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+        after = hotcache.stats()
+        r.check("repeat hit served from the arena, not a file",
+                res.status == 200 and res.body == BODY and not isinstance(res.iterable, _FileWrapper)
+                and after["hits"] == before["hits"] + 1, f"type={type(res.iterable).__name__} stats={after}")
+        r.check("same validators and length as on the miss that stored it",
+                res.headers.get("etag") == first.headers.get("etag") and res.headers.get("etag")
+                and res.headers.get("content-length") == str(len(BODY))
+                and res.headers.get("content-type") == "application/json", str(res.headers))
+        again = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"If-None-Match": res.headers.get("etag")})
+        r.check("a current client still gets 304", again.status == 304 and again.body == b"", f"status={again.status}")
+        part = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"Range": "bytes=0-9"})
+        r.check("Range requests are still streamed from the file",
+                part.status == 206 and part.body == BODY[:10], f"status={part.status}")
+    finally:
+        config.APP_CONFIG["HOT_CACHE_BYTES"] = 0
+
+
+def test_server_timing(r):
+    r.section("Server-Timing lists the stages a request ran")
+    res = _Wsgi("/hrrr/temp_2m/bundle/png", "time=2024-03-05T19:00:00Z&fxx=0&projwin=-105,40,-104.9,39.8")
+    timing = res.headers.get("server-timing", "")
+    r.check("a build reports its stages (from the hour-build threads too) and the total",
+            res.status == 200 and "subset;dur=" in timing and "produce;dur=" in timing
+            and timing.endswith(tuple("0123456789")) and ", total;dur=" in timing, timing)
+    hit = _Wsgi(f"/hrrr/winds/gribjson/{RUN}").headers.get("server-timing", "")
+    r.check("a cache hit has only the total", hit.startswith("total;dur="), hit)
+    config.APP_CONFIG["SERVER_TIMING"] = False
+    try:
+        off = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+    finally:
+        config.APP_CONFIG["SERVER_TIMING"] = True
+    r.check("SERVER_TIMING off -> no header", "server-timing" not in off.headers, "")
+
+
+def test_metrics(r):
+    r.section("/metrics sums the pipeline counters of every worker")
+    res = _Wsgi("/metrics")
+    text = res.body.decode()
+    r.check("200 in the Prometheus text format",
+            res.status == 200 and res.headers.get("content-type", "").startswith("text/plain; version=0.0.4")
+            and "# TYPE veloserver_cache_requests_total counter" in text, f"status={res.status}")
+    r.check("the earlier cache hits are counted",
+            'veloserver_cache_requests_total{format="gribjson",model="hrrr",product="winds",result="hit"}' in text, "")
+    r.check("this request is in flight on this worker",
+            f'veloserver_requests_in_flight{{pid="{os.getpid()}"}} 1' in text, "")
+
+
+def test_access_log(r):
+    r.section("ACCESS_LOG: one JSON line per request through the real routes")
+    saved = config.APP_CONFIG["ACCESS_LOG"]
+    path = config.APP_CONFIG["ACCESS_LOG"] = os.path.join(config.APP_CONFIG["CACHE_DIR"], "access.jsonl")
+    try:
+        app = access_log.middleware(server.bottle_app)
+        _Wsgi(f"/hrrr/winds/gribjson/{RUN}", query="fxx=0", app=app)
+        _Wsgi("/hrrr/nosuch/gribjson/" + RUN, app=app)
+        cold = _Wsgi("/hrrr/temp_2m/bundle/png", "time=2024-03-05T19:00:00Z&fxx=0-2&projwin=-104.9,40,-104.7,39.8",
+                     app=app)
+        with open(path) as f:
+            hit, bad, bundle = [json.loads(line) for line in f]
+    finally:
+        config.APP_CONFIG["ACCESS_LOG"] = saved
+    r.check("a cached gribjson: 200, its size, a cache hit, the route's fields",
+            hit["status"] == 200 and hit["bytes"] == len(BODY) and hit["cache"] == "hit"
+            and (hit["model"], hit["product"], hit["format"], hit["time"], hit["fxx"])
+            == ("hrrr", "winds", "gribjson", RUN, "0")
+            and hit["route"] == "/<model>/<seg2>/<seg3>/<seg4>", str(hit))
+    r.check("a rejected request: its 400 and no cache lookup",
+            bad["status"] == 400 and bad["cache"] is None, str(bad))
+    r.check("a cold bundle: every hour's miss and the bytes streamed, logged at the stream's end",
+            bundle["status"] == 200 and bundle["cache"] == "miss" and bundle["bytes"] == len(cold.body) > 0,
+            str(bundle))
+
+
+def test_streamed_output(r):
+    r.section("data routes stream cached files (file_wrapper, Content-Length, Range)")
+    res = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+    r.check("cache hit -> 200 with the cached body", res.status == 200 and res.body == BODY,
+            f"status={res.status} bytes={len(res.body)}")
+    r.check("body handed to wsgi.file_wrapper (not read into memory)",
+            isinstance(res.iterable, _FileWrapper), f"type={type(res.iterable).__name__}")
+    r.check("Content-Length is the file size", res.headers.get("content-length") == str(len(BODY)),
+            f"got {res.headers.get('content-length')}")
+    r.check("Content-Type is application/json", res.headers.get("content-type") == "application/json",
+            f"got {res.headers.get('content-type')}")
+    r.check("Accept-Ranges advertised", res.headers.get("accept-ranges") == "bytes", "")
+    r.check("CORS header still applied",
+            res.headers.get("access-control-allow-origin") == "*", "")
+
+    part = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"Range": "bytes=10-19"})
+    r.check("Range -> 206 with just the requested bytes",
+            part.status == 206 and part.body == BODY[10:20], f"status={part.status} body={part.body!r}")
+    r.check("Content-Range describes the slice",
+            part.headers.get("content-range") == f"bytes 10-19/{len(BODY)}", f"got {part.headers.get('content-range')}")
+    bad = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"Range": f"bytes={len(BODY) + 10}-"})
+    r.check("unsatisfiable Range -> 416", bad.status == 416, f"status={bad.status}")
+
+    for fmt, ext, ctype in (("windbin", ".windbin", "application/octet-stream"),
+                            ("windpng", ".wind.png", "image/png"),
+                            ("legend", ".legend.png", "image/png")):
+        with open(os.path.join(config.APP_CONFIG["CACHE_DIR"], PREFIX + ext), "wb") as f:
+            f.write(BODY)
+        res = _Wsgi(f"/hrrr/winds/{fmt}/{RUN}")
+        r.check(f"{fmt} cache hit -> 200 as {ctype}",
+                res.status == 200 and res.body == BODY and res.headers.get("content-type") == ctype,
+                f"status={res.status} type={res.headers.get('content-type')}")
+
+    err = _Wsgi(f"/hrrr/temp_2m/gribjson/{RUN}")
+    r.check("validation errors still return a 400 body", err.status == 400 and b"gribjson" in err.body,
+            f"status={err.status}")
+
+
+def test_content_encoding(r):
+    r.section("gribjson served precompressed when Accept-Encoding allows")
+    path = os.path.join(config.APP_CONFIG["CACHE_DIR"], PREFIX + ".json")
+    convert._write_compressed_siblings(path)
+    url = f"/hrrr/winds/gribjson/{RUN}"
+
+    gz = _Wsgi(url, headers={"Accept-Encoding": "gzip"})
+    r.check("gzip accepted -> gzip body that inflates to the JSON",
+            gz.status == 200 and gz.headers.get("content-encoding") == "gzip"
+            and gzip.decompress(gz.body) == BODY, f"status={gz.status} enc={gz.headers.get('content-encoding')}")
+    r.check("Content-Length is the compressed size", gz.headers.get("content-length") == str(len(gz.body)), "")
+    r.check("Vary: Accept-Encoding", gz.headers.get("vary") == "Accept-Encoding", f"got {gz.headers.get('vary')}")
+    r.check("Content-Type stays application/json", gz.headers.get("content-type") == "application/json", "")
+
+    plain = _Wsgi(url)
+    r.check("no Accept-Encoding -> plain body, still Vary",
+            plain.body == BODY and "content-encoding" not in plain.headers
+            and plain.headers.get("vary") == "Accept-Encoding", "")
+    r.check("encoded and plain bodies have distinct ETags",
+            gz.headers.get("etag") != plain.headers.get("etag"), "")
+    nm = _Wsgi(url, headers={"Accept-Encoding": "gzip", "If-None-Match": gz.headers.get("etag", "")})
+    r.check("If-None-Match on the gzip ETag -> 304 with Vary",
+            nm.status == 304 and nm.headers.get("vary") == "Accept-Encoding", f"status={nm.status}")
+    r.check("q=0 refuses the coding",
+            "content-encoding" not in _Wsgi(url, headers={"Accept-Encoding": "gzip;q=0"}).headers, "")
+
+    if convert.brotli is not None:
+        br = _Wsgi(url, headers={"Accept-Encoding": "gzip, deflate, br"})
+        r.check("br preferred when offered", br.headers.get("content-encoding") == "br"
+                and convert.brotli.decompress(br.body) == BODY, f"enc={br.headers.get('content-encoding')}")
+    else:
+        r.skipped("br body", "brotli not installed")
+
+    # A sibling older than the parent is from a previous build: never served.
+    os.utime(path + ".gz", ns=(0, os.stat(path).st_mtime_ns - 10**9))
+    stale = _Wsgi(url, headers={"Accept-Encoding": "gzip"})
+    r.check("stale sibling ignored -> plain body", stale.body == BODY and "content-encoding" not in stale.headers, "")
+
+    for suffix, _coding in config.COMPRESSED_SIBLINGS:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    gone = _Wsgi(url, headers={"Accept-Encoding": "gzip, br"})
+    r.check("no siblings built -> plain body", gone.status == 200 and gone.body == BODY
+            and "content-encoding" not in gone.headers, f"status={gone.status}")
+
+
+def test_conditional_get(r):
+    r.section("data routes send validators and answer 304")
+    res = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+    etag = res.headers.get("etag", "")
+    r.check("strong quoted ETag sent", etag.startswith('"') and etag.endswith('"'), f"got {etag!r}")
+    r.check("Last-Modified sent", bool(res.headers.get("last-modified")), "")
+    r.check("past run -> Cache-Control immutable", "immutable" in res.headers.get("cache-control", ""),
+            f"got {res.headers.get('cache-control')!r}")
+
+    again = _Wsgi(f"/hrrr/winds/gribjson/{RUN}")
+    r.check("ETag is stable across hits (mark_used keeps the build time)",
+            again.headers.get("etag") == etag, f"{etag} vs {again.headers.get('etag')}")
+
+    nm = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"If-None-Match": etag})
+    r.check("If-None-Match match -> 304 with no body", nm.status == 304 and nm.body == b"",
+            f"status={nm.status} bytes={len(nm.body)}")
+    r.check("304 repeats the validators", nm.headers.get("etag") == etag and "cache-control" in nm.headers, "")
+    ims = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"If-Modified-Since": res.headers["last-modified"]})
+    r.check("If-Modified-Since at build time -> 304", ims.status == 304, f"status={ims.status}")
+    stale = _Wsgi(f"/hrrr/winds/gribjson/{RUN}", headers={"If-None-Match": '"stale"',
+                                                         "If-Modified-Since": res.headers["last-modified"]})
+    r.check("stale If-None-Match -> 200 even with a fresh If-Modified-Since",
+            stale.status == 200 and stale.body == BODY, f"status={stale.status}")
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("app route unit tests",
+                  f"server deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    saved = config.APP_CONFIG["CACHE_DIR"], config.APP_CONFIG["HOT_CACHE_BYTES"]
+    d = tempfile.mkdtemp(prefix="velo-app-")
+    config.APP_CONFIG["CACHE_DIR"] = d
+    # The streaming checks need the file path; test_hot_cache turns it back on.
+    config.APP_CONFIG["HOT_CACHE_BYTES"] = 0
+    try:
+        _seed(d)
+        _seed_fields(d)
+        test_streamed_output(r)
+        test_conditional_get(r)
+        test_content_encoding(r)
+        test_point(r)
+        test_bundle(r)
+        test_batch(r)
+        test_hot_cache(r)
+        test_server_timing(r)
+        test_metrics(r)
+        test_access_log(r)
+    finally:
+        config.APP_CONFIG["CACHE_DIR"], config.APP_CONFIG["HOT_CACHE_BYTES"] = saved
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Tests for the process_data CLI's batch mode: modules/batch.py's expansion,
+grouping and state file (stdlib only), and process_data.run_batch building a
+small backfill across worker processes against tests/fake_upstream.py.
+
+run_batch needs process_data (herbie, rasterio, ...), so like test_app that
+part SKIPs where the stack is missing; in the container it runs.
+
+Run standalone:  python3 tests/test_batch.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import contextlib
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+from modules import batch  # noqa: E402
+
+try:
+    import process_data
+    import fake_upstream
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+BOX = "-105,41,-104,40"
+
+
+def test_expand(r):
+    r.section("batch: specs expand to every output, normalized per model")
+    outputs, dropped = batch.expand({"model": "hrrr", "products": "winds,temp_2m", "date": "2024-08-01",
+                                     "end_date": "2024-08-02", "hours": "6,18", "fxx": "0-2",
+                                     "projwins": [BOX, None], "formats": "gribjson,png"})
+    # 2 days x 2 runs x 3 hours x 2 boxes x (winds: 2 formats, temp_2m: png only)
+    r.check("product of the lists, scalar gribjson dropped",
+            len(outputs) == 2 * 2 * 3 * 2 * 3 and dropped == [("temp_2m", "gribjson")],
+            f"outputs={len(outputs)} dropped={dropped}")
+    first = outputs[0]
+    r.check("first output normalized",
+            first == batch.Output("hrrr", "winds", "2024-08-01", "06:00:00", 0, (-105.0, 41.0, -104.0, 40.0),
+                                  "gribjson"), str(first))
+    gfs, _ = batch.expand({"model": "gfs", "date": "2024-08-01", "hours": "0-11", "fxx": "0-6",
+                           "formats": "gribjson"})
+    r.check("GFS hours collapse to their 6-hourly cycles, f000 only",
+            [(o.hour, o.fxx) for o in gfs] == [("00:00:00", 0), ("06:00:00", 0)], str(gfs))
+    for bad in ({"model": "nam", "date": "2024-08-01"}, {"date": "2024-08-01", "products": "nosuch"},
+                {"date": "2024-08-01", "fxx": "0-99"}, {"date": "2024-08-03", "end_date": "2024-08-01"},
+                {"date": "2024-08-01", "projwins": ["1,2,3"]}, {"date": "2024-08-01", "hours": "20-25"}):
+        try:
+            batch.expand(bad)
+            r.failed(f"malformed spec rejected: {bad}", "no ValueError")
+        except ValueError:
+            r.passed(f"malformed spec rejected: {bad}")
+
+
+def test_group_and_state(r, d):
+    r.section("batch: outputs grouped by the intermediate they share; resumable state")
+    outputs, _ = batch.expand({"products": "winds,temp_2m", "date": "2024-08-01", "fxx": "0-1",
+                               "projwins": [BOX, None], "formats": "png,geotiff"})
+    outputs += batch.expand({"model": "gfs", "date": "2024-08-01", "hours": "0,3,6",
+                             "projwins": [BOX, None], "formats": "gribjson,windbin"})[0]
+    groups = batch.group(outputs)
+    hrrr = [g for k, g in groups.items() if k[0] == "hrrr"]
+    gfs = [g for k, g in groups.items() if k[0] == "gfs"]
+    r.check("one HRRR group per product/run/fxx, holding every box and format",
+            len(hrrr) == 4 and all(len(g) == 4 for g in hrrr), str([len(g) for g in hrrr]))
+    r.check("one GFS group per cycle, holding every box", len(gfs) == 2 and all(len(g) == 4 for g in gfs),
+            str([len(g) for g in gfs]))
+    saved = config.APP_CONFIG["GFS_GLOBAL"]
+    config.APP_CONFIG["GFS_GLOBAL"] = False
+    try:
+        gfs = [g for k, g in batch.group(outputs).items() if k[0] == "gfs"]
+    finally:
+        config.APP_CONFIG["GFS_GLOBAL"] = saved
+    r.check("GFS_GLOBAL off: one GFS group per cycle and box", len(gfs) == 4 and all(len(g) == 2 for g in gfs),
+            str([len(g) for g in gfs]))
+
+    state = os.path.join(d, "state.jsonl")
+    batch.record_state(state, outputs[0], True, "/x.png")
+    batch.record_state(state, outputs[1], False, "Error retrieving data")
+    with open(state, "a") as f:
+        f.write('{"key": "cut sh')  # a crash mid-line
+    r.check("state keeps what succeeded, not what failed or was cut short",
+            batch.load_state(state) == {batch.key(outputs[0])}, str(batch.load_state(state)))
+    manifest = os.path.join(d, "manifest.json")
+    with open(manifest, "w") as f:
+        json.dump({"jobs": [{"date": "2024-08-01"}]}, f)
+    r.check("manifest of jobs loads", batch.load_manifest(manifest) == [{"date": "2024-08-01"}], "")
+
+
+def _stats(base):
+    with urllib.request.urlopen(base + "/_stats", timeout=5) as f:
+        stats = json.loads(f.read())
+    stats.pop("connections", None)  # each /_stats call is one
+    return stats
+
+
+def test_run_batch(r, d):
+    r.section("batch: run_batch across processes, one download per group, resumed")
+    if _IMPORT_ERR is not None:
+        r.skipped("run_batch against the fake upstream",
+                  f"process_data not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    server = fake_upstream.serve(workdir=d)
+    base = f"http://127.0.0.1:{server.server_port}"
+    saved = {k: config.APP_CONFIG[k] for k in ("HRRR_SOURCE_URL", "GFS_FILTER_URL", "CACHE_DIR")}
+    out = os.path.join(d, "out")
+    config.APP_CONFIG.update(HRRR_SOURCE_URL=base + "/hrrr", GFS_FILTER_URL=base + "/cgi-bin/filter_gfs_0p25.pl",
+                             CACHE_DIR=out)
+    try:
+        outputs, _ = batch.expand({"products": "winds,temp_2m", "date": "2024-08-01", "hours": 6, "fxx": "0-1",
+                                   "projwins": [BOX, None], "formats": "png,geotiff,gribjson"})
+        outputs += batch.expand({"model": "gfs", "date": "2024-08-01", "hours": "0,6",
+                                 "projwins": [BOX], "formats": "gribjson,windbin"})[0]
+        state = os.path.join(d, "batch-state.jsonl")
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            failed = process_data.run_batch(outputs, out, workers=2, state_path=state)
+        stats = _stats(base)
+        r.check(f"{len(outputs)} outputs built, none failed",
+                failed == 0 and len(batch.load_state(state)) == len(outputs),
+                f"failed={failed} " + log.getvalue()[-300:])
+        r.check("one HRRR download per product/run/fxx and one GFS fetch per cycle",
+                stats.get("grib") == 4 and stats.get("gfs") == 2, str(stats))
+        r.check("progress reported per group", "[batch] 6/6 groups" in log.getvalue(), log.getvalue()[-300:])
+
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            failed = process_data.run_batch(outputs, out, workers=2, state_path=state)
+        r.check("a rerun builds nothing and fetches nothing",
+                failed == 0 and "0 to build" in log.getvalue() and _stats(base) == stats, log.getvalue()[:200])
+    finally:
+        config.APP_CONFIG.update(saved)
+        server.shutdown()
+
+
+def test_stream_groups(r):
+    r.section("batch: stream_groups stops its groups when closed, even unread")
+    if _IMPORT_ERR is not None:
+        r.skipped("stream_groups", f"process_data not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    built = []
+
+    def slow(output, output_dir):
+        time.sleep(0.2)
+        built.append(output)
+        return output_dir
+
+    outputs, _ = batch.expand({"products": "temp_2m", "date": "2024-08-01", "fxx": "0-5", "formats": "png"})
+    saved = process_data._process_output, config.APP_CONFIG["HOUR_BUILD_WORKERS"]
+    process_data._process_output, config.APP_CONFIG["HOUR_BUILD_WORKERS"] = slow, 1
+    try:
+        groups = [[o] for o in outputs[:3]] + [outputs[3:]]
+        process_data.stream_groups(groups, "out").close()
+        time.sleep(1)
+        r.check("closed before the first item: only the group already running finishes its output",
+                len(built) == 1, f"built={len(built)}")
+        built.clear()
+        results = process_data.stream_groups(groups, "out")
+        items = list(results)
+        r.check("read to the end: every output, in the order they finish",
+                [o for o, _ in items] == outputs and [o for o, _ in items] == built, str(items)[:200])
+    finally:
+        process_data._process_output, config.APP_CONFIG["HOUR_BUILD_WORKERS"] = saved
+
+
+def run(r):
+    d = tempfile.mkdtemp(prefix="velo-batch-")
+    try:
+        test_expand(r)
+        test_group_and_state(r, d)
+        test_run_batch(r, d)
+        test_stream_groups(r)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Unit tests for modules/cache_index.py (the SQLite size/last-use index that
+# manage_cache evicts from instead of walking the cache).
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results
+import config
+from modules import cache_index, manage_cache
+from modules.concurrency import _atomic_output
+
+
+def _mkfile(path, size, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _rows(d):
+    return {os.path.relpath(p, d): (size, used) for p, size, used in cache_index.least_recently_used(d)}
+
+
+def test_built_from_disk(r):
+    with tempfile.TemporaryDirectory() as d:
+        _mkfile(os.path.join(d, 'a'), 100, 1000)
+        _mkfile(os.path.join(d, 'sub', 'b'), 200, 2000)
+        _mkfile(os.path.join(d, 'g.json'), 50, 3000)
+        _mkfile(os.path.join(d, 'g.json.gz'), 10, 3000)
+        r.check('no index -> total 0, nothing listed', cache_index.total_bytes(d) == 0 and _rows(d) == {}, '')
+        r.check('prepare_index builds it', manage_cache.prepare_index(d) is True, '')
+        rows = _rows(d)
+        r.check('one row per unit, oldest first, siblings folded',
+                list(rows) == ['a', os.path.join('sub', 'b'), 'g.json'] and rows['g.json'][0] == 60, f'rows={rows}')
+        r.check('total kept in the meta row', cache_index.total_bytes(d) == 360, f'total={cache_index.total_bytes(d)}')
+        r.check('fresh index is not rebuilt again', manage_cache.prepare_index(d) is False, '')
+        r.check('index files never listed as evictable',
+                not [p for p, _, _ in manage_cache._evictable_entries(d)
+                     if cache_index.is_index_file(os.path.basename(p))], '')
+
+
+def test_record_and_touch(r):
+    with tempfile.TemporaryDirectory() as d:
+        manage_cache.prepare_index(d)
+        saved = config.APP_CONFIG['CACHE_DIR']
+        config.APP_CONFIG['CACHE_DIR'] = d
+        try:
+            out = os.path.join(d, 'tiles', 'x', 'f.json')
+            os.makedirs(os.path.dirname(out))
+            with _atomic_output(out) as tmp:
+                with open(tmp, 'wb') as f:
+                    f.write(b'x' * 40)
+            r.check('_atomic_output records the published file',
+                    _rows(d).get(os.path.join('tiles', 'x', 'f.json'), (0,))[0] == 40, f'rows={_rows(d)}')
+            with _atomic_output(out + '.gz') as tmp:
+                with open(tmp, 'wb') as f:
+                    f.write(b'z' * 5)
+            r.check('a published sibling grows its parent entry',
+                    _rows(d).get(os.path.join('tiles', 'x', 'f.json'), (0,))[0] == 45
+                    and cache_index.total_bytes(d) == 45, f'rows={_rows(d)}')
+            old = _mkfile(os.path.join(d, 'old'), 10, 1000)
+            cache_index.record(old)
+            cache_index.record(old)
+            r.check('re-recording does not double count', cache_index.total_bytes(d) == 55,
+                    f'total={cache_index.total_bytes(d)}')
+            cache_index.forget(d, old)
+            key = os.path.join('tiles', 'x', 'f.json')
+            first = _rows(d)[key][1]
+            time.sleep(0.01)
+            manage_cache.mark_used(out)
+            touched = _rows(d)[key][1]
+            time.sleep(0.01)
+            manage_cache.mark_used(out)
+            r.check('mark_used refreshes last use in the index', touched > first, f'{first} -> {touched}')
+            r.check('repeat hits are throttled per process', _rows(d)[key][1] == touched, '')
+            cache_index.record(os.path.join(d, 'missing'))
+            r.check('recording a vanished file is a no-op', 'missing' not in _rows(d), '')
+            outside = tempfile.NamedTemporaryFile(delete=False)
+            outside.close()
+            cache_index.record(outside.name)
+            os.remove(outside.name)
+            r.check('files outside the cache are ignored', cache_index.total_bytes(d) == 45, '')
+        finally:
+            config.APP_CONFIG['CACHE_DIR'] = saved
+
+
+def test_budget_check_does_not_walk(r):
+    with tempfile.TemporaryDirectory() as d:
+        for i in range(5):
+            _mkfile(os.path.join(d, f'f{i}'), 100, 1000 + i)
+        manage_cache.prepare_index(d)
+        walks = []
+        real = manage_cache._evictable_entries
+        manage_cache._evictable_entries = lambda cache_dir: walks.append(cache_dir) or real(cache_dir)
+        try:
+            deleted = manage_cache.enforce_budget(d, max_bytes=10_000)
+            r.check('under budget with a fresh index: no walk, nothing deleted',
+                    deleted == 0 and walks == [], f'deleted={deleted} walks={len(walks)}')
+            deleted = manage_cache.enforce_budget(d, max_bytes=300, target_ratio=0.85)
+            r.check('over budget: evicts oldest from the index without walking',
+                    deleted == 3 and walks == [] and sorted(os.listdir(d))[-2:] == ['f3', 'f4'],
+                    f'deleted={deleted} walks={len(walks)}')
+            r.check('evicted rows dropped from the index', cache_index.total_bytes(d) == 200
+                    and set(_rows(d)) == {'f3', 'f4'}, f'rows={_rows(d)}')
+            manage_cache.enforce_budget(d, max_bytes=10_000, rebuild_seconds=0)
+            r.check('stale index is rebuilt from disk', len(walks) == 1, f'walks={len(walks)}')
+        finally:
+            manage_cache._evictable_entries = real
+
+
+def test_reconciles_with_disk(r):
+    with tempfile.TemporaryDirectory() as d:
+        _mkfile(os.path.join(d, 'gone'), 100, 1000)
+        _mkfile(os.path.join(d, 'kept'), 100, 2000)
+        manage_cache.prepare_index(d)
+        os.remove(os.path.join(d, 'gone'))                  # removed behind the index's back
+        _mkfile(os.path.join(d, 'unindexed'), 100, 1500)   # added behind the index's back
+        manage_cache.prepare_index(d, rebuild_seconds=0)
+        r.check('rebuild drops missing files and adds unindexed ones',
+                set(_rows(d)) == {'kept', 'unindexed'} and cache_index.total_bytes(d) == 200, f'rows={_rows(d)}')
+
+        os.remove(os.path.join(d, 'unindexed'))
+        deleted = manage_cache.enforce_budget(d, max_bytes=150, target_ratio=0.5)
+        r.check('a stale row is forgotten during eviction, not retried',
+                'unindexed' not in _rows(d) and deleted == 1, f'deleted={deleted} rows={_rows(d)}')
+
+
+def test_corrupt_index(r):
+    with tempfile.TemporaryDirectory() as d:
+        _mkfile(os.path.join(d, 'a'), 100, 1000)
+        with open(cache_index.index_path(d), 'wb') as f:
+            f.write(b'not a database' * 100)
+        rebuilt = manage_cache.prepare_index(d)
+        r.check('unreadable index is replaced and rebuilt',
+                rebuilt and cache_index.total_bytes(d) == 100, f'total={cache_index.total_bytes(d)}')
+
+
+def run(r):
+    r.section('cache_index.py persistent cache index (unit)')
+    for test in (test_built_from_disk, test_record_and_touch, test_budget_check_does_not_walk,
+                 test_reconciles_with_disk, test_corrupt_index):
+        test(r)
+
+
+if __name__ == '__main__':
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
-"""Unit tests for modules/concurrency.py -- atomic publish + the cross-process
-download lock. Stdlib only (os/fcntl/threading/contextlib + parse._safe_path).
+"""Unit tests for modules/concurrency.py -- atomic publish, the cross-process
+download lock and in-process single-flight. Stdlib only (os/fcntl/threading/
+contextlib + parse._safe_path).
 
 Run standalone:  python3 tests/test_concurrency.py
 Or via the suite: python3 tests/run_all.py
@@ -8,9 +9,12 @@ Or via the suite: python3 tests/run_all.py
 
 import os
 import sys
+import time
 import fcntl
 import shutil
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -93,9 +97,69 @@ def test_download_lock(r):
         shutil.rmtree(d, ignore_errors=True)
 
 
+def test_single_flight(r):
+    r.section("_single_flight (threads of one process share a build)")
+    n = 8
+    calls = []
+    started, release = threading.Event(), threading.Event()
+
+    def build():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "/cache/hrrr-winds.json"
+
+    before = concurrency.flight_counts()
+    with ThreadPoolExecutor(max_workers=n) as pool:
+        leader = pool.submit(concurrency._single_flight, "key-a", build)
+        started.wait(5)
+        waiters = [pool.submit(concurrency._single_flight, "key-a", build) for _ in range(n - 1)]
+        deadline = time.monotonic() + 5
+        while concurrency.flight_counts()["waiting"] < n - 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        during = concurrency.flight_counts()
+        release.set()
+        results = [leader.result()] + [w.result() for w in waiters]
+    after = concurrency.flight_counts()
+    r.check("N identical callers run the build once and all get its result",
+            len(calls) == 1 and set(results) == {"/cache/hrrr-winds.json"}, f"calls={len(calls)}")
+    r.check("waiters counted while blocked, then as coalesced",
+            during["waiting"] == n - 1 and during["in_flight"] == 1 and after["waiting"] == 0
+            and after["coalesced"] - before["coalesced"] == n - 1 and after["leaders"] - before["leaders"] == 1,
+            f"during={during} after={after}")
+
+    started.clear()
+    release.clear()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(concurrency._single_flight, "key-b", failing)]
+        started.wait(5)
+        futures.append(pool.submit(concurrency._single_flight, "key-b", failing))
+        deadline = time.monotonic() + 5
+        while concurrency.flight_counts()["waiting"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        errors = []
+        for f in futures:
+            try:
+                f.result()
+            except RuntimeError as e:
+                errors.append(str(e))
+    r.check("the leader's exception reaches every waiter", errors == ["upstream down"] * 2, str(errors))
+    r.check("a finished key starts a fresh build (results are not memoized)",
+            concurrency._single_flight("key-a", lambda: "again") == "again"
+            and concurrency.flight_counts()["in_flight"] == 0, "")
+
+
 def run(r):
     test_atomic_output(r)
     test_download_lock(r)
+    test_single_flight(r)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/conditional.py -- ETag / Last-Modified / Cache-Control
+for cached artifacts. Stdlib only.
+
+Run standalone:  python3 tests/test_conditional.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import tempfile
+import email.utils
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+from modules import conditional  # noqa: E402
+
+
+def test_etag(r):
+    r.section("etag_for (strong, per build)")
+    with tempfile.TemporaryDirectory() as d:
+        p = os.path.join(d, "hrrr-winds.json")
+        with open(p, "w") as f:
+            f.write("x" * 10)
+        os.utime(p, (1000, 1000))
+        st = os.stat(p)
+        tag = conditional.etag_for(p, st)
+        r.check("quoted strong ETag", tag.startswith('"') and tag.endswith('"') and not tag.startswith("W/"), tag)
+        os.utime(p, (5000, 1000))  # a cache hit moves only the atime
+        r.check("atime change (mark_used) keeps the ETag", conditional.etag_for(p, os.stat(p)) == tag, "")
+        os.utime(p, (5000, 2000))  # a rebuild publishes a new mtime
+        r.check("new build time -> new ETag", conditional.etag_for(p, os.stat(p)) != tag, "")
+        r.check("variant distinguishes encodings", conditional.etag_for(p, st, "gzip") != tag, "")
+
+
+def test_not_modified(r):
+    r.section("is_not_modified (If-None-Match / If-Modified-Since)")
+    tag = '"abc"'
+    r.check("matching If-None-Match -> 304", conditional.is_not_modified({"HTTP_IF_NONE_MATCH": tag}, tag, 1000), "")
+    r.check("list with a match -> 304",
+            conditional.is_not_modified({"HTTP_IF_NONE_MATCH": '"x", "abc"'}, tag, 1000), "")
+    r.check("weak form matches (weak comparison)",
+            conditional.is_not_modified({"HTTP_IF_NONE_MATCH": 'W/"abc"'}, tag, 1000), "")
+    r.check("'*' matches", conditional.is_not_modified({"HTTP_IF_NONE_MATCH": "*"}, tag, 1000), "")
+    r.check("stale ETag -> full response",
+            not conditional.is_not_modified({"HTTP_IF_NONE_MATCH": '"old"'}, tag, 1000), "")
+    later = email.utils.formatdate(2000, usegmt=True)
+    earlier = email.utils.formatdate(500, usegmt=True)
+    r.check("If-Modified-Since after build -> 304",
+            conditional.is_not_modified({"HTTP_IF_MODIFIED_SINCE": later}, tag, 1000), "")
+    r.check("If-Modified-Since before build -> full response",
+            not conditional.is_not_modified({"HTTP_IF_MODIFIED_SINCE": earlier}, tag, 1000), "")
+    r.check("If-None-Match wins over If-Modified-Since",
+            not conditional.is_not_modified({"HTTP_IF_NONE_MATCH": '"old"',
+                                             "HTTP_IF_MODIFIED_SINCE": later}, tag, 1000), "")
+    r.check("garbage If-Modified-Since ignored",
+            not conditional.is_not_modified({"HTTP_IF_MODIFIED_SINCE": "yesterday"}, tag, 1000), "")
+    r.check("no conditionals -> full response", not conditional.is_not_modified({}, tag, 1000), "")
+
+
+def test_cache_control(r):
+    r.section("cache_control (immutable past runs, short max-age for recent ones)")
+    now = datetime(2024, 3, 5, 19, tzinfo=timezone.utc)
+    old = conditional.cache_control(now - timedelta(hours=24), 6, 60, now=now)
+    r.check("past run -> immutable", "immutable" in old and f"max-age={conditional.IMMUTABLE_MAX_AGE}" in old, old)
+    recent = conditional.cache_control(now - timedelta(hours=2), 6, 60, now=now)
+    r.check("recent run -> short max-age", recent == "public, max-age=60", recent)
+    r.check("unknown run -> short max-age",
+            conditional.cache_control(None, 6, 60, now=now) == "public, max-age=60", "")
+    r.check("run_time parses the request date/time as UTC",
+            conditional.run_time("2024-03-05", "19:00:00") == now, "")
+
+
+def test_negotiate_encoding(r):
+    r.section("negotiate_encoding (Accept-Encoding q-values)")
+    avail = ["br", "gzip"]
+    neg = conditional.negotiate_encoding
+    r.check("no header -> identity", neg(None, avail) is None and neg("", avail) is None, "")
+    r.check("browser default prefers br", neg("gzip, deflate, br, zstd", avail) == "br", "")
+    r.check("gzip only -> gzip", neg("gzip", avail) == "gzip", "")
+    r.check("q-values rank codings", neg("br;q=0.5, gzip;q=0.9", avail) == "gzip", "")
+    r.check("q=0 excludes a coding", neg("br;q=0, gzip", avail) == "gzip", "")
+    r.check("all q=0 -> identity", neg("br;q=0, gzip;q=0", avail) is None, "")
+    r.check("'*' covers unnamed codings", neg("*", avail) == "br", "")
+    r.check("'*;q=0' with an explicit gzip", neg("gzip;q=0.5, *;q=0", avail) == "gzip", "")
+    r.check("codings are case-insensitive", neg("GZIP", avail) == "gzip", "")
+    r.check("unsupported coding only -> identity", neg("deflate", avail) is None, "")
+    r.check("identity preferred explicitly", neg("identity, gzip;q=0.5", avail) is None, "")
+    r.check("malformed q dropped, not raised", neg("br;q=x, gzip", avail) == "gzip", "")
+
+
+def run(r):
+    test_etag(r)
+    test_not_modified(r)
+    test_cache_control(r)
+    test_negotiate_encoding(r)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
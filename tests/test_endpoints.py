@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """Content-validity tests: hit every route x product x format and verify the
 response body is the right kind of artifact (valid velocity JSON / GeoTIFF / PNG).
+Every case is then requested again from cache, and both passes are reported as
+throughput and p50/p95/p99 latency (cold vs warm).
 
 Run standalone:  python3 tests/test_endpoints.py
 Or via the suite: python3 tests/run_all.py
@@ -8,14 +10,18 @@ Or via the suite: python3 tests/run_all.py
 
 import os
 import sys
+import time
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from helpers import ( 
-    Results, fetch, recent_time, PROJWIN, HRRR_PRODUCTS, HRRR_FORMATS,
+    Results, fetch, timed_fetch, recent_time, PROJWIN, HRRR_PRODUCTS, HRRR_FORMATS,
     validate_gribjson, validate_tiff, validate_png, validate_nonempty,
-    validate_cog_winds, validate_cog_scalar,
+    validate_cog_winds, validate_cog_scalar, latency_summary, upstream_stats, upstream_fetches,
 )
 
+# (path, fmt, product, seconds) of every case that passed, for the warm pass.
+_CASES = []
+
 
 def _validate(fmt, body, product=None):
     if fmt == "gribjson":
@@ -32,13 +38,14 @@ def _validate(fmt, body, product=None):
 
 
 def _run_case(r, name, path, fmt, product=None):
-    status, body, err = fetch(path)
+    status, body, err, seconds = timed_fetch(path)
     if err:
         return r.failed(name, f"ERROR {err}")
     if status != 200:
         return r.failed(name, f"HTTP {status}: {body[:100].decode('utf-8', 'replace')}")
     ok, detail = _validate(fmt, body, product)
-    r.check(name, ok, detail)
+    if r.check(name, ok, detail):
+        _CASES.append((path, fmt, product, seconds))
 
 
 def _fetch_gribjson(r, name, path):
@@ -82,6 +89,33 @@ def test_forecast(r):
                 p00 != p06, "fxx=6 projwin body is byte-identical to F00")
 
 
+def test_warm(r):
+    """Request every passing case again, now cached, and report both passes.
+    Against the fake upstream, the warm pass must not go upstream at all."""
+    if not _CASES:
+        return r.skipped("warm pass", "no case passed cold")
+    cold = [seconds for _p, _f, _pr, seconds in _CASES]
+    before = upstream_stats()
+    warm, bad = [], []
+    start = time.time()
+    for path, fmt, product, _seconds in _CASES:
+        status, body, _err, seconds = timed_fetch(path)
+        warm.append(seconds)
+        if status != 200 or not _validate(fmt, body, product)[0]:
+            bad.append(f"{path} -> HTTP {status}")
+    wall = time.time() - start
+    print(f"#   cold: {latency_summary(cold, sum(cold))}")
+    print(f"#   warm: {latency_summary(warm, wall)}")
+    r.check(f"warm pass: {len(_CASES)} cached cases all 200 + valid", not bad, "; ".join(bad[:3]))
+    after = upstream_stats()
+    if before is None or after is None:
+        r.skipped("warm pass fetched nothing upstream",
+                  "set VELOSERVER_UPSTREAM to the fake upstream (OFFLINE=1 tests/run_tests.sh)")
+    else:
+        r.check("warm pass fetched nothing upstream", upstream_fetches(before, after) == 0,
+                f"fetched={upstream_fetches(before, after)}")
+
+
 def run(r):
     T = recent_time()
     TZ = T + "Z"
@@ -127,6 +161,9 @@ def run(r):
         r.skipped("ecmwf/gribjson",
                   "set VELOSERVER_ECMWF=1 to test (needs .ecmwfapirc credentials)")
 
+    r.section("Cold vs warm cache latency")
+    test_warm(r)
+
 
 if __name__ == "__main__":
     from helpers import Results, server_up, clear_cache
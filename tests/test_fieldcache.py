@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/fieldcache.py -- memory-mapped decoded fields and the
+projwin slices HRRR subsets are served from.
+
+The GRIB2 fixture is written on the fly with GDAL's GRIB driver, as in
+test_gribjson. fieldcache imports rasterio, so without the GIS stack these
+tests SKIP.
+
+Run standalone:  python3 tests/test_fieldcache.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+
+try:
+    import numpy as np
+    import rasterio
+    from modules import convert, fieldcache, gribjson, windfield
+    import test_gribjson
+    from test_gribjson import NX, NY
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+
+def _raises_value_error(fn):
+    try:
+        fn()
+    except ValueError:
+        return True
+    return False
+
+
+def test_load(r, d):
+    r.section("fieldcache: decode once, then map")
+    grib = test_gribjson._make_grib(d)
+    field = fieldcache.load(grib)
+    path = fieldcache.field_path(grib)
+    r.check(".field file written next to the GRIB", os.path.exists(path) and path.endswith('uv.field'), path)
+    r.check("data is a read-only memmap (bands, ny, nx) float32",
+            isinstance(field.data, np.memmap) and field.data.shape == (3, NY, NX)
+            and field.data.dtype == np.float32 and not field.data.flags.writeable, str(field.data.shape))
+    r.check("array starts 64-byte aligned in the file", field.data.offset % 64 == 0, f"offset={field.data.offset}")
+    expected = test_gribjson._field()
+    r.check("north-up values, nodata as NaN",
+            np.isnan(field.data[0, 0, 0]) and np.array_equal(field.data[0].ravel()[1:], expected.ravel()[1:]), "")
+    r.check("grid: pixel centers of the GRIB",
+            (field.grid['nx'], field.grid['ny'], field.grid['lo1'], field.grid['la1'], field.grid['dx'])
+            == (NX, NY, 0.0, 40.0, 1.0), str(field.grid))
+    r.check("per-band GDAL tags and gribjson headers kept",
+            field.bands[0]['tags'].get('GRIB_ELEMENT') == 'UGRD'
+            and field.bands[1]['header']['parameterNumber'] == 3, "")
+    r.check("same process reuses the mapping", fieldcache.load(grib) is field, "")
+    os.remove(path)
+    again = fieldcache.load(grib)
+    r.check("evicted .field rebuilt on the next load", again is not field and os.path.exists(path), "")
+
+
+def test_subset(r, d):
+    r.section("fieldcache: projwin slices (wgrib2 -small_grib box)")
+    grib = test_gribjson._make_grib(d)
+    field = fieldcache.load(grib)
+    sub = fieldcache.subset(field, [2, 39, 4.5, 37])
+    r.check("view of the mapped array, not a copy", np.shares_memory(sub.data, field.data), "")
+    r.check("points on the edges are inside", (sub.grid['nx'], sub.grid['ny'], sub.grid['lo1'], sub.grid['la1'])
+            == (3, 3, 2.0, 39.0), str(sub.grid))
+    r.check("slice values", np.array_equal(sub.data[0], field.data[0, 1:4, 2:5]), "")
+    r.check("box off the grid -> ValueError",
+            _raises_value_error(lambda: fieldcache.subset(field, [100, 10, 101, 9])), "")
+
+    os.makedirs(os.path.join(d, 'wrapped'))
+    wrapped = fieldcache.load(test_gribjson._make_grib(os.path.join(d, 'wrapped'), west=349.5))
+    sub = fieldcache.subset(wrapped, [-8, 40, -6, 36])
+    r.check("-180..180 box matched against a 0-360 grid",
+            sub.grid['lo1'] == 352.0 and sub.grid['nx'] == 3, str(sub.grid))
+
+    # A global 45-degree grid: columns at 0, 45, ..., 315 E.
+    globe = fieldcache.Field(np.arange(3 * 8, dtype=np.float32).reshape(1, 3, 8),
+                             {'nx': 8, 'ny': 3, 'lo1': 0.0, 'la1': 10.0, 'dx': 45.0, 'dy': 5.0, 'crs': None},
+                             field.bands[:1])
+    sub = fieldcache.subset(globe, [-50, 10, 50, 0])
+    r.check("box across the seam of a global grid continues from its west edge",
+            (sub.grid['lo1'], sub.grid['nx']) == (315.0, 3)
+            and np.array_equal(sub.data[0], globe.data[0][:, [7, 0, 1]]), str(sub.grid))
+    sub = fieldcache.subset(globe, [-180, 10, 180, 0])
+    r.check("a whole-globe box takes each column once", sub.grid['nx'] == 8, str(sub.grid))
+    gfs = fieldcache.Field(np.zeros((1, 721, 1440), dtype=np.float32),
+                           {'nx': 1440, 'ny': 721, 'lo1': 0.0, 'la1': 90.0, 'dx': 0.25, 'dy': 0.25, 'crs': None},
+                           field.bands[:1])
+    sub = fieldcache.subset(gfs, [170, 60, -170, 50])
+    r.check("box across the antimeridian (east < west) wraps on a global grid",
+            (sub.grid['lo1'], sub.grid['nx'], sub.grid['ny']) == (170.0, 81, 41), str(sub.grid))
+    sub = fieldcache.subset(field, [2, 39, 30, 37])
+    r.check("a regional grid does not wrap", sub.grid['nx'] == NX - 2, str(sub.grid))
+
+    # A regional 0-360 grid like the regridded HRRR: columns at 226, 236, ..., 296 E.
+    conus = fieldcache.Field(np.arange(3 * 8, dtype=np.float32).reshape(1, 3, 8),
+                             {'nx': 8, 'ny': 3, 'lo1': 226.0, 'la1': 50.0, 'dx': 10.0, 'dy': 10.0, 'crs': None},
+                             field.bands[:1])
+    sub = fieldcache.subset(conus, [-140, 50, -100, 30])
+    r.check("box starting west of a regional grid is clipped to its west edge",
+            (sub.grid['lo1'], sub.grid['nx']) == (226.0, 4)
+            and np.array_equal(sub.data[0], conus.data[0, :, :4]), str(sub.grid))
+    sub = fieldcache.subset(conus, [-180, 60, -60, 20])
+    r.check("box covering a regional grid takes all of it",
+            (sub.grid['lo1'], sub.grid['nx'], sub.grid['ny']) == (226.0, 8, 3), str(sub.grid))
+    sub = fieldcache.subset(conus, [260, 50, 280, 30])
+    r.check("box in the grid's own 0-360 longitudes", (sub.grid['lo1'], sub.grid['nx']) == (266.0, 2), str(sub.grid))
+
+
+def test_producers(r, d):
+    r.section("fieldcache: format producers read slices directly")
+    grib = test_gribjson._make_grib(d)
+    field = fieldcache.load(grib)
+    whole, sliced = io.StringIO(), io.StringIO()
+    gribjson.encode(grib, whole, surface_value=10.0)
+    gribjson.encode_field(field, sliced, surface_value=10.0)
+    r.check("gribjson of the whole field == gribjson of the GRIB", whole.getvalue() == sliced.getvalue(), "")
+
+    sub = fieldcache.subset(field, [2, 39, 4.5, 37])
+    out = io.StringIO()
+    gribjson.encode_field(sub, out, surface_value=10.0)
+    record = json.loads(out.getvalue())[0]
+    header = record['header']
+    r.check("subset header: size and corners in the message's scan order (scanMode 64)",
+            (header['nx'], header['ny'], header['numberPoints'], header['lo1'], header['la1'], header['la2'])
+            == (3, 3, 9, 2.0, 37.0, 39.0), str({k: header[k] for k in ('nx', 'ny', 'lo1', 'la1', 'la2')}))
+    r.check("subset data in scan order", record['data'] == np.flipud(sub.data[0]).ravel().tolist(), "")
+
+    with open(windfield.to_windbin(sub, os.path.join(d, 'sub.windbin')), 'rb') as f:
+        blob = f.read()
+    wind_header, u, _ = windfield.decode_windbin(blob)
+    r.check("windbin from a slice", (wind_header['nx'], wind_header['lo1'], wind_header['la1']) == (3, 2.0, 39.0)
+            and np.allclose(u * wind_header['u']['scale'], sub.data[0], atol=0.005), str(wind_header)[:120])
+
+    tif = convert.to_geotiff(sub, os.path.join(d, 'sub.tif'))
+    with rasterio.open(tif) as src:
+        left, bottom, right, top = src.bounds
+        # 1.5..4.5 E, as gdalwarp sizes it: square pixels, so within a pixel.
+        r.check("geotiff from a slice: EPSG:3857 over the slice's extent",
+                src.crs.to_epsg() == 3857 and src.count == 3
+                and abs(left - 166979) < src.res[0] and abs(right - 500938) < src.res[0] * 1.5,
+                f"bounds={src.bounds}")
+
+    png = convert.to_png(sub, os.path.join(d, 'sub.png'), 'winds')
+    with open(png, 'rb') as f:
+        r.check("png from a slice", f.read(8) == b'\x89PNG\r\n\x1a\n', "")
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("fieldcache unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    d = tempfile.mkdtemp(prefix="velo-fieldcache-")
+    try:
+        for test in (test_load, test_subset, test_producers):
+            sub = tempfile.mkdtemp(dir=d)
+            test(r, sub)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
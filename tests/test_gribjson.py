@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/gribjson.py -- the in-process grib2json encoder.
+
+GRIB2 fixtures are written on the fly with GDAL's GRIB driver (rasterio), so no
+network or downloads. Two of them are also committed under tests/fixtures/gribjson
+with the grib2json tool's output for each, and the encoder is always compared
+with those. When the grib2json Java tool is on PATH (the container), its output
+is compared live as well, on a fresh file and on the committed ones; elsewhere
+that check SKIPs. Rewrite the committed outputs with the tool (after a change to
+the fixture GRIBs) with:  python3 tests/test_gribjson.py --regen-fixtures
+
+gribjson imports rasterio, so like test_tiles the import is wrapped: without
+the GIS stack these tests SKIP.
+
+Run standalone:  python3 tests/test_gribjson.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+
+try:
+    import numpy as np
+    import rasterio
+    import rasterio.shutil
+    from rasterio.transform import from_origin
+    from modules import convert, fieldcache, gribjson
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+NX, NY = 8, 5
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'gribjson')
+# <name>.grib2 (written by _make_grib, west=-0.5 and 349.5) and <name>.grib2json.json.
+FIXTURE_NAMES = ('uv', 'uv-0360')
+_IDS = ('CENTER=7 SUBCENTER=0 MASTER_TABLE=2 SIGNF_REF_TIME=1 '
+        'REF_TIME=2024-03-05T19:00:00Z PROD_STATUS=0 TYPE=1')
+# PDS template 4.0 values: category, number, process, ..., forecast time 3,
+# first surface 103 (height above ground) at 10 m -- or 2 m for the TMP band.
+_PDS = {1: '2 2 2 0 96 0 0 1 3 103 0 10 255 0 0',   # UGRD 10 m
+        2: '2 3 2 0 96 0 0 1 3 103 0 10 255 0 0',   # VGRD 10 m
+        3: '0 0 2 0 96 0 0 1 3 103 0 2 255 0 0'}    # TMP 2 m, dropped by the 10 m filter
+
+
+def _field():
+    data = np.arange(NX * NY, dtype=np.float32).reshape(NY, NX) / 4
+    data[0, 0] = -9999  # nodata -> bitmap -> null
+    return data
+
+
+def _make_grib(d, west=-0.5):
+    """A 3-message GRIB2 on a 1-degree lat/lon grid, as GDAL writes it."""
+    tif, grib = os.path.join(d, 'src.tif'), os.path.join(d, 'uv.grib2')
+    data = _field()
+    profile = dict(driver='GTiff', width=NX, height=NY, count=3, dtype='float32',
+                   crs='EPSG:4326', transform=from_origin(west, 40.5, 1, 1), nodata=-9999)
+    with rasterio.open(tif, 'w', **profile) as dst:
+        dst.write(data, 1)
+        dst.write(np.where(data == -9999, data, -data), 2)
+        dst.write(data + 273, 3)
+    opts = {'DISCIPLINE': '0', 'IDS': _IDS}
+    for band, pds in _PDS.items():
+        opts[f'BAND_{band}_PDS_PDTN'] = '0'
+        opts[f'BAND_{band}_PDS_TEMPLATE_ASSEMBLED_VALUES'] = pds
+    rasterio.shutil.copy(tif, grib, driver='GRIB', **opts)
+    return grib
+
+
+def _encode(path, surface_value=10.0):
+    out = io.StringIO()
+    count = gribjson.encode(path, out, surface_value=surface_value)
+    return count, out.getvalue()
+
+
+def _grib2json(path):
+    """The grib2json tool's output for ``path``, as the server runs it."""
+    java = subprocess.run(['grib2json', '--names', '--data', '--fv', '10.0', path],
+                          capture_output=True, text=True, timeout=120)
+    return java.stdout
+
+
+def _fixture(name):
+    grib = os.path.join(FIXTURES, name + '.grib2')
+    with open(os.path.join(FIXTURES, name + '.grib2json.json')) as f:
+        return grib, f.read()
+
+
+def _same_records(r, what, records, theirs):
+    """Check our records against grib2json's, record by record."""
+    r.check(f"{what}: same record count as grib2json", len(theirs) == len(records),
+            f"{len(theirs)} vs {len(records)}")
+    for ours, ref in zip(records, theirs):
+        name = f"{what} {ref['header'].get('parameterNumberName')}"
+        diff = {k: (ours['header'].get(k), v) for k, v in ref['header'].items() if ours['header'].get(k) != v}
+        r.check(f"{name}: header identical to grib2json", not diff, str(diff)[:300])
+        same = len(ours['data']) == len(ref['data']) and all(
+            (a is None and b is None) or (a is not None and b is not None and np.float32(a) == np.float32(b))
+            for a, b in zip(ours['data'], ref['data']))
+        r.check(f"{name}: data identical to grib2json (as float32)", same, "")
+
+
+def _number_text(text):
+    """Every data value as the text it was printed as."""
+    return [record['data'] for record in json.loads(text, parse_float=str)]
+
+
+def _raises_unsupported(fn):
+    try:
+        fn()
+    except gribjson.UnsupportedGrib:
+        return True
+    except Exception:
+        return False
+    return False
+
+
+def test_java_float(r):
+    r.section("gribjson: floats printed like Java's Float.toString")
+    cases = {10.0: '10.0', 1.5: '1.5', -2.3400002: '-2.3400002', 0.1: '0.1', 1e-4: '1.0E-4',
+             1.2345e7: '1.2345E7', 0.0: '0.0', 359.0: '359.0', 0.001: '0.001'}
+    got = {v: gribjson.java_float(v) for v in cases}
+    r.check("shortest digits, '.0', E notation outside [1e-3, 1e7)", got == cases,
+            str({k: v for k, v in got.items() if cases[k] != v}))
+
+
+def test_records(r, d):
+    r.section("gribjson: records match the GRIB (header, order, filter)")
+    grib = _make_grib(d)
+    count, text = _encode(grib)
+    records = json.loads(text)
+    r.check("--fv 10.0 filter keeps the two 10 m messages", count == 2 and len(records) == 2,
+            f"count={count} records={len(records)}")
+    header = records[0]['header']
+    r.check("header keys in grib2json order", tuple(header) == gribjson.HEADER_KEYS, "")
+    r.check("U then V by category/number",
+            [(h['header']['parameterCategory'], h['header']['parameterNumber']) for h in records]
+            == [(2, 2), (2, 3)] and header['parameterNumberName'] == 'U-component_of_wind', "")
+    r.check("identification fields", header['center'] == 7 and header['refTime'] == '2024-03-05T19:00:00.000Z'
+            and header['forecastTime'] == 3 and header['surface1Value'] == 10.0, str(header)[:200])
+    r.check("grid fields", (header['nx'], header['ny'], header['dx'], header['dy'], header['lo1'])
+            == (NX, NY, 1.0, 1.0, 0.0), f"{header['nx']}x{header['ny']} lo1={header['lo1']}")
+    data = records[0]['data']
+    r.check("numberPoints values, nodata written as null",
+            len(data) == header['numberPoints'] == NX * NY and data.count(None) == 1, f"len={len(data)}")
+    # GDAL writes south-to-north (scanMode 64): storage order starts at the
+    # southern row, which is what grib2json emits.
+    expected = np.flipud(_field()).ravel().tolist()
+    r.check("data in the message's scan order (south row first for scanMode 64)",
+            header['scanMode'] == 64 and data[:NX] == expected[:NX] and data[-NX + 1:] == expected[-NX + 1:],
+            f"scanMode={header['scanMode']} first={data[:3]}")
+    r.check("compact: no whitespace between tokens", '\n' not in text and ', ' not in text, "")
+
+
+def test_scan_mode(r, d):
+    r.section("gribjson: storage order kept whatever GDAL's north-up view is")
+    grib = _make_grib(d)
+    with open(grib, 'rb') as f:
+        blob = bytearray(f.read())
+    # Rewrite message 1's grid as north-to-south (scanMode 0, la1/la2 swapped):
+    # the stored values are unchanged, so the encoded data must be too.
+    sec3 = 16
+    while blob[sec3 + 4] != 3:
+        sec3 += struct.unpack_from('>I', blob, sec3)[0]
+    la1, la2 = blob[sec3 + 46:sec3 + 50], blob[sec3 + 55:sec3 + 59]
+    blob[sec3 + 46:sec3 + 50], blob[sec3 + 55:sec3 + 59] = la2, la1
+    blob[sec3 + 71] = 0
+    patched = os.path.join(d, 'north-first.grib2')
+    with open(patched, 'wb') as f:
+        f.write(blob)
+    before = json.loads(_encode(grib)[1])[0]
+    after = json.loads(_encode(patched)[1])[0]
+    r.check("scanMode 0 header read back", after['header']['scanMode'] == 0
+            and after['header']['la1'] == before['header']['la2'], "")
+    r.check("same stored values -> same data", after['data'] == before['data'], "")
+
+    os.makedirs(os.path.join(d, 'wrapped'))
+    wrapped = _make_grib(os.path.join(d, 'wrapped'), west=349.5)
+    rec = json.loads(_encode(wrapped)[1])[0]
+    r.check("0-360 longitudes are not rotated to -180..180",
+            rec['header']['lo1'] == 350.0 and rec['data'][NX:2 * NX] == np.flipud(_field())[1].tolist(),
+            f"lo1={rec['header']['lo1']}")
+
+
+def test_fixtures(r):
+    r.section("gribjson: records match grib2json's committed output")
+    for name in FIXTURE_NAMES:
+        grib, ref = _fixture(name)
+        _, text = _encode(grib)
+        _same_records(r, name, json.loads(text), json.loads(ref))
+        r.check(f"{name}: values printed as grib2json prints them", _number_text(text) == _number_text(ref), "")
+
+
+def test_unsupported(r, d):
+    r.section("gribjson: unsupported input -> UnsupportedGrib (grib2json fallback)")
+    grib1 = os.path.join(d, 'g1.grib')
+    with open(grib1, 'wb') as f:
+        f.write(b'GRIB' + b'\x00\x00\x1c\x01' + b'\x00' * 24 + b'7777')
+    r.check("GRIB1 rejected", _raises_unsupported(lambda: _encode(grib1)), "")
+
+
+def _field_fallback(r, d, grib):
+    """A Field goes to grib2json (here a stand-in script on PATH that names the
+    file it was given) on the GRIB its ``grib`` callable returns."""
+    bin_dir = os.path.join(d, 'bin')
+    os.makedirs(bin_dir)
+    script = os.path.join(bin_dir, 'grib2json')
+    with open(script, 'w') as f:
+        f.write('#!/bin/sh\nfor last; do :; done\necho "[\\"$last\\"]"\n')
+    os.chmod(script, 0o755)
+    field = fieldcache.read_grib(grib)
+    saved = config.APP_CONFIG['GRIBJSON_ENCODER'], os.environ['PATH']
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+    def produce(name, source, **kw):
+        out = os.path.join(d, name + '.json')
+        convert.to_gribjson(source, out, **kw)
+        with open(out) as f:
+            return json.load(f)
+    try:
+        config.APP_CONFIG['GRIBJSON_ENCODER'] = 'grib2json'
+        r.check("GRIBJSON_ENCODER=grib2json: a Field's GRIB goes to grib2json",
+                produce('configured', field, grib=lambda: grib) == [grib], "")
+        r.check("a Field without a GRIB behind it is still encoded natively",
+                len(produce('no-grib', field)) == 2, "")
+        config.APP_CONFIG['GRIBJSON_ENCODER'] = 'native'
+        broken = field._replace(bands=[dict(b, header=None) for b in field.bands])
+        r.check("native encoder failing on a Field falls back to grib2json",
+                produce('fallback', broken, grib=lambda: grib) == [grib], "")
+        r.check("... and with no GRIB to fall back on, the failure is raised",
+                _raises_unsupported(lambda: produce('raised', broken)), "")
+    finally:
+        config.APP_CONFIG['GRIBJSON_ENCODER'], os.environ['PATH'] = saved
+
+
+def test_to_gribjson(r, d):
+    r.section("convert.to_gribjson: native encoder, grib2json fallback")
+    grib = _make_grib(d)
+    out = os.path.join(d, 'uv.json')
+    saved = config.APP_CONFIG['GRIBJSON_ENCODER']
+    config.APP_CONFIG['GRIBJSON_ENCODER'] = 'native'
+    try:
+        convert.to_gribjson(grib, out)
+        with open(out) as f:
+            records = json.load(f)
+        r.check("native path writes the records", len(records) == 2, f"records={len(records)}")
+        r.check("compressed siblings built alongside", os.path.exists(out + '.gz'), "")
+    finally:
+        config.APP_CONFIG['GRIBJSON_ENCODER'] = saved
+    _field_fallback(r, d, grib)
+
+    if shutil.which('grib2json') is None:
+        r.skipped("grib2json parity", "grib2json (Java) not on PATH; runs in container")
+        return
+    _same_records(r, "fresh GRIB", records, json.loads(_grib2json(grib)))
+    for name in FIXTURE_NAMES:
+        fixture, ref = _fixture(name)
+        _same_records(r, f"committed {name}", json.loads(ref), json.loads(_grib2json(fixture)))
+
+
+def regen_fixtures():
+    """Rewrite the committed grib2json outputs with the tool (needs grib2json)."""
+    for name in FIXTURE_NAMES:
+        grib = os.path.join(FIXTURES, name + '.grib2')
+        with open(os.path.join(FIXTURES, name + '.grib2json.json'), 'w') as f:
+            f.write(_grib2json(grib))
+        print('Wrote', name + '.grib2json.json')
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("gribjson unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    test_java_float(r)
+    test_fixtures(r)
+    d = tempfile.mkdtemp(prefix="velo-gribjson-")
+    try:
+        for test in (test_records, test_scan_mode, test_unsupported, test_to_gribjson):
+            sub = tempfile.mkdtemp(dir=d)
+            test(r, sub)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if "--regen-fixtures" in sys.argv:
+        if shutil.which('grib2json') is None:
+            sys.exit("grib2json (Java) not on PATH")
+        regen_fixtures()
+        sys.exit(0)
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/hotcache.py -- the arena of small response bodies
+shared by the gunicorn workers. Stdlib only (mmap/fcntl/struct + config).
+
+Run standalone:  python3 tests/test_hotcache.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+from modules import hotcache, manage_cache  # noqa: E402
+
+
+def _write(d, name, body, mtime_ns=None):
+    path = os.path.join(d, name)
+    with open(path, "wb") as f:
+        f.write(body)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def _get(path):
+    return hotcache.get(path, os.stat(path))
+
+
+def test_hits(r, d):
+    r.section("hotcache: stored once, then served from the shared arena")
+    path = _write(d, "hrrr-winds-2024-03-05T19:00:00-f00.wind.png", b"\x89PNG" + bytes(range(256)) * 40)
+    before = hotcache.stats()
+    body = _get(path)
+    again = _get(path)
+    after = hotcache.stats()
+    r.check("miss reads and stores the body, the next call is a hit",
+            body == again == open(path, "rb").read()
+            and (after["misses"] - before["misses"], after["stores"] - before["stores"],
+                 after["hits"] - before["hits"]) == (1, 1, 1), str(after))
+
+    # Same size and mtime, other bytes: only a read of the file would see them.
+    st = os.stat(path)
+    _write(d, os.path.basename(path), b"\0" * st.st_size, mtime_ns=st.st_mtime_ns)
+    r.check("a hit never opens the file", _get(path) == body, "")
+
+    cfg = config.APP_CONFIG
+    other = hotcache._Arena(os.path.join(d, hotcache.ARENA_NAME),
+                            cfg["HOT_CACHE_BYTES"], cfg["HOT_CACHE_MAX_ENTRY"])
+    r.check("a separate mapping of the arena (another worker) sees the entry",
+            other.get(hotcache._digest(path), os.stat(path).st_mtime_ns, len(body)) == body, "")
+
+    st = os.stat(path)
+    _write(d, os.path.basename(path), b"rebuilt", mtime_ns=st.st_mtime_ns + 10 ** 9)
+    r.check("a rebuilt file (new mtime) is not answered with the old body", _get(path) == b"rebuilt", "")
+
+    big = _write(d, "big.tif", b"x" * (cfg["HOT_CACHE_MAX_ENTRY"] + 1))
+    r.check("bodies over HOT_CACHE_MAX_ENTRY are left to streaming",
+            _get(big) is None and hotcache.stats()["too_large"] >= 1, str(hotcache.stats()))
+
+    names = set(os.listdir(d))
+    evictable = {os.path.basename(p) for p, _s, _u in manage_cache._evictable_entries(d)}
+    r.check("eviction never deletes the arena",
+            hotcache.ARENA_NAME in names and hotcache.ARENA_NAME not in evictable, str(sorted(evictable)))
+
+
+def test_lru(r, d):
+    r.section("hotcache: least recently used way of a set is replaced")
+    # One 4 KB class with a single set of 8 ways.
+    config.APP_CONFIG["HOT_CACHE_BYTES"] = hotcache._HEADER_BYTES + 8 * (hotcache._SLOT_HEADER + 4096)
+    config.APP_CONFIG["HOT_CACHE_MAX_ENTRY"] = 4096
+    paths = [_write(d, f"tile-{i}.png", bytes([i]) * 1000) for i in range(9)]
+    for p in paths[:8]:
+        _get(p)
+    _get(paths[0])  # most recent now; tile-1 is the oldest
+    before = hotcache.stats()
+    _get(paths[8])
+    after = hotcache.stats()
+    arena = hotcache._arena
+    present = [arena.get(hotcache._digest(p), os.stat(p).st_mtime_ns, 1000) is not None for p in paths]
+    r.check("a ninth entry evicts exactly the least recently used one",
+            after["evictions"] - before["evictions"] == 1 and present == [True, False] + [True] * 7, str(present))
+    config.APP_CONFIG["HOT_CACHE_BYTES"] = 0
+    r.check("HOT_CACHE_BYTES=0 disables it", _get(paths[0]) is None, "")
+
+
+def run(r):
+    saved = {k: config.APP_CONFIG[k] for k in ("CACHE_DIR", "HOT_CACHE_BYTES", "HOT_CACHE_MAX_ENTRY")}
+    d = tempfile.mkdtemp(prefix="velo-hot-")
+    try:
+        for test in (test_hits, test_lru):
+            sub = tempfile.mkdtemp(dir=d)
+            config.APP_CONFIG.update(saved, CACHE_DIR=sub)
+            test(r, sub)
+    finally:
+        config.APP_CONFIG.update(saved)
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -54,6 +54,17 @@ def test_mark_used_protects(r):
                 f"f0={_exists(d,'f0')} f1={_exists(d,'f1')} f4={_exists(d,'f4')}")
 
 
+def test_mark_used_keeps_build_time(r):
+    # mark_used moves only the atime, so the mtime (build time) the HTTP
+    # validators are derived from stays put across cache hits.
+    with tempfile.TemporaryDirectory() as d:
+        p = _mkfile(os.path.join(d, 'f'), 10, 1000)
+        manage_cache.mark_used(p)
+        st = os.stat(p)
+        r.check('mark_used keeps mtime (build time), bumps atime',
+                st.st_mtime == 1000 and st.st_atime > 1000, f'mtime={st.st_mtime} atime={st.st_atime}')
+
+
 def test_never_evicts_locks(r):
     with tempfile.TemporaryDirectory() as d:
         _mkfile(os.path.join(d, 'big'), 1000, 1000)
@@ -78,6 +89,25 @@ def test_recursive_and_prunes_dirs(r):
                 f'deleted={deleted} nested_gone={not os.path.exists(nested)}')
 
 
+def test_compressed_siblings_are_one_unit(r):
+    with tempfile.TemporaryDirectory() as d:
+        # Old gribjson (100 + 30 + 20 bytes) vs a newer 100-byte file.
+        _mkfile(os.path.join(d, 'g.json'), 100, 1000)
+        _mkfile(os.path.join(d, 'g.json.gz'), 30, 1000)
+        _mkfile(os.path.join(d, 'g.json.br'), 20, 1000)
+        _mkfile(os.path.join(d, 'keep'), 100, 5000)
+        _mkfile(os.path.join(d, 'orphan.json.gz'), 10, 900)  # parent already gone
+        entries = {os.path.basename(p): size for p, size, _ in manage_cache._evictable_entries(d)}
+        r.check('siblings are folded into their parent entry',
+                entries.get('g.json') == 150 and 'g.json.gz' not in entries and 'g.json.br' not in entries,
+                f'entries={entries}')
+        r.check('orphaned sibling is its own entry', entries.get('orphan.json.gz') == 10, f'entries={entries}')
+        deleted = manage_cache.enforce_budget(d, max_bytes=200, target_ratio=0.85)
+        r.check('parent and siblings evicted together',
+                deleted == 2 and not any(_exists(d, n) for n in ('g.json', 'g.json.gz', 'g.json.br', 'orphan.json.gz'))
+                and _exists(d, 'keep'), f'deleted={deleted} left={sorted(os.listdir(d))}')
+
+
 def test_ttl(r):
     with tempfile.TemporaryDirectory() as d:
         import time
@@ -114,11 +144,46 @@ def test_enforce_configured(r):
             manage_cache.enforce_configured({}) == 0, '')
 
 
+def test_background_evictor(r):
+    import time
+    with tempfile.TemporaryDirectory() as d:
+        for i in range(5):
+            _mkfile(os.path.join(d, f'f{i}'), 100, 1000 + i)
+        cfg = {'CACHE_DIR': d, 'CACHE_MAX_BYTES': 300, 'CACHE_TTL_HOURS': 0,
+               'CACHE_TARGET_RATIO': 0.85, 'CACHE_EVICT_IN_BACKGROUND': True,
+               'CACHE_EVICT_POLL_SECONDS': 1, 'CACHE_EVICT_DELETES_PER_SEC': 20}
+        manage_cache.prepare_index(d)
+        r.check('no evictor yet -> note_growth evicts inline', manage_cache.note_growth(cfg) == 3,
+                f'left={sorted(os.listdir(d))}')
+
+        for i in range(5, 10):
+            _mkfile(os.path.join(d, f'f{i}'), 100, 2000 + i)
+        manage_cache.prepare_index(d, rebuild_seconds=0)  # pick up the new files
+        started = time.monotonic()
+        stop = manage_cache.start_evictor(cfg)
+        try:
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline and not manage_cache._evictor_alive(cfg):
+                time.sleep(0.05)
+            elapsed = time.monotonic() - started
+            left = sorted(n for n in os.listdir(d) if n.startswith('f'))
+            r.check('evictor thread brings the cache under budget', left == ['f8', 'f9'], f'left={left}')
+            r.check('deletions are paced (5 at 20/s take >= 0.25 s)', elapsed >= 0.25, f'{elapsed:.2f}s')
+            _mkfile(os.path.join(d, 'big'), 10_000, 3000)
+            manage_cache.prepare_index(d, rebuild_seconds=0)
+            r.check('while the evictor is alive, note_growth never deletes inline',
+                    manage_cache.note_growth(cfg) == 0, '')
+        finally:
+            stop.set()
+        r.check('CACHE_EVICT_IN_BACKGROUND off -> no thread',
+                manage_cache.start_evictor(dict(cfg, CACHE_EVICT_IN_BACKGROUND=False)) is None, '')
+
+
 def run(r):
     r.section('manage_cache.py LRU eviction (unit)')
     for test in (test_under_budget, test_evicts_oldest_first, test_mark_used_protects,
-                 test_never_evicts_locks, test_recursive_and_prunes_dirs, test_ttl, test_disabled,
-                 test_enforce_configured):
+                 test_mark_used_keeps_build_time, test_never_evicts_locks, test_recursive_and_prunes_dirs, test_compressed_siblings_are_one_unit, test_ttl, test_disabled,
+                 test_enforce_configured, test_background_evictor):
         test(r)
 
 
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/metrics.py -- per-process counters and histograms
+summed across worker processes for /metrics. Stdlib only (json/os.fork +
+config, manage_cache for the eviction counters).
+
+Run standalone:  python3 tests/test_metrics.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+from modules import manage_cache, metrics  # noqa: E402
+
+
+def _samples(text):
+    """``{'name{labels}': value}`` of the sample lines of an exposition."""
+    out = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            out[name] = float(value)
+    return out
+
+
+def test_exposition(r, d):
+    r.section("metrics: counters and histograms in the text exposition format")
+    metrics.inc("veloserver_cache_requests_total", model="hrrr", product="t-expo", format="png", result="hit")
+    metrics.inc("veloserver_cache_requests_total", 2, model="hrrr", product="t-expo", format="png", result="hit")
+    for seconds in (0.003, 0.2, 500):
+        metrics.observe("veloserver_stage_seconds", seconds, stage="t-expo", model="hrrr")
+    text = metrics.render(d)
+    got = _samples(text)
+    r.check("counter summed under its labels",
+            got.get('veloserver_cache_requests_total{format="png",model="hrrr",product="t-expo",result="hit"}') == 3,
+            text[:400])
+    labels = 'model="hrrr",stage="t-expo"'
+    r.check("histogram buckets are cumulative, +Inf is the count",
+            got.get(f'veloserver_stage_seconds_bucket{{{labels},le="0.005"}}') == 1
+            and got.get(f'veloserver_stage_seconds_bucket{{{labels},le="0.25"}}') == 2
+            and got.get(f'veloserver_stage_seconds_bucket{{{labels},le="120.0"}}') == 2
+            and got.get(f'veloserver_stage_seconds_bucket{{{labels},le="+Inf"}}') == 3
+            and got.get(f'veloserver_stage_seconds_count{{{labels}}}') == 3
+            and abs(got.get(f'veloserver_stage_seconds_sum{{{labels}}}', 0) - 500.203) < 1e-6, "")
+    r.check("every family has HELP and TYPE lines",
+            all(f"# TYPE {name} {kind}" in text for name, (kind, _h) in metrics.FAMILIES.items()), "")
+
+
+def test_across_processes(r, d):
+    r.section("metrics: samples of every worker process are summed")
+    counter = 'veloserver_download_bytes_total{source="t-fork"}'
+    metrics.inc("veloserver_download_bytes_total", 5, source="t-fork")
+    pid = os.fork()
+    if pid == 0:  # a worker: starts from zero, counts, flushes and exits
+        try:
+            metrics.inc("veloserver_download_bytes_total", 2, source="t-fork")
+            metrics.gauge_add("veloserver_requests_in_flight", 1, pid="t-dead")
+            metrics.flush(d)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    # A worker that is still running (pid 1 always is).
+    with open(os.path.join(metrics.metrics_dir(d), "1.json"), "w") as f:
+        json.dump([["veloserver_requests_in_flight", [["pid", "t-live"]], 3]], f)
+    got = _samples(metrics.render(d))
+    r.check("a forked worker's counts add to the parent's (not re-counting inherited ones)",
+            got.get(counter) == 7, str(got.get(counter)))
+    r.check("gauges of an exited worker are dropped, live ones kept",
+            'veloserver_requests_in_flight{pid="t-dead"}' not in got
+            and got.get('veloserver_requests_in_flight{pid="t-live"}') == 3, "")
+    metrics.clear(d)
+    r.check("clear() drops earlier runs' snapshots", os.listdir(metrics.metrics_dir(d)) == [], "")
+
+
+def test_eviction(r, d):
+    r.section("metrics: eviction passes, files and bytes freed")
+    for i in range(3):
+        with open(os.path.join(d, f"old-{i}.json"), "wb") as f:
+            f.write(b"x" * 1000)
+        os.utime(os.path.join(d, f"old-{i}.json"), (1, 1))
+    metrics.flush(d)
+    before = _samples(metrics.render(d))
+    deleted = manage_cache.enforce_budget(d, max_bytes=10 ** 9, ttl_seconds=60)
+    after = _samples(metrics.render(d))
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+    r.check("deleted files and their bytes counted",
+            deleted == 3 and delta("veloserver_evicted_files_total") == 3
+            and delta("veloserver_evicted_bytes_total") == 3000
+            and delta("veloserver_eviction_passes_total") == 1, f"deleted={deleted}")
+    r.check("the snapshot directory is never evicted",
+            os.path.isdir(metrics.metrics_dir(d))
+            and not any(metrics.METRICS_DIR_NAME in p for p, _s, _u in manage_cache._evictable_entries(d)), "")
+
+
+def run(r):
+    saved = config.APP_CONFIG["CACHE_DIR"]
+    d = tempfile.mkdtemp(prefix="velo-metrics-")
+    try:
+        for test in (test_exposition, test_across_processes, test_eviction):
+            sub = tempfile.mkdtemp(dir=d)
+            config.APP_CONFIG["CACHE_DIR"] = sub
+            test(r, sub)
+    finally:
+        config.APP_CONFIG["CACHE_DIR"] = saved
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
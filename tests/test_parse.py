@@ -96,6 +96,8 @@ def test_validate_request(r):
     # product NOT checked for non-hrrr models
     _, err = parse.validate_request("gfs", "gribjson", None, "bogus")
     r.check("product ignored for gfs -> no error", err is None, f"err={err!r}")
+    _, err = parse.validate_request("gfs", "windbin", None, "winds")
+    r.check("windbin accepted", err is None, f"err={err!r}")
     # projwin wrong count
     _, err = parse.validate_request("hrrr", "geotiff", ["1", "2", "3"], "winds")
     r.check("projwin with 3 values -> error", err is not None and "projwin" in err.lower(), f"err={err!r}")
@@ -196,10 +198,37 @@ def test_parse_fxx(r):
             parse.parse_fxx("6", "19:30:00") == 6, f"got {parse.parse_fxx('6', '19:30:00')}")
 
 
+def test_point_params(r):
+    r.section("parse_fxx_range / parse_points (point route)")
+    r.check("absent -> the whole run (F00-F18, F00-F48 synoptic)",
+            parse.parse_fxx_range(None, "19:00:00") == list(range(19))
+            and parse.parse_fxx_range("", "00:00:00") == list(range(49)), "")
+    r.check("'3-5' -> [3, 4, 5]; '6' and 0 -> one hour",
+            parse.parse_fxx_range("3-5", "19:00:00") == [3, 4, 5]
+            and parse.parse_fxx_range("6", "19:00:00") == [6] and parse.parse_fxx_range(0, "19:00:00") == [0], "")
+    r.check("backwards, past the run's last hour or garbage -> ValueError",
+            all(_raises_valueerror(lambda v=v: parse.parse_fxx_range(v, "19:00:00")) for v in ("5-3", "0-19", "a-b")),
+            "want ValueError")
+    lats, lons = parse.parse_points([{"lat": "39.7", "lon": -105}, {"lat": 40, "lon": 255}], 10)
+    r.check("points -> float lat/lon lists, either longitude convention",
+            (lats, lons) == ([39.7, 40.0], [-105.0, 255.0]), f"{lats} {lons}")
+    bad = ([], None, [{"lat": 1}], [{"lat": "x", "lon": 1}], [{"lat": 91, "lon": 0}],
+           [{"lat": 0, "lon": float("nan")}], [[39, -105]])
+    r.check("empty, malformed or out-of-range points -> ValueError",
+            all(_raises_valueerror(lambda p=p: parse.parse_points(p, 10)) for p in bad), "want ValueError")
+    r.check("more than max_points -> ValueError",
+            _raises_valueerror(lambda: parse.parse_points([{"lat": 0, "lon": 0}] * 3, 2)), "want ValueError")
+
+
 def test_hrrr_format_error(r):
-    r.section("hrrr_format_error (gribjson is winds-only)")
+    r.section("hrrr_format_error (wind formats are winds-only)")
     r.check("scalar + gribjson -> message",
             parse.hrrr_format_error("temp_2m", "gribjson") is not None, "")
+    r.check("scalar + windbin/windpng -> message naming the format",
+            all(f in (parse.hrrr_format_error("temp_2m", f) or "") for f in ("windbin", "windpng")), "")
+    r.check("winds + windbin/windpng -> None",
+            parse.hrrr_format_error("winds", "windbin") is None
+            and parse.hrrr_format_error("winds", "windpng") is None, "")
     r.check("winds + gribjson -> None", parse.hrrr_format_error("winds", "gribjson") is None, "")
     r.check("scalar + geotiff -> None", parse.hrrr_format_error("temp_2m", "geotiff") is None, "")
     r.check("scalar + png -> None", parse.hrrr_format_error("temp_2m", "png") is None, "")
@@ -215,6 +244,7 @@ def run(r):
     test_parse_request_time(r)
     test_parse_cog_time(r)
     test_parse_fxx(r)
+    test_point_params(r)
     test_hrrr_format_error(r)
 
 
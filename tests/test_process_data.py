@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 """Unit tests for the pure (non-GIS) helpers in process_data.py: longitude
-conversion and the COG cache-filename scheme.
+conversion, the COG cache-filename scheme, and against tests/fake_upstream.py
+the streamed GFS download (GRIB2 checks as it arrives, pooled connections) and
+process_gfs cutting every projwin from one global download per cycle.
 
 process_data imports the heavy stack (herbie / ecmwfapi / convert -> matplotlib,
 rasterio) at module load, so it can only be imported where that stack exists (the
@@ -14,13 +16,23 @@ Or via the suite: python3 tests/run_all.py
 
 import os
 import sys
+import json
+import shutil
+import time
+import struct
+import tempfile
+import urllib.request
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from helpers import Results  # noqa: E402
 
 try:
-    from process_data import lon360, _cog_name_prefix, _cog_filename, _regrid_name_prefix
+    import numpy as np
+    import config
+    from process_data import (lon360, _cog_name_prefix, _cog_filename, _regrid_name_prefix,
+                              _check_grib_stream, _stream_download, process_gfs)
+    import fake_upstream
     _IMPORT_ERR = None
 except Exception as e:  # heavy GIS/web deps absent (e.g. running outside the container)
     _IMPORT_ERR = e
@@ -69,6 +81,141 @@ def test_regrid_name_prefix(r):
             == "hrrr-temp_2m-2024-03-05T00:00:00-f48", "")
 
 
+def _grib2(payload):
+    """A GRIB2-framed message: section 0 (magic, edition 2, total length), then
+    ``payload`` standing in for sections 1-8."""
+    return b"GRIB\0\0\0\2" + struct.pack(">Q", 16 + len(payload)) + payload
+
+
+def _chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def _passes(chunks):
+    try:
+        return b"".join(_check_grib_stream(chunks)) == b"".join(chunks)
+    except IOError:
+        return False
+
+
+def test_check_grib_stream(r):
+    r.section("process_data._check_grib_stream: whole GRIB2 messages only")
+    body = _grib2(b"x" * 300) + _grib2(b"y" * 5) + _grib2(b"7777")
+    r.check("two-plus messages pass through, however they are chunked",
+            all(_passes(_chunked(body, n)) for n in (1, 7, 16, 17, 1000)), "")
+    r.check("an empty body passes (left to the empty-download guard)", _passes([]), "")
+    for name, data in (("cut short mid-message", body[:-3]), ("cut short mid-header", body[:len(body) - 2 - 16]),
+                       ("an HTML error page", b"<html><body>data not available</body></html>"),
+                       ("GRIB1", b"GRIB\0\0\x20\1" + b"\0" * 24)):
+        r.check(f"{name} -> IOError", not _passes(_chunked(data, 7)), "")
+
+
+def _connections(base):
+    with urllib.request.urlopen(base + "/_stats", timeout=5) as f:
+        return json.loads(f.read())["connections"]
+
+
+def test_stream_download(r):
+    r.section("process_data._stream_download: streamed to disk over pooled connections")
+    d = tempfile.mkdtemp(prefix="velo-download-")
+    server = fake_upstream.serve(workdir=d)
+    base = f"http://127.0.0.1:{server.server_port}"
+    gfs = (base + "/cgi-bin/filter_gfs_0p25.pl?dir=%2Fgfs.20240801%2F00%2Fatmos&file=gfs.t00z.pgrb2.0p25.f000"
+           "&var_UGRD=on&var_VGRD=on&lev_10_m_above_ground=on")
+    try:
+        before = _connections(base)
+        paths = [os.path.join(d, f"gfs-{n}.grib") for n in range(3)]
+        errors = [_stream_download(gfs, path, "nomads") for path in paths]
+        # Each /_stats call is a connection of its own.
+        opened = _connections(base) - before - 1
+        with open(paths[0], "rb") as f:
+            first = f.read()
+        r.check("three downloads written whole", errors == [None] * 3 and first[:4] == b"GRIB"
+                and all(os.path.getsize(p) == len(first) for p in paths), str(errors))
+        r.check("one kept-alive connection for all three", opened == 1, f"connections opened={opened}")
+
+        error = _stream_download(base + "/cgi-bin/nothing", os.path.join(d, "missing.grib"), "nomads")
+        r.check("non-200 -> error message, nothing written",
+                error is not None and "404" in error and not os.path.exists(os.path.join(d, "missing.grib")), error)
+        try:
+            _stream_download(base + "/_stats", os.path.join(d, "page.grib"), "nomads")
+            r.failed("a 200 that is not GRIB2 raises", "no IOError")
+        except IOError:
+            r.check("a 200 that is not GRIB2 raises, nothing written, no temp left",
+                    not any(n.startswith("page.grib") for n in os.listdir(d)), str(os.listdir(d)))
+    finally:
+        server.shutdown()
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def _upstream_count(base, kind):
+    with urllib.request.urlopen(base + "/_stats", timeout=5) as f:
+        return json.loads(f.read()).get(kind, 0)
+
+
+def _gribjson(path):
+    """{parameterNumber: (header, data)} of a gribjson file."""
+    with open(path) as f:
+        return {rec["header"]["parameterNumber"]: (rec["header"], np.array(rec["data"], dtype=float))
+                for rec in json.load(f)}
+
+
+def _same_winds(a, b):
+    """The same grid corners and sizes, and values within the GRIB packing."""
+    a, b = _gribjson(a), _gribjson(b)
+    keys = ("nx", "ny", "lo1", "la1", "lo2", "la2")
+    return sorted(a) == sorted(b) and all(
+        all(abs(a[n][0][k] - b[n][0][k]) < 1e-6 for k in keys) and np.allclose(a[n][1], b[n][1], atol=0.05)
+        for n in a)
+
+
+def test_gfs_global(r):
+    r.section("process_gfs: one global download per cycle, projwins cut locally")
+    d = tempfile.mkdtemp(prefix="velo-gfs-")
+    server = fake_upstream.serve(workdir=d)
+    base = f"http://127.0.0.1:{server.server_port}"
+    saved = {k: config.APP_CONFIG[k] for k in ("GFS_FILTER_URL", "GFS_GLOBAL", "GFS_COLD_FILTER")}
+    config.APP_CONFIG["GFS_FILTER_URL"] = base + "/cgi-bin/filter_gfs_0p25.pl"
+    boxes = ([-105.0, 41.0, -104.0, 40.0], [-10.0, 10.0, 10.0, -10.0], [100.0, 20.0, 101.5, 19.0],
+             [170.0, 60.0, -170.0, 50.0])
+    local, filtered = os.path.join(d, "local"), os.path.join(d, "filtered")
+    os.makedirs(local)
+    os.makedirs(filtered)
+    try:
+        before = _upstream_count(base, "gfs")
+        paths = [process_gfs(box, "2024-08-01", "03:00:00", local, fmt) for box in boxes + (None,)
+                 for fmt in ("gribjson", "windbin")]
+        r.check("four projwins and the globe, two formats: one NOMADS request",
+                all(os.path.isfile(p) for p in paths) and _upstream_count(base, "gfs") - before == 1,
+                f"gfs requests={_upstream_count(base, 'gfs') - before} {paths[:2]}")
+
+        config.APP_CONFIG["GFS_GLOBAL"] = False
+        before = _upstream_count(base, "gfs")
+        cut = [process_gfs(box, "2024-08-01", "03:00:00", filtered, "gribjson") for box in boxes]
+        r.check("GFS_GLOBAL off: a subregion request per projwin", _upstream_count(base, "gfs") - before == 4,
+                f"gfs requests={_upstream_count(base, 'gfs') - before}")
+        r.check("local slices match the filter's subregions, across 0 E and 180 E too",
+                all(_same_winds(a, b) for a, b in zip(paths[0:8:2], cut)), str(cut))
+
+        config.APP_CONFIG.update(GFS_GLOBAL=True, GFS_COLD_FILTER=True)
+        before = _upstream_count(base, "gfs")
+        first = process_gfs(boxes[0], "2024-08-01", "07:00:00", local, "windbin")
+        field = os.path.join(local, "gfs-global-2024-08-01T06:00:00.field")
+        for _ in range(300):
+            if os.path.exists(field):
+                break
+            time.sleep(0.1)
+        second = process_gfs(boxes[1], "2024-08-01", "07:00:00", local, "windbin")
+        r.check("GFS_COLD_FILTER: a cold cycle's projwin is filtered, the global field fetched behind it",
+                os.path.isfile(first) and "-105.0_41.0_-104.0_40.0-" in first and os.path.exists(field)
+                and os.path.isfile(second) and _upstream_count(base, "gfs") - before == 2,
+                f"gfs requests={_upstream_count(base, 'gfs') - before}")
+    finally:
+        config.APP_CONFIG.update(saved)
+        server.shutdown()
+        shutil.rmtree(d, ignore_errors=True)
+
+
 def run(r):
     if _IMPORT_ERR is not None:
         r.skipped("process_data unit tests",
@@ -77,6 +224,9 @@ def run(r):
     test_lon360(r)
     test_cog_filename(r)
     test_regrid_name_prefix(r)
+    test_check_grib_stream(r)
+    test_stream_download(r)
+    test_gfs_global(r)
 
 
 if __name__ == "__main__":
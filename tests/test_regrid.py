@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/regrid.py -- the precomputed lookup tables HRRR's
+lat/lon regrid and EPSG:3857 COG warp gather through.
+
+The Lambert GRIB2 fixture is test_cog's (HRRR's projection, 3 km, written with
+GDAL's GRIB driver). regrid imports rasterio and pyproj, so without the GIS
+stack these tests SKIP.
+
+Run standalone:  python3 tests/test_regrid.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+
+try:
+    import numpy as np
+    import pyproj
+    import rasterio
+    import rasterio.warp
+    from modules import fieldcache, gribjson, regrid
+    import test_cog
+    from test_cog import NX, NY
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+# A 0.1-degree grid well inside the fixture (about -100.3..-94.7 E, 37.1..39.9 N),
+# and one reaching past its western edge.
+_INSIDE = (-99.5, 40, 0.1, 37.5, 20, 0.1)
+_PAST_EDGE = (-101.0, 20, 0.1, 38.0, 5, 0.1)
+
+
+def _grid(grib):
+    with rasterio.open(grib) as src:
+        return src.crs, src.transform, src.shape
+
+
+def _source_pixel(crs, transform, lon, lat):
+    """Fractional (col, row) of lon/lat in pixel-center units."""
+    lcc = pyproj.CRS.from_wkt(crs.to_wkt())
+    x, y = pyproj.Transformer.from_crs(lcc.geodetic_crs, lcc, always_xy=True).transform(lon, lat)
+    return (x - transform.c) / transform.a - 0.5, (y - transform.f) / transform.e - 0.5
+
+
+def test_latlon_table(r, d):
+    r.section("latlon_table: bilinear weights, stored and mapped")
+    rows, cols = np.mgrid[0:NY, 0:NX]
+    band = (0.5 * cols + 2.0 * rows).astype(np.float32)
+    grib = test_cog._make_grib(d, [band])
+    crs, transform, shape = _grid(grib)
+    luts = os.path.join(d, 'luts')
+
+    table = regrid.latlon_table(crs, transform, shape, luts, _INSIDE)
+    index, weight = table
+    r.check("(4, points) int32 indices and float32 weights summing to 1",
+            index.shape == (4, 800) and index.dtype == np.int32 and weight.dtype == np.float32
+            and np.allclose(weight.sum(axis=0), 1), f"{index.shape} {index.dtype} {weight.dtype}")
+    r.check("memory-mapped from .npy files under luts/",
+            isinstance(index, np.memmap) and sorted(os.listdir(luts)) == sorted(
+                os.path.basename(p.filename) for p in table), str(os.listdir(luts)))
+
+    lon0, nx, dlon, lat0, ny, dlat = _INSIDE
+    lon, lat = np.meshgrid(lon0 + np.arange(nx) * dlon, (lat0 + np.arange(ny) * dlat)[::-1])
+    col, row = _source_pixel(crs, transform, lon, lat)
+    out = regrid.bilinear(band, table).reshape(ny, nx)
+    r.check("a field linear in the grid is reproduced exactly (rows north first)",
+            np.allclose(out, 0.5 * col + 2.0 * row, atol=1e-3), f"max err={np.abs(out - 0.5 * col - 2.0 * row).max()}")
+
+    # Drop the neighbour of point (5, 5) farthest from it: its weight is at most
+    # 1/4, so the point stays defined from the other three.
+    far_col = int(np.floor(col[5, 5])) + (col[5, 5] % 1 < 0.5)
+    far_row = int(np.floor(row[5, 5])) + (row[5, 5] % 1 < 0.5)
+    holed = band.copy()
+    holed[far_row, far_col] = np.nan
+    gap = regrid.bilinear(holed, table).reshape(ny, nx)
+    r.check("a missing neighbour is renormalized away, not spread as NaN",
+            np.isfinite(gap[5, 5]) and abs(gap[5, 5] - out[5, 5]) < 2.5, f"{gap[5, 5]} vs {out[5, 5]}")
+
+    past = regrid.bilinear(band, regrid.latlon_table(crs, transform, shape, luts, _PAST_EDGE)).reshape(5, 20)
+    r.check("points off the source grid are NaN, points on it are not",
+            np.isnan(past[:, 0]).all() and np.isfinite(past[:, -1]).all(), f"{past[0, :3]} .. {past[0, -1]}")
+
+    r.check("same process reuses the mapping",
+            regrid.latlon_table(crs, transform, shape, luts, _INSIDE) is table, "")
+    for name in os.listdir(luts):
+        os.remove(os.path.join(luts, name))
+    again = regrid.latlon_table(crs, transform, shape, luts, _INSIDE)
+    r.check("an evicted table is rebuilt", again is not table and np.array_equal(again[0], index)
+            and len(os.listdir(luts)) == 2, str(os.listdir(luts)))
+
+
+def test_rotation(r, d):
+    r.section("rotation_table: grid-relative -> earth-relative winds")
+    grib = test_cog._make_grib(d, [np.zeros((NY, NX))])
+    crs, transform, shape = _grid(grib)
+    rotation = regrid.rotation_table(crs, transform, shape, os.path.join(d, 'luts'))
+    r.check("(2, ny, nx) cos/sin", rotation.shape == (2, NY, NX)
+            and np.allclose(rotation[0] ** 2 + rotation[1] ** 2, 1, atol=1e-6), str(rotation.shape))
+
+    # On a tangent LCC the convergence is sin(lat_1) * (lon - lon_0).
+    proj = pyproj.Proj(pyproj.CRS.from_wkt(crs.to_wkt()))
+    x = transform.c + (np.arange(NX) + 0.5) * transform.a
+    y = np.full(NX, transform.f + (NY // 2 + 0.5) * transform.e)
+    lon, _lat = proj(x, y, inverse=True)
+    expected = np.sin(np.radians(38.5)) * (lon + 97.5)
+    angle = np.degrees(np.arctan2(rotation[1, NY // 2], rotation[0, NY // 2]))
+    r.check("angle is the meridian convergence", np.allclose(angle, expected, atol=1e-3),
+            f"west {angle[0]:.3f} vs {expected[0]:.3f}, east {angle[-1]:.3f} vs {expected[-1]:.3f}")
+
+    u, v = regrid.rotate_to_earth(np.zeros((NY, NX)), np.ones((NY, NX)), rotation)
+    r.check("grid north points east of true north east of lon_0, west of it to the west",
+            u[NY // 2, -1] > 0 > u[NY // 2, 0] and np.allclose(np.hypot(u, v), 1, atol=1e-6),
+            f"u west={u[NY // 2, 0]:.4f} east={u[NY // 2, -1]:.4f}")
+
+
+def test_mercator_table(r, d):
+    r.section("mercator_table: nearest source pixel on gdalwarp's EPSG:3857 grid")
+    rows, cols = np.mgrid[0:NY, 0:NX]
+    band = (cols + 1000 * rows).astype(np.float32)
+    grib = test_cog._make_grib(d, [band])
+    crs, transform, shape = _grid(grib)
+    index, dst_transform, width, height = regrid.mercator_table(crs, transform, shape, os.path.join(d, 'luts'))
+
+    expected = np.full((height, width), -1, dtype=np.float32)
+    rasterio.warp.reproject(band, expected, src_transform=transform, src_crs=crs, dst_transform=dst_transform,
+                            dst_crs='EPSG:3857', dst_nodata=-1, resampling=rasterio.warp.Resampling.nearest)
+    got = regrid.nearest(band, index, -1).reshape(height, width)
+    both = (got >= 0) & (expected >= 0)
+    step = np.abs(got - expected)[both]
+    r.check("same output grid and coverage as rasterio's nearest warp",
+            index.shape == (height, width) and ((got >= 0) != (expected >= 0)).sum() <= width,
+            f"coverage differs at {((got >= 0) != (expected >= 0)).sum()} pixels")
+    # GDAL's approximate transformer breaks near-ties differently; never by more
+    # than the adjacent source pixel.
+    r.check("picks rasterio's pixel, or a neighbour of it on ties",
+            (step == 0).mean() > 0.85 and np.isin(step, (0, 1, 1000, 1001, 999)).all(),
+            f"exact={(step == 0).mean():.3f}")
+
+    empty = np.full_like(band, np.nan)
+    r.check("NaN source pixels take the fill value", (regrid.nearest(empty, index, -9) == -9).all(), "")
+
+
+def test_latlon_field(r, d):
+    r.section("to_latlon_field: regridded winds as a .field")
+    u = np.full((NY, NX), 0.0)
+    v = np.full((NY, NX), 10.0)
+    grib = test_cog._make_grib(d, [u, v])
+    out = regrid.to_latlon_field(grib, os.path.join(d, 'hrrr-winds.field'), winds=True, spec=_INSIDE)
+    field = fieldcache.open_field(out)
+    grid = field.grid
+    r.check("lat/lon grid, north-west pixel first, 0-360 longitudes",
+            field.data.shape == (2, 20, 40) and (grid['nx'], grid['ny']) == (40, 20)
+            and np.isclose(grid['lo1'], 260.5) and np.isclose(grid['la1'], 39.4)
+            and (grid['dx'], grid['dy']) == (0.1, 0.1), str(grid)[:160])
+    r.check("wind speed kept, direction rotated off grid north",
+            np.allclose(np.hypot(field.data[0], field.data[1]), 10, atol=1e-4)
+            and (field.data[0, :, 0] < 0).all() and (field.data[0, :, -1] > 0).all(),
+            f"u west={field.data[0, 0, 0]:.3f} east={field.data[0, 0, -1]:.3f}")
+    r.check("band tags carried", field.bands[0]['tags'].get('GRIB_ELEMENT') == 'UGRD'
+            and field.bands[1]['tags'].get('GRIB_ELEMENT') == 'VGRD', str(field.bands[0]['tags']))
+
+    text = io.StringIO()
+    gribjson.encode_field(field, text, surface_value=10.0)
+    records = json.loads(text.getvalue())
+    header = records[0]['header']
+    r.check("gribjson of the field: a latlon grid scanned south to north with earth winds",
+            len(records) == 2 and header['gridDefinitionTemplate'] == 0 and header['scanMode'] == 64
+            and header['winds'] == 'true' and (header['nx'], header['ny']) == (40, 20)
+            and np.isclose(header['lo1'], 260.5) and np.isclose(header['la1'], 37.5)
+            and np.isclose(header['la2'], 39.4)
+            and np.allclose(records[0]['data'], np.flipud(field.data[0]).ravel()),
+            str({k: header[k] for k in ('gridDefinitionTemplate', 'scanMode', 'lo1', 'la1', 'la2')}))
+
+    sub = fieldcache.subset(field, [-98, 39, -97, 38])
+    r.check("projwin slices of it work as for any field",
+            sub.data.shape == (2, 11, 11) and np.isclose(sub.grid['lo1'], 262.0), str(sub.data.shape))
+    mtime = os.stat(out).st_mtime_ns
+    regrid.to_latlon_field(grib, out, winds=True, spec=_INSIDE)
+    r.check("an existing field is not rebuilt", os.stat(out).st_mtime_ns == mtime, "")
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("regrid unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    d = tempfile.mkdtemp(prefix="velo-regrid-")
+    try:
+        for test in (test_latlon_table, test_rotation, test_mercator_table, test_latlon_field):
+            sub = tempfile.mkdtemp(dir=d)
+            test(r, sub)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/render.py -- colormap lookup tables and the direct
+PNG encoder -- and the HRRR png / legend producers in modules/convert.py.
+
+PNGs are decoded here with zlib (no Pillow) so the encoder is checked byte for
+byte. convert imports rasterio, so without the GIS stack these tests SKIP.
+
+Run standalone:  python3 tests/test_render.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import json
+import zlib
+import shutil
+import struct
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+import config  # noqa: E402
+
+try:
+    import numpy as np
+    import matplotlib
+    from modules import convert, fieldcache, render
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+
+def _decode_png(blob):
+    """(rgba, {tEXt keyword: text}) of an 8-bit RGBA PNG using only the filters
+    encode_png writes (None, Up)."""
+    assert blob[:8] == b'\x89PNG\r\n\x1a\n'
+    pos, idat, text = 8, b'', {}
+    while pos < len(blob):
+        size, kind = struct.unpack_from('>I4s', blob, pos)
+        data = blob[pos + 8:pos + 8 + size]
+        assert zlib.crc32(kind + data) == struct.unpack_from('>I', blob, pos + 8 + size)[0]
+        if kind == b'IHDR':
+            width, height, depth, color = struct.unpack_from('>IIBB', data)
+            assert (depth, color) == (8, 6)
+        elif kind == b'IDAT':
+            idat += data
+        elif kind == b'tEXt':
+            key, _, value = data.partition(b'\0')
+            text[key.decode('latin-1')] = value.decode('latin-1')
+        pos += 12 + size
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width * 4 + 1)
+    rows = raw[:, 1:].copy()
+    for i in range(height):
+        if raw[i, 0] == 2 and i:
+            rows[i] += rows[i - 1]
+    return rows.reshape(height, width, 4), text
+
+
+def _field(values):
+    """A one- or two-band Field over a small lat/lon grid."""
+    values = np.asarray(values, dtype=np.float32)
+    if values.ndim == 2:
+        values = values[None]
+    grid = {'nx': values.shape[2], 'ny': values.shape[1], 'lo1': 250.0, 'la1': 45.0,
+            'dx': 0.1, 'dy': 0.1, 'crs': None}
+    return fieldcache.Field(values, grid, [{'tags': {}, 'header': None}] * len(values))
+
+
+def test_lut(r, d):
+    r.section("render: colormap lookup tables match matplotlib")
+    lut = render.colormap_lut('viridis')
+    r.check("256 RGBA entries, read-only, built once per process",
+            lut.shape == (256, 4) and lut.dtype == np.uint8 and not lut.flags.writeable
+            and render.colormap_lut('viridis') is lut, str(lut.shape))
+
+    rng = np.random.default_rng(1)
+    values = rng.uniform(-5, 35, (60, 80)).astype(np.float32)
+    values[5, 5] = np.nan
+    rgba = render.colorize(values, 'RdYlBu_r', 0.0, 30.0)
+    expected = matplotlib.colormaps['RdYlBu_r'](matplotlib.colors.Normalize(0.0, 30.0)(values), bytes=True)
+    finite = np.isfinite(values)
+    # float32 vs matplotlib's float64 normalize may differ on an exact bin edge.
+    differs = (rgba != expected).any(axis=2) & finite
+    r.check("colors match Normalize + colormap (clamped outside the limits)",
+            differs.sum() <= 2, f"{differs.sum()} of {finite.sum()} pixels differ")
+    r.check("NaN is transparent", (rgba[5, 5] == 0).all(), str(rgba[5, 5]))
+
+    logged = render.colorize(np.array([[-1.0, 0.0, 1.0, 10.0, 100.0]]), 'Blues', 1.0, 100.0, log=True)
+    lut = render.colormap_lut('Blues')
+    r.check("log scale: <= 0 transparent, decades evenly spaced",
+            (logged[0, :2] == 0).all() and (logged[0, 2] == lut[0]).all()
+            and (logged[0, 3] == lut[128]).all() and (logged[0, 4] == lut[255]).all(), str(logged[0, 2:, 0]))
+
+    flat = render.colorize(np.full((2, 2), 7.0), 'viridis', 7.0, 7.0)
+    r.check("vmin == vmax draws the low color", (flat == render.colormap_lut('viridis')[0]).all(), "")
+
+    info = {'cmap': 'viridis', 'label': 'x'}
+    ramp = np.arange(101, dtype=np.float32)
+    r.check("limits: 2nd/98th percentile, fixed limits win, (0, 1) when empty",
+            render.color_limits(ramp, info) == (2.0, 98.0)
+            and render.color_limits(ramp, dict(info, vmin=0, vmax=250)) == (0, 250)
+            and render.color_limits(np.full(3, np.nan), info) == (0.0, 1.0),
+            str(render.color_limits(ramp, info)))
+
+
+def test_encode(r, d):
+    r.section("render: direct PNG encoding")
+    rng = np.random.default_rng(2)
+    rgba = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    blob = render.encode_png(rgba, {'legend': '{"vmin":0}'})
+    decoded, text = _decode_png(blob)
+    r.check("RGBA round trip through the Up filter", np.array_equal(decoded, rgba), "")
+    r.check("tEXt chunk carried", text == {'legend': '{"vmin":0}'}, str(text))
+
+    smooth = render.colorize(np.tile(np.linspace(0, 1, 400, dtype=np.float32), (300, 1)), 'viridis', 0, 1)
+    r.check("a smooth field compresses well (rows repeat)", len(render.encode_png(smooth)) < smooth.nbytes / 50,
+            f"{len(render.encode_png(smooth))} bytes for {smooth.nbytes}")
+
+
+def test_png_producers(r, d):
+    r.section("convert: fast png, legend and the matplotlib renderer")
+    u = np.tile(np.linspace(0, 30, 40, dtype=np.float32), (20, 1))
+    v = np.zeros_like(u)
+    u[0, 0] = np.nan
+    field = _field([u, v])
+    saved = config.APP_CONFIG['PNG_RENDERER']
+    try:
+        config.APP_CONFIG['PNG_RENDERER'] = 'fast'
+        png = convert.to_png(field, os.path.join(d, 'fast.png'), 'winds')
+        with open(png, 'rb') as f:
+            rgba, text = _decode_png(f.read())
+        legend = json.loads(text.get('legend', '{}'))
+        speed = np.hypot(u, v)
+        vmin, vmax = np.nanpercentile(speed, (2, 98))
+        r.check("one pixel per grid point, north-up, speed colored",
+                rgba.shape == (20, 40, 4)
+                and np.array_equal(rgba[1:], render.colorize(speed, 'viridis', vmin, vmax)[1:]),
+                str(rgba.shape))
+        r.check("nodata transparent", rgba[0, 0, 3] == 0 and (rgba[1:, :, 3] == 255).all(), "")
+        r.check("legend tEXt: label, colormap and limits",
+                legend.get('label') == 'Wind Speed (m/s)' and legend.get('cmap') == 'viridis'
+                and np.isclose(legend.get('vmin'), vmin) and np.isclose(legend.get('vmax'), vmax),
+                str(legend))
+
+        smoke = convert.to_png(_field(np.full((10, 10), 1e-7)), os.path.join(d, 'smoke.png'), 'smoke_massden')
+        with open(smoke, 'rb') as f:
+            smoke_rgba, smoke_text = _decode_png(f.read())
+        r.check("catalog scale and fixed limits applied (1e-7 kg/m^3 = 100 of 0..250)",
+                (smoke_rgba[0, 0] == render.colormap_lut('YlOrRd')[102]).all()
+                and json.loads(smoke_text['legend'])['vmax'] == 250, str(smoke_rgba[0, 0]))
+
+        leg = convert.to_legend(field, os.path.join(d, 'fast.legend.png'), 'winds')
+        with open(leg, 'rb') as f:
+            r.check("legend is its own small PNG", f.read(8) == b'\x89PNG\r\n\x1a\n'
+                    and os.path.getsize(leg) < os.path.getsize(png) * 50, f"{os.path.getsize(leg)} bytes")
+
+        config.APP_CONFIG['PNG_RENDERER'] = 'matplotlib'
+        figure = convert.to_png(field, os.path.join(d, 'figure.png'), 'winds')
+        with open(figure, 'rb') as f:
+            head = f.read(24)
+        width, height = struct.unpack('>II', head[16:24])
+        r.check("PNG_RENDERER=matplotlib still draws the titled figure", width > 1000 and height > 500,
+                f"{width}x{height}")
+    finally:
+        config.APP_CONFIG['PNG_RENDERER'] = saved
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("render unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    d = tempfile.mkdtemp(prefix="velo-render-")
+    try:
+        for test in (test_lut, test_encode, test_png_producers):
+            sub = tempfile.mkdtemp(dir=d)
+            test(r, sub)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """Stress / concurrency test for a *running* Veloserver.
 
-Proves three things against a live server under load:
+Proves four things against a live server under load:
 
   A. Concurrency correctness -- many concurrent IDENTICAL uncached requests all
      return a valid, non-corrupt, byte-identical body (proves the atomic
@@ -15,6 +15,10 @@ Proves three things against a live server under load:
      deterministically by file presence (and that the on-disk total stays within
      the byte budget); otherwise it falls back to a response-latency heuristic
      (cache hit fast vs. rebuilt slow).
+  D. Cold vs warm latency -- one batch of distinct uncached requests, then the
+     same batch again from cache, each reported as throughput and p50/p95/p99.
+     Against the fake upstream (VELOSERVER_UPSTREAM) the warm passes must not
+     fetch anything upstream.
 
 Env:
   VELOSERVER_URL        base URL (default http://localhost:8105)
@@ -24,6 +28,8 @@ Env:
                         the on-disk size assertion)
   STRESS_CACHED_MAX     seconds under which a response counts as served from cache
   STRESS_REBUILT_MIN    seconds over which a response counts as rebuilt (uncached)
+  STRESS_WARM_PASSES    warm (cached) passes over the batch in D
+  VELOSERVER_UPSTREAM   base URL of tests/fake_upstream.py when running offline
 """
 
 import os
@@ -34,8 +40,8 @@ from concurrent.futures import ThreadPoolExecutor
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from helpers import (
-    Results, server_up, BASE, HRRR_PRODUCTS, fetch,
-    validate_gribjson, validate_tiff, validate_png,
+    Results, server_up, BASE, HRRR_PRODUCTS, fetch, latency_summary,
+    upstream_stats, upstream_fetches, validate_gribjson, validate_tiff, validate_png,
 )
 from datetime import datetime, timedelta, timezone
 
@@ -44,6 +50,7 @@ CONCURRENCY = int(os.environ.get("STRESS_CONCURRENCY", 16))
 CACHE_DIR = os.environ.get("STRESS_CACHE_DIR") or os.environ.get("VELOSERVER_CACHE_DIR")
 CACHED_MAX = float(os.environ.get("STRESS_CACHED_MAX", 0.6))
 REBUILT_MIN = float(os.environ.get("STRESS_REBUILT_MIN", 1.0))
+WARM_PASSES = int(os.environ.get("STRESS_WARM_PASSES", 3))
 
 
 def hours_ago(h):
@@ -330,6 +337,61 @@ def test_lru_eviction(r):
     _check_within_budget(r, on_disk)
 
 
+# ------------------------------------------------------- D. cold vs warm
+
+def _latency_specs(h):
+    """Distinct keys no other test requests: every product's PNG, winds and GFS
+    gribjson, and two COGs (one 3-band, one scalar)."""
+    T = hours_ago(h)
+    specs = [(f"/hrrr/{p}/png/{T}", "png", p) for p in HRRR_PRODUCTS]
+    specs += [(f"/hrrr/winds/gribjson/{T}", "gribjson", "winds"),
+              (f"/gfs/gribjson/{T}", "gribjson", "winds"),
+              (f"/cog/winds/{T}Z", "cog", "winds"),
+              (f"/cog/temp_2m/{T}Z", "cog", "temp_2m")]
+    return specs
+
+
+def _timed_pass(specs):
+    """Request every spec at CONCURRENCY; returns (failures, latencies, wall)."""
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as ex:
+        out = list(ex.map(lambda s: (s, timed_get(s[0])), specs))
+    wall = time.time() - start
+    bad = [f"{path} -> status={status} err={err}"
+           for (path, fmt, product), (status, body, err, _lat) in out
+           if not (status == 200 and body and _validate(fmt, body, product)[0])]
+    return bad, [lat for _s, (_st, _b, _e, lat) in out], wall
+
+
+def test_cold_warm_latency(r):
+    specs = _latency_specs(50)
+    before = upstream_stats()
+    bad, cold, cold_wall = _timed_pass(specs)
+    print(f"#   cold: {latency_summary(cold, cold_wall)}")
+    r.check(f"latency: cold batch of {len(specs)} distinct keys, all 200 + valid",
+            not bad, f"failures={len(bad)} {bad[:3]}")
+
+    built = upstream_stats()
+    warm, warm_wall, warm_bad = [], 0.0, []
+    for _ in range(WARM_PASSES):
+        bad, lats, wall = _timed_pass(specs)
+        warm_bad += bad
+        warm += lats
+        warm_wall += wall
+    print(f"#   warm: {latency_summary(warm, warm_wall)}")
+    r.check(f"latency: {WARM_PASSES} warm passes, all 200 + valid",
+            not warm_bad, f"failures={len(warm_bad)} {warm_bad[:3]}")
+
+    name = "latency: warm passes fetched nothing upstream"
+    after = upstream_stats()
+    if before is None or built is None or after is None:
+        r.skipped(name, "set VELOSERVER_UPSTREAM to the fake upstream (OFFLINE=1 tests/run_tests.sh)")
+    else:
+        r.check(name, upstream_fetches(built, after) == 0,
+                f"cold fetched {upstream_fetches(before, built)}, "
+                f"warm fetched {upstream_fetches(built, after)}")
+
+
 def run(r):
     r.section("A. concurrency correctness (identical uncached requests)")
     test_concurrent_identical(r)
@@ -339,6 +401,8 @@ def run(r):
     test_slam(r)
     r.section("C. LRU eviction under pressure")
     test_lru_eviction(r)
+    r.section("D. cold vs warm cache latency")
+    test_cold_warm_latency(r)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/tiles.py -- XYZ tile math and windowed rendering from a
+COG. Builds a small synthetic EPSG:3857 COG in a temp dir, so no server/network.
+
+tiles imports rasterio/matplotlib, so like test_process_data the import is
+wrapped: without the GIS stack these tests SKIP; in the container they run.
+
+Run standalone:  python3 tests/test_tiles.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import shutil
+import struct
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+from config import NODATA  # noqa: E402
+
+try:
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_bounds
+    from modules import tiles
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+
+def _raises_valueerror(fn):
+    try:
+        fn()
+    except ValueError:
+        return True
+    except Exception:
+        return False
+    return False
+
+
+def _make_cog(path, bounds, bands=3, size=1024):
+    """A tiled, overviewed EPSG:3857 raster whose pixel value is its column index
+    (band 1), so a tile read can be checked against the source."""
+    data = np.tile(np.arange(size, dtype=np.float32), (size, 1))
+    profile = dict(driver='GTiff', width=size, height=size, count=bands, dtype='float32',
+                   crs='EPSG:3857', nodata=NODATA, tiled=True, blockxsize=512, blockysize=512,
+                   transform=from_bounds(*bounds, size, size))
+    with rasterio.open(path, 'w', **profile) as dst:
+        for b in range(1, bands + 1):
+            dst.write(data * b, b)
+        dst.build_overviews([2, 4, 8])
+    return path
+
+
+def test_tile_math(r):
+    r.section("tiles: XYZ tile math + validation")
+    left, bottom, right, top = tiles.tile_bounds(0, 0, 0)
+    half = tiles.WEB_MERCATOR_HALF
+    r.check("z0 tile covers the whole web-mercator square",
+            (left, bottom, right, top) == (-half, -half, half, half), f"got {(left, bottom, right, top)}")
+    l1, b1, r1, t1 = tiles.tile_bounds(1, 1, 0)
+    r.check("z1 x1 y0 is the north-east quadrant", (l1, b1, r1, t1) == (0, 0, half, half), "")
+    r.check("x out of range rejected", _raises_valueerror(lambda: tiles.validate_tile(1, 2, 0, 'png')), "")
+    r.check("negative y rejected", _raises_valueerror(lambda: tiles.validate_tile(3, 0, -1, 'png')), "")
+    r.check("zoom past MAX_ZOOM rejected",
+            _raises_valueerror(lambda: tiles.validate_tile(tiles.MAX_ZOOM + 1, 0, 0, 'png')), "")
+    r.check("unknown extension rejected", _raises_valueerror(lambda: tiles.validate_tile(0, 0, 0, 'gif')), "")
+    r.check("size default 256", tiles.parse_tile_size(None) == 256, "")
+    r.check("size 512 accepted", tiles.parse_tile_size("512") == 512, "")
+    r.check("size 300 rejected", _raises_valueerror(lambda: tiles.parse_tile_size("300")), "")
+    rel = tiles.tile_relpath("hrrr-winds-2024-03-05T190000-f00", 5, 7, 12, 256, "png")
+    r.check("tile cache path nests per COG / z / x",
+            rel == os.path.join("tiles", "hrrr-winds-2024-03-05T190000-f00", "5", "7", "12-256.png"), rel)
+
+
+def test_render(r):
+    r.section("tiles: windowed render from a COG (png/tif/npy)")
+    d = tempfile.mkdtemp(prefix="velo-tiles-")
+    try:
+        # The source covers exactly the z1 north-east quadrant.
+        bounds = tiles.tile_bounds(1, 1, 0)
+        cog = _make_cog(os.path.join(d, "src.tif"), bounds)
+
+        npy = tiles.to_tile(cog, os.path.join(d, "t", "a.npy"), "winds", 1, 1, 0, 256, "npy")
+        arr = np.load(npy)
+        r.check("npy tile is (3, 256, 256) float32",
+                arr.shape == (3, 256, 256) and arr.dtype == np.float32, f"{arr.shape} {arr.dtype}")
+        r.check("npy tile decimates the source (col 255 -> source col ~1020)",
+                abs(float(arr[0, 0, 255]) - 1020) <= 4, f"got {arr[0, 0, 255]}")
+
+        # z1 x0 y0 (north-west quadrant) lies entirely outside the source.
+        empty = np.load(tiles.to_tile(cog, os.path.join(d, "t", "b.npy"), "winds", 1, 0, 0, 256, "npy"))
+        r.check("tile outside the raster is all NODATA", bool((empty == NODATA).all()), "")
+
+        # z2 x2 y0 is the NW quarter of the source: a partial-res read.
+        part = np.load(tiles.to_tile(cog, os.path.join(d, "t", "c.npy"), "temp_2m", 2, 2, 0, 256, "npy"))
+        r.check("scalar product reads a single band", part.shape == (1, 256, 256), f"{part.shape}")
+        r.check("z2 tile maps to the left half of the source columns",
+                float(part[0, 0, 255]) < 520, f"got {part[0, 0, 255]}")
+
+        png = tiles.to_tile(cog, os.path.join(d, "t", "d.png"), "winds", 1, 1, 0, 512, "png")
+        with open(png, "rb") as f:
+            head = f.read(26)
+        r.check("png tile is a PNG", head[:8] == b"\x89PNG\r\n\x1a\n", "")
+        # IHDR: width/height big-endian at 16..24, color type 6 (RGBA) at 25
+        w, h = struct.unpack(">II", head[16:24])
+        r.check("png tile is 512x512 RGBA", (w, h, head[25]) == (512, 512, 6), f"{w}x{h} type={head[25]}")
+
+        tif = tiles.to_tile(cog, os.path.join(d, "t", "e.tif"), "winds", 1, 1, 0, 256, "tif")
+        with rasterio.open(tif) as src:
+            r.check("tif tile is georeferenced EPSG:3857 with u/v/speed bands",
+                    src.crs.to_epsg() == 3857 and src.descriptions == ("u", "v", "speed"),
+                    f"crs={src.crs} desc={src.descriptions}")
+        before = os.path.getmtime(npy)
+        r.check("cached tile is returned as-is on a hit",
+                tiles.to_tile(cog, npy, "winds", 1, 1, 0, 256, "npy") == npy
+                and os.path.getmtime(npy) == before, "")
+        r.check("no temp files left behind",
+                not [n for n in os.listdir(os.path.join(d, "t")) if n.endswith(".tmp")], "")
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("tiles unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    test_tile_math(r)
+    test_render(r)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
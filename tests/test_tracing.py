@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/tracing.py -- per-request stage timings for the
+Server-Timing header, including the waits in _download_lock and
+_single_flight. Stdlib only (contextvars/threading + modules.concurrency).
+
+Run standalone:  python3 tests/test_tracing.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import contextvars
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+from modules import concurrency, metrics, tracing  # noqa: E402
+
+
+def _durations(header):
+    return {name: float(ms) for name, ms in re.findall(r"(\w+);dur=([\d.]+)", header)}
+
+
+def test_spans(r):
+    r.section("tracing: stages summed into a Server-Timing header")
+    r.check("no trace started -> span is a shared no-op",
+            tracing.current() is None and tracing.span("regrid") is tracing.span("produce"), "")
+    trace = tracing.start()
+    try:
+        with tracing.span("regrid"):
+            time.sleep(0.01)
+        with tracing.span("produce"):
+            pass
+        with tracing.span("regrid"):
+            time.sleep(0.01)
+        with metrics.timer("veloserver_stage_seconds", span="subset", stage="t-trace", model="hrrr"):
+            pass
+        # A copied context (as map_forecast_hours runs each hour) adds to the same trace.
+        t = threading.Thread(target=contextvars.copy_context().run,
+                             args=(tracing.add, "download", 0.5))
+        t.start()
+        t.join()
+    finally:
+        done = tracing.finish()
+    header = done.header()
+    got = _durations(header)
+    r.check("stages listed in first-run order, then total",
+            list(got) == ["regrid", "produce", "subset", "download", "total"], header)
+    r.check("a repeated stage is summed; a copied context reports into the request's trace",
+            got["regrid"] >= 20 and got["download"] == 500.0, header)
+    r.check("finish() ends it", done is trace and tracing.current() is None, "")
+    r.check("structured record in milliseconds",
+            set(done.record()) == {"total_ms", "spans_ms"} and done.record()["spans_ms"]["download"] == 500.0, "")
+
+
+def test_waits(r):
+    r.section("tracing: waiting on another build is told apart from building")
+    d = tempfile.mkdtemp(prefix="velo-trace-")
+    try:
+        held, release = threading.Event(), threading.Event()
+
+        def other_worker():
+            with concurrency._download_lock(d, "hrrr-winds-2024-03-05T190000"):
+                held.set()
+                release.wait(5)
+
+        t = threading.Thread(target=other_worker)
+        t.start()
+        held.wait(5)
+        threading.Timer(0.05, release.set).start()
+        tracing.start()
+        try:
+            with concurrency._download_lock(d, "hrrr-winds-2024-03-05T190000"):
+                pass
+        finally:
+            got = _durations(tracing.finish().header())
+        t.join()
+        r.check("blocked on a _download_lock -> lock_wait", got.get("lock_wait", 0) >= 40, str(got))
+
+        started, release = threading.Event(), threading.Event()
+
+        def build():
+            started.set()
+            release.wait(5)
+            return "/cache/out.png"
+
+        leader = threading.Thread(target=concurrency._single_flight, args=("t-trace-key", build))
+        leader.start()
+        started.wait(5)
+
+        def release_once_waiting():
+            deadline = time.monotonic() + 5
+            while concurrency.flight_counts()["waiting"] < 1 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            release.set()
+
+        threading.Thread(target=release_once_waiting).start()
+        tracing.start()
+        try:
+            concurrency._single_flight("t-trace-key", build)
+        finally:
+            got = _durations(tracing.finish().header())
+        leader.join()
+        r.check("coalesced onto another thread's build -> flight_wait",
+                got.get("flight_wait", 0) >= 40 and "lock_wait" not in got, str(got))
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+def run(r):
+    test_spans(r)
+    test_waits(r)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)
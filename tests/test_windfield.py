@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Unit tests for modules/windfield.py -- the windbin / windpng wind formats.
+
+The U/V GRIB2 fixture is written on the fly with GDAL's GRIB driver, as in
+test_gribjson, so no network or downloads. windfield imports rasterio, so
+without the GIS stack these tests SKIP.
+
+Run standalone:  python3 tests/test_windfield.py
+Or via the suite: python3 tests/run_all.py
+"""
+
+import os
+import sys
+import json
+import shutil
+import struct
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from helpers import Results  # noqa: E402
+
+try:
+    import numpy as np
+    from modules import windfield
+    import test_gribjson
+    from test_gribjson import NX, NY
+    _IMPORT_ERR = None
+except Exception as e:  # heavy GIS deps absent (e.g. running outside the container)
+    _IMPORT_ERR = e
+
+
+def _expected():
+    """The fixture's U field north-up, NaN where it is nodata."""
+    u = test_gribjson._field().astype(np.float32)
+    u[u == -9999] = np.nan
+    return u
+
+
+def _png_text(path):
+    """{keyword: text} of a PNG's tEXt chunks."""
+    with open(path, 'rb') as f:
+        blob = f.read()
+    out, pos = {}, 8
+    while pos < len(blob):
+        size, kind = struct.unpack_from('>I4s', blob, pos)
+        if kind == b'tEXt':
+            key, _, text = blob[pos + 8:pos + 8 + size].partition(b'\0')
+            out[key.decode('latin-1')] = text.decode('latin-1')
+        pos += 12 + size
+    return out
+
+
+def test_windbin(r, d):
+    r.section("windfield: windbin layout and round trip")
+    grib = test_gribjson._make_grib(d)
+    out = windfield.to_windbin(grib, os.path.join(d, 'uv.windbin'))
+    with open(out, 'rb') as f:
+        blob = f.read()
+    header, u, v = windfield.decode_windbin(blob)
+    size = int.from_bytes(blob[4:8], 'little')
+    r.check("magic, then arrays start 4-byte aligned", blob[:4] == windfield.MAGIC and (8 + size) % 4 == 0,
+            f"header bytes={size}")
+    r.check("length = prefix + header + two int16 grids", len(blob) == 8 + size + 2 * 2 * NX * NY,
+            f"len={len(blob)}")
+    r.check("grid header (pixel centers)",
+            (header['nx'], header['ny'], header['lo1'], header['la1'], header['dx'], header['encoding'])
+            == (NX, NY, 0.0, 40.0, 1.0, 'int16le') and header['la2'] == 40.0 - (NY - 1),
+            str(header)[:200])
+    r.check("reference and forecast time", header['refTime'] == '2024-03-05T19:00:00Z'
+            and header['forecastTime'] == 3, f"{header['refTime']} +{header['forecastTime']}")
+    expected = _expected()
+    decoded = np.where(u == header['nodata'], np.nan, u * header['u']['scale'] + header['u']['offset'])
+    r.check("north-up rows, decoded within half a step",
+            np.allclose(decoded, expected, atol=header['u']['scale'] / 2, equal_nan=True), "")
+    r.check("nodata kept on missing points", u[0, 0] == windfield.INT16_NODATA
+            and v[0, 0] == windfield.INT16_NODATA, f"u[0,0]={u[0, 0]}")
+    r.check("V carried separately", np.allclose(v[1:] * header['v']['scale'], -expected[1:],
+                                                atol=header['v']['scale'] / 2), "")
+    r.check("existing output returned as-is", windfield.to_windbin(grib, out) == out, "")
+
+    os.makedirs(os.path.join(d, 'wrapped'))
+    wrapped = test_gribjson._make_grib(os.path.join(d, 'wrapped'), west=349.5)
+    with open(windfield.to_windbin(wrapped, os.path.join(d, 'wrapped.windbin')), 'rb') as f:
+        header, _, _ = windfield.decode_windbin(f.read())
+    r.check("0-360 longitudes are not rotated", header['lo1'] == 350.0 and header['lo2'] == 357.0,
+            f"lo1={header['lo1']} lo2={header['lo2']}")
+
+
+def test_quantization(r):
+    r.section("windfield: int16 scale")
+    raw, q = windfield._int16(np.array([0.0, 12.34, -3.0, np.nan], dtype=np.float32))
+    r.check("fixed 0.01 m/s step for ordinary winds",
+            q['scale'] == 0.01 and raw.tolist() == [0, 1234, -300, windfield.INT16_NODATA], f"raw={raw.tolist()} q={q}")
+    raw, q = windfield._int16(np.array([0.0, 1000.0], dtype=np.float32))
+    r.check("scale widens so the peak still fits", raw[1] == 32767 and q['scale'] > 0.01, f"q={q}")
+
+
+def test_windpng(r, d):
+    r.section("windfield: windpng channels and tEXt header")
+    grib = test_gribjson._make_grib(d)
+    out = windfield.to_windpng(grib, os.path.join(d, 'uv.wind.png'))
+    with open(out, 'rb') as f:
+        blob = f.read()
+    width, height, depth, color = struct.unpack_from('>IIBB', blob, 16)
+    r.check("RGBA 8-bit PNG of the grid size", blob[:8] == b'\x89PNG\r\n\x1a\n'
+            and (width, height, depth, color) == (NX, NY, 8, 6), f"{width}x{height} depth={depth} color={color}")
+    text = _png_text(out)
+    header = json.loads(text.get(windfield.PNG_TEXT_KEY, '{}'))
+    r.check("header in the 'wind' tEXt chunk", header.get('encoding') == 'uint8'
+            and header.get('nx') == NX and 'scale' in header.get('u', {}), str(text)[:200])
+    import matplotlib.image
+    rgba = np.round(matplotlib.image.imread(out) * 255).astype(int)
+    decoded = rgba[..., 0] * header['u']['scale'] + header['u']['offset']
+    expected = _expected()
+    r.check("red decodes to U within half a step, north-up",
+            np.allclose(decoded[1:], expected[1:], atol=header['u']['scale'] / 2 + 1e-6), "")
+    r.check("alpha 0 only on the missing point", rgba[0, 0, 3] == 0 and (rgba[..., 3] == 255).sum() == NX * NY - 1,
+            "")
+
+
+def run(r):
+    if _IMPORT_ERR is not None:
+        r.skipped("windfield unit tests",
+                  f"GIS deps not importable here ({type(_IMPORT_ERR).__name__}); runs in container")
+        return
+    test_quantization(r)
+    d = tempfile.mkdtemp(prefix="velo-windfield-")
+    try:
+        for test in (test_windbin, test_windpng):
+            sub = tempfile.mkdtemp(dir=d)
+            test(r, sub)
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    r = Results()
+    run(r)
+    sys.exit(0 if r.summary() else 1)